@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.ancestor_lookups
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares ancestor and descendant lookups with and without the path field,
+    on a tree of ``NODES`` nodes where every node has ``FANOUT`` children.
+    ``LOOKUPS`` random nodes have their ancestors queried (with the self-join,
+    or by the primary keys listed in the path), their ancestor ids read (with
+    a query, or from the path without one) and their descendants queried (by
+    the tree fields, or by path prefix). Reports the time taken by each.
+
+    Since ``Node`` can only be mapped once, each configuration is run in a
+    process of its own.
+
+    Usage::
+
+      python benchmarks/ancestor_lookups.py [NODES [LOOKUPS [FANOUT]]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+import subprocess
+import sys
+
+from common import Node, setup, timed
+
+CONFIGURATIONS = {
+    'self-join': {},
+    'path': {'path_field': True},
+}
+
+
+def insert_rows(connection, table, size, fanout, path):
+    """Inserts ``size`` nodes, each the child of the node ``fanout`` times
+    smaller, with no tree fields."""
+    rows = []
+    for pk in range(1, size + 1):
+        row = {'id': pk, 'name': 'node%d' % pk,
+               'parent_id': (pk - 2) // fanout + 1 if pk > 1 else None,
+               'tree_id': 0, 'tree_left': 0, 'tree_right': 0, 'tree_depth': 0}
+        if path:
+            row['tree_path'] = ''
+        rows.append(row)
+        if len(rows) == 50000:
+            connection.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def run(size, lookups, fanout, name):
+    engine, table, Session = setup(**CONFIGURATIONS[name])
+    with engine.begin() as connection:
+        insert_rows(connection, table, size, fanout, name == 'path')
+    session = Session()
+    Node.tree.bulk_rebuild(session)
+    rng = random.Random(size)
+    nodes = [session.query(Node).get(rng.randint(1, size))
+             for _ in range(lookups)]
+
+    def ancestors():
+        for node in nodes:
+            node.tree.query_ancestors().all()
+
+    def ancestor_ids():
+        for node in nodes:
+            node.tree.get_ancestor_ids()
+
+    def descendants():
+        for node in nodes:
+            node.tree.query_descendants(by_path=name == 'path').all()
+
+    print('%10s %12.3f %14.3f %12.3f' % (
+        name, timed(ancestors, 3), timed(ancestor_ids, 3),
+        timed(descendants, 3)))
+    session.close()
+
+
+def main(size, lookups, fanout):
+    print('%10s %12s %14s %12s' % ('lookup', 'ancestors', 'ancestor ids',
+                                   'descendants'))
+    sys.stdout.flush()
+    for name in ('self-join', 'path'):
+        subprocess.check_call([sys.executable, __file__, '--run', str(size),
+                               str(lookups), str(fanout), name])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(*[int(arg) for arg in sys.argv[2:5]] + [sys.argv[5]])
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        main(*(args + [100000, 1000, 4][len(args):]))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.batch_moves
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Moves ``MOVES`` random leaf children of ``TREES`` trees of a root and
+    ``CHILDREN`` leaf children each under other random leaves, and deletes a
+    tenth as many, first with a flush after every change and then all within
+    one ``TreeClassManager.batch``. Reports the time taken and the number of
+    statements run.
+
+    Usage::
+
+      python benchmarks/batch_moves.py [TREES [CHILDREN [MOVES]]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+
+def main(trees, children, moves):
+    engine, table, Session = setup()
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def changes(session):
+        rng = random.Random(0)
+        leaves = [pk for pk in range(1, trees * (children + 1) + 1)
+                  if (pk - 1) % (children + 1)]
+        rng.shuffle(leaves)
+        for idx in range(moves):
+            node, target = (nodes[pk] for pk in leaves[2 * idx:2 * idx + 2])
+            if idx % 10:
+                yield lambda: Node.tree.insert(node, target)
+            else:
+                yield lambda: session.delete(node)
+
+    def per_change():
+        for change in changes(session):
+            change()
+            session.flush()
+        session.commit()
+
+    def batch():
+        with Node.tree.batch(session):
+            for change in changes(session):
+                change()
+        session.commit()
+
+    print('%12s %10s %10s' % ('method', 'time (s)', 'statements'))
+    for name, func in (('per change', per_change), ('batch', batch)):
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            fill_flat_trees(connection, table, trees, children)
+        session = Session()
+        nodes = dict((node.id, node) for node in session.query(Node))
+        del statements[:]
+        elapsed = timed(func)
+        print('%12s %10.3f %10d' % (name, elapsed, len(statements)))
+        session.close()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [20, 100, 500][len(args):]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.bulk_load
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Measures the throughput, in nodes per second, of computing the tree fields
+    of a table where only the adjacency list is filled in, with
+    :meth:`TreeClassManager.bulk_rebuild`, with :meth:`TreeClassManager.rebuild`
+    computing them inside the database (``method='cte'``) and, for the smaller
+    sizes, with :meth:`TreeClassManager.rebuild` walking the trees. The table
+    holds random trees of about a hundred nodes each, stored in a file so the
+    streaming cursor is exercised.
+
+    Usage::
+
+      python benchmarks/bulk_load.py [NODES ...]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import os
+import random
+import sys
+import tempfile
+
+from common import Node, setup, timed
+
+TREE_SIZE = 100
+PYTHON_LIMIT = 10000
+
+
+def fill_adjacency_list(connection, table, size):
+    """Inserts ``size`` nodes with random parents, and zeroes for the tree
+    fields, as when they have just been added to an existing table."""
+    rng = random.Random(size)
+    rows = []
+    for pk in range(1, size + 1):
+        offset = (pk - 1) % TREE_SIZE
+        parent_id = pk - rng.randint(1, offset) if offset else None
+        rows.append({'id': pk, 'name': 'node%d' % pk, 'parent_id': parent_id,
+                     'tree_id': 0, 'tree_left': 0, 'tree_right': 0,
+                     'tree_depth': 0})
+        if len(rows) == 50000:
+            connection.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def main(sizes):
+    handle, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(handle)
+    try:
+        engine, table, Session = setup('sqlite:///' + path)
+        methods = [
+            ('bulk', lambda session: Node.tree.bulk_rebuild(session)),
+            ('cte', lambda session: Node.tree.rebuild(session=session,
+                                                      method='cte')),
+            ('python', lambda session: Node.tree.rebuild(session=session)),
+        ]
+        print('%10s' % 'nodes' + ''.join(
+            '%24s' % ('%s (s / nodes/s)' % name) for name, _ in methods))
+        for size in sizes:
+            with engine.begin() as connection:
+                connection.execute(table.delete())
+                fill_adjacency_list(connection, table, size)
+            line = '%10d' % size
+            for name, method in methods:
+                if name == 'python' and size > PYTHON_LIMIT:
+                    line += '%24s' % '-'
+                    continue
+                session = Session()
+                elapsed = timed(lambda: method(session))
+                session.close()
+                line += '%10.2f / %11.0f' % (elapsed, size / elapsed)
+            print(line)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
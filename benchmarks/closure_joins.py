@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.closure_joins
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares aggregating a value over subtrees by joining through the closure
+    table with joining the nodes table with itself on the tree fields, on a
+    tree of ``NODES`` nodes where every node has ``FANOUT`` children and a
+    row of ``amount`` holding a value. The totals of ``LOOKUPS`` random
+    subtrees are summed one query each, then those of every node down to
+    depth two in one grouped query. Reports the time taken by each.
+
+    Since ``Node`` can only be mapped once, each configuration is run in a
+    process of its own.
+
+    Usage::
+
+      python benchmarks/closure_joins.py [NODES [LOOKUPS [FANOUT]]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+import subprocess
+import sys
+
+import sqlalchemy
+from sqlalchemy import Column, ForeignKey, Integer, Table
+
+from common import Node, setup, timed
+
+CONFIGURATIONS = {
+    'self-join': {},
+    'closure': {'closure_table': True},
+}
+
+
+def insert_rows(connection, table, amount, size, fanout):
+    """Inserts ``size`` nodes, each the child of the node ``fanout`` times
+    smaller, with no tree fields, and a value for each."""
+    rows = []
+    for pk in range(1, size + 1):
+        rows.append({'id': pk, 'name': 'node%d' % pk,
+                     'parent_id': (pk - 2) // fanout + 1 if pk > 1 else None,
+                     'tree_id': 0, 'tree_left': 0, 'tree_right': 0,
+                     'tree_depth': 0})
+        if len(rows) == 50000:
+            connection.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        connection.execute(table.insert(), rows)
+    connection.execute(amount.insert(), [
+        {'node_id': pk, 'value': pk % 100} for pk in range(1, size + 1)])
+
+
+def run(size, lookups, fanout, name):
+    engine, table, Session = setup(**CONFIGURATIONS[name])
+    amount = Table('benchmark_amount', table.metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('node_id', Integer, ForeignKey('benchmark_node.id'),
+                          nullable=False, index=True),
+                   Column('value', Integer, nullable=False))
+    amount.create()
+    with engine.begin() as connection:
+        insert_rows(connection, table, amount, size, fanout)
+    session = Session()
+    Node.tree.bulk_rebuild(session)
+    rng = random.Random(size)
+    pks = [rng.randint(1, size) for _ in range(lookups)]
+    total = sqlalchemy.func.sum(amount.c.value)
+    if name == 'closure':
+        closure = Node.tree.closure_table
+        query = session.query(table.c.id, total) \
+            .join(closure, closure.c.ancestor_id == table.c.id) \
+            .join(amount, amount.c.node_id == closure.c.descendant_id)
+    else:
+        descendant = table.alias()
+        query = session.query(table.c.id, total) \
+            .join(descendant, (descendant.c.tree_id == table.c.tree_id) &
+                  descendant.c.tree_left.between(table.c.tree_left,
+                                                 table.c.tree_right)) \
+            .join(amount, amount.c.node_id == descendant.c.id)
+    query = query.group_by(table.c.id)
+    results = []
+
+    def subtrees():
+        del results[:]
+        for pk in pks:
+            results.append(query.filter(table.c.id == pk).one())
+
+    def report():
+        results.extend(query.filter(table.c.tree_depth <= 2).all())
+
+    print('%10s %12.3f %12.3f %12d' % (
+        name, timed(subtrees, 3), timed(report, 3),
+        sum(value for pk, value in results)))
+    session.close()
+
+
+def main(size, lookups, fanout):
+    print('%10s %12s %12s %12s' % ('join', 'subtrees', 'report', 'checksum'))
+    sys.stdout.flush()
+    for name in ('self-join', 'closure'):
+        subprocess.check_call([sys.executable, __file__, '--run', str(size),
+                               str(lookups), str(fanout), name])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(*[int(arg) for arg in sys.argv[2:5]] + [sys.argv[5]])
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        main(*(args + [100000, 500, 4][len(args):]))
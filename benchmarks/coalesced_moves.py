@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.coalesced_moves
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Runs ``FLUSHES`` flushes of a tree of a root and ``CHILDREN`` leaf
+    children, each moving ``MOVES`` random children in front of other random
+    children, first with the moves of a flush applied one at a time and then
+    together (see ``TreeSessionExtension._coalesce_moves``). Reports the time
+    taken and the number of statements run per flush.
+
+    Usage::
+
+      python benchmarks/coalesced_moves.py [CHILDREN [MOVES [FLUSHES]]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+
+def main(children, moves, flushes):
+    engine, table, Session = setup()
+    extension = Node.tree.session_extension
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def func():
+        rng = random.Random(0)
+        for _ in range(flushes):
+            for _ in range(moves):
+                node, target = rng.sample(nodes, 2)
+                Node.tree.insert(node, target, Node.tree.POSITION_LEFT)
+            session.flush()
+        session.commit()
+
+    print('%12s %14s %10s' % ('moves', 'per flush (ms)', 'statements'))
+    for name, coalesces in (('one by one', False), ('together', True)):
+        extension._coalesces_moves = coalesces
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            fill_flat_trees(connection, table, 1, children)
+        session = Session()
+        nodes = session.query(Node).filter(Node.parent_id == 1).all()
+        del statements[:]
+        elapsed = timed(func) / flushes
+        print('%12s %14.3f %10.1f' % (name, elapsed * 1000,
+                                      len(statements) / flushes))
+        session.close()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [2000, 10, 20][len(args):]))
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.common
+    ~~~~~~~~~~~~~~~~~
+
+    Shared fixtures for the benchmark scripts: a throw-away node model mapped
+    onto a fresh database, and helpers for filling it quickly and timing
+    operations against it.
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import sqlalchemy
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, Table, Unicode
+from sqlalchemy.orm import backref, mapper, relationship, sessionmaker
+
+import sqlalchemy_tree
+from sqlalchemy_tree.orm import ROOT_ORDER_SPACING
+
+
+class Node(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+
+
+def setup(url='sqlite://', **manager_kwargs):
+    """Creates the benchmark table on the database at ``url``, maps ``Node``
+    onto it and returns ``(engine, table, Session)``."""
+    engine = sqlalchemy.create_engine(url)
+    metadata = MetaData(engine)
+    table = Table('benchmark_node', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', Unicode),
+                  Column('parent_id', Integer,
+                         ForeignKey('benchmark_node.id')))
+    Node.tree = sqlalchemy_tree.TreeManager(table, **manager_kwargs)
+    mapper(Node, table, properties={
+        'parent': relationship(Node,
+                               backref=backref('children', lazy='dynamic'),
+                               remote_side=table.c.id),
+    })
+    Node.tree.register()
+    metadata.drop_all()
+    metadata.create_all()
+    return engine, table, sessionmaker(bind=engine)
+
+
+def fill_flat_trees(connection, table, trees, children, after=(0, 0)):
+    """Inserts ``trees`` trees, each made of a root with ``children`` leaf
+    children, writing the tree fields directly. The tree ids and primary keys
+    are numbered after the pair of them ``after``. Returns the last primary
+    key, which is the number of rows unless ``after`` is given."""
+    rows = []
+    last_tree_id, pk = after
+    for tree_id in range(last_tree_id + 1, last_tree_id + trees + 1):
+        pk += 1
+        root_pk = pk
+        rows.append({'id': pk, 'name': 'node%d' % pk, 'parent_id': None,
+                     'tree_id': tree_id, 'tree_left': 1,
+                     'tree_right': 2 * children + 2, 'tree_depth': 0})
+        for idx in range(children):
+            pk += 1
+            rows.append({'id': pk, 'name': 'node%d' % pk,
+                         'parent_id': root_pk, 'tree_id': tree_id,
+                         'tree_left': 2 * idx + 2, 'tree_right': 2 * idx + 3,
+                         'tree_depth': 1})
+    if 'tree_root_order' in table.c:
+        for row in rows:
+            row['tree_root_order'] = row['tree_id'] * ROOT_ORDER_SPACING \
+                if row['parent_id'] is None else 0
+    connection.execute(table.insert(), rows)
+    return pk
+
+
+def timed(func, repeat=1):
+    "Calls ``func`` ``repeat`` times and returns the best wall-clock time."
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.deep_rebuild
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Times :meth:`TreeClassManager.rebuild` on a single chain of ``DEPTH``
+    nodes and on a wide tree of ``WIDE`` nodes (a root with a thousand
+    children, each with the same number of leaf children). Reports the
+    statements issued, and the peak Python memory allocated during a second,
+    traced, rebuild. The adjacency list is indexed, as it would be in any
+    table rebuilt this way.
+
+    Usage::
+
+      python benchmarks/deep_rebuild.py [DEPTH [WIDE]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import sqlalchemy
+
+from common import Node, setup, timed
+
+
+def insert_rows(connection, table, parent_ids):
+    "Inserts a node for each parent id, numbered from 1, with no tree fields."
+    rows = []
+    for pk, parent_id in enumerate(parent_ids, 1):
+        rows.append({'id': pk, 'name': 'node%d' % pk, 'parent_id': parent_id,
+                     'tree_id': 0, 'tree_left': 0, 'tree_right': 0,
+                     'tree_depth': 0})
+        if len(rows) == 50000:
+            connection.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def chain(size):
+    yield None
+    for pk in range(1, size):
+        yield pk
+
+
+def wide(size):
+    fanout = int(round(size ** 0.5))
+    yield None
+    for idx in range(1, size):
+        yield 1 if idx <= fanout else 2 + (idx - fanout - 1) // fanout
+
+
+def main(depth, width):
+    engine, table, Session = setup()
+    sqlalchemy.Index('benchmark_node__parent_id', table.c.parent_id) \
+        .create(engine)
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    print('%-6s %10s %10s %10s %12s' % (
+        'shape', 'nodes', 'seconds', 'statements', 'peak (KiB)'))
+    for name, shape, size in (('chain', chain, depth), ('wide', wide, width)):
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            insert_rows(connection, table, shape(size))
+        session = Session()
+        del statements[:]
+        elapsed = timed(lambda: Node.tree.rebuild(session=session))
+        count = len(statements)
+        peak = 0
+        if tracemalloc is not None:
+            # Tracing slows the rebuild down a lot, so it is run once more.
+            tracemalloc.start()
+            Node.tree.rebuild(session=session)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        session.close()
+        print('%-6s %10d %10.2f %10d %12d' % (
+            name, size, elapsed, count, peak // 1024))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [100000, 1000000][len(args):]))
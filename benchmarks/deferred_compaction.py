@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.deferred_compaction
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Deletes ``DELETES`` leaves spread over a tree of ``CHILDREN`` leaf
+    children, each in a flush of its own, with and without closing the gaps
+    on delete. Without, the tree is then compacted. Reports the time taken
+    and the number of rows updated by the deletes and by the compaction.
+
+    Since ``Node`` can only be mapped once, each configuration is run in a
+    process of its own.
+
+    Usage::
+
+      python benchmarks/deferred_compaction.py [DELETES [CHILDREN]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import subprocess
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+CONFIGURATIONS = {
+    'close gaps': {},
+    'leave gaps': {'close_gaps': False},
+}
+
+
+def run(deletes, children, name):
+    engine, table, Session = setup(**CONFIGURATIONS[name])
+    rowcounts = []
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE') and 'tree_left' in statement:
+            rowcounts.append(cursor.rowcount)
+
+    with engine.begin() as connection:
+        fill_flat_trees(connection, table, 1, children)
+    session = Session()
+    step = children // deletes
+
+    def delete():
+        for pk in range(2, children + 2, step)[:deletes]:
+            session.delete(session.query(Node).get(pk))
+            session.commit()
+
+    elapsed = timed(delete)
+    print('%12s %10s %10.3f %10d' % (name, 'deletes', elapsed, sum(rowcounts)))
+    if not Node.tree._tree_options.close_gaps:
+        del rowcounts[:]
+        elapsed = timed(lambda: Node.tree.compact(session))
+        print('%12s %10s %10.3f %10d' % (
+            name, 'compact', elapsed, sum(rowcounts)))
+    session.close()
+
+
+def main(deletes, children):
+    print('%12s %10s %10s %10s' % ('mode', 'operation', 'time (s)', 'rows'))
+    sys.stdout.flush()
+    for name in ('close gaps', 'leave gaps'):
+        subprocess.check_call([sys.executable, __file__, '--run',
+                               str(deletes), str(children), name])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(*[int(arg) for arg in sys.argv[2:4]] + [sys.argv[4]])
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        main(*(args + [200, 20000][len(args):]))
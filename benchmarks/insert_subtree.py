@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.insert_subtree
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares :meth:`TreeClassManager.insert_subtree` with inserting the same
+    hierarchy through the flush, a level at a time (every node of a level is
+    given its parent as target, which must already have been flushed).
+
+    Usage::
+
+      python benchmarks/insert_subtree.py [SUBTREE_SIZE ...]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+FANOUT = 10
+
+
+def build_levels(size):
+    "Returns the nodes of a transient hierarchy of ``size`` nodes, by level."
+    root = Node(name='subtree')
+    levels, count = [[root]], 1
+    while count < size:
+        level = []
+        for parent in levels[-1]:
+            for idx in range(FANOUT):
+                if count == size:
+                    break
+                level.append(Node(name='n%d' % count, parent=parent))
+                count += 1
+        levels.append(level)
+    return levels
+
+
+def main(sizes):
+    engine, table, Session = setup()
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    print('%8s %20s %20s' % ('size', 'flush (ms / stmts)', 'bulk (ms / stmts)'))
+    for size in sizes:
+        results = []
+        for bulk in (False, True):
+            with engine.begin() as connection:
+                connection.execute(table.delete())
+                fill_flat_trees(connection, table, 1, 100)
+            session = Session()
+            target = session.query(Node).get(2)
+            levels = build_levels(size)
+
+            def insert():
+                if bulk:
+                    Node.tree.insert_subtree(levels[0][0], target,
+                                             session=session)
+                    session.flush()
+                    return
+                for level in levels:
+                    for node in level:
+                        Node.tree.insert(node, node.parent or target)
+                        session.add(node)
+                    session.flush()
+
+            del statements[:]
+            results.extend((timed(insert) * 1000, len(statements)))
+            session.rollback()
+            session.close()
+        print('%8d %12.2f / %5d %12.2f / %5d' % ((size,) + tuple(results)))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000])
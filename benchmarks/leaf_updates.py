@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.leaf_updates
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Deletes the last leaf of a tree of ``CHILDREN`` leaf children, then swaps
+    the two leaves left at its end, and reports the number of rows updated and
+    the time taken by each flush. Only the rows between the positions
+    concerned and their ancestors should be written, however large the tree.
+
+    Usage::
+
+      python benchmarks/leaf_updates.py [CHILDREN]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+
+def main(children):
+    engine, table, Session = setup()
+    rowcounts = []
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE') and 'tree_left' in statement:
+            rowcounts.append(cursor.rowcount)
+
+    with engine.begin() as connection:
+        pk = fill_flat_trees(connection, table, 1, children)
+    session = Session()
+
+    def delete():
+        session.delete(session.query(Node).get(pk))
+        session.commit()
+
+    def move():
+        Node.tree.insert(session.query(Node).get(pk - 1),
+                         session.query(Node).get(pk - 2),
+                         Node.tree.POSITION_LEFT)
+        session.commit()
+
+    print('%10s %10s %10s' % ('operation', 'rows', 'time (ms)'))
+    for name, func in (('delete', delete), ('move', move)):
+        del rowcounts[:]
+        elapsed = timed(func)
+        print('%10s %10d %10.2f' % (name, sum(rowcounts), elapsed * 1000))
+    session.close()
+
+
+if __name__ == '__main__':
+    main(*([int(arg) for arg in sys.argv[1:]] or [200000]))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.parallel_rebuild
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Times :meth:`TreeClassManager.rebuild` on a database file holding random
+    trees of a hundred nodes each, serially and with ``parallel`` set to each
+    worker count, checks that every parallel rebuild gives the same tree fields
+    as the serial one, and reports the speedup.
+
+    Usage::
+
+      python benchmarks/parallel_rebuild.py [NODES [WORKERS ...]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import os
+import sys
+import tempfile
+
+import sqlalchemy
+
+from bulk_load import fill_adjacency_list
+from common import Node, setup, timed
+
+
+def main(size, workers):
+    handle, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(handle)
+    try:
+        engine, table, Session = setup('sqlite:///' + path)
+        sqlalchemy.Index('benchmark_node__parent_id', table.c.parent_id) \
+            .create(engine)
+        with engine.begin() as connection:
+            fill_adjacency_list(connection, table, size)
+        query = sqlalchemy.select([table]).order_by(table.c.id)
+
+        print('%8s %10s %8s' % ('workers', 'seconds', 'speedup'))
+        serial = expected = None
+        for count in [None] + workers:
+            session = Session()
+            elapsed = timed(
+                lambda: Node.tree.rebuild(session=session, parallel=count))
+            session.close()
+            with engine.connect() as connection:
+                rows = connection.execute(query).fetchall()
+            if expected is None:
+                serial, expected = elapsed, rows
+            elif rows != expected:
+                raise AssertionError('rebuild with %d workers differs' % count)
+            print('%8s %10.2f %8.2f' % (count or 'serial', elapsed,
+                                        serial / elapsed))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(args[0] if args else 100000, args[1:] or [1, 2, 4, 8])
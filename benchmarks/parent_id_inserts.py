@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.parent_id_inserts
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Counts the statements issued, and measures the time taken, by a single
+    flush inserting a growing number of nodes, each under another root not
+    loaded by the session, given by the parent id column alone (as bulk loads
+    set it). The parents are loaded together, so the number of ``SELECT``
+    statements should stay constant.
+
+    Usage::
+
+      python benchmarks/parent_id_inserts.py [INSERTED_NODES ...]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+
+def main(sizes):
+    engine, table, Session = setup()
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split(None, 1)[0].upper())
+
+    print('%8s %10s %10s %10s' % ('inserted', 'selects', 'updates',
+                                  'time (ms)'))
+    for size in sizes:
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            fill_flat_trees(connection, table, size, 0)
+        session = Session()
+
+        def insert():
+            for pk in range(1, size + 1):
+                node = Node(name='new%d' % pk)
+                node.parent_id = pk
+                session.add(node)
+            del statements[:]
+            session.flush()
+
+        elapsed = timed(insert)
+        print('%8d %10d %10d %10.2f' % (
+            size, statements.count('SELECT'), statements.count('UPDATE'),
+            elapsed * 1000))
+        session.rollback()
+        session.close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 500])
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.rational_intervals
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the rational encoding with the integer one (and with spacing).
+    ``INSERTS`` nodes are inserted one flush at a time, each at a random
+    position around a random node, into a tree of a root with ``EXISTING``
+    children. Then ``MOVES`` random nodes are moved, one flush at a time, to a
+    random position around another random node outside their subtree. Reports
+    the time taken and the number of rows updated by each phase.
+
+    Since ``Node`` can only be mapped once, each configuration is run in a
+    process of its own.
+
+    Usage::
+
+      python benchmarks/rational_intervals.py [INSERTS [EXISTING [MOVES]]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+import subprocess
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+CONFIGURATIONS = {
+    'integer': {},
+    'spacing=8': {'spacing': 8},
+    'rational': {'encoding': 'rational'},
+}
+
+
+def run(inserts, existing, moves, name):
+    engine, table, Session = setup(**CONFIGURATIONS[name])
+    written = []
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE'):
+            written.append(cursor.rowcount)
+
+    with engine.begin() as connection:
+        fill_flat_trees(connection, table, 1, existing)
+    session = Session()
+    rng = random.Random(existing)
+    positions = [Node.tree.POSITION_FIRST_CHILD, Node.tree.POSITION_LAST_CHILD,
+                 Node.tree.POSITION_LEFT, Node.tree.POSITION_RIGHT]
+
+    def insert():
+        for idx in range(inserts):
+            target = session.query(Node).get(rng.randint(2, existing + idx))
+            node = Node(name='new%d' % idx)
+            Node.tree.insert(node, target, rng.choice(positions))
+            session.add(node)
+            session.commit()
+
+    def move():
+        size = existing + inserts
+        for idx in range(moves):
+            node = session.query(Node).get(rng.randint(2, size))
+            target = session.query(Node).get(rng.randint(2, size))
+            if node.tree.is_ancestor_of(target, include_self=True):
+                continue
+            Node.tree.insert(node, target, rng.choice(positions))
+            session.commit()
+
+    results = []
+    for phase in (insert, move):
+        del written[:]
+        results.extend((timed(phase), sum(written)))
+    session.close()
+    print('%10s %10.2f / %9d %10.2f / %9d' % ((name,) + tuple(results)))
+
+
+def main(inserts, existing, moves):
+    print('%10s %22s %22s' % ('encoding', 'inserts (s / rows)',
+                              'moves (s / rows)'))
+    sys.stdout.flush()
+    for name in ('integer', 'spacing=8', 'rational'):
+        subprocess.check_call([sys.executable, __file__, '--run',
+                               str(inserts), str(existing), str(moves), name])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(*[int(arg) for arg in sys.argv[2:5]] + [sys.argv[5]])
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        main(*(args + [1000, 10000, 1000][len(args):]))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.reload_round_trips
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Counts the statements issued, and measures the time taken, by a single
+    flush which moves a growing number of nodes. The tree fields of every node
+    and target taking part in the flush are prefetched in one query, so the
+    number of ``SELECT`` statements should stay constant.
+
+    Usage::
+
+      python benchmarks/reload_round_trips.py [MOVED_NODES ...]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+
+def main(sizes):
+    engine, table, Session = setup()
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split(None, 1)[0].upper())
+
+    print('%8s %10s %10s %10s' % ('moved', 'selects', 'updates', 'time (ms)'))
+    for size in sizes:
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            fill_flat_trees(connection, table, 2, size)
+        session = Session()
+        children = session.query(Node).filter(Node.parent_id == 1).all()
+        target = session.query(Node).get(size + 2)
+
+        def move():
+            for child in children:
+                Node.tree.insert(child, target)
+            del statements[:]
+            session.flush()
+
+        elapsed = timed(move)
+        print('%8d %10d %10d %10.2f' % (
+            size, statements.count('SELECT'), statements.count('UPDATE'),
+            elapsed * 1000))
+        session.rollback()
+        session.close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 500])
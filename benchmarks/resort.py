@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.resort
+    ~~~~~~~~~~~~~~~~~
+
+    Compares sorting the children of every node of a tree by name, by moving
+    each node to the end of its parent in order, with a single
+    :meth:`TreeClassManager.rebuild` given ``order_by``. The tree has a root,
+    ``FANOUT`` children and ``FANOUT`` grandchildren under each, named at
+    random.
+
+    Usage::
+
+      python benchmarks/resort.py [FANOUT ...]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+import sys
+
+import sqlalchemy
+
+from common import Node, setup, timed
+
+
+def fill_tree(connection, table, fanout):
+    "Inserts the tree with its tree fields, in primary key order."
+    rng = random.Random(fanout)
+    rows = [{'id': 1, 'name': 'root', 'parent_id': None, 'tree_id': 1,
+             'tree_left': 1, 'tree_right': 2 * (fanout + 1) * fanout + 2,
+             'tree_depth': 0}]
+    for idx in range(fanout):
+        pk = 2 + idx * (fanout + 1)
+        left = 2 + idx * 2 * (fanout + 1)
+        rows.append({'id': pk, 'name': '%08x' % rng.getrandbits(32),
+                     'parent_id': 1, 'tree_id': 1, 'tree_left': left,
+                     'tree_right': left + 2 * fanout + 1, 'tree_depth': 1})
+        for child in range(fanout):
+            rows.append({'id': pk + 1 + child,
+                         'name': '%08x' % rng.getrandbits(32),
+                         'parent_id': pk, 'tree_id': 1,
+                         'tree_left': left + 1 + 2 * child,
+                         'tree_right': left + 2 + 2 * child, 'tree_depth': 2})
+    connection.execute(table.insert(), rows)
+    return len(rows)
+
+
+def main(fanouts):
+    engine, table, Session = setup()
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    print('%8s %22s %22s' % ('nodes', 'moves (s / stmts)',
+                             'rebuild (s / stmts)'))
+    for fanout in fanouts:
+        results = []
+        for rebuild in (False, True):
+            with engine.begin() as connection:
+                connection.execute(table.delete())
+                size = fill_tree(connection, table, fanout)
+            session = Session()
+
+            def resort():
+                if rebuild:
+                    Node.tree.rebuild(session=session, order_by=table.c.name)
+                    return
+                parents = [session.query(Node).get(1)]
+                while parents:
+                    parent = parents.pop()
+                    children = sorted(parent.children, key=lambda n: n.name)
+                    for child in children:
+                        Node.tree.insert(child, parent)
+                        session.flush()
+                    parents.extend(children)
+                session.commit()
+
+            del statements[:]
+            results.extend((timed(resort), len(statements)))
+            session.close()
+        print('%8d %12.2f / %7d %12.2f / %7d' % ((size,) + tuple(results)))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 30, 100])
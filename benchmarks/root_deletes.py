@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.root_deletes
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Deletes the root node of a tree with ``CHILDREN`` leaf children, which are
+    all promoted to be root nodes, in front of ``EXISTING`` trees of a root
+    and ten children, with and without a root order field. Reports the time
+    taken and the number of statements run by the flush.
+
+    Since ``Node`` can only be mapped once, each configuration is run in a
+    process of its own.
+
+    Usage::
+
+      python benchmarks/root_deletes.py [CHILDREN [EXISTING]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import subprocess
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+CONFIGURATIONS = {
+    'tree id': {},
+    'root order': {'root_order_field': True},
+}
+
+
+def run(children, existing, name):
+    engine, table, Session = setup(**CONFIGURATIONS[name])
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with engine.begin() as connection:
+        pk = fill_flat_trees(connection, table, 1, children)
+        fill_flat_trees(connection, table, existing, 10, after=(1, pk))
+    session = Session()
+    root = session.query(Node).get(1)
+
+    def delete():
+        session.delete(root)
+        session.commit()
+
+    del statements[:]
+    elapsed = timed(delete)
+    print('%10s %10.3f %10d' % (name, elapsed, len(statements)))
+    session.close()
+
+
+def main(children, existing):
+    print('%10s %10s %10s' % ('ordered by', 'time (s)', 'statements'))
+    sys.stdout.flush()
+    for name in ('tree id', 'root order'):
+        subprocess.check_call([sys.executable, __file__, '--run',
+                               str(children), str(existing), name])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(*[int(arg) for arg in sys.argv[2:4]] + [sys.argv[4]])
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        main(*(args + [5000, 1000][len(args):]))
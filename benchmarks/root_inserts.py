@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.root_inserts
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the tree id allocators. ``INSERTS`` new root nodes are inserted,
+    one commit each, next to ``EXISTING`` trees of a root and ten children.
+    Reports the time taken, and the number of ``SELECT`` statements and of
+    statements of any kind run per new tree.
+
+    Since ``Node`` can only be mapped once, each configuration is run in a
+    process of its own. SQLite has no sequences, so
+    :class:`SequenceTreeIdAllocator` is left out.
+
+    Usage::
+
+      python benchmarks/root_inserts.py [INSERTS [EXISTING]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import subprocess
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+from sqlalchemy_tree import CounterTreeIdAllocator
+
+CONFIGURATIONS = {
+    'max': lambda: None,
+    'counter': lambda: CounterTreeIdAllocator(),
+    'block=100': lambda: CounterTreeIdAllocator(block_size=100),
+}
+
+
+def run(inserts, existing, name):
+    engine, table, Session = setup(
+        tree_id_allocator=CONFIGURATIONS[name]())
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split(None, 1)[0].upper())
+
+    with engine.begin() as connection:
+        fill_flat_trees(connection, table, existing, 10)
+    session = Session()
+
+    def insert():
+        for idx in range(inserts):
+            session.add(Node(name='new%d' % idx))
+            session.commit()
+
+    del statements[:]
+    elapsed = timed(insert)
+    print('%10s %10.3f %10.2f %10.2f' % (
+        name, elapsed, statements.count('SELECT') / inserts,
+        len(statements) / inserts))
+    session.close()
+
+
+def main(inserts, existing):
+    print('%10s %10s %10s %10s' % ('allocator', 'time (s)', 'selects',
+                                   'statements'))
+    sys.stdout.flush()
+    for name in ('max', 'counter', 'block=100'):
+        subprocess.check_call([sys.executable, __file__, '--run',
+                               str(inserts), str(existing), name])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(*[int(arg) for arg in sys.argv[2:4]] + [sys.argv[4]])
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        main(*(args + [2000, 10000][len(args):]))
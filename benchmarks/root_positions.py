@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.root_positions
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares positioning root nodes with and without a root order field.
+    ``INSERTS`` new root nodes are inserted, one commit each, left of the
+    first of ``EXISTING`` trees of a root and ten children, so that every
+    later tree is renumbered each time unless root nodes are ordered by the
+    root order field. Reports the time taken, and the number of rows updated
+    per new tree.
+
+    Since ``Node`` can only be mapped once, each configuration is run in a
+    process of its own.
+
+    Usage::
+
+      python benchmarks/root_positions.py [INSERTS [EXISTING]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import subprocess
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+CONFIGURATIONS = {
+    'tree id': {},
+    'root order': {'root_order_field': True},
+}
+
+
+def run(inserts, existing, name):
+    engine, table, Session = setup(**CONFIGURATIONS[name])
+    updated = []
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE'):
+            updated.append(cursor.rowcount)
+
+    with engine.begin() as connection:
+        fill_flat_trees(connection, table, existing, 10)
+    session = Session()
+    first = session.query(Node).filter(Node.tree.filter_root_nodes()) \
+        .order_by(Node.tree).first()
+
+    def insert():
+        for idx in range(inserts):
+            node = Node(name='new%d' % idx)
+            Node.tree.insert(node, first, Node.tree.POSITION_LEFT)
+            session.add(node)
+            session.commit()
+
+    del updated[:]
+    elapsed = timed(insert)
+    print('%10s %10.3f %10.2f' % (name, elapsed, sum(updated) / inserts))
+    session.close()
+
+
+def main(inserts, existing):
+    print('%10s %10s %10s' % ('ordered by', 'time (s)', 'updated'))
+    sys.stdout.flush()
+    for name in ('tree id', 'root order'):
+        subprocess.check_call([sys.executable, __file__, '--run',
+                               str(inserts), str(existing), name])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(*[int(arg) for arg in sys.argv[2:4]] + [sys.argv[4]])
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        main(*(args + [200, 10000][len(args):]))
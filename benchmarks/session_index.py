@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.session_index
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the cost of flushing a single leaf insertion and a single move as
+    the number of tree nodes loaded into the session's identity map grows. With
+    the per-flush :class:`TreeSessionIndex` only the nodes of the affected tree
+    are visited, so the flush time should stay roughly flat.
+
+    Usage::
+
+      python benchmarks/session_index.py [IDENTITY_MAP_SIZE ...]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+from common import Node, fill_flat_trees, setup, timed
+
+TREE_SIZE = 100
+
+
+def main(sizes):
+    engine, table, Session = setup()
+    print('%12s %14s %14s' % ('session size', 'insert (ms)', 'move (ms)'))
+    for size in sizes:
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            fill_flat_trees(connection, table, size // TREE_SIZE,
+                            TREE_SIZE - 1)
+        session = Session()
+        nodes = session.query(Node).all()
+        root = session.query(Node).get(1)
+        leaf = session.query(Node).get(2)
+        other = session.query(Node).get(3)
+
+        def insert():
+            node = Node(name='new')
+            Node.tree.insert(node, root)
+            session.add(node)
+            session.flush()
+
+        def move():
+            Node.tree.insert(leaf, other, Node.tree.POSITION_LAST_CHILD)
+            session.flush()
+            Node.tree.insert(leaf, root, Node.tree.POSITION_FIRST_CHILD)
+            session.flush()
+
+        print('%12d %14.2f %14.2f' % (
+            len(nodes), timed(insert, 5) * 1000, timed(move, 5) * 500))
+        session.rollback()
+        session.close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000])
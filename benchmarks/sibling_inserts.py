@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.sibling_inserts
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures a single flush which adds a growing number of new children under
+    the same parent, in a tree which has many nodes to the right of the gap.
+    Runs of inserts at the same position share one gap-opening ``UPDATE``.
+
+    Usage::
+
+      python benchmarks/sibling_inserts.py [NEW_CHILDREN ...]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+EXISTING_CHILDREN = 5000
+
+
+def main(sizes):
+    engine, table, Session = setup()
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split(None, 1)[0].upper())
+
+    print('%8s %10s %10s' % ('inserted', 'updates', 'time (ms)'))
+    for size in sizes:
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            fill_flat_trees(connection, table, 1, EXISTING_CHILDREN)
+        session = Session()
+        parent = session.query(Node).get(2)
+
+        def insert():
+            for idx in range(size):
+                node = Node(name='new%d' % idx)
+                Node.tree.insert(node, parent)
+                session.add(node)
+            del statements[:]
+            session.flush()
+
+        elapsed = timed(insert)
+        print('%8d %10d %10.2f' % (
+            size, statements.count('UPDATE'), elapsed * 1000))
+        session.rollback()
+        session.close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 2000])
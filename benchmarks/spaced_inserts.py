@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.spaced_inserts
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Inserts ``INSERTS`` nodes one flush at a time, each at a random position
+    around a random node, into a tree of a root with ``EXISTING`` children,
+    with dense numbering and with each of the given ``spacing`` values. Reports
+    the time taken and the number of rows updated. The tree starts out densely
+    numbered, so with spacing the first inserts have to spread it out.
+
+    Since ``Node`` can only be mapped once, each configuration is run in a
+    process of its own.
+
+    Usage::
+
+      python benchmarks/spaced_inserts.py [INSERTS [EXISTING [SPACING ...]]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+import subprocess
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+
+def run(inserts, existing, spacing):
+    engine, table, Session = setup(spacing=spacing or None)
+    written = []
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE'):
+            written.append(cursor.rowcount)
+
+    with engine.begin() as connection:
+        fill_flat_trees(connection, table, 1, existing)
+    session = Session()
+    rng = random.Random(existing)
+    positions = [Node.tree.POSITION_FIRST_CHILD, Node.tree.POSITION_LAST_CHILD,
+                 Node.tree.POSITION_LEFT, Node.tree.POSITION_RIGHT]
+
+    def insert():
+        for idx in range(inserts):
+            target = session.query(Node).get(rng.randint(2, existing + idx))
+            node = Node(name='new%d' % idx)
+            Node.tree.insert(node, target, rng.choice(positions))
+            session.add(node)
+            session.commit()
+
+    elapsed = timed(insert)
+    session.close()
+    print('%8s %10.2f %12d' % (spacing or 'dense', elapsed, sum(written)))
+
+
+def main(inserts, existing, spacings):
+    print('%8s %10s %12s' % ('spacing', 'seconds', 'rows updated'))
+    sys.stdout.flush()
+    for spacing in spacings:
+        subprocess.check_call([sys.executable, __file__, '--run',
+                               str(inserts), str(existing), str(spacing)])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(*[int(arg) for arg in sys.argv[2:]])
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        main(*(args[:2] + [1000, 10000][len(args):]),
+             spacings=args[2:] or [0, 2, 8, 32])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.statement_cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Moves the last child of a small tree of ``CHILDREN`` leaf children to
+    the front ``MOVES`` times, a flush each, and deletes and re-inserts a
+    child as many times, and reports the time taken per operation, first
+    with the tree-maintenance statements built and compiled anew for every
+    operation (by clearing their caches), then reusing them. On trees this
+    small, building and compiling the statements costs about as much as
+    running them.
+
+    Usage::
+
+      python benchmarks/statement_cache.py [CHILDREN [MOVES]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+from common import Node, fill_flat_trees, setup, timed
+
+
+def main(children, moves):
+    engine, table, Session = setup()
+    extension = Node.tree.mapper_extension
+    with engine.begin() as connection:
+        fill_flat_trees(connection, table, 1, children)
+    session = Session()
+    root = session.query(Node).get(1)
+    nodes = session.query(Node).filter(Node.parent_id == 1).all()
+
+    def run(operation, cached):
+        def func():
+            for _ in range(moves):
+                if not cached:
+                    extension._statements.clear()
+                    extension._compiled_cache.clear()
+                operation()
+                session.flush()
+        return timed(func) / moves
+
+    def move():
+        Node.tree.insert(nodes[-1], nodes[0], Node.tree.POSITION_LEFT)
+        nodes.insert(0, nodes.pop())
+
+    def delete_insert():
+        session.delete(nodes.pop())
+        session.flush()
+        node = Node(name='node')
+        Node.tree.insert(node, root)
+        session.add(node)
+        nodes.append(node)
+
+    print('%15s %12s %12s' % ('operation', 'built (ms)', 'cached (ms)'))
+    for name, operation in (('move', move), ('delete/insert', delete_insert)):
+        built = run(operation, False)
+        cached = run(operation, True)
+        print('%15s %12.3f %12.3f' % (name, built * 1000, cached * 1000))
+    session.close()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [20, 500][len(args):]))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.subtree_deletes
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Deletes a tree of a root and ``CHILDREN`` leaf children, in front of
+    ``EXISTING`` trees of a root and ten children, first by deleting each of
+    its nodes through the session and then with
+    ``TreeClassManager.delete_subtree``. Reports the time taken and the number
+    of statements run.
+
+    Usage::
+
+      python benchmarks/subtree_deletes.py [CHILDREN [EXISTING]]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+import sqlalchemy
+
+from common import Node, fill_flat_trees, setup, timed
+
+
+def main(children, existing):
+    engine, table, Session = setup()
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def per_node():
+        for node in session.query(Node).filter(Node.tree.tree_id_field == 1):
+            session.delete(node)
+        session.commit()
+
+    def delete_subtree():
+        Node.tree.delete_subtree(session.query(Node).get(1))
+        session.commit()
+
+    print('%15s %10s %10s' % ('method', 'time (s)', 'statements'))
+    for name, func in (('per node', per_node),
+                       ('delete_subtree', delete_subtree)):
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            pk = fill_flat_trees(connection, table, 1, children)
+            fill_flat_trees(connection, table, existing, 10, after=(1, pk))
+        session = Session()
+        del statements[:]
+        elapsed = timed(func)
+        print('%15s %10.3f %10d' % (name, elapsed, len(statements)))
+        session.close()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [1000, 1000][len(args):]))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.subtree_rebuild
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares repairing one subtree of ``FANOUT + 1`` nodes, in a tree of a
+    root with ``FANOUT`` such subtrees, with :meth:`TreeClassManager.rebuild`
+    given that subtree's root, against a complete rebuild. Reports the time and
+    the number of rows written by each.
+
+    Usage::
+
+      python benchmarks/subtree_rebuild.py [FANOUT ...]
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sys
+
+import sqlalchemy
+
+from common import Node, setup, timed
+from resort import fill_tree
+
+
+def main(fanouts):
+    engine, table, Session = setup()
+    sqlalchemy.Index('benchmark_node__parent_id', table.c.parent_id) \
+        .create(engine)
+    written = []
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE'):
+            written.append(cursor.rowcount)
+
+    print('%8s %24s %24s' % ('nodes', 'subtree (s / rows)',
+                             'complete (s / rows)'))
+    for fanout in fanouts:
+        with engine.begin() as connection:
+            connection.execute(table.delete())
+            size = fill_tree(connection, table, fanout)
+        results = []
+        for subtree in (True, False):
+            session = Session()
+            node = session.query(Node).get(2)
+
+            def rebuild():
+                if subtree:
+                    Node.tree.rebuild(node)
+                else:
+                    Node.tree.rebuild(session=session)
+
+            del written[:]
+            results.extend((timed(rebuild), sum(written)))
+            session.close()
+        print('%8d %14.4f / %7d %14.4f / %7d' % ((size,) + tuple(results)))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 300])
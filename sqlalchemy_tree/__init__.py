@@ -15,13 +15,17 @@
 
 from operator import attrgetter
 
+from .allocators import CounterTreeIdAllocator, MaxTreeIdAllocator, \
+    SequenceTreeIdAllocator, TreeIdAllocator
+from .batch import TreeBatch
 from .exceptions import InvalidMoveError
 from .manager import TreeClassManager, TreeInstanceManager, TreeManager
 from .options import TreeOptions
 from .orm import TreeMapperExtension, TreeSessionExtension, \
     DeclarativeMeta
 from .types import TreeDepthType, TreeEndpointType, TreeIdType, \
-    TreeIntegerType, TreeLeftType, TreeRightType
+    TreeIntegerType, TreeLeftType, TreePathType, TreeRationalLeftType, \
+    TreeRationalRightType, TreeRightType, TreeRootOrderType
 
 from . import tests
 
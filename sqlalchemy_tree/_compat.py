@@ -10,6 +10,9 @@ if PY2:
     text_type = unicode
     string_types = (str, unicode)
     integer_types = (int, long)
+    # The array typecode of the widest integers: there is no ``q`` before
+    # Python 3.3, and typecodes have to be native strings.
+    integer_typecode = str('l')
     from urllib import urlretrieve
 
     text_to_native = lambda s, enc: s.encode(enc)
@@ -44,6 +47,7 @@ else:
     text_type = str
     string_types = (str,)
     integer_types = (int, )
+    integer_typecode = 'q'
 
     text_to_native = lambda s, enc: s
 
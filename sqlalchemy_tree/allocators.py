@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.allocators
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Strategies for picking the tree id of new trees, one of which is passed to
+    :class:`TreeManager` as ``tree_id_allocator``.
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import threading
+
+import sqlalchemy
+
+__all__ = (
+    'TreeIdAllocator',
+    'MaxTreeIdAllocator',
+    'SequenceTreeIdAllocator',
+    'CounterTreeIdAllocator',
+)
+
+
+class TreeIdAllocator(object):
+
+    """Base class of the tree id allocators. An allocator hands out the tree
+    id of every tree created by an insert or a move, which must be greater
+    than those of all the existing trees so that the new tree comes last.
+
+    Tree ids are also changed by other operations, which report it to the
+    allocator: positioning a root node left or right of another one makes
+    room by adding to the tree ids of the trees after it (see
+    :meth:`shifted`), and complete rebuilds number the trees from 1 (see
+    :meth:`renumbered`). An allocator serves a single tree.
+    """
+
+    def bind(self, options):
+        "Attaches the allocator to the tree of the :class:`TreeOptions` given."
+        assert getattr(self, 'options', None) is None, \
+            "A tree id allocator can only serve one tree"
+        self.options = options
+
+    def next_tree_id(self, connection, session_index):
+        """Returns the tree id of a new tree, given the connection the flush
+        runs over and the :class:`TreeSessionIndex` of its session."""
+        raise NotImplementedError
+
+    def next_tree_ids(self, connection, session_index, count):
+        """Returns the tree ids of ``count`` new trees, all taken before any
+        of them is given to a node."""
+        return [self.next_tree_id(connection, session_index)
+                for _ in range(count)]
+
+    def shifted(self, connection, size):
+        """The tree ids of some of the trees have just been increased by
+        ``size``, so the greatest tree id may have."""
+        pass
+
+    def renumbered(self, connection, count):
+        "The trees have just been numbered from 1 to ``count``."
+        pass
+
+    def _get_max_tree_id(self, connection, session_index):
+        """Returns the greatest tree id in the table or in the session (as the
+        nodes of the flush are only written at its end), or 0."""
+        options = self.options
+        return max(session_index.max_tree_id() or 0, connection.execute(
+            sqlalchemy.select([
+                (sqlalchemy.func.max(options.tree_id_field)).label('tree_id')
+            ])).fetchone()[0] or 0)
+
+
+class MaxTreeIdAllocator(TreeIdAllocator):
+
+    """Gives new trees the greatest tree id in use plus one, found with a
+    ``SELECT max(tree_id)`` query. This is the default, and needs nothing but
+    the table, but costs a query for every new tree, and two flushes creating
+    trees at the same time may pick the same tree id."""
+
+    def next_tree_id(self, connection, session_index):
+        return self._get_max_tree_id(connection, session_index) + 1
+
+    def next_tree_ids(self, connection, session_index, count):
+        tree_id = self._get_max_tree_id(connection, session_index) + 1
+        return list(range(tree_id, tree_id + count))
+
+
+class SequenceTreeIdAllocator(TreeIdAllocator):
+
+    """Takes the tree ids of new trees from a database sequence, so that new
+    trees are numbered with no query of the table and no two flushes ever
+    pick the same tree id. The sequence is defined in the metadata of the
+    table, named after it unless ``sequence`` is given, and is created along
+    with it; on a table which already has trees, it has to be started above
+    their greatest tree id. On databases without sequences, tree ids are
+    allocated as by :class:`MaxTreeIdAllocator`.
+
+    :param sequence:
+      the name of the sequence, or the :class:`sqlalchemy.Sequence` itself.
+      Defaults to the name of the table followed by ``'__tree_id_seq'``.
+    """
+
+    def __init__(self, sequence=None):
+        self.sequence = sequence
+
+    def bind(self, options):
+        super(SequenceTreeIdAllocator, self).bind(options)
+        if not isinstance(self.sequence, sqlalchemy.Sequence):
+            self.sequence = sqlalchemy.Sequence(
+                self.sequence or '__'.join((options.table.name, 'tree_id_seq')),
+                metadata=options.table.metadata)
+
+    def next_tree_id(self, connection, session_index):
+        if not connection.dialect.supports_sequences:
+            return self._get_max_tree_id(connection, session_index) + 1
+        return connection.execute(self.sequence)
+
+    def next_tree_ids(self, connection, session_index, count):
+        if not connection.dialect.supports_sequences:
+            tree_id = self._get_max_tree_id(connection, session_index) + 1
+            return list(range(tree_id, tree_id + count))
+        return super(SequenceTreeIdAllocator, self).next_tree_ids(
+            connection, session_index, count)
+
+    def shifted(self, connection, size):
+        # Sequences can't be moved forward portably, so the values the shift
+        # may have taken are used up instead.
+        if connection.dialect.supports_sequences:
+            for _ in range(size):
+                connection.execute(self.sequence)
+
+    def renumbered(self, connection, count):
+        if not connection.dialect.supports_sequences:
+            return
+        if connection.dialect.name == 'postgresql':
+            connection.execute(sqlalchemy.text(
+                'SELECT setval(:name, greatest(:count, last_value)) FROM %s' %
+                connection.dialect.identifier_preparer.format_sequence(
+                    self.sequence)), name=self.sequence.name, count=count)
+            return
+        while connection.execute(self.sequence) < count:
+            pass
+
+
+class CounterTreeIdAllocator(TreeIdAllocator):
+
+    """Takes the tree ids of new trees from a counter row kept for the table
+    in a registry table, which can be shared by several trees. Reserving tree
+    ids increments the counter with an ``UPDATE``, which locks the row until
+    the end of the transaction, so no two flushes ever pick the same tree id.
+    The row is created the first time a tree id is needed, from the greatest
+    tree id in the table.
+
+    With a ``block_size`` greater than one, tree ids are reserved that many
+    at a time and handed out from memory, so that most new trees are numbered
+    without any statement at all. Blocks are kept per thread, and dropped
+    whenever a transaction or savepoint is rolled back over the engine, as
+    the reservation may have been rolled back with it, or when positioning a
+    root node or a complete rebuild moves the trees over the ids left. Trees
+    are only ordered by tree id within each process then, since every process
+    numbers its new trees from blocks of its own, and positioning root nodes
+    in several processes at once may move trees of one onto the ids left in
+    a block of another.
+
+    :param registry:
+      the name of the registry table, or the :class:`sqlalchemy.Table`
+      itself, which is defined in the metadata of the table unless it is
+      there already.
+    :param block_size:
+      the number of tree ids reserved at a time.
+    """
+
+    def __init__(self, registry='tree_registry', block_size=1):
+        assert block_size > 0, "The block size should be a positive number"
+        self.registry = registry
+        self.block_size = block_size
+        self._local = threading.local()
+        # Bumped to drop the blocks of every thread at once:
+        self._generation = 0
+
+    def bind(self, options):
+        super(CounterTreeIdAllocator, self).bind(options)
+        metadata = options.table.metadata
+        if not isinstance(self.registry, sqlalchemy.Table):
+            registry = metadata.tables.get(self.registry)
+            if registry is None:
+                registry = sqlalchemy.Table(
+                    self.registry, metadata,
+                    sqlalchemy.Column('table_name', sqlalchemy.Unicode(255),
+                                      primary_key=True),
+                    sqlalchemy.Column('next_tree_id', sqlalchemy.Integer,
+                                      nullable=False),
+                )
+            self.registry = registry
+        self._where = self.registry.c.table_name == options.table.name
+
+    def next_tree_id(self, connection, session_index):
+        block = getattr(self._local, 'block', None)
+        if (block is None or block[0] == block[1] or
+                block[2] != self._generation):
+            block = self._local.block = self._reserve(
+                connection, session_index)
+        tree_id = block[0]
+        block[0] += 1
+        return tree_id
+
+    def _reserve(self, connection, session_index):
+        """Reserves the next block of tree ids, returned as the list of the
+        first and last plus one, and the generation it belongs to."""
+        generation = self._generation
+        if not sqlalchemy.event.contains(
+                connection.engine, 'rollback', self._drop_block):
+            sqlalchemy.event.listen(
+                connection.engine, 'rollback', self._drop_block)
+            sqlalchemy.event.listen(
+                connection.engine, 'rollback_savepoint', self._drop_block)
+        counter = self.registry.c.next_tree_id
+        if connection.execute(self.registry.update()
+                              .values({counter: counter + self.block_size})
+                              .where(self._where)).rowcount:
+            end = connection.execute(
+                sqlalchemy.select([counter]).where(self._where)).scalar()
+        else:
+            end = self._get_max_tree_id(connection, session_index) + 1 + \
+                self.block_size
+            connection.execute(self.registry.insert().values({
+                self.registry.c.table_name: self.options.table.name,
+                counter: end}))
+        return [end - self.block_size, end, generation]
+
+    def _drop_block(self, connection, *args):
+        self._local.block = None
+
+    def shifted(self, connection, size):
+        self._generation += 1
+        counter = self.registry.c.next_tree_id
+        connection.execute(self.registry.update()
+                           .values({counter: counter + size})
+                           .where(self._where))
+
+    def renumbered(self, connection, count):
+        self._generation += 1
+        counter = self.registry.c.next_tree_id
+        connection.execute(self.registry.update()
+                           .values({counter: count + 1})
+                           .where(self._where & (counter <= count)))
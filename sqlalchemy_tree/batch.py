@@ -0,0 +1,791 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.batch
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Batches of inserts, moves and deletes of tree nodes applied together, see
+    :meth:`TreeClassManager.batch`.
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sqlalchemy
+
+from ._compat import integer_types
+from .exceptions import InvalidMoveError
+from .orm import RELOAD_CHUNK_SIZE
+
+__all__ = (
+    'TreeBatch',
+)
+
+
+class _Gap(object):
+
+    """Stands, among the root nodes of a :class:`_Forest`, for the trees left
+    untouched with a tree id between ``lower`` and ``upper`` exclusive (with
+    no upper bound if ``upper`` is ``None``)."""
+
+    def __init__(self, lower, upper):
+        self.lower = lower
+        self.upper = upper
+
+
+class _Ghost(object):
+
+    """Stands, among the root nodes of a :class:`_Forest`, for the place left
+    by the root node of the tree ``tree_id`` once moved away or deleted."""
+
+    def __init__(self, key, tree_id):
+        self.key = key
+        self.tree_id = tree_id
+        self.deleted = False
+
+
+# Marks the end of the root nodes found in the table: the trees put after it
+# are given new tree ids.
+_END = object()
+
+
+class _Forest(object):
+
+    """The trees touched by a batch, held in memory as the list of the
+    children of each node, keyed by primary key (or by instance state for new
+    nodes). The root nodes are kept in a list of their own, in which the trees
+    not read are stood for by gaps, so that the tree ids the trees end up with
+    can be worked out along it.
+
+    :param class_manager:
+      the :class:`TreeClassManager` of the tree.
+    :param rows:
+      the rows of the trees, ordered by tree id and ``left``, each made of a
+      primary key followed by the values of the tree fields ``names``.
+    """
+
+    def __init__(self, class_manager, rows, names):
+        self._class_manager = class_manager
+        # key -> key of the parent, or None for root nodes
+        self.parent = {}
+        # key -> keys of the children, in order
+        self.children = {}
+        # primary key -> values of the tree fields read
+        self.old = {}
+        # primary keys of the root nodes still in their place
+        self.in_place = set()
+
+        roots, stack = [], []
+        for row in rows:
+            pk, values = row[0], dict(zip(names, row[1:]))
+            while stack and (stack[-1][1] != values['tree_id'] or
+                             stack[-1][2] < values['left']):
+                stack.pop()
+            if stack:
+                self.parent[pk] = stack[-1][0]
+                self.children[stack[-1][0]].append(pk)
+            else:
+                self.parent[pk] = None
+                roots.append(pk)
+            self.children[pk] = []
+            self.old[pk] = values
+            stack.append((pk, values['tree_id'], values['right']))
+        self.in_place.update(roots)
+
+        if 'root_order' in names:
+            # Root nodes are ordered by root order, and tree ids do not move.
+            self.roots = sorted(
+                roots, key=lambda pk: self.old[pk]['root_order'])
+        else:
+            self.roots, lower = [], 0
+            for pk in roots:
+                self.roots.extend((_Gap(lower, self.old[pk]['tree_id']), pk))
+                lower = self.old[pk]['tree_id']
+            self.roots.append(_Gap(lower, None))
+        self.roots.append(_END)
+
+    def _siblings(self, key):
+        parent = self.parent[key]
+        return self.roots if parent is None else self.children[parent]
+
+    def place(self, key, target, position):
+        """Moves the node ``key`` (inserting it if it is not there yet) to
+        ``position`` relative to the node ``target``, or after the last root
+        node if ``target`` is ``None``."""
+        class_manager = self._class_manager
+        if position not in (class_manager.POSITION_LEFT,
+                            class_manager.POSITION_RIGHT,
+                            class_manager.POSITION_FIRST_CHILD,
+                            class_manager.POSITION_LAST_CHILD):
+            raise ValueError(u"an invalid position was given: %s" % position)
+        if key in self.parent:
+            if target is not None:
+                relation = 'sibling' if position in (
+                    class_manager.POSITION_LEFT,
+                    class_manager.POSITION_RIGHT) else 'child'
+                if target == key:
+                    raise InvalidMoveError(
+                        u"a node may not be made a %s of itself" % relation)
+                ancestor = self.parent[target]
+                while ancestor is not None:
+                    if ancestor == key:
+                        raise InvalidMoveError(
+                            u"a node may not be made a %s of any of its "
+                            u"descendants" % relation)
+                    ancestor = self.parent[ancestor]
+            self._unlink(key)
+        else:
+            self.children[key] = []
+
+        if target is None:
+            self.parent[key] = None
+            self.roots.append(key)
+        elif position == class_manager.POSITION_FIRST_CHILD:
+            self.parent[key] = target
+            self.children[target].insert(0, key)
+        elif position == class_manager.POSITION_LAST_CHILD:
+            self.parent[key] = target
+            self.children[target].append(key)
+        else:
+            self.parent[key] = self.parent[target]
+            siblings = self._siblings(target)
+            idx = siblings.index(target)
+            if position == class_manager.POSITION_RIGHT:
+                idx += 1
+            siblings.insert(idx, key)
+
+    def delete(self, key):
+        "Removes the node ``key``, its children taking its place."
+        siblings, idx, ghost = self._unlink(key)
+        if ghost is not None:
+            ghost.deleted = True
+            idx += 1
+        children = self.children.pop(key)
+        parent = self.parent.pop(key)
+        for child in children:
+            self.parent[child] = parent
+        siblings[idx:idx] = children
+
+    def _unlink(self, key):
+        """Takes the node ``key`` out of the list of its siblings, leaving a
+        ghost in the place of root nodes which were still in their place.
+        Returns the list, the index the node was at and the ghost, if any."""
+        siblings = self._siblings(key)
+        idx = siblings.index(key)
+        ghost = None
+        if key in self.in_place:
+            self.in_place.discard(key)
+            siblings[idx] = ghost = _Ghost(key, self.old[key]['tree_id'])
+        else:
+            del siblings[idx]
+        return siblings, idx, ghost
+
+    def iter_preorder(self, root):
+        "Yields the keys of the tree of the root node ``root`` in preorder."
+        stack = [root]
+        while stack:
+            key = stack.pop()
+            yield key
+            stack.extend(reversed(self.children[key]))
+
+
+class TreeBatch(object):
+
+    """Collects the inserts, moves and deletes of tree nodes made through a
+    session, to apply them together, as returned by
+    :meth:`TreeClassManager.batch`. Within the block, nodes are inserted and
+    moved with :meth:`TreeClassManager.insert` (or by giving new nodes a
+    parent) and deleted with ``session.delete``, and nothing is written: the
+    changes are applied when the block is left, or when the session is
+    flushed within it.
+
+    The trees the changes touch are read with two queries, and the changes
+    applied in memory, in the order they were made (new nodes added without
+    :meth:`TreeClassManager.insert` and nodes given a new parent next, as a
+    flush would, and deletes last). The trees are then numbered anew, as
+    :meth:`TreeClassManager.compact` would, and only the rows whose tree
+    fields end up different are written back, with one executemany
+    ``UPDATE``; the tree ids of the trees in between are shifted with one
+    more ``UPDATE`` when trees were positioned among them, and trees put after
+    the last one are numbered on from it, the tree id allocator being told
+    through :meth:`TreeIdAllocator.shifted`. New nodes are
+    inserted one by one, as their primary keys are needed for the links and
+    paths of their children. The nodes held by the session are kept in step.
+
+    If the block is left by an exception, nothing is applied.
+
+    :param class_manager:
+      the :class:`TreeClassManager` of the tree.
+    :param session:
+      the session the changes are made through.
+    """
+
+    def __init__(self, class_manager, session):
+        self.class_manager = class_manager
+        self.session = session
+        # (node, target, position) of the calls to insert, in order
+        self._recorded = []
+        self._autoflush = None
+
+    def __enter__(self):
+        session_index = self._session_index()
+        if session_index.batch is not None:
+            raise ValueError(u"a batch is already open on this session")
+        session_index.batch = self
+        self._autoflush = self.session.autoflush
+        self.session.autoflush = False
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._session_index().batch = None
+        self.session.autoflush = self._autoflush
+        if exc_type is None:
+            self.apply()
+        else:
+            del self._recorded[:]
+
+    def _session_index(self):
+        return self.class_manager.session_extension.session_index(
+            self.session)
+
+    def record(self, node, target, position):
+        """Queues the insert or move of ``node`` to ``position`` relative to
+        ``target``, as requested from :meth:`TreeClassManager.insert`."""
+        self._recorded.append((node, target, position))
+
+    def has_overlapping_moves(self, count=2):
+        """Returns whether at least ``count`` of the moves of persistent nodes
+        to apply touch the same tree, as the tree of the node moved or of its
+        target, read from the values committed to the nodes of the session.
+        Such moves shift the rows of one another one after the other, where
+        applying them together writes each changed row once.
+
+        Moves making, moving or placing nodes next to roots are not counted
+        but answered with ``False``: one at a time, each renumbers the trees
+        which follow as it is applied, which the batch does not replay."""
+        class_manager = self.class_manager
+        options = class_manager._tree_options
+        mapper = sqlalchemy.orm.class_mapper(options.node_class)
+        identity_map = self.session.identity_map
+        tree_id_name = options.tree_id_field.name
+        parent_id_name = options.parent_id_field.name
+
+        def _committed(obj, name):
+            # insert() sets the tree id of the nodes it moves to 0.
+            state = sqlalchemy.orm.attributes.instance_state(obj)
+            return state.committed_state.get(name, state.dict.get(name))
+
+        def _tree_id(obj):
+            tree_id = _committed(obj, tree_id_name)
+            return tree_id if isinstance(tree_id, integer_types) else None
+
+        counts = {}
+        for node, key, target, position in self._get_ops(self._recorded):
+            if isinstance(key, sqlalchemy.orm.state.InstanceState):
+                continue
+            if target is None or _committed(node, parent_id_name) is None:
+                return False
+            tree_ids = set([_tree_id(node)])
+            if not isinstance(target, sqlalchemy.orm.state.InstanceState):
+                obj = identity_map.get(
+                    mapper.identity_key_from_primary_key([target]))
+                if obj is not None:
+                    if (_committed(obj, parent_id_name) is None and
+                            position in (class_manager.POSITION_LEFT,
+                                         class_manager.POSITION_RIGHT)):
+                        return False
+                    tree_ids.add(_tree_id(obj))
+            tree_ids.discard(None)
+            for tree_id in tree_ids:
+                counts[tree_id] = counts.get(tree_id, 0) + 1
+                if counts[tree_id] >= count:
+                    return True
+        return False
+
+    def apply(self):
+        """Applies the changes collected so far. Called when the block is left,
+        and by the session extension before the session is flushed."""
+        options = self.class_manager._tree_options
+        session = self.session
+        recorded, self._recorded = self._recorded, []
+
+        ops = self._get_ops(recorded)
+        deleted = sorted(
+            (node for node in session.deleted
+             if isinstance(node, options.node_class)),
+            key=lambda node: self._key(node))
+        if not ops and not deleted:
+            return
+
+        mapper = sqlalchemy.orm.class_mapper(options.node_class)
+        connection = session.connection(mapper=mapper)
+        session_index = self._session_index()
+        session_index.reset()
+
+        pks = set(self._key(node) for node in deleted)
+        for node, key, target, position in ops:
+            pks.update(obj for obj in (key, target)
+                       if obj is not None and
+                       not isinstance(obj, sqlalchemy.orm.state.InstanceState))
+        forest = self._load(connection, pks)
+
+        # Apply the changes in order. A new node given as target before it
+        # was placed itself is placed first.
+        queued = {}
+        for idx, op in enumerate(ops):
+            queued.setdefault(op[1], []).append(idx)
+        done = [False] * len(ops)
+        for idx in range(len(ops)):
+            stack = [idx]
+            while stack:
+                if done[stack[-1]]:
+                    stack.pop()
+                    continue
+                node, key, target, position = ops[stack[-1]]
+                if target is not None and target not in forest.parent:
+                    waiting = [op_idx for op_idx in queued.get(target, ())
+                               if not done[op_idx]]
+                    if not waiting or waiting[0] in stack:
+                        raise ValueError(
+                            u"a node may only be positioned relative to a "
+                            u"node of the trees")
+                    stack.append(waiting[0])
+                    continue
+                forest.place(key, target, position)
+                done[stack.pop()] = True
+        for node in deleted:
+            forest.delete(self._key(node))
+
+        values, shifts = self._number(connection, session_index, forest)
+        inserted, changed = self._write(
+            connection, session_index, forest, values, shifts,
+            [self._key(node) for node in deleted])
+        self._sync(session_index, forest, values, shifts, ops, inserted,
+                   changed, deleted)
+
+    def _key(self, node):
+        "Returns the primary key of ``node``, or its state if it is new."
+        state = sqlalchemy.orm.attributes.instance_state(node)
+        if state.key is not None:
+            return state.key[1][0]
+        return state
+
+    def _get_ops(self, recorded):
+        """Returns the inserts and moves to apply as ``(node, key, target,
+        position)``, with the key of ``node`` and ``target`` given by
+        :meth:`_key` (or the parent id column). The recorded ones come first,
+        then those a flush would find, with the same rules as
+        :meth:`TreeSessionExtension.before_flush`: in the order new nodes
+        were added, then by primary key."""
+        options = self.class_manager._tree_options
+        session = self.session
+
+        def _op(node, target, position):
+            if isinstance(target, options.node_class):
+                target = self._key(target)
+            return (node, self._key(node), target, position)
+
+        ops, seen = [], set()
+        for node, target, position in recorded:
+            if node in session:
+                seen.add(sqlalchemy.orm.attributes.instance_state(node))
+                ops.append(_op(node, target, position))
+
+        new = session.new
+        found = []
+        for node in new.union(session.dirty):
+            if not isinstance(node, options.node_class):
+                continue
+            state = sqlalchemy.orm.attributes.instance_state(node)
+            if state in seen:
+                continue
+            if hasattr(node, options.delayed_op_attr):
+                target, position = getattr(node, options.delayed_op_attr)
+            elif (node in new or
+                  sqlalchemy.orm.attributes.get_history(
+                    node, options.parent_field_name).has_changes()):
+                position = self.class_manager.POSITION_LAST_CHILD
+                target = getattr(node, options.parent_field_name)
+                if target is None and node in new:
+                    # As in a flush, new nodes without a parent take the
+                    # parent id column.
+                    target = getattr(node, options.parent_id_field.name)
+            else:
+                continue
+            found.append((
+                (0, state.insert_order) if state.key is None else
+                (1, state.key[1][0]), _op(node, target, position)))
+        found.sort(key=lambda item: item[0])
+        return ops + [op for order, op in found]
+
+    def _load(self, connection, pks):
+        """Reads the trees of the nodes with the primary keys ``pks``, the ids
+        of which are found with one query, and returns them as a
+        :class:`_Forest`. Both queries are made in chunks of
+        ``RELOAD_CHUNK_SIZE``."""
+        options = self.class_manager._tree_options
+        names = ['parent_id', 'tree_id', 'left', 'right', 'depth']
+        if options.path_field is not None:
+            names.append('path')
+        if options.root_order_field is not None:
+            names.append('root_order')
+        columns = [options.pk_field] + [
+            getattr(options, '%s_field' % name) for name in names]
+
+        pks, tree_ids = sorted(pks), set()
+        for idx in range(0, len(pks), RELOAD_CHUNK_SIZE):
+            tree_ids.update(row[0] for row in connection.execute(
+                sqlalchemy.select([options.tree_id_field]).distinct()
+                .where(options.pk_field.in_(pks[idx:idx + RELOAD_CHUNK_SIZE]))))
+        tree_ids, rows = sorted(tree_ids), []
+        for idx in range(0, len(tree_ids), RELOAD_CHUNK_SIZE):
+            rows.extend(connection.execute(
+                sqlalchemy.select(columns)
+                .where(options.tree_id_field.in_(
+                    tree_ids[idx:idx + RELOAD_CHUNK_SIZE]))
+                .order_by(options.tree_id_field, options.left_field)))
+
+        forest = _Forest(self.class_manager, rows, names)
+        missing = [pk for pk in pks if pk not in forest.old]
+        if missing:
+            raise ValueError(u"no node has the primary key %r" % missing[0])
+        return forest
+
+    def _number(self, connection, session_index, forest):
+        """Gives the trees of ``forest`` their tree ids (and their root nodes
+        their root orders, if kept), and numbers them from 1. Returns the new
+        values of the tree fields of every node, and the shifts of the tree
+        ids of the trees in between, as ``(lower, upper, size)``."""
+        options = self.class_manager._tree_options
+        allocator = options.tree_id_allocator
+
+        entries = forest.roots
+        end = entries.index(_END)
+        moved = [key for key in entries
+                 if not isinstance(key, (_Gap, _Ghost)) and key is not _END and
+                 key not in forest.in_place]
+        tree_ids, root_orders, shifts = {}, {}, []
+
+        if options.root_order_field is not None:
+            # Tree ids do not move; the trees put among the others are given
+            # new ones, and root orders between those of their neighbours.
+            if moved:
+                tree_ids.update(zip(moved, allocator.next_tree_ids(
+                    connection, session_index, len(moved))))
+            for key in forest.in_place:
+                tree_ids[key] = forest.old[key]['tree_id']
+            self._order_roots(connection, session_index, forest, root_orders)
+
+        else:
+            # Walk the root nodes, the tree ids after each place being moved by
+            # as many trees as were put in, less those taken out, before it.
+            moved = set(moved)
+            delta = last = 0
+            for idx, entry in enumerate(entries[:end]):
+                if isinstance(entry, _Gap):
+                    if entry.upper is None or entry.upper - entry.lower > 1:
+                        if delta:
+                            shifts.append((entry.lower, entry.upper, delta))
+                        if entry.upper is not None:
+                            last = entry.upper - 1 + delta
+                elif isinstance(entry, _Ghost):
+                    if (entry.deleted and not options.close_gaps and
+                            entries[idx + 1] not in moved):
+                        last = entry.tree_id + delta
+                    else:
+                        delta -= 1
+                elif entry in forest.in_place:
+                    last = forest.old[entry]['tree_id'] + delta
+                    tree_ids[entry] = last
+                else:
+                    last = tree_ids[entry] = last + 1
+                    delta += 1
+            # The trees put after the last one are numbered on from it, as the
+            # allocator could not tell the tree ids given above yet.
+            appended = entries[end + 1:]
+            max_tree_id = entries[end - 1].lower
+            if appended:
+                max_tree_id = connection.execute(sqlalchemy.select([
+                    sqlalchemy.func.max(options.tree_id_field)])).scalar() or 0
+                if max_tree_id > entries[end - 1].lower:
+                    last = max_tree_id + delta
+                for key in appended:
+                    last = tree_ids[key] = last + 1
+                delta = last - max_tree_id
+            if delta > 0:
+                allocator.shifted(connection, delta)
+
+        step = (options.spacing or 0) + 1
+        values = {}
+        for root in (key for key in entries if key in tree_ids):
+            position, stack = 1, [(root, False)]
+            while stack:
+                key, leaving = stack.pop()
+                if leaving:
+                    values[key]['right'] = position
+                    position += step
+                    continue
+                parent = forest.parent[key]
+                values[key] = {
+                    'parent_id': parent,
+                    'tree_id': tree_ids[root],
+                    'left': position,
+                    'depth': 0 if parent is None else
+                    values[parent]['depth'] + 1,
+                }
+                if key in root_orders:
+                    values[key]['root_order'] = root_orders[key]
+                position += step
+                stack.append((key, True))
+                stack.extend((child, False)
+                             for child in reversed(forest.children[key]))
+        return values, shifts
+
+    def _order_roots(self, connection, session_index, forest, root_orders):
+        """Gives the root nodes of ``forest`` which were moved or are new root
+        orders between those of their neighbours, in ``root_orders``. Each run
+        of them is placed right of the root node (or the place left by a root
+        node) before it, or left of the one after it."""
+        options = self.class_manager._tree_options
+        mapper_extension = self.class_manager.mapper_extension
+        class_manager = self.class_manager
+        field = options.root_order_field
+
+        def _is_anchor(entry):
+            return isinstance(entry, _Ghost) or entry in forest.in_place
+
+        def _order(entry):
+            # Making room may have moved it, so it is read afresh.
+            pk = entry.key if isinstance(entry, _Ghost) else entry
+            return connection.execute(
+                sqlalchemy.select([field])
+                .where(options.pk_field == pk)).scalar()
+
+        entries, idx = forest.roots, 0
+        while idx < len(entries):
+            if _is_anchor(entries[idx]) or entries[idx] is _END:
+                idx += 1
+                continue
+            start = idx
+            while (idx < len(entries) and entries[idx] is not _END and
+                   not _is_anchor(entries[idx])):
+                idx += 1
+            run = entries[start:idx]
+            if start and _is_anchor(entries[start - 1]):
+                order = _order(entries[start - 1])
+                position = class_manager.POSITION_RIGHT
+            elif idx < len(entries) and _is_anchor(entries[idx]):
+                order = _order(entries[idx])
+                position = class_manager.POSITION_LEFT
+            else:
+                order = position = None
+            root_orders.update(zip(run, mapper_extension._get_root_orders_at(
+                connection, session_index, order, position, len(run))))
+
+    def _write(self, connection, session_index, forest, values, shifts,
+               deleted):
+        """Writes the ``values`` of the tree fields of ``forest`` which changed
+        and shifts the tree ids of the trees in between by ``shifts``; inserts
+        the new nodes and deletes the ``deleted`` ones. Returns the rows of
+        the new nodes, by instance state, and the primary keys of the rows
+        which changed."""
+        options = self.class_manager._tree_options
+        pk_name = options.pk_field.name
+        tree_id_field = options.tree_id_field
+
+        if shifts:
+            cases = []
+            for lower, upper, size in shifts:
+                condition = tree_id_field > lower
+                if upper is not None:
+                    condition &= tree_id_field < upper
+                cases.append((condition, tree_id_field + size))
+            connection.execute(
+                options.table.update()
+                .values({tree_id_field: sqlalchemy.case(
+                    cases, else_=tree_id_field)})
+                .where(sqlalchemy.or_(*[case[0] for case in cases])))
+
+        # New nodes are inserted in preorder, so the primary key of their
+        # parent is known by then; the paths of all nodes follow from them.
+        mapper = sqlalchemy.orm.class_mapper(options.node_class)
+        properties = [prop for prop in mapper.iterate_properties
+                      if isinstance(prop, sqlalchemy.orm.ColumnProperty) and
+                      prop.columns[0].table is options.table]
+        pks, inserted, queued = {}, {}, []
+
+        def _insert_queued():
+            groups = {}
+            for row in queued:
+                groups.setdefault(frozenset(row), []).append(row)
+            for group in groups.values():
+                connection.execute(options.table.insert(), group)
+            del queued[:]
+
+        entries = [key for key in forest.roots if key in values]
+        for root in entries:
+            for key in forest.iter_preorder(root):
+                obj_values = values[key]
+                parent = obj_values['parent_id']
+                if parent is not None:
+                    obj_values['parent_id'] = pks.get(parent, parent)
+                if options.path_field is not None:
+                    obj_values['path'] = '' if parent is None else \
+                        values[parent]['path'] + options.path_segment(
+                            obj_values['parent_id'])
+                if key in forest.old:
+                    continue
+                state_dict = key.dict
+                row = dict((prop.columns[0].key, state_dict[prop.key])
+                           for prop in properties
+                           if state_dict.get(prop.key) is not None)
+                for name, value in obj_values.items():
+                    row[getattr(options, '%s_field' % name).name] = value
+                if options.root_order_field is not None:
+                    row.setdefault(options.root_order_field.name, 0)
+                if pk_name in row:
+                    queued.append(row)
+                else:
+                    _insert_queued()
+                    row[pk_name] = connection.execute(
+                        options.table.insert(), row).inserted_primary_key[0]
+                pks[key] = row[pk_name]
+                inserted[key] = row
+        _insert_queued()
+
+        names = [name for name in ('parent_id', 'tree_id', 'left', 'right',
+                                   'depth', 'path')
+                 if name in session_index.field_names]
+        groups, changed = {}, []
+        for pk, old in forest.old.items():
+            new = values.get(pk)
+            if new is None or all(
+                    new.get(name) == old.get(name) for name in
+                    names + ['root_order'] * ('root_order' in new)):
+                continue
+            changed.append(pk)
+            params = dict(('_%s' % name, new[name]) for name in names)
+            params['_pk'] = pk
+            if 'root_order' in new:
+                params['_root_order'] = new['root_order']
+            groups.setdefault('root_order' in new, []).append(params)
+        for with_root_order, params in groups.items():
+            columns = names + ['root_order'] * with_root_order
+            connection.execute(
+                options.table.update()
+                .where(options.pk_field == sqlalchemy.bindparam('_pk'))
+                .values(dict((getattr(options, '%s_field' % name),
+                              sqlalchemy.bindparam('_%s' % name))
+                             for name in columns)), params)
+
+        closure = options.closure_table
+        if deleted:
+            for idx in range(0, len(deleted), RELOAD_CHUNK_SIZE):
+                chunk = deleted[idx:idx + RELOAD_CHUNK_SIZE]
+                if closure is not None:
+                    connection.execute(closure.delete().where(
+                        closure.c.descendant_id.in_(chunk) |
+                        closure.c.ancestor_id.in_(chunk)))
+                connection.execute(options.table.delete().where(
+                    options.pk_field.in_(chunk)))
+        if closure is not None:
+            tree_ids = sorted(set(values[key]['tree_id'] for key in entries))
+            for idx in range(0, len(tree_ids), RELOAD_CHUNK_SIZE):
+                self.class_manager._rebuild_closure(
+                    connection,
+                    tree_ids=tree_ids[idx:idx + RELOAD_CHUNK_SIZE])
+        return inserted, changed
+
+    def _sync(self, session_index, forest, values, shifts, ops, inserted,
+              changed, deleted):
+        """Brings the nodes held by the session in step with what was written:
+        sets the tree fields of the ``changed`` rows and of the nodes moved,
+        makes the new nodes persistent (from their ``inserted`` rows),
+        expunges the deleted ones and expires the relationships of the nodes
+        whose parent changed."""
+        options = self.class_manager._tree_options
+        session = self.session
+        mapper = sqlalchemy.orm.class_mapper(options.node_class)
+        set_committed_value = sqlalchemy.orm.attributes.set_committed_value
+
+        # Compute every shifted tree id first, as the trees may move onto the
+        # old tree ids of one another.
+        shifted = []
+        for lower, upper, size in shifts:
+            for tree_id in session_index.tree_ids(
+                    lower + 1, None if upper is None else upper - 1):
+                shifted.extend((obj, tree_id + size)
+                               for obj in session_index.tree(tree_id))
+        for obj, tree_id in shifted:
+            session_index.set_values(obj, tree_id=tree_id)
+
+        names = [name for name in ('parent_id', 'tree_id', 'left', 'right',
+                                   'depth', 'path')
+                 if name in session_index.field_names]
+        # insert() set the tree id of the nodes moved, even back in place.
+        pks = set(changed).union(
+            op[1] for op in ops if op[1] in forest.old and op[1] in values)
+        session_index.patch_rows(names, [
+            [pk] + [values[pk][name] for name in names] for pk in pks])
+        session_index.patch_rows(['root_order'], [
+            (pk, values[pk]['root_order'])
+            for pk in forest.old if 'root_order' in values.get(pk, ())])
+
+        relationships = [
+            prop.key for prop in mapper.iterate_properties
+            if isinstance(prop, sqlalchemy.orm.RelationshipProperty) and
+            prop.mapper is mapper and
+            prop.direction is sqlalchemy.orm.interfaces.ONETOMANY]
+        identity_map = session.identity_map
+
+        def _get(pk):
+            if pk is None:
+                return None
+            return identity_map.get(mapper.identity_key_from_primary_key([pk]))
+
+        for pk, old in forest.old.items():
+            new = values.get(pk)
+            if new is not None and new['parent_id'] == old['parent_id']:
+                continue
+            for obj_pk in (old['parent_id'], None if new is None else
+                           new['parent_id']):
+                obj = _get(obj_pk)
+                if obj is not None:
+                    session.expire(obj, relationships)
+            obj = _get(pk)
+            if obj is not None and new is not None:
+                session.expire(obj, [options.parent_field_name])
+        for node, key, target, position in ops:
+            if hasattr(node, options.delayed_op_attr):
+                delattr(node, options.delayed_op_attr)
+            if key in forest.old:
+                session.expire(node, [options.parent_field_name])
+                # Nodes still in the flush would otherwise be refreshed one at
+                # a time just to read it:
+                if options.pk_field.name not in \
+                        sqlalchemy.orm.attributes.instance_state(node).dict:
+                    set_committed_value(node, options.pk_field.name, key)
+
+        properties = [prop for prop in mapper.iterate_properties
+                      if isinstance(prop, sqlalchemy.orm.ColumnProperty) and
+                      prop.columns[0].table is options.table]
+        for state, row in inserted.items():
+            obj = state.obj()
+            session.expunge(obj)
+            for prop in properties:
+                if prop.columns[0].key in row:
+                    set_committed_value(obj, prop.key, row[prop.columns[0].key])
+            sqlalchemy.orm.make_transient_to_detached(obj)
+            session.add(obj)
+            session.expire(obj, [options.parent_field_name])
+            parent = _get(row[options.parent_id_field.name])
+            if parent is not None:
+                session.expire(parent, relationships)
+
+        for node in deleted:
+            session_index.discard(node)
+            session.expunge(node)
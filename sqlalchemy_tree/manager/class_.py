@@ -12,12 +12,16 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement, unicode_literals
 
+from array import array
+from bisect import bisect_left
 from functools import reduce
+from multiprocessing.pool import ThreadPool
 
 # SQLAlchemy object-relational mapper and SQL expression language
 import sqlalchemy
 
-from .._compat import py2map as map
+from .._compat import integer_typecode, py2map as map
+from ..batch import TreeBatch
 
 
 class TreeClassManager(object):
@@ -61,6 +65,15 @@ class TreeClassManager(object):
             sqlalchemy.event.listen(sqlalchemy.orm.session.Session,
                                     'before_flush',
                                     self.session_extension.before_flush)
+            sqlalchemy.event.listen(sqlalchemy.orm.session.Session,
+                                    'after_attach',
+                                    self.session_extension.after_attach)
+            sqlalchemy.event.listen(self.node_class,
+                                    'load',
+                                    self.session_extension.load)
+            sqlalchemy.event.listen(self.node_class,
+                                    'refresh',
+                                    self.session_extension.refresh)
             sqlalchemy.event.listen(self.node_class,
                                     'before_insert',
                                     self.mapper_extension.before_insert)
@@ -108,6 +121,18 @@ class TreeClassManager(object):
     def depth_field(self):
         return self._tree_options.depth_field
 
+    @property
+    def root_order_field(self):
+        return self._tree_options.root_order_field
+
+    @property
+    def root_sort_field(self):
+        """The field root nodes are ordered by: the root order field if it is
+        kept, or else the tree id field."""
+        if self._tree_options.root_order_field is not None:
+            return self._tree_options.root_order_field
+        return self._tree_options.tree_id_field
+
     def filter_root_nodes(self):
         "Get a filter condition for all root nodes."
         # We avoid using the adjacency-list parent field because that column may
@@ -173,16 +198,33 @@ class TreeClassManager(object):
                       .filter(self.filter_root_node_of_node(*args, **kwargs))
 
     def filter_ancestors_of_node(self, *args, **kwargs):
-        "Returns a filter condition for the ancestors of passed-in nodes."
+        """Returns a filter condition for the ancestors of passed-in nodes.
+        With ``by_closure=True``, ancestors are found through the closure
+        table (which must be kept) instead."""
         options = self._tree_options
         # Include self in results
         include_self = kwargs.pop('include_self', False)
         # Logical-AND vs. -OR for reduction
         disjoint = kwargs.pop('disjoint',     True)
+        # Join through the closure table
+        by_closure = kwargs.pop('by_closure',   False)
         for extra in kwargs:
             raise TypeError(u"unexpected keyword argument '%s'" % extra)
+        self._check_closure(by_closure)
 
         def _filter_ancestors_of_node_helper(node):
+            if by_closure:
+                return self._filter_closure(
+                    'ancestor_id', 'descendant_id', node, include_self)
+
+            if options.path_field is not None:
+                # The path of the node lists its ancestors, so there is no need
+                # for a self-join:
+                pks = options.path_pks(getattr(node, options.path_field.name))
+                if include_self:
+                    pks.append(getattr(node, self.pk_field.name))
+                return self.pk_field.in_(pks)
+
             # Restrict ourselves to just those nodes within the same tree as
             # node:
             tree_id = getattr(node, self.tree_id_field.name)
@@ -299,10 +341,10 @@ class TreeClassManager(object):
             filter_ = self.parent_id_field == parent_id
 
             if parent_id is None:
-                # Restrict to the specified root node and those with lower
-                # `tree_id` values:
-                filter_ &= self.tree_id_field <= getattr(
-                    node, self.tree_id_field.name)
+                # Restrict to the specified root node and those ordered before
+                # it (by `tree_id`, unless root orders are kept):
+                filter_ &= self.root_sort_field <= getattr(
+                    node, self.root_sort_field.name)
             else:
                 # Restrict to the specified child node and those with lower
                 # `left` values:
@@ -353,10 +395,10 @@ class TreeClassManager(object):
             filter_ = self.parent_id_field == parent_id
 
             if parent_id is None:
-                # Restrict to the specified root node and those with higher
-                # `tree_id` values:
-                filter_ &= self.tree_id_field >= getattr(
-                    node, self.tree_id_field.name)
+                # Restrict to the specified root node and those ordered after
+                # it (by `tree_id`, unless root orders are kept):
+                filter_ &= self.root_sort_field >= getattr(
+                    node, self.root_sort_field.name)
             else:
                 # Restrict to the specified child node and those with higher
                 # `left` values:
@@ -425,30 +467,59 @@ class TreeClassManager(object):
                       .filter(self.filter_children_of_node(*args, **kwargs))
 
     def filter_descendants_of_node(self, *args, **kwargs):
-        "Returns a filter condition for the descendants of passed-in nodes."
+        """Returns a filter condition for the descendants of passed-in nodes.
+        With ``by_path=True``, descendants are found by a prefix match of the
+        path field (which must be kept) instead, which may be cheaper on
+        backends scanning the path index better than the tree index, and with
+        ``by_closure=True`` through the closure table (which must be kept)."""
+        options = self._tree_options
         # Include self in results
         include_self = kwargs.pop('include_self', False)
         # Logical-AND vs. -OR for reduction
         disjoint = kwargs.pop('disjoint',     True)
+        # Prefix match of the path field
+        by_path = kwargs.pop('by_path',      False)
+        # Join through the closure table
+        by_closure = kwargs.pop('by_closure',   False)
         for extra in kwargs:
             raise TypeError(u"unexpected keyword argument '%s'" % extra)
+        if by_path and options.path_field is None:
+            raise ValueError(u"descendants can only be found by path if the "
+                             u"path field is kept")
+        self._check_closure(by_closure)
+
+        def _filter_descendants_by_path_helper(node):
+            pk = getattr(node, self.pk_field.name)
+            # The paths starting with the prefix are those between it and the
+            # prefix with its final separator replaced by the next character, a
+            # range any backend can scan the path index for, unlike ``LIKE``:
+            prefix = getattr(node, options.path_field.name) + \
+                options.path_segment(pk)
+            filter_ = (options.path_field >= prefix) & \
+                (options.path_field < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+            if include_self:
+                filter_ |= self.pk_field == pk
+            return filter_
 
         def _filter_descendants_of_node_helper(node):
+            if by_path:
+                return _filter_descendants_by_path_helper(node)
+            if by_closure:
+                return self._filter_closure(
+                    'descendant_id', 'ancestor_id', node, include_self)
             tree_id = getattr(node, self.tree_id_field.name)
             left = getattr(node, self.left_field.name)
-            right = getattr(node, self.right_field.name) - 1
-
-            # If the caller requests the specified node to be included, this is most
-            # easily accomplished by not incrementing left by one, so that the node
-            # is now included in the resulting interval:
-            left = include_self and left or left + 1
+            right = getattr(node, self.right_field.name)
 
             # Restrict ourselves to just those nodes within the same tree:
             filter_ = self.tree_id_field == tree_id
 
             # Any node which has a left value between this node's left and right
-            # values must be a descendant of this node:
-            filter_ &= sqlalchemy.between(self.left_field, left, right)
+            # values must be a descendant of this node. If the caller requests the
+            # specified node to be included, its own left value is accepted too.
+            # (The bounds are compared strictly, rather than adjusted by one, so
+            # that this holds for sparse and rational numbering as well.)
+            filter_ &= self._filter_left_between(left, right, include_self)
 
             # We're done!
             return filter_
@@ -472,9 +543,66 @@ class TreeClassManager(object):
                       .filter(self.filter_descendants_of_node(*args, **kwargs))\
                       .order_by(self)
 
+    def _check_closure(self, by_closure):
+        if by_closure and self._tree_options.closure_table is None:
+            raise ValueError(u"the closure table can only be joined through "
+                             u"if it is kept")
+
+    def _filter_closure(self, column, other_column, node, include_self):
+        """Creates the condition for a node to be listed in the ``column`` of
+        the closure table where ``other_column`` is ``node``, at a distance of
+        at least one unless ``include_self`` is set."""
+        closure = self._tree_options.closure_table
+        filter_ = closure.c[other_column] == getattr(node, self.pk_field.name)
+        if not include_self:
+            filter_ &= closure.c.distance > 0
+        return self.pk_field.in_(
+            sqlalchemy.select([closure.c[column]]).where(filter_))
+
+    @property
+    def closure_table(self):
+        """The closure table, listing every ``(ancestor_id, descendant_id,
+        distance)`` of the trees (each node being its own ancestor at distance
+        zero), or ``None`` if it is not kept. Joining through it gives every
+        node along with all its descendants, so that reports aggregating over
+        whole subtrees join on primary keys alone::
+
+          closure = Category.tree.closure_table
+          session.query(Category, sqlalchemy.func.sum(Order.amount)) \\
+                 .join(closure, closure.c.ancestor_id == Category.id) \\
+                 .join(Order, Order.category_id == closure.c.descendant_id) \\
+                 .group_by(Category.id)
+        """
+        return self._tree_options.closure_table
+
+    def _filter_left_between(self, left, right, include_left=False):
+        """Creates the condition for a node's ``left`` value to lie strictly
+        between ``left`` and ``right``, or to equal ``left`` if
+        ``include_left`` is set."""
+        if include_left:
+            filter_ = self.left_field >= left
+        else:
+            filter_ = self.left_field > left
+        return filter_ & (self.left_field < right)
+
     def filter_leaf_nodes(self):
         "Creates a filter condition containing all leaf nodes."
-        return self.left_field == (self.right_field - 1)
+        return self._filter_leaf_condition()
+
+    def _filter_leaf_condition(self):
+        """Creates the condition for a node to be a leaf node: with dense
+        numbering, that its ``left`` and ``right`` values are consecutive, and
+        with sparse (spaced or rational) numbering, that no node lies within its
+        interval."""
+        if not self._tree_options.sparse:
+            return self.left_field == (self.right_field - 1)
+        inner = self._tree_options.table.alias()
+        inner_left = inner.corresponding_column(self.left_field)
+        return ~sqlalchemy.exists().where(
+            (inner.corresponding_column(self.tree_id_field) ==
+             self.tree_id_field) &
+            (inner_left > self.left_field) &
+            (inner_left < self.right_field))
 
     def query_leaf_nodes(self, session=None, *args, **kwargs):
         "Returns a query containing all leaf nodes."
@@ -523,23 +651,18 @@ class TreeClassManager(object):
         def _filter_leaf_nodes_of_node_helper(node):
             tree_id = getattr(node, self.tree_id_field.name)
             left = getattr(node, self.left_field.name)
-            right = getattr(node, self.right_field.name) - 1
-
-            # If the caller requests the specified node to be included, this is most
-            # easily accomplished by not incrementing left by one, so that the node
-            # is now included in the resulting interval:
-            left = include_self and left or left + 1
+            right = getattr(node, self.right_field.name)
 
             # Restrict ourselves to just those nodes within the same tree:
             filter_ = self.tree_id_field == tree_id
 
             # Restrict ourselves to leaf nodes...
-            filter_ &= self.left_field == (self.right_field - 1)
+            filter_ &= self._filter_leaf_condition()
 
             # ...which are descendants of this node (any node which has a left value
             # between this node's left and right values must be a descendant of this
-            # node):
-            filter_ &= sqlalchemy.between(self.left_field, left, right)
+            # node), or the node itself if the caller requests it:
+            filter_ &= self._filter_left_between(left, right, include_self)
 
             # We're done!
             return filter_
@@ -598,20 +721,30 @@ class TreeClassManager(object):
         "Return `True` if any of the positional arguments are leaf nodes."
         return reduce(
             lambda l, r: l or r,
-            map(
-                lambda node: getattr(node, self.left_field.name) ==
-                getattr(node, self.right_field.name) - 1,
-                args))
+            map(self._is_leaf_node, args))
 
     def all_leaf_nodes(self, *args):
         """Return `False` unless every one of the positional arguments is a leaf
         node."""
         return reduce(
             lambda l, r: l and r,
-            map(
-                lambda node: getattr(node, self.left_field.name) ==
-                getattr(node, self.right_field.name) - 1,
-                args))
+            map(self._is_leaf_node, args))
+
+    def _is_leaf_node(self, node):
+        """Returns whether ``node`` is a leaf node. With sparse (spaced or
+        rational) numbering, this takes a query for any node within its
+        interval."""
+        left = getattr(node, self.left_field.name)
+        right = getattr(node, self.right_field.name)
+        if not self._tree_options.sparse:
+            return left == right - 1
+        if getattr(node, self.pk_field.name) is None:
+            # The node hasn't been saved yet:
+            return True
+        session = sqlalchemy.orm.object_session(node)
+        return not session.query(sqlalchemy.exists().where(
+            (self.tree_id_field == getattr(node, self.tree_id_field.name)) &
+            self._filter_left_between(left, right))).scalar()
 
     def any_ancestors_of(self, descendant, *args, **kwargs):
         """Return `True` if the first positional argument is a descendant of any
@@ -639,14 +772,20 @@ class TreeClassManager(object):
         left = getattr(descendant, self.left_field.name)
         right = getattr(descendant, self.right_field.name)
 
+        # Compare the bounds inclusively rather than adjusting them by one, so
+        # that this holds for sparse and rational numbering as well:
         if include_self:
-            left, right = left + 1, right - 1
-
-        results = map(
-            lambda node: getattr(node, self.tree_id_field.name) == tree_id and
-            getattr(node, self.left_field.name) < left and
-            getattr(node, self.right_field.name) > right,
-            args)
+            results = map(
+                lambda node: getattr(node, self.tree_id_field.name) == tree_id and
+                getattr(node, self.left_field.name) <= left and
+                getattr(node, self.right_field.name) >= right,
+                args)
+        else:
+            results = map(
+                lambda node: getattr(node, self.tree_id_field.name) == tree_id and
+                getattr(node, self.left_field.name) < left and
+                getattr(node, self.right_field.name) > right,
+                args)
 
         if disjoint:
             return reduce(lambda l, r: l or r, results)
@@ -740,13 +879,17 @@ class TreeClassManager(object):
         right = getattr(ancestor, self.right_field.name)
 
         if include_self:
-            left = left - 1
-
-        results = map(
-            lambda node: getattr(node, self.tree_id_field.name) == tree_id and
-            getattr(node, self.left_field.name) > left and
-            getattr(node, self.left_field.name) < right,
-            args)
+            results = map(
+                lambda node: getattr(node, self.tree_id_field.name) == tree_id and
+                getattr(node, self.left_field.name) >= left and
+                getattr(node, self.left_field.name) < right,
+                args)
+        else:
+            results = map(
+                lambda node: getattr(node, self.tree_id_field.name) == tree_id and
+                getattr(node, self.left_field.name) > left and
+                getattr(node, self.left_field.name) < right,
+                args)
 
         if disjoint:
             return reduce(lambda l, r: l or r, results)
@@ -770,6 +913,446 @@ class TreeClassManager(object):
 
         setattr(node, options.tree_id_field.name, 0)
 
+        if session is None:
+            for obj in (node, target):
+                if obj is not None:
+                    session = sqlalchemy.orm.object_session(obj)
+                    if session is not None:
+                        break
+        if session is not None:
+            batch = self.session_extension.session_index(session).batch
+            if batch is not None:
+                batch.record(node, target, position)
+
+    def batch(self, session):
+        """Returns a context manager collecting the inserts, moves and deletes of
+        nodes made through ``session`` while it is open, to apply them all
+        together when it closes::
+
+          with Node.tree.batch(session):
+              Node.tree.insert(node, target, Node.tree.POSITION_LEFT)
+              session.delete(other)
+
+        Nothing is written to the database until then (autoflush is turned
+        off within the block). The trees the changes touch are then read with
+        two queries, the changes applied to them in memory, in the order they
+        were made, and only the rows whose tree fields end up different
+        written back, with one executemany ``UPDATE``. See
+        :class:`~sqlalchemy_tree.batch.TreeBatch`.
+
+        :param session:
+          the session the changes are made through.
+        """
+        return TreeBatch(self, session)
+
+    def insert_subtree(
+            self, node, target=None, position=POSITION_LAST_CHILD,
+            session=None):
+        """Inserts the transient ``node``, along with every transient descendant
+        reachable from it through its relationships (such as a hierarchy built
+        by setting the ``parent`` relationship of each node), at ``position``
+        relative to ``target``, exactly as :meth:`insert` would for a single
+        node. Children keep the order of their parent's collection.
+
+        Rather than having each node go through the flush on its own, the tree
+        fields of the whole subtree are computed with one preorder walk, a
+        single gap is made for it in the target tree, and the rows are written
+        with one executemany ``INSERT``. Primary keys generated by the database
+        are read back with one more query, and the adjacency-list links they
+        complete written with one executemany ``UPDATE``. When this returns, the
+        nodes are persistent instances of ``session``.
+
+        :param session:
+          the session to insert into, which defaults to the session ``target``
+          or ``node`` is attached to.
+        """
+        options = self._tree_options
+        mapper_extension = self.mapper_extension
+
+        if session is None:
+            for obj in (target, node):
+                if obj is not None:
+                    session = sqlalchemy.orm.object_session(obj)
+                    if session is not None:
+                        break
+            if session is None:
+                raise ValueError(
+                    u"must specify session as keyword argument if neither "
+                    u"node nor target is bound to one")
+
+        nodes, parents = self._get_transient_subtree(node)
+        for obj in nodes:
+            if obj in session:
+                session.expunge(obj)
+            if hasattr(obj, options.delayed_op_attr):
+                delattr(obj, options.delayed_op_attr)
+
+        # Number the nodes as a tree of their own. In preorder, every parent
+        # comes before its children, and siblings come in order.
+        sizes = [1] * len(nodes)
+        for idx in range(len(nodes) - 1, 0, -1):
+            sizes[parents[idx]] += sizes[idx]
+        lefts, depths, next_lefts = [1], [0], [2]
+        for idx in range(1, len(nodes)):
+            parent = parents[idx]
+            lefts.append(next_lefts[parent])
+            depths.append(depths[parent] + 1)
+            next_lefts[parent] += 2 * sizes[idx]
+            next_lefts.append(lefts[idx] + 1)
+        rights = [left + 2 * size - 1 for left, size in zip(lefts, sizes)]
+
+        mapper = sqlalchemy.orm.object_mapper(node)
+        connection = session.connection(mapper=mapper)
+        session_index = self.session_extension.session_index(session)
+        session_index.reset()
+
+        left_right_change = depth_change = 0
+        # Only the root node of a new tree is given a root order:
+        root_order = 0
+        if target is None:
+            parent_id = None
+            tree_id = mapper_extension._get_next_tree_id(
+                connection, session_index)
+            if options.root_order_field is not None:
+                [root_order] = mapper_extension._get_root_orders(
+                    connection, session_index, None, None, 1)
+
+        else:
+            mapper_extension._reload_tree_parameters(
+                connection, session_index, target)
+
+            if (getattr(target, options.left_field.name) == 1 and
+                    position in [self.POSITION_LEFT, self.POSITION_RIGHT]):
+                parent_id = None
+                if options.root_order_field is not None:
+                    tree_id = mapper_extension._get_next_tree_id(
+                        connection, session_index)
+                    [root_order] = mapper_extension._get_root_orders(
+                        connection, session_index, target, position, 1)
+                else:
+                    tree_id = getattr(target, options.tree_id_field.name)
+                    if position == self.POSITION_RIGHT:
+                        tree_id += 1
+                    mapper_extension._manage_tree_gap(
+                        connection, session_index, tree_id - 1, 1)
+
+            elif options.encoding == 'rational':
+                # Map the numbering of the subtree onto values found between
+                # those of its new neighbours.
+                tree_id, parent_id, depth_change, positions = mapper_extension \
+                    ._make_rational_room(
+                        connection, session_index, target, position,
+                        len(nodes))
+                lefts = [positions[left - 1] for left in lefts]
+                rights = [positions[right - 1] for right in rights]
+
+            else:
+                set_committed_value = \
+                    sqlalchemy.orm.attributes.set_committed_value
+                set_committed_value(node, options.left_field.name, 1)
+                set_committed_value(node, options.right_field.name, 2 * sizes[0])
+                set_committed_value(node, options.depth_field.name, 0)
+                gap_target, depth_change, left_right_change, parent_id, \
+                    right_shift = mapper_extension \
+                    ._calculate_inter_tree_move_values(node, target, position)
+                tree_id = getattr(target, options.tree_id_field.name)
+                mapper_extension._manage_position_gap(
+                    connection, session_index, tree_id, gap_target, right_shift)
+
+        values = [{
+            options.tree_id_field.name: tree_id,
+            options.left_field.name:    lefts[idx] + left_right_change,
+            options.right_field.name:   rights[idx] + left_right_change,
+            options.depth_field.name:   depths[idx] + depth_change,
+        } for idx in range(len(nodes))]
+        values[0][options.parent_id_field.name] = parent_id
+        if options.path_field is not None:
+            values[0][options.path_field.name] = mapper_extension._get_path(
+                target, position)
+        if options.root_order_field is not None:
+            for obj_values in values:
+                obj_values[options.root_order_field.name] = 0
+            values[0][options.root_order_field.name] = root_order
+
+        self._bulk_insert_nodes(
+            session, connection, mapper, nodes, parents, values)
+
+    def _get_transient_subtree(self, node):
+        """Returns the transient nodes of the subtree rooted at ``node`` in
+        preorder, found by cascading along the relationships of ``node``, along
+        with the position in that list of the parent of each (``None`` for
+        ``node`` itself)."""
+        options = self._tree_options
+
+        state = sqlalchemy.orm.attributes.instance_state(node)
+        candidates = [obj for obj, obj_mapper, obj_state, obj_dict in
+                      state.mapper.cascade_iterator(
+                          'save-update', state,
+                          halt_on=lambda obj_state: obj_state.key is not None)
+                      if isinstance(obj, self.node_class)]
+
+        # Keep the candidates whose chain of parents leads back to ``node``, as
+        # the cascade may also have reached unrelated pending nodes.
+        children = {id(node): []}
+        for obj in candidates:
+            chain = []
+            while id(obj) not in children:
+                chain.append(obj)
+                obj = getattr(obj, options.parent_field_name)
+                if obj is None or \
+                        sqlalchemy.orm.attributes.instance_state(obj).key:
+                    break
+            else:
+                for child in reversed(chain):
+                    children[id(obj)].append(child)
+                    children[id(child)] = []
+                    obj = child
+
+        nodes, parents = [], []
+        stack = [(node, None)]
+        while stack:
+            obj, parent = stack.pop()
+            parents.append(parent)
+            nodes.append(obj)
+            stack.extend((child, len(nodes) - 1)
+                         for child in reversed(children[id(obj)]))
+        return nodes, parents
+
+    def _bulk_insert_nodes(
+            self, session, connection, mapper, nodes, parents, values):
+        """Writes the rows of ``nodes`` (in preorder, with ``parents`` giving the
+        position of the parent of each) completed by the tree fields in
+        ``values`` (the path of the first node included, if paths are kept),
+        and makes the nodes persistent instances of ``session``."""
+        options = self._tree_options
+        pk_name = options.pk_field.name
+        parent_id_name = options.parent_id_field.name
+        path_name = options.path_field is not None and options.path_field.name
+
+        def set_path(idx):
+            parent = rows[parents[idx]]
+            rows[idx][path_name] = parent[path_name] + \
+                options.path_segment(parent[pk_name])
+
+        properties = [prop for prop in mapper.iterate_properties
+                      if isinstance(prop, sqlalchemy.orm.ColumnProperty) and
+                      prop.columns[0].table is options.table]
+        rows = []
+        for obj, obj_values in zip(nodes, values):
+            obj_dict = sqlalchemy.orm.attributes.instance_state(obj).dict
+            row = dict((prop.columns[0].key, obj_dict[prop.key])
+                       for prop in properties
+                       if obj_dict.get(prop.key) is not None)
+            row.update(obj_values)
+            rows.append(row)
+
+        # Nodes whose parent already has its primary key can be linked right
+        # away; the others are linked (and given their path) once the keys
+        # have been generated. Parents come first, so their paths are known.
+        unlinked, unknown_paths = [], set()
+        for idx in range(1, len(nodes)):
+            parent_pk = rows[parents[idx]].get(pk_name)
+            if parent_pk is None or parents[idx] in unknown_paths:
+                unlinked.append(idx)
+                if path_name:
+                    rows[idx][path_name] = ''
+                    unknown_paths.add(idx)
+            else:
+                rows[idx][parent_id_name] = parent_pk
+                if path_name:
+                    set_path(idx)
+
+        # An executemany needs every row to have the same columns, so the rows
+        # are grouped by the columns they set.
+        groups = {}
+        for row in rows:
+            groups.setdefault(frozenset(row), []).append(row)
+        for group in groups.values():
+            connection.execute(options.table.insert(), group)
+
+        if any(pk_name not in row for row in rows):
+            left_name = options.left_field.name
+            pks = dict(connection.execute(
+                sqlalchemy.select([options.left_field, options.pk_field])
+                .where((options.tree_id_field == rows[0][options.tree_id_field.name]) &
+                       (options.left_field >= rows[0][left_name]) &
+                       (options.left_field <= rows[0][options.right_field.name]))
+            ).fetchall())
+            for row in rows:
+                row[pk_name] = pks[row[left_name]]
+
+        if unlinked:
+            values = {options.parent_id_field:
+                      sqlalchemy.bindparam('_parent_id')}
+            if path_name:
+                values[options.path_field] = sqlalchemy.bindparam('_path')
+            params = []
+            for idx in unlinked:
+                rows[idx][parent_id_name] = rows[parents[idx]][pk_name]
+                params.append({'_pk': rows[idx][pk_name],
+                               '_parent_id': rows[idx][parent_id_name]})
+                if path_name:
+                    set_path(idx)
+                    params[-1]['_path'] = rows[idx][path_name]
+            connection.execute(
+                options.table.update()
+                .where(options.pk_field == sqlalchemy.bindparam('_pk'))
+                .values(values), params)
+
+        closure = options.closure_table
+        if closure is not None:
+            # Each node is linked to itself, and to the ancestors its parent is
+            # linked to, one further away.
+            parent_id = rows[0][parent_id_name]
+            parent_ancestors = []
+            if parent_id is not None:
+                parent_ancestors = connection.execute(
+                    sqlalchemy.select([closure.c.ancestor_id,
+                                       closure.c.distance])
+                    .where(closure.c.descendant_id == parent_id)).fetchall()
+            ancestors = [[(rows[0][pk_name], 0)] + [
+                (ancestor_id, distance + 1)
+                for ancestor_id, distance in parent_ancestors]]
+            for idx in range(1, len(nodes)):
+                ancestors.append([(rows[idx][pk_name], 0)] + [
+                    (ancestor_id, distance + 1)
+                    for ancestor_id, distance in ancestors[parents[idx]]])
+            connection.execute(closure.insert(), [
+                {'ancestor_id': ancestor_id, 'descendant_id': row[pk_name],
+                 'distance': distance}
+                for row, row_ancestors in zip(rows, ancestors)
+                for ancestor_id, distance in row_ancestors])
+
+        set_committed_value = sqlalchemy.orm.attributes.set_committed_value
+        for obj, row in zip(nodes, rows):
+            for prop in properties:
+                if prop.columns[0].key in row:
+                    set_committed_value(obj, prop.key, row[prop.columns[0].key])
+            sqlalchemy.orm.make_transient_to_detached(obj)
+            session.add(obj)
+
+    def delete_subtree(self, node, session=None):
+        """Deletes the persistent ``node`` along with all of its descendants.
+
+        Deleting nodes through the session promotes the children of each to
+        take its place, and goes through the flush one node at a time. Here
+        the rows of the whole subtree are removed with one ``DELETE`` over its
+        interval instead, and the gap it leaves closed with one ``UPDATE`` (or
+        left free in sparse trees, as in :meth:`TreeMapperExtension.after_delete`).
+        If a closure table is kept, the rows of the subtree are removed from it
+        with one more ``DELETE``. Pending changes are flushed first, so that
+        nodes inserted into or moved into the subtree go with it. The nodes of
+        the subtree held by ``session`` are expunged from it, and the child
+        collections of the parent of ``node`` expired.
+
+        :param session:
+          the session ``node`` belongs to, which defaults to the session
+          ``node`` is attached to.
+        """
+        options = self._tree_options
+        mapper_extension = self.mapper_extension
+
+        if session is None:
+            session = sqlalchemy.orm.object_session(node)
+            if session is None:
+                raise ValueError(
+                    u"must specify session as keyword argument if node is "
+                    u"not bound to one")
+
+        # The statements below work on the rows, which have to reflect the
+        # inserts and moves made through the session so far:
+        session.flush()
+
+        mapper = sqlalchemy.orm.object_mapper(node)
+        connection = session.connection(mapper=mapper)
+        session_index = self.session_extension.session_index(session)
+        session_index.reset()
+        mapper_extension._reload_tree_parameters(
+            connection, session_index, node)
+
+        tree_id = getattr(node, options.tree_id_field.name)
+        left = getattr(node, options.left_field.name)
+        right = getattr(node, options.right_field.name)
+        within = ((options.tree_id_field == tree_id) &
+                  (options.left_field >= left) &
+                  (options.left_field <= right))
+
+        closure = options.closure_table
+        if closure is not None:
+            subtree = closure.alias()
+            connection.execute(closure.delete().where(
+                closure.c.descendant_id.in_(
+                    sqlalchemy.select([subtree.c.descendant_id])
+                    .where(subtree.c.ancestor_id ==
+                           getattr(node, options.pk_field.name)))))
+        connection.execute(options.table.delete().where(within))
+
+        if left == 1:
+            # A whole tree; unless root orders are kept or gaps left, the trees
+            # after it move up to take its tree id.
+            if options.root_order_field is None and options.close_gaps:
+                mapper_extension._manage_tree_gap(
+                    connection, session_index, tree_id, -1)
+        elif not options.sparse:
+            mapper_extension._manage_position_gap(
+                connection, session_index, tree_id, right, left - right - 1)
+
+        # The nodes of the subtree held by the session are gone. The parent of
+        # ``node`` is still there, but its children no longer are:
+        subtree = session_index.left_between(tree_id, left, right)
+        if node not in subtree:
+            subtree.append(node)
+        for obj in subtree:
+            session_index.discard(obj)
+            if obj in session:
+                session.expunge(obj)
+        parent = sqlalchemy.orm.attributes.instance_state(node).dict.get(
+            options.parent_field_name)
+        if parent is not None and parent in session:
+            session.expire(parent, [
+                prop.key for prop in mapper.iterate_properties
+                if isinstance(prop, sqlalchemy.orm.RelationshipProperty) and
+                prop.mapper is mapper and
+                prop.direction is sqlalchemy.orm.interfaces.ONETOMANY])
+
+    def compact(self, session, *tree_ids):
+        """Renumbers the trees identified by ``tree_ids`` (every tree, if none is
+        given) without the positions left free in them by deletes (see
+        ``close_gaps`` of :class:`TreeManager`), keeping their values in
+        order: from 1 with no free position, or with :attr:`spacing` free
+        positions between neighbouring values if the tree is numbered with
+        spacing. Each tree is read with one query, and the rows whose values
+        change written with one executemany ``UPDATE``, so that the cost of
+        closing the gaps is paid once rather than on every delete.
+
+        :param session:
+          the session to compact the trees through, which is committed.
+        """
+        options = self._tree_options
+        mapper_extension = self.mapper_extension
+
+        connection = session.connection(
+            mapper=sqlalchemy.orm.class_mapper(self.node_class))
+        session_index = self.session_extension.session_index(session)
+        session_index.reset()
+        if not tree_ids:
+            tree_ids = [tree_id for tree_id, in connection.execute(
+                sqlalchemy.select([options.tree_id_field]).distinct())]
+
+        step = (options.spacing or 0) + 1
+        for tree_id in tree_ids:
+            rows, values = mapper_extension._get_tree_values(
+                connection, session_index, tree_id)
+            positions = dict((value, 1 + idx * step)
+                             for idx, value in enumerate(values))
+            rows = [row for row in rows
+                    if (positions[row[1]], positions[row[2]]) != tuple(row[1:3])]
+            mapper_extension._renumber_nodes(
+                connection, session_index, tree_id, None, None, rows,
+                positions)
+
+        session.commit()
+
     def _get_session_from_args_or_self(self, *args):
         # Try retrieving the session from one of our positional parameters:
         for node in args:
@@ -787,15 +1370,55 @@ class TreeClassManager(object):
         arguments. Specifying no positional arguments performs a complete rebuild
         of all trees.
 
-        :param order_by:
-          an “order by clause” for sorting children nodes of each subtree.
+        A subtree is rebuilt in place: its root node keeps the tree id, left
+        value and depth stored for it, and only the rows of the subtree are
+        written. If the subtree turns out to span a different number of
+        positions than it is stored with, :exc:`ValueError` is raised before
+        any of its rows are written, unless ``allow_resize`` is set, in which
+        case the rest of its tree is shifted with one more statement. The nodes
+        passed must not be descendants of one another. With rational encoding,
+        the whole trees of the nodes passed are rebuilt instead, with whole
+        numbers.
+
+        The trees are walked depth-first over an explicit stack, so that there
+        is no limit on their depth. The children of up to ``batch_size`` nodes
+        about to be visited are fetched with one query, and the new tree
+        parameters written with executemany ``UPDATE`` statements of
+        ``batch_size`` rows, so that memory use is bounded by the nodes waiting
+        on the stack rather than by the size of the trees.
 
-        TODO: Support order_by. What about the rest of sqlalchemy_tree. Is
-        any order_by used when inserting a new node?
+        :param order_by:
+          an “order by clause”, or a list of them, for sorting the root nodes
+          and the children of each node, which can be used to re-sort whole
+          trees in a single rebuild. Ties are broken by primary key, which is
+          also the default order. Nodes inserted afterwards are placed where
+          they are inserted, regardless of this order.
+        :param batch_size:
+          the number of nodes whose children are fetched, and of nodes updated,
+          per statement.
+        :param method:
+          ``'python'`` (the default) to rebuild as described above, or
+          ``'cte'`` to compute the tree parameters inside the database with a
+          recursive common table expression and window functions, so that no
+          rows are read back at all. The database must support both (SQLite
+          does from version 3.25).
+        :param parallel:
+          the number of threads to rebuild trees with, if more than one tree is
+          rebuilt with the ``'python'`` method. Each tree is then rebuilt over a
+          connection of its own from the pool of the engine the session is bound
+          to, and committed on its own, after the changes pending in the session
+          have been committed. Only complete rebuilds can be run in parallel.
+        :param allow_resize:
+          whether a rebuilt subtree may span a different number of positions
+          than it is stored with, shifting the rest of its tree.
         """
         options = self._tree_options
-        order_by = kwargs.pop('order_by', options.pk_field)
+        order_by = kwargs.pop('order_by', [])
         session = kwargs.pop('session',  None)
+        batch_size = kwargs.pop('batch_size', 500)
+        method = kwargs.pop('method', 'python')
+        parallel = kwargs.pop('parallel', None)
+        allow_resize = kwargs.pop('allow_resize', False)
 
         if kwargs:
             if len(kwargs) == 1:
@@ -803,6 +1426,15 @@ class TreeClassManager(object):
             else:
                 message = u"unexpected keyword arguments '%s'"
             raise TypeError(message % "', '".join(kwargs.keys()))
+        if not isinstance(order_by, (list, tuple)):
+            order_by = [order_by]
+        order_by = list(order_by) + [options.pk_field]
+        if method not in ('python', 'cte'):
+            raise ValueError(u"unknown rebuild method %r" % method)
+        if parallel and (method != 'python' or args):
+            raise ValueError(
+                u"only complete rebuilds with the 'python' method can be run "
+                u"in parallel")
 
         if session is None:
             for node in args:
@@ -814,41 +1446,556 @@ class TreeClassManager(object):
                     u"must specify session as keyword argument if no bound "
                     u"nodes are passed in as positional arguments")
 
+        connection = session.connection(
+            mapper=sqlalchemy.orm.class_mapper(self.node_class))
         if len(args):
-            root_node_ids = session.query(self.node_class) \
+            root_node_ids = session.query(options.pk_field) \
                 .filter(options.pk_field.in_(
                 [getattr(root, options.pk_field.name) for root in args]
             )) \
-                .order_by(order_by) \
+                .order_by(*order_by) \
                 .all()
+            if options.encoding == 'rational':
+                # The values between the bounds of a subtree can't in general
+                # be renumbered in place, so the whole trees of the nodes are
+                # rebuilt instead, which only ever writes their own rows.
+                # Nothing follows a root node, so they can always be resized.
+                tree_ids = [tree_id for tree_id, in session.query(
+                    options.tree_id_field).filter(options.pk_field.in_(
+                        [pk for pk, in root_node_ids]))]
+                root_node_ids = session.query(options.pk_field) \
+                    .filter((options.left_field == 1) &
+                            options.tree_id_field.in_(tree_ids)) \
+                    .order_by(options.tree_id_field) \
+                    .all()
+                allow_resize = True
+            session_index = self.session_extension.session_index(session)
+            session_index.reset()
+            for root_node_id in root_node_ids:
+                self._rebuild_subtree(
+                    connection, session_index, root_node_id[0], order_by,
+                    method, allow_resize, batch_size)
+        elif method == 'cte':
+            self._rebuild_with_cte(connection, order_by)
+            tree_count = connection.execute(
+                sqlalchemy.select([sqlalchemy.func.count()])
+                .where(options.parent_id_field == None)).scalar()
         else:
             root_node_ids = session.execute(
-                sqlalchemy.select([options.pk_field.name]).where(options.parent_id_field==None)
+                sqlalchemy.select([options.pk_field]).where(options.parent_id_field==None)
+                .order_by(*order_by)
             ).fetchall()
 
-        for idx, root_node_id in enumerate(root_node_ids):
-            self._do_rebuild_subtree(session, root_node_id[0], 1, idx+1)
+            trees = [(idx + 1, root_node_id[0])
+                     for idx, root_node_id in enumerate(root_node_ids)]
+            tree_count = len(trees)
+            if parallel:
+                self._rebuild_trees_in_parallel(
+                    session, trees, order_by, parallel, batch_size)
+            else:
+                self._rebuild_trees(connection, trees, order_by, batch_size)
+
+        # A parallel rebuild has committed the session already.
+        connection = session.connection(
+            mapper=sqlalchemy.orm.class_mapper(self.node_class))
+        pks = [None]
+        if len(args):
+            pks = [root_node_id[0] for root_node_id in root_node_ids]
+        else:
+            options.tree_id_allocator.renumbered(connection, tree_count)
+            self.mapper_extension._rebuild_root_orders(connection)
+        for pk in pks:
+            if options.path_field is not None:
+                self._rebuild_paths(connection, batch_size, pk)
+            if options.closure_table is not None:
+                self._rebuild_closure(connection, pk)
+
+        session.commit()
 
+    def rebuild_closure(self, session):
+        """Fills the closure table (see :attr:`closure_table`) anew from the
+        tree fields, with one ``INSERT ... SELECT`` joining the table with
+        itself, as is needed when the closure table is adopted on an existing
+        tree."""
+        if self._tree_options.closure_table is None:
+            raise ValueError(u"the closure table is not kept")
+        self._rebuild_closure(session.connection(
+            mapper=sqlalchemy.orm.class_mapper(self.node_class)))
         session.commit()
 
-    def _do_rebuild_subtree(self, session, pk, left, tree_id, depth=0):
+    def _rebuild_closure(self, connection, pk=None, tree_ids=None):
+        """Rewrites the rows of the closure table from the tree fields, for all
+        trees, only for the descendants of the node with primary key ``pk``
+        (whose own rows are kept), or only for the nodes of the trees
+        identified by ``tree_ids``."""
         options = self._tree_options
-        right = left + 1
+        closure = options.closure_table
+        ancestor, descendant = options.table.alias(), options.table.alias()
+
+        def field(alias, field):
+            return getattr(alias.c, field.name)
+        pairs = sqlalchemy.select([
+            field(ancestor, options.pk_field),
+            field(descendant, options.pk_field),
+            field(descendant, options.depth_field) -
+            field(ancestor, options.depth_field),
+        ]).where(
+            (field(ancestor, options.tree_id_field) ==
+             field(descendant, options.tree_id_field)) &
+            (field(descendant, options.left_field) >=
+             field(ancestor, options.left_field)) &
+            (field(descendant, options.left_field) <=
+             field(ancestor, options.right_field)))
+        if tree_ids is not None:
+            subtree = field(descendant, options.tree_id_field).in_(tree_ids)
+            pairs = pairs.where(subtree)
+            connection.execute(closure.delete().where(
+                closure.c.descendant_id.in_(
+                    sqlalchemy.select([field(descendant, options.pk_field)])
+                    .where(subtree))))
+        elif pk is None:
+            connection.execute(closure.delete())
+        else:
+            tree_id, left, right = connection.execute(
+                sqlalchemy.select([options.tree_id_field, options.left_field,
+                                   options.right_field])
+                .where(options.pk_field == pk)).fetchone()
+            subtree = (field(descendant, options.tree_id_field) == tree_id) & \
+                (field(descendant, options.left_field) > left) & \
+                (field(descendant, options.left_field) < right)
+            pairs = pairs.where(subtree)
+            connection.execute(closure.delete().where(
+                closure.c.descendant_id.in_(
+                    sqlalchemy.select([field(descendant, options.pk_field)])
+                    .where(subtree))))
+        connection.execute(closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'distance'], pairs))
+
+    def _rebuild_paths(self, connection, batch_size, pk=None):
+        """Rewrites the paths of the nodes which differ from those given by the
+        tree parameters, over all trees, or only under the node with primary
+        key ``pk`` (whose own path is kept). The nodes are streamed in preorder,
+        keeping their ancestors on a stack, and the paths written with
+        executemany ``UPDATE`` statements of ``batch_size`` rows."""
+        options = self._tree_options
+        query = sqlalchemy.select([
+            options.pk_field, options.tree_id_field, options.left_field,
+            options.right_field, options.path_field,
+        ]).order_by(options.tree_id_field, options.left_field)
+        if pk is not None:
+            tree_id, left, right = connection.execute(
+                sqlalchemy.select([options.tree_id_field, options.left_field,
+                                   options.right_field])
+                .where(options.pk_field == pk)).fetchone()
+            query = query.where(
+                (options.tree_id_field == tree_id) &
+                self._filter_left_between(left, right, True))
+        statement = options.table.update() \
+            .where(options.pk_field == sqlalchemy.bindparam('_pk')) \
+            .values({options.path_field: sqlalchemy.bindparam('_path')})
+
+        # Each frame holds the tree id and right value of an ancestor, and the
+        # path of its children.
+        stack, batch = [], []
+        result = connection.execution_options(stream_results=True) \
+            .execute(query)
+        for node_pk, tree_id, left, right, path in result:
+            while stack and (stack[-1][0] != tree_id or stack[-1][1] < left):
+                stack.pop()
+            if stack:
+                new_path = stack[-1][2]
+            elif node_pk == pk:
+                new_path = path
+            else:
+                new_path = ''
+            stack.append((tree_id, right, new_path +
+                          options.path_segment(node_pk)))
+            if new_path != path:
+                batch.append({'_pk': node_pk, '_path': new_path})
+                if len(batch) == batch_size:
+                    connection.execute(statement, batch)
+                    batch = []
+        result.close()
+        if batch:
+            connection.execute(statement, batch)
+
+    def _rebuild_trees(self, connection, trees, order_by, batch_size):
+        """Rebuilds the trees given as ``(tree_id, pk)`` pairs, where ``pk`` is
+        the primary key of their root node, over ``connection``, with children
+        sorted by the clauses in ``order_by``."""
+        self._write_rebuilt_nodes(connection, (
+            (pk, tree_id, left, right, depth)
+            for tree_id, root_pk in trees
+            for pk, left, right, depth in self._iter_rebuilt_subtree(
+                connection, root_pk, 1, 0, order_by, batch_size)
+        ), batch_size)
+
+    def _rebuild_subtree(self, connection, session_index, pk, order_by,
+                         method, allow_resize, batch_size):
+        """Rebuilds the subtree rooted at the node with primary key ``pk`` in
+        place, with children sorted by the clauses in ``order_by``."""
+        options = self._tree_options
+        tree_id, left, right, depth = connection.execute(
+            sqlalchemy.select([options.tree_id_field, options.left_field,
+                               options.right_field, options.depth_field])
+            .where(options.pk_field == pk)).fetchone()
+
+        def resize(new_right):
+            if new_right == right:
+                return
+            if not allow_resize:
+                raise ValueError(
+                    u"the subtree of node %r spans %d positions instead of "
+                    u"the %d it is stored with" % (
+                        pk, new_right - left + 1, right - left + 1))
+            self.mapper_extension._manage_position_gap(
+                connection, session_index, tree_id, right, new_right - right)
+
+        if method == 'cte':
+            self._rebuild_with_cte(
+                connection, order_by, (pk, tree_id, left, depth), resize)
+            return
+        nodes = list(self._iter_rebuilt_subtree(
+            connection, pk, left, depth, order_by, batch_size))
+        resize(nodes[-1][2])
+        self._write_rebuilt_nodes(connection, (
+            (node_pk, tree_id, node_left, node_right, node_depth)
+            for node_pk, node_left, node_right, node_depth in nodes
+        ), batch_size)
+
+    def _write_rebuilt_nodes(self, connection, nodes, batch_size):
+        """Writes the tree parameters of ``nodes``, given as
+        ``(pk, tree_id, left, right, depth)``, with executemany ``UPDATE``
+        statements of ``batch_size`` rows."""
+        options = self._tree_options
+        statement = options.table.update() \
+            .where(options.pk_field == sqlalchemy.bindparam('_pk')) \
+            .values({
+                options.tree_id_field: sqlalchemy.bindparam('_tree_id'),
+                options.left_field:    sqlalchemy.bindparam('_left'),
+                options.right_field:   sqlalchemy.bindparam('_right'),
+                options.depth_field:   sqlalchemy.bindparam('_depth'),
+            })
+        batch = []
+        for pk, tree_id, left, right, depth in nodes:
+            batch.append({'_pk': pk, '_tree_id': tree_id, '_left': left,
+                          '_right': right, '_depth': depth})
+            if len(batch) == batch_size:
+                connection.execute(statement, batch)
+                batch = []
+        if batch:
+            connection.execute(statement, batch)
+
+    def _rebuild_trees_in_parallel(
+            self, session, trees, order_by, parallel, batch_size):
+        """Rebuilds the trees given as ``(tree_id, pk)`` pairs with a pool of
+        ``parallel`` threads, each tree over a connection of its own and in a
+        transaction of its own. Changes made in ``session`` are committed first
+        so that they are seen by the other connections."""
+        engine = session.get_bind(
+            mapper=sqlalchemy.orm.class_mapper(self.node_class)).engine
+        if engine.dialect.name == 'sqlite' and \
+                engine.url.database in (None, '', ':memory:'):
+            raise ValueError(
+                u"an in-memory SQLite database cannot be rebuilt in parallel, "
+                u"as every connection would have a database of its own")
+        session.commit()
 
-        child_id_results = session.execute(
-            sqlalchemy.select([options.pk_field]).where(options.parent_id_field==pk)
-        ).fetchall()
-        for result in child_id_results:
-            right = self._do_rebuild_subtree(session, result[0], right, tree_id, depth+1)
+        def rebuild_tree(tree):
+            with engine.begin() as connection:
+                self._rebuild_trees(connection, [tree], order_by, batch_size)
+
+        pool = ThreadPool(parallel)
+        try:
+            for _ in pool.imap_unordered(rebuild_tree, trees):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+    def _iter_rebuilt_subtree(
+            self, connection, pk, left, depth, order_by, batch_size):
+        """Walks the subtree rooted at the node with primary key ``pk``, given
+        ``left`` and ``depth`` as its new tree parameters, with children sorted
+        by the clauses in ``order_by``, and yields ``(pk, left, right, depth)``
+        for each of its nodes in postorder."""
+        options = self._tree_options
 
-        session.execute(options.table.update().values({
-            options.tree_id_field.name: tree_id,
-            options.left_field.name: left,
-            options.right_field.name: right,
-            options.depth_field.name: depth,
-        }).where(options.pk_field==pk))
+        # Each frame holds a node, the primary keys of its children still to be
+        # visited (last one first, or ``None`` if not known yet), its left value
+        # and its depth. ``unfetched`` holds the nodes waiting on the stack whose
+        # children have not been fetched, in the same order, so that the nodes
+        # about to be visited are at its end.
+        stack = [[pk, None, left, depth]]
+        unfetched = [pk]
+        children_of = {}
+        counter = left + 1
+        while stack:
+            frame = stack[-1]
+            if frame[1] is None:
+                if frame[0] not in children_of:
+                    # This node is the last one in ``unfetched``: fetch its
+                    # children along with those of the nodes visited next.
+                    wanted = unfetched[-batch_size:]
+                    del unfetched[-batch_size:]
+                    for parent_pk in wanted:
+                        children_of[parent_pk] = []
+                    for child_pk, parent_pk in connection.execute(
+                            sqlalchemy.select([options.pk_field,
+                                               options.parent_id_field])
+                            .where(options.parent_id_field.in_(wanted))
+                            .order_by(*order_by)):
+                        children_of[parent_pk].append(child_pk)
+                frame[1] = children_of.pop(frame[0])
+                frame[1].reverse()
+                unfetched.extend(frame[1])
+            if frame[1]:
+                stack.append([frame[1].pop(), None, counter, frame[3] + 1])
+            else:
+                stack.pop()
+                yield frame[0], frame[2], counter, frame[3]
+            counter += 1
+
+    def _rebuild_with_cte(
+            self, connection, order_by, subtree=None, resize=None):
+        """Rebuilds all trees inside the database, with root nodes and
+        children sorted by the clauses in ``order_by``. If ``subtree`` is given,
+        as the primary key, tree id, left value and depth of a node, only the
+        subtree rooted at that node is rebuilt, and ``resize`` is called with the
+        new right value of the node before anything is written.
+
+        Each node is given the path of the ordinals of its ancestors and itself
+        among their siblings, as fixed-width strings, by a recursive common table
+        expression. Sorting the nodes of a tree by path gives their rank ``pre``
+        in preorder, and sorting them by path followed by a character that sorts
+        after every digit gives their rank ``post`` in postorder, from which
+
+          left  = 2 * pre - depth + 1
+          right = 2 * post + depth + 2
+
+        with both ranks starting from zero and ``depth`` counted from the root
+        of the subtree (the values are offset by those of its root for a
+        subtree). The results are stored in a
+        temporary table, which the tree is then updated from in one statement.
+        """
+        options = self._tree_options
+        table = options.table
+        row_number = sqlalchemy.func.row_number
+
+        def segment(ordinal):
+            return sqlalchemy.cast(ordinal + 1000000000, sqlalchemy.String)
+
+        if subtree is None:
+            root_filter = options.parent_id_field == None
+            base_left, base_depth = 1, 0
+        else:
+            root_pk, tree_id, base_left, base_depth = subtree
+            root_filter = options.pk_field == root_pk
+
+        ordered = sqlalchemy.select([
+            options.pk_field.label('pk'),
+            options.parent_id_field.label('parent_id'),
+            row_number().over(partition_by=options.parent_id_field,
+                              order_by=order_by).label('ordinal'),
+        ]).cte('ordered')
+        walk = sqlalchemy.select([
+            options.pk_field.label('pk'),
+            row_number().over(order_by=order_by).label('tree_id'),
+            sqlalchemy.literal_column(
+                '0', type_=options.depth_field.type).label('depth'),
+            segment(row_number().over(order_by=order_by)).label('path'),
+        ]).where(root_filter).cte('walk', recursive=True)
+        walk = walk.union_all(sqlalchemy.select([
+            ordered.c.pk,
+            walk.c.tree_id,
+            walk.c.depth + 1,
+            walk.c.path + segment(ordered.c.ordinal),
+        ]).where(ordered.c.parent_id == walk.c.pk))
+        pre = row_number().over(partition_by=walk.c.tree_id,
+                                order_by=walk.c.path) - 1
+        post = row_number().over(partition_by=walk.c.tree_id,
+                                 order_by=walk.c.path + 'z') - 1
+        if subtree is not None:
+            tree_id = sqlalchemy.literal(
+                tree_id, type_=options.tree_id_field.type)
+        else:
+            tree_id = walk.c.tree_id
+        numbered = sqlalchemy.select([
+            walk.c.pk,
+            tree_id,
+            2 * pre - walk.c.depth + base_left,
+            2 * post + walk.c.depth + base_left + 1,
+            walk.c.depth + base_depth,
+        ])
+
+        fields = (options.pk_field, options.tree_id_field, options.left_field,
+                  options.right_field, options.depth_field)
+        rebuilt = sqlalchemy.Table(
+            '%s__rebuild' % table.name, sqlalchemy.MetaData(),
+            *[sqlalchemy.Column(field.name, field.type,
+                                primary_key=field is options.pk_field)
+              for field in fields],
+            prefixes=['TEMPORARY'])
+        rebuilt.create(connection)
+        try:
+            connection.execute(rebuilt.insert().from_select(
+                [field.name for field in fields], numbered))
+
+            pk = rebuilt.c[options.pk_field.name]
+            if subtree is not None:
+                resize(connection.execute(
+                    sqlalchemy.select([rebuilt.c[options.right_field.name]])
+                    .where(pk == root_pk)).scalar())
+            if connection.dialect.name == 'sqlite':
+                # SQLite has no ``UPDATE ... FROM`` that SQLAlchemy can emit, so
+                # each field is set from a correlated subquery on the primary
+                # key of the temporary table.
+                values = dict((field, sqlalchemy.select([rebuilt.c[field.name]])
+                                      .where(pk == options.pk_field)
+                                      .as_scalar())
+                              for field in fields[1:])
+                statement = table.update() \
+                    .where(options.pk_field.in_(sqlalchemy.select([pk])))
+            else:
+                values = dict((field, rebuilt.c[field.name])
+                              for field in fields[1:])
+                statement = table.update().where(options.pk_field == pk)
+            connection.execute(statement.values(values))
+        finally:
+            rebuilt.drop(connection)
+
+    def bulk_rebuild(self, session, batch_size=10000, progress=None):
+        """Rebuilds the tree parameters of every node in the table from the
+        adjacency relations alone, as is needed when the tree manager is adopted
+        on an existing table where only the parent ids are filled in. Roots and
+        children are numbered in primary key order, which must be an integer.
+
+        Unlike :meth:`rebuild`, which walks the trees with a query and an update
+        per node, the ``(pk, parent_id)`` pairs are streamed once from a
+        server-side cursor into compact arrays, the tree parameters computed
+        without recursion, and the rows written back with executemany
+        ``UPDATE`` statements of ``batch_size`` rows each. Memory use is a few
+        machine words per node.
+
+        :param progress:
+          a callable, called after each batch with the number of nodes written
+          so far and the total number of nodes.
+
+        :raises ValueError:
+          if some nodes cannot be reached from a root node, that is if the parent
+          links form a cycle. Nothing is written in that case.
+        """
+        options = self._tree_options
+        connection = session.connection(
+            mapper=sqlalchemy.orm.class_mapper(self.node_class))
+
+        # Stream the adjacency list in primary key order. Until every primary
+        # key is known, a node without parent is recorded as its own parent.
+        pks, parents = array(integer_typecode), array(integer_typecode)
+        result = connection.execution_options(stream_results=True).execute(
+            sqlalchemy.select([options.pk_field, options.parent_id_field])
+            .order_by(options.pk_field))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for pk, parent_id in rows:
+                pks.append(pk)
+                parents.append(pk if parent_id is None else parent_id)
+        result.close()
+        count = len(pks)
+
+        # Replace parent ids by the position of the parent in ``pks``, -1 for
+        # roots, and lay out the children of each node contiguously in
+        # ``children``, from ``offsets[idx]`` up to ``offsets[idx + 1]``.
+        offsets = array(integer_typecode, [0]) * (count + 1)
+        roots = array(integer_typecode)
+        for idx in range(count):
+            parent = bisect_left(pks, parents[idx])
+            if parent == idx or parent == count or pks[parent] != parents[idx]:
+                parents[idx] = -1
+                roots.append(idx)
+            else:
+                parents[idx] = parent
+                offsets[parent + 1] += 1
+        for idx in range(count):
+            offsets[idx + 1] += offsets[idx]
+        children = array(integer_typecode, [0]) * count
+        for idx in range(count):
+            parent = parents[idx]
+            if parent != -1:
+                children[offsets[parent]] = idx
+                offsets[parent] += 1
+        del parents
+        for idx in range(count, 0, -1):
+            offsets[idx] = offsets[idx - 1]
+        offsets[0] = 0
+
+        # A node on a cycle of parent links is never reached from a root.
+        reached = sum(1 for _ in self._iter_rebuilt_nodes(
+            roots, offsets, children))
+        if reached != count:
+            raise ValueError(
+                u"%d nodes cannot be reached from a root node, the parent "
+                u"links must form a cycle" % (count - reached))
+
+        statement = options.table.update() \
+            .where(options.pk_field == sqlalchemy.bindparam('_pk')) \
+            .values({
+                options.tree_id_field: sqlalchemy.bindparam('_tree_id'),
+                options.left_field:    sqlalchemy.bindparam('_left'),
+                options.right_field:   sqlalchemy.bindparam('_right'),
+                options.depth_field:   sqlalchemy.bindparam('_depth'),
+            })
+        batch, written = [], 0
+        for idx, tree_id, left, right, depth in self._iter_rebuilt_nodes(
+                roots, offsets, children):
+            batch.append({'_pk': pks[idx], '_tree_id': tree_id,
+                          '_left': left, '_right': right, '_depth': depth})
+            if len(batch) == batch_size:
+                connection.execute(statement, batch)
+                written += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(written, count)
+        if batch:
+            connection.execute(statement, batch)
+            written += len(batch)
+            if progress is not None:
+                progress(written, count)
+
+        options.tree_id_allocator.renumbered(connection, len(roots))
+        self.mapper_extension._rebuild_root_orders(connection)
+        if options.path_field is not None:
+            self._rebuild_paths(connection, batch_size)
+        if options.closure_table is not None:
+            self._rebuild_closure(connection)
+
+        session.commit()
 
-        return right + 1
+    @staticmethod
+    def _iter_rebuilt_nodes(roots, offsets, children):
+        """Walks the trees rooted at the positions in ``roots``, with the
+        children of each node laid out in ``children`` as given by ``offsets``,
+        and yields ``(idx, tree_id, left, right, depth)`` for each node in
+        postorder. Only the path to the current node is kept on the stack."""
+        for tree_id, root in enumerate(roots, 1):
+            # Each frame holds a node, the position of its next child in
+            # ``children``, its left value and its depth.
+            stack = [[root, offsets[root], 1, 0]]
+            counter = 2
+            while stack:
+                frame = stack[-1]
+                idx, position = frame[0], frame[1]
+                if position < offsets[idx + 1]:
+                    frame[1] = position + 1
+                    child = children[position]
+                    stack.append(
+                        [child, offsets[child], counter, frame[3] + 1])
+                else:
+                    stack.pop()
+                    yield idx, tree_id, frame[2], counter, frame[3]
+                counter += 1
 
 # FIXME: write a helper routine that converts the args parameters of the
 #   various *_of_node methods into standard form, so that either a positional
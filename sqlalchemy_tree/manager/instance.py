@@ -110,15 +110,33 @@ class TreeInstanceManager(TreeClassManager):
         "Return the root node of the tree which includes this node."
         return self.query_root_node_of_node(self._get_obj()).one()
 
-    def filter_ancestors(self, include_self=False):
+    def filter_ancestors(self, include_self=False, by_closure=False):
         "The same as :meth:`filter_descendants` but filters ancestor nodes."
         return self.filter_ancestors_of_node(
-            self._get_obj(), include_self=include_self)
+            self._get_obj(), include_self=include_self, by_closure=by_closure)
 
-    def query_ancestors(self, session=None, include_self=False):
+    def query_ancestors(self, session=None, include_self=False,
+                        by_closure=False):
         "The same as :meth:`query_descendants` but queries node's ancestors."
         return self.query_ancestors_of_node(
-            self._get_obj(), session=session, include_self=include_self)
+            self._get_obj(), session=session, include_self=include_self,
+            by_closure=by_closure)
+
+    def get_ancestor_ids(self, session=None, include_self=False):
+        """Returns the primary keys of node's ancestors, root first. If the
+        path field is kept, they are read from node's path without any query;
+        otherwise they are queried."""
+        options = self._tree_options
+        obj = self._get_obj()
+        if options.path_field is not None:
+            pks = options.path_pks(getattr(obj, options.path_field.name))
+            if include_self:
+                pks.append(getattr(obj, options.pk_field.name))
+            return pks
+        return [pk for pk, in self.query_ancestors(
+            session=session, include_self=include_self)
+            .with_entities(options.pk_field)
+            .order_by(options.left_field)]
 
     def filter_parent(self):
         "Get a filter condition for a node's parent."
@@ -158,7 +176,7 @@ class TreeInstanceManager(TreeClassManager):
     def previous_sibling(self):
         "Returns the previous sibling with respect to tree ordering, or `None`."
         if self.is_root_node:
-            ordering = sqlalchemy.sql.expression.desc(self.tree_id_field)
+            ordering = sqlalchemy.sql.expression.desc(self.root_sort_field)
         else:
             ordering = sqlalchemy.sql.expression.desc(self.left_field)
         return self.query_previous_siblings().order_by(ordering).first()
@@ -167,7 +185,7 @@ class TreeInstanceManager(TreeClassManager):
     def next_sibling(self):
         "Returns the next sibling with respect to tree ordering, or `None`."
         if self.is_root_node:
-            ordering = sqlalchemy.sql.expression.asc(self.tree_id_field)
+            ordering = sqlalchemy.sql.expression.asc(self.root_sort_field)
         else:
             ordering = sqlalchemy.sql.expression.asc(self.left_field)
         return self.query_next_siblings().order_by(ordering).first()
@@ -182,7 +200,8 @@ class TreeInstanceManager(TreeClassManager):
         and does not accept an :attr:`include_self` parameter."""
         return self.query_children_of_node(self._get_obj(), session=session)
 
-    def filter_descendants(self, include_self=False):
+    def filter_descendants(self, include_self=False, by_path=False,
+                           by_closure=False):
         """Get a filter condition for node's descendants.
 
         Requires that node has `tree_id`, `left`, `right` and `depth` values
@@ -201,14 +220,22 @@ class TreeInstanceManager(TreeClassManager):
 
         :param include_self:
           `bool`, if set to `True`, include this node in the filter as well.
+        :param by_path:
+          `bool`, if set to `True`, match the descendants by the prefix of
+          their path, which requires the path field to be kept.
+        :param by_closure:
+          `bool`, if set to `True`, find the descendants through the closure
+          table, which must be kept.
         :return:
           a filter clause applicable as argument for
           `sqlalchemy.orm.Query.filter()` and others.
         """
         return self.filter_descendants_of_node(
-            self._get_obj(), include_self=include_self)
+            self._get_obj(), include_self=include_self, by_path=by_path,
+            by_closure=by_closure)
 
-    def query_descendants(self, session=None, include_self=False):
+    def query_descendants(self, session=None, include_self=False,
+                          by_path=False, by_closure=False):
         """Get a query for node's descendants.
 
         Requires that node is in “persistent” state or in “pending” state in
@@ -221,11 +248,16 @@ class TreeInstanceManager(TreeClassManager):
           execute).
         :param include_self:
           `bool`, if set to `True` self node will be selected by query.
+        :param by_path:
+          `bool`, the same as for :meth:`filter_descendants`.
+        :param by_closure:
+          `bool`, the same as for :meth:`filter_descendants`.
         :return:
           a `sqlalchemy.orm.Query` object which contains only node's descendants.
         """
         return self.query_descendants_of_node(
-            self._get_obj(), session=session, include_self=include_self)
+            self._get_obj(), session=session, include_self=include_self,
+            by_path=by_path, by_closure=by_closure)
 
     def get_descendant_count(self):
         "Returns the number of descendants this node has."
@@ -238,6 +270,10 @@ class TreeInstanceManager(TreeClassManager):
         if pk is None:
             return 0
 
+        if self._tree_options.sparse:
+            # Free positions make the interval wider than its descendants need:
+            return self.query_descendants().count()
+
         return (right - left - 1) / 2
 
     def filter_leaf_nodes(self, include_self=False):
@@ -291,7 +327,7 @@ class TreeInstanceManager(TreeClassManager):
     @property
     def is_leaf_node(self):
         "Returns `True` if the node has no children."
-        return self.left == self.right - 1
+        return self._is_leaf_node(self._get_obj())
 
     def is_ancestor_of(self, descendant, include_self=False):
         "Returns `True` if the passed-in node is a descendant of this node."
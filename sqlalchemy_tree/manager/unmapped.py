@@ -81,6 +81,104 @@ class TreeManager(object):
       the same as for :attr:`tree_id_field`, except that the type of this column
       should be :class:`TreeDepthField`.
 
+    :param spacing=None:
+      when set to a positive number ``K``, nodes are numbered sparsely: every
+      inserted node is given ``K`` free positions inside it, and ``K`` more
+      before or after it, so that later inserts can usually be placed in free
+      positions without updating any other row. When the free positions at an
+      insertion point run out, the nodes of the enclosing subtree are spread
+      out evenly over its interval again, after widening it (to at least twice
+      its size) if they would be packed too closely. Deleting a node leaves
+      its positions free. Filters and queries work as with dense numbering, but
+      finding leaf nodes and counting descendants take a query. An additional
+      index on the tree id and right fields is created.
+
+    :param encoding='integer':
+      with ``'rational'``, the left and right fields hold rational numbers,
+      stored as double-precision floats (columns of types
+      :class:`TreeRationalLeftType` and :class:`TreeRationalRightType`) of
+      which the fraction is recovered exactly from the float. Inserted and
+      moved nodes are given values between those of their new neighbours, by
+      chains of mediants, so that inserts, moves and deletes within the same
+      tree only ever write the rows concerned. Only when the denominators
+      needed would no longer fit in a float is the tree renumbered with whole
+      numbers first. Filters work as with the integer encoding, with finding
+      leaf nodes and counting descendants taking a query, like with
+      :attr:`spacing`, with which it can not be combined.
+
+    :param path_field=None:
+      the materialized path column, of type :class:`TreePathType`, which is
+      only kept if given (``True`` stands for the name ``'tree_path'``) or if
+      the table has a column of that type. The path of a node lists the
+      primary keys of its ancestors, root first, each zero-padded to
+      :attr:`path_digits` digits and followed by ``'/'``, so that it is empty
+      for root nodes. Paths are maintained by the same statements as the other
+      tree fields, and allow ancestors to be found without a self-join (see
+      :meth:`TreeInstanceManager.get_ancestor_ids`) and descendants by a
+      prefix scan of the index created on the column (see ``by_path`` of
+      :meth:`TreeClassManager.filter_descendants_of_node`).
+
+    :param path_digits=10:
+      the number of digits primary keys are padded to in paths, which must
+      be non-negative integers of at most that many digits: the path field
+      requires an integer primary key, and a ``ValueError`` is raised when a
+      wider primary key is to be written to a path.
+
+    :param closure_table=None:
+      the name of a closure table to keep alongside :attr:`table` (``True``
+      stands for the name of the table followed by ``'__closure'``), which
+      is defined in the same metadata unless it is there already. It holds a
+      row ``(ancestor_id, descendant_id, distance)`` for every node and each
+      of its ancestors, itself included at distance zero, written by the same
+      flush handlers as the tree fields with one ``INSERT ... SELECT``,
+      ``UPDATE`` or ``DELETE`` per change of structure. Joining through it
+      (see :attr:`TreeClassManager.closure_table` and ``by_closure`` of the
+      ancestor and descendant filters) relates every node to all its
+      descendants by primary key alone, as reports aggregating over subtrees
+      need. :meth:`TreeClassManager.rebuild_closure` fills it from the tree
+      fields.
+
+    :param tree_id_allocator=None:
+      the :class:`TreeIdAllocator` picking the tree id of new trees, for the
+      use of this tree only. Defaults to a :class:`MaxTreeIdAllocator`, which
+      queries the greatest tree id every time. A
+      :class:`SequenceTreeIdAllocator` takes them from a sequence instead, and
+      a :class:`CounterTreeIdAllocator` from a counter row in a registry table,
+      optionally reserving blocks of them so that most new trees cost no
+      statement at all.
+
+    :param root_order_field=None:
+      the name of a column ordering the root nodes, of type
+      :class:`TreeRootOrderType` (``True`` stands for ``'tree_root_order'``),
+      created as for :attr:`tree_id_field` if the table has no such column.
+      It is auto-detected like :attr:`path_field`, and kept only if given
+      or detected. Root nodes are then ordered by it rather than by tree id,
+      and are given values spread apart, so that putting a root node left or
+      right of another one only writes its own row (and, once in a great
+      many times, moves the root nodes after it to make room), where every
+      later tree would otherwise be given a new tree id. Tree ids then never
+      change. Only the values of root nodes are meaningful; those of other
+      nodes are left as they were.
+
+    :param close_gaps=True:
+      with ``False``, deleting a node only writes its own row and the rows
+      of its descendants, which take its place under its parent: the
+      positions it held are left free, as with :attr:`spacing`, and so is
+      the tree id of a deleted root node without children. Finding leaf
+      nodes and counting descendants then take a query.
+      :meth:`TreeClassManager.compact` renumbers trees without their free
+      positions, for instance from a maintenance job.
+
+    :param returning=False:
+      with ``True``, and on databases where ``UPDATE`` statements can return
+      the rows they change (such as PostgreSQL), the statements moving nodes to open
+      or close a gap return the new tree fields of these rows, which are then
+      set on the nodes held by the session, instead of being computed again
+      in Python for every loaded node. This saves work when the session holds
+      many nodes of the trees changed, but transfers every shifted row, so it
+      is best left off for large trees of which few nodes are loaded. Other
+      databases ignore it.
+
     :param instance_manager_attr='_tree_instance_manager':
       name for node instance's attribute to cache node's instance manager.
 
@@ -14,7 +14,10 @@ from __future__ import absolute_import, division, print_function, \
 
 import sqlalchemy
 
-from .types import TreeIdType, TreeLeftType, TreeRightType, TreeDepthType
+from .allocators import MaxTreeIdAllocator
+from .types import TreeIdType, TreeLeftType, TreeRightType, TreeDepthType, \
+    TreePathType, TreeRationalLeftType, TreeRationalRightType, \
+    TreeRootOrderType
 from ._compat import string_types, py2map as map
 
 
@@ -34,9 +37,32 @@ class TreeOptions(object):
                  left_field=None,
                  right_field=None,
                  depth_field=None,
+                 spacing=None,
+                 encoding='integer',
+                 path_field=None,
+                 path_digits=10,
+                 closure_table=None,
+                 tree_id_allocator=None,
+                 root_order_field=None,
+                 close_gaps=True,
+                 returning=False,
                  _attach_columns=True):
         # Record required options for future use:
         self.table = table
+        assert spacing is None or spacing > 0, \
+            "The spacing should be a positive number of positions"
+        assert encoding in ('integer', 'rational'), \
+            "The encoding should be either 'integer' or 'rational'"
+        assert not (spacing and encoding == 'rational'), \
+            "Spacing only applies to the integer encoding"
+        self.spacing = spacing
+        self.encoding = encoding
+        self.path_digits = path_digits
+        self.close_gaps = close_gaps
+        self.returning = returning
+        # Whether positions may be left free between the values of a tree, so
+        # that tests for leaf nodes and descendant counts have to query:
+        self.sparse = bool(spacing) or encoding == 'rational' or not close_gaps
         self._node_manager_attr = None
         self.instance_manager_attr = instance_manager_attr
         self.delayed_op_attr = None
@@ -120,10 +146,13 @@ class TreeOptions(object):
         # fields:
         self.tree_id_field = _check_field(
             table, tree_id_field, 'id', TreeIdType)
+        rational = encoding == 'rational'
         self.left_field = _check_field(
-            table, left_field, 'left', TreeLeftType)
+            table, left_field, 'left',
+            rational and TreeRationalLeftType or TreeLeftType)
         self.right_field = _check_field(
-            table, right_field, 'right', TreeRightType)
+            table, right_field, 'right',
+            rational and TreeRationalRightType or TreeRightType)
         self.depth_field = _check_field(
             table, depth_field, 'depth', TreeDepthType)
         self.required_fields = (
@@ -133,6 +162,70 @@ class TreeOptions(object):
             self.depth_field,
         )
 
+        # The path field is optional: it is only kept if it is specified, or
+        # if the table has a column of its type. ``True`` stands for the
+        # default name.
+        if path_field is None:
+            candidates = [column for column in table.columns
+                          if isinstance(column.type, TreePathType)]
+            path_field = len(candidates) == 1 and candidates[0]
+        if path_field is False:
+            self.path_field = None
+        else:
+            self.path_field = _check_field(
+                table, None if path_field is True else path_field, 'path',
+                TreePathType)
+            self.required_fields += (self.path_field,)
+            # Paths list the primary keys as zero-padded numbers:
+            assert isinstance(self.pk_field.type, sqlalchemy.types.Integer), \
+                "The path field requires an integer primary key"
+            assert path_digits > 0, \
+                "The path digits should be a positive number of digits"
+
+        # So is the root order field, which is kept the same way.
+        if root_order_field is None:
+            candidates = [column for column in table.columns
+                          if isinstance(column.type, TreeRootOrderType)]
+            root_order_field = len(candidates) == 1 and candidates[0]
+        if root_order_field is False:
+            self.root_order_field = None
+        else:
+            self.root_order_field = _check_field(
+                table, None if root_order_field is True else root_order_field,
+                'root_order', TreeRootOrderType)
+            self.required_fields += (self.root_order_field,)
+
+        # The closure table is optional too, and is defined alongside the table
+        # if requested (``True`` standing for the default name), unless the
+        # metadata already has it.
+        if not closure_table:
+            self.closure_table = None
+        else:
+            if closure_table is True:
+                closure_table = '__'.join((table.name, 'closure'))
+            self.closure_table = table.metadata.tables.get(closure_table)
+            if self.closure_table is None:
+                self.closure_table = sqlalchemy.Table(
+                    closure_table, table.metadata,
+                    sqlalchemy.Column('ancestor_id', self.pk_field.type,
+                                      sqlalchemy.ForeignKey(self.pk_field),
+                                      primary_key=True),
+                    sqlalchemy.Column('descendant_id', self.pk_field.type,
+                                      sqlalchemy.ForeignKey(self.pk_field),
+                                      primary_key=True),
+                    sqlalchemy.Column('distance', TreeDepthType(),
+                                      nullable=False),
+                    # For finding the ancestors of a node:
+                    sqlalchemy.Index(
+                        '__'.join((closure_table, 'descendant_id')),
+                        'descendant_id', 'distance'),
+                )
+
+        # New trees are numbered by the allocator, which may define a table or
+        # a sequence of its own alongside the table:
+        self.tree_id_allocator = tree_id_allocator or MaxTreeIdAllocator()
+        self.tree_id_allocator.bind(self)
+
         if _attach_columns:
             self.attach_indices()
 
@@ -155,6 +248,32 @@ class TreeOptions(object):
                 # unique=True
             ),
         ]
+        if self.sparse:
+            # In sparse trees, the free positions around a node are found by
+            # looking up the closest left and right values on either side, so
+            # right values need an index of their own:
+            self.indices.append(sqlalchemy.Index(
+                '__'.join((self.table.name,
+                           self.tree_id_field.name,
+                           self.right_field.name)),
+                self.tree_id_field,
+                self.right_field,
+            ))
+        if self.root_order_field is not None:
+            # For finding the neighbours of a root node:
+            self.indices.append(sqlalchemy.Index(
+                '__'.join((self.table.name,
+                           self.left_field.name,
+                           self.root_order_field.name)),
+                self.left_field,
+                self.root_order_field,
+            ))
+        if self.path_field is not None:
+            # For scanning descendants by path prefix:
+            self.indices.append(sqlalchemy.Index(
+                '__'.join((self.table.name, self.path_field.name)),
+                self.path_field,
+            ))
         map(self.table.append_constraint, self.indices)
 
     def class_mapped(self, manager):
@@ -199,10 +318,37 @@ class TreeOptions(object):
             u"could not auto-detect parent field name; tree extension will not "
             u"work property without a parent relationship defined")
 
+    def path_segment(self, pk):
+        "Returns the segment standing for the node ``pk`` in the paths of nodes."
+        if not 0 <= pk < 10 ** self.path_digits:
+            raise ValueError(
+                u"the primary key %r does not fit in a path of %d digits per "
+                u"node; raise path_digits" % (pk, self.path_digits))
+        return '%0*d/' % (self.path_digits, pk)
+
+    def path_pks(self, path):
+        "Returns the primary keys of the ancestors listed in ``path``, root first."
+        width = self.path_digits + 1
+        return [int(path[offset:offset + self.path_digits])
+                for offset in range(0, len(path), width)]
+
     def order_by_clause(self):
         """Get an object applicable for usage as an argument for
         `Query.order_by()`. Used to sort subtree query by `tree_id` then
-        `left`."""
+        `left`. When root nodes are ordered by the root order field, the trees
+        are sorted by the root order of their root node first (only root nodes
+        hold one), so that each tree comes whole, and the trees in order."""
+        if self.root_order_field is not None:
+            root = self.table.alias()
+            root_order = sqlalchemy.select(
+                [root.c[self.root_order_field.name]]).where(
+                (root.c[self.tree_id_field.name] == self.tree_id_field) &
+                (root.c[self.left_field.name] == 1)).as_scalar()
+            return sqlalchemy.sql.expression.ClauseList(
+                sqlalchemy.sql.expression.asc(root_order),
+                sqlalchemy.sql.expression.asc(self.tree_id_field),
+                sqlalchemy.sql.expression.asc(self.left_field),
+                group=False, group_contents=False)
         return sqlalchemy.sql.expression.asc(self.left_field)
         # FIXME: We should be sorting based on ``tree_id`` first, then ``left``
         #        (see disabled code below), however this was generating SQL not
@@ -12,6 +12,11 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement, unicode_literals
 
+from bisect import bisect_left, bisect_right
+from fractions import Fraction
+from heapq import merge
+from weakref import WeakKeyDictionary, ref
+
 import sqlalchemy
 from sqlalchemy.ext.declarative import DeclarativeMeta as BaseDeclarativeMeta
 
@@ -23,6 +28,495 @@ __all__ = (
     'DeclarativeMeta'
 )
 
+_missing = object()
+
+# The maximum number of primary keys to put in the ``IN (...)`` clause of a
+# single query, kept below the bound parameter limit of common databases.
+RELOAD_CHUNK_SIZE = 500
+
+# In trees with rational encoding, the left and right values are fractions
+# stored as double-precision floats. A fraction ``p / q`` is only ever stored if
+# ``q ** 2 * max(p / q, 1)`` is at most this bound, which leaves it the only
+# fraction of so small a denominator within the rounding error of the float, so
+# that it can be recovered exactly.
+RATIONAL_PRECISION = 2 ** 48
+
+# When root nodes are ordered by a root order field, new root nodes are given
+# root orders this far apart, so that many root nodes can be put between two
+# others before their neighbours have to make room.
+ROOT_ORDER_SPACING = 2 ** 16
+
+# A flush applies its moves together, reading the trees they touch, if at
+# least this many of them touch the same tree (see
+# :meth:`TreeSessionExtension._coalesce_moves`). Fewer moves cost less applied
+# one at a time.
+COALESCE_MIN_MOVES = 3
+
+
+def _to_fraction(value):
+    "Recovers the fraction stored as ``value`` in a tree with rational encoding."
+    return Fraction(value).limit_denominator(
+        max(1, int((RATIONAL_PRECISION / max(abs(value), 1)) ** 0.5)))
+
+
+def _literal(value):
+    """Returns the integer ``value`` as a literal, rather than a bound
+    parameter, for statements which may take too many to bind."""
+    return sqlalchemy.literal_column('%d' % value)
+
+
+def _supports_update_returning(dialect):
+    """Returns whether ``UPDATE`` statements changing many rows can return them
+    with ``RETURNING`` on ``dialect``. Before SQLAlchemy 2.0 tells, only
+    PostgreSQL is relied upon."""
+    supported = getattr(dialect, 'update_returning', None)
+    if supported is None:
+        supported = dialect.name == 'postgresql'
+    return supported
+
+
+def _get_mediants(lower, upper, count):
+    """Returns ``count`` increasing values between ``lower`` and ``upper``
+    exclusive, as floats: the fractions ``(a + t * c) / (b + t * d)`` for ``t``
+    from 1 to ``count``, where ``lower`` is ``a / b`` and ``upper`` is ``c /
+    d``. Returns ``None`` if any of them would be too precise to be stored."""
+    lower, upper = _to_fraction(lower), _to_fraction(upper)
+    values = []
+    for step in range(1, count + 1):
+        value = Fraction(lower.numerator + step * upper.numerator,
+                         lower.denominator + step * upper.denominator)
+        if value.denominator ** 2 * max(value, 1) > RATIONAL_PRECISION:
+            return None
+        values.append(float(value))
+    return values
+
+
+class TreeSessionIndex(object):
+
+    """An index of the tree nodes held by a session, used during a flush to keep
+    in-memory nodes consistent with the changes made to the database. Nodes are
+    bucketed by ``tree_id`` and sorted by their ``left`` and ``right`` values,
+    so that mirroring a tree-maintenance statement only touches the nodes of
+    the affected tree and interval rather than every object in the identity
+    map. This class is instantiated by the session extension, and the average
+    developer need not bother himself with it.
+
+    One index is kept per session for the lifetime of that session, and is fed
+    by the session extension as nodes are loaded, refreshed or attached, so
+    that no flush ever has to walk the identity map. Entries are checked
+    lazily, a tree at a time: nodes which have since been garbage collected,
+    removed from the session or had their tree fields expired are dropped,
+    since they will be refreshed from the database on next access anyway.
+
+    :param options:
+      instance of :class:`TreeOptions`
+    :param session:
+      the session whose new and persistent nodes are to be indexed.
+    """
+
+    def __init__(self, options, session):
+        self._tree_options = options
+        self._session_key = session.hash_key
+        self._session = ref(session)
+        self._field_names = {
+            'parent_id': options.parent_id_field.name,
+            'tree_id':   options.tree_id_field.name,
+            'left':      options.left_field.name,
+            'right':     options.right_field.name,
+            'depth':     options.depth_field.name,
+        }
+        if options.path_field is not None:
+            self._field_names['path'] = options.path_field.name
+        if options.root_order_field is not None:
+            self._field_names['root_order'] = options.root_order_field.name
+        # tree_id -> {state: None}
+        self._trees = {}
+        # state -> tree_id
+        self._tree_of = {}
+        # tree_id -> (lefts, nodes by left, rights, nodes by right)
+        self._sorted = {}
+        # ids of the trees whose entries have been checked this flush
+        self._checked = set()
+        # states whose tree fields are to be reloaded from the database
+        self._stale = {}
+        # states whose tree fields are known to match the database
+        self._fresh = set()
+        # (target state, position) -> pending states to be inserted there
+        self._inserts = {}
+        # pending state -> its key in ``_inserts``
+        self._insert_of = {}
+        # pending states already given their place by an earlier insert
+        self._placed = set()
+        # the :class:`TreeBatch` open on the session, if any
+        self.batch = None
+
+    def reset(self):
+        """Discards everything cached since the index was last used, as the
+        session may have expired or reloaded nodes in the meantime. Called at
+        the start of every flush, and of every other bulk tree operation."""
+        self._sorted.clear()
+        self._checked.clear()
+        self._stale.clear()
+        self._fresh.clear()
+        self._inserts.clear()
+        self._insert_of.clear()
+        self._placed.clear()
+
+    def mark_stale(self, node):
+        """Queues ``node`` to have its tree fields reloaded from the database by
+        the next call to :meth:`pop_stale`."""
+        if node is not None:
+            state = sqlalchemy.orm.attributes.instance_state(node)
+            if state not in self._fresh:
+                self._stale[state] = None
+
+    def mark_fresh(self, node):
+        """Records that the tree fields of ``node`` match the database, and will
+        be kept in step with it for the rest of the flush."""
+        state = sqlalchemy.orm.attributes.instance_state(node)
+        self._stale.pop(state, None)
+        self._fresh.add(state)
+
+    def queue_insert(self, node, target, position):
+        """Records that the pending ``node`` is to be inserted at ``position``
+        relative to ``target``, so that a run of inserts at the same place can be
+        handled together by :meth:`pop_insert_run`."""
+        state = sqlalchemy.orm.attributes.instance_state(node)
+        key = (sqlalchemy.orm.attributes.instance_state(target), position)
+        self._inserts.setdefault(key, []).append(state)
+        self._insert_of[state] = key
+
+    def pop_insert_run(self, node):
+        """Returns the pending nodes queued for insertion at the same place as
+        ``node`` (``node`` included) in the order they were added to the
+        session, and marks them all as placed."""
+        state = sqlalchemy.orm.attributes.instance_state(node)
+        key = self._insert_of.get(state)
+        if key is None:
+            return [node]
+        states = sorted(self._inserts.pop(key),
+                        key=lambda state: state.insert_order)
+        for state in states:
+            del self._insert_of[state]
+            self._placed.add(state)
+        return [state.obj() for state in states]
+
+    def is_placed(self, node):
+        """Returns ``True`` if ``node`` was given its place in the tree when an
+        earlier node of its run was inserted."""
+        return sqlalchemy.orm.attributes.instance_state(node) in self._placed
+
+    def pop_stale(self, *nodes):
+        """Returns every queued node, along with any of ``nodes`` whose tree
+        fields have not been loaded yet during this flush, and marks them all as
+        fresh."""
+        for node in nodes:
+            self.mark_stale(node)
+        stale = [state.obj() for state in self._stale]
+        self._fresh.update(self._stale)
+        self._stale.clear()
+        return [node for node in stale if node is not None]
+
+    @property
+    def field_names(self):
+        """The names of the tree fields kept in step by the index (``parent_id``,
+        ``tree_id``, ``left``, ``right``, ``depth``, and ``path`` and
+        ``root_order`` if the tree has them), mapped to their column names."""
+        return dict(self._field_names)
+
+    def add(self, node):
+        """Start tracking ``node``, unless it is not a tree node or its tree
+        fields are not loaded."""
+        if not isinstance(node, self._tree_options.node_class):
+            return
+        state = sqlalchemy.orm.attributes.instance_state(node)
+        if self._field_names['tree_id'] in state.dict:
+            self._track(state)
+
+    def _track(self, state):
+        tree_id = state.dict[self._field_names['tree_id']]
+        old_tree_id = self._tree_of.get(state, _missing)
+        if old_tree_id is not _missing:
+            if old_tree_id == tree_id:
+                self._sorted.pop(tree_id, None)
+                return
+            self._untrack(state)
+        self._tree_of[state] = tree_id
+        self._trees.setdefault(tree_id, {})[state] = None
+        self._sorted.pop(tree_id, None)
+
+    def _untrack(self, state, keep_view=False):
+        tree_id = self._tree_of.pop(state)
+        states = self._trees[tree_id]
+        del states[state]
+        if not states:
+            del self._trees[tree_id]
+        if not keep_view:
+            self._sorted.pop(tree_id, None)
+
+    def discard(self, node):
+        "Stop tracking ``node``."
+        state = sqlalchemy.orm.attributes.instance_state(node)
+        tree_id = self._tree_of.get(state, _missing)
+        if tree_id is not _missing:
+            self._untrack(state, keep_view=self._view_remove(tree_id, node))
+
+    def _bucket(self, tree_id):
+        "Returns the checked states of tree ``tree_id``."
+        if tree_id not in self._checked:
+            self._checked.add(tree_id)
+            tree_id_name = self._field_names['tree_id']
+            for state in list(self._trees.get(tree_id, ())):
+                if (state.obj() is None or
+                        state.session_id != self._session_key or
+                        tree_id_name not in state.dict):
+                    self._untrack(state)
+                elif state.dict[tree_id_name] != tree_id:
+                    self._track(state)
+        return self._trees.get(tree_id, {})
+
+    def tree(self, tree_id):
+        "Returns a list of the tracked nodes in the tree identified by ``tree_id``."
+        # Nodes may be collected after their tree was checked, mid-flush:
+        return [obj for obj in (state.obj() for state in self._bucket(tree_id))
+                if obj is not None]
+
+    def tree_ids(self, lower=None, upper=None):
+        """Returns the sorted ids of the trees with tracked nodes, optionally
+        restricted to those between ``lower`` and ``upper`` inclusive."""
+        return [
+            tree_id for tree_id in sorted(
+                tree_id for tree_id in self._trees
+                if tree_id is not None and
+                (lower is None or tree_id >= lower) and
+                (upper is None or tree_id <= upper))
+            if self._bucket(tree_id)]
+
+    def max_tree_id(self):
+        "Returns the largest tree id of any tracked node, or ``None``."
+        for tree_id in sorted((tree_id for tree_id in self._trees
+                               if tree_id is not None), reverse=True):
+            if self._bucket(tree_id):
+                return tree_id
+        return None
+
+    def roots(self):
+        "Returns the tracked root nodes, pending or not."
+        left_name = self._field_names['left']
+        return [obj for obj in (
+                    state.obj() for tree_id in self.tree_ids()
+                    for state in self._bucket(tree_id)
+                    if state.dict.get(left_name) == 1)
+                if obj is not None]
+
+    def _sorted_view(self, tree_id):
+        view = self._sorted.get(tree_id)
+        if view is None:
+            left_name = self._field_names['left']
+            right_name = self._field_names['right']
+            nodes = [
+                n for n in self.tree(tree_id)
+                if getattr(n, left_name) is not None and
+                getattr(n, right_name) is not None]
+            by_left = sorted(nodes, key=lambda n: getattr(n, left_name))
+            by_right = sorted(nodes, key=lambda n: getattr(n, right_name))
+            view = self._sorted[tree_id] = (
+                [getattr(n, left_name) for n in by_left], by_left,
+                [getattr(n, right_name) for n in by_right], by_right)
+        return view
+
+    def left_between(self, tree_id, lower, upper):
+        """Returns the tracked nodes of tree ``tree_id`` whose ``left`` value lies
+        between ``lower`` and ``upper`` inclusive, sorted by ``left``."""
+        lefts, by_left, rights, by_right = self._sorted_view(tree_id)
+        return by_left[bisect_left(lefts, lower):bisect_right(lefts, upper)]
+
+    def right_of(self, tree_id, target):
+        """Returns the tracked nodes of tree ``tree_id`` whose ``right`` value is
+        greater than ``target``. This includes every node which lies to the right
+        of ``target`` and every node whose interval contains it."""
+        lefts, by_left, rights, by_right = self._sorted_view(tree_id)
+        return by_right[bisect_right(rights, target):]
+
+    def boundary_below(self, tree_id, target):
+        """Returns the greatest ``left`` or ``right`` value of the tracked nodes
+        of tree ``tree_id`` less than ``target``, or ``None`` if there is none."""
+        lefts, by_left, rights, by_right = self._sorted_view(tree_id)
+        values = [values[idx - 1] for values in (lefts, rights)
+                  for idx in (bisect_left(values, target),) if idx]
+        return max(values) if values else None
+
+    def boundary_above(self, tree_id, target):
+        """Returns the least ``left`` or ``right`` value of the tracked nodes of
+        tree ``tree_id`` greater than ``target``, or ``None`` if there is none."""
+        lefts, by_left, rights, by_right = self._sorted_view(tree_id)
+        values = [values[idx] for values in (lefts, rights)
+                  for idx in (bisect_right(values, target),)
+                  if idx < len(values)]
+        return min(values) if values else None
+
+    def _view_remove(self, tree_id, node):
+        """Removes ``node`` from the sorted view of tree ``tree_id``, if there is
+        one, using its current ``left`` and ``right`` values. Returns ``False``
+        if the view had to be discarded instead."""
+        view = self._sorted.get(tree_id)
+        if view is None:
+            return True
+        for values, nodes, name in ((view[0], view[1], 'left'),
+                                    (view[2], view[3], 'right')):
+            value = getattr(node, self._field_names[name])
+            if value is None:
+                return True
+            idx = bisect_left(values, value)
+            while (idx < len(values) and values[idx] == value and
+                   nodes[idx] is not node):
+                idx += 1
+            if idx == len(values) or nodes[idx] is not node:
+                del self._sorted[tree_id]
+                return False
+            del values[idx]
+            del nodes[idx]
+        return True
+
+    def _view_insert(self, tree_id, node):
+        "Adds ``node`` to the sorted view of tree ``tree_id``, if there is one."
+        view = self._sorted.get(tree_id)
+        if view is None:
+            return
+        left = getattr(node, self._field_names['left'])
+        right = getattr(node, self._field_names['right'])
+        if left is None or right is None:
+            return
+        for values, nodes, value in ((view[0], view[1], left),
+                                     (view[2], view[3], right)):
+            idx = bisect_right(values, value)
+            values.insert(idx, value)
+            nodes.insert(idx, node)
+
+    def set_values(self, node, **values):
+        """Sets the committed values of the tree fields of ``node`` (given by the
+        keywords ``parent_id``, ``tree_id``, ``left``, ``right``, ``depth``,
+        ``path`` and ``root_order``), tracking the node if it wasn't already.
+        The sorted views of the affected trees are updated in place."""
+        set_committed_value = sqlalchemy.orm.attributes.set_committed_value
+        field_names = self._field_names
+        state = sqlalchemy.orm.attributes.instance_state(node)
+        old_tree_id = self._tree_of.get(state, _missing)
+        moved = 'tree_id' in values or 'left' in values or 'right' in values
+        keep_view = not moved or old_tree_id is _missing or \
+            self._view_remove(old_tree_id, node)
+        for key, value in values.items():
+            set_committed_value(node, field_names[key], value)
+        if field_names['tree_id'] not in state.dict:
+            if old_tree_id is not _missing:
+                self._untrack(state, keep_view)
+            return
+        tree_id = state.dict[field_names['tree_id']]
+        if old_tree_id is not _missing and old_tree_id != tree_id:
+            self._untrack(state, keep_view)
+        if old_tree_id is _missing or old_tree_id != tree_id:
+            self._tree_of[state] = tree_id
+            self._trees.setdefault(tree_id, {})[state] = None
+        if moved:
+            self._view_insert(tree_id, node)
+
+    def patch_rows(self, names, rows):
+        """Sets the tree fields ``names`` of the nodes held by the session from
+        the ``rows`` returned by a tree-maintenance statement, each made of a
+        primary key followed by the values of these fields. Rows of nodes not
+        in the identity map, or whose tree fields are not loaded, are skipped.
+        Returns the set of the states of the nodes patched."""
+        patched = set()
+        session = self._session()
+        if session is None:
+            return patched
+        identity_map = session.identity_map
+        mapper = sqlalchemy.orm.class_mapper(self._tree_options.node_class)
+        tree_id_name = self._field_names['tree_id']
+        for row in rows:
+            node = identity_map.get(
+                mapper.identity_key_from_primary_key([row[0]]))
+            if node is None:
+                continue
+            state = sqlalchemy.orm.attributes.instance_state(node)
+            if tree_id_name in state.dict:
+                self.set_values(node, **dict(zip(names, row[1:])))
+                patched.add(state)
+        return patched
+
+    def shift_tree_ids(self, target_tree_id, size, returned=()):
+        """Mirrors :meth:`TreeMapperExtension._manage_tree_gap`, adding ``size``
+        to the tree id of all nodes in trees after ``target_tree_id``, but for
+        those whose states are in ``returned``, already patched from the rows
+        the statement returned (see :meth:`patch_rows`)."""
+        set_committed_value = sqlalchemy.orm.attributes.set_committed_value
+        tree_id_name = self._field_names['tree_id']
+        if returned:
+            # Every tree is read before any is changed, since the nodes of one
+            # move into the bucket of another:
+            shifted = [(node, tree_id + size)
+                       for tree_id in self.tree_ids(lower=target_tree_id + 1)
+                       for node in self.tree(tree_id)
+                       if sqlalchemy.orm.attributes.instance_state(node)
+                       not in returned]
+            for node, tree_id in shifted:
+                self.set_values(node, tree_id=tree_id)
+            return
+        shifted = {}
+        for tree_id in self.tree_ids(lower=target_tree_id + 1):
+            states = self._trees.pop(tree_id)
+            self._sorted.pop(tree_id, None)
+            for state in states:
+                obj = state.obj()
+                if obj is not None:
+                    set_committed_value(obj, tree_id_name, tree_id + size)
+                self._tree_of[state] = tree_id + size
+            shifted[tree_id + size] = states
+        for tree_id, states in shifted.items():
+            self._trees.setdefault(tree_id, {}).update(states)
+            self._sorted.pop(tree_id, None)
+
+    def shift_positions(self, tree_id, target, size, returned=()):
+        """Mirrors :meth:`TreeMapperExtension._manage_position_gap`, adding
+        ``size`` to the ``left`` and ``right`` values greater than ``target`` in
+        the tree identified by ``tree_id``, but for the nodes whose states are
+        in ``returned`` (see :meth:`shift_tree_ids`). Since this shift is
+        monotonic, the sorted views of the tree are updated in place."""
+        set_committed_value = sqlalchemy.orm.attributes.set_committed_value
+        if returned:
+            left_name = self._field_names['left']
+            right_name = self._field_names['right']
+            for node in self.right_of(tree_id, target):
+                if (sqlalchemy.orm.attributes.instance_state(node)
+                        not in returned):
+                    values = {'right': getattr(node, right_name) + size}
+                    if getattr(node, left_name) > target:
+                        values['left'] = getattr(node, left_name) + size
+                    self.set_values(node, **values)
+            return
+        lefts, by_left, rights, by_right = self._sorted_view(tree_id)
+        for values, nodes, name in ((lefts, by_left, 'left'),
+                                    (rights, by_right, 'right')):
+            name = self._field_names[name]
+            for idx in range(bisect_right(values, target), len(values)):
+                values[idx] += size
+                set_committed_value(nodes[idx], name, values[idx])
+
+    def remap_positions(self, tree_id, lower, upper, positions):
+        """Mirrors :meth:`TreeMapperExtension._respace_subtree`, replacing the
+        ``left`` and ``right`` values of the nodes of tree ``tree_id`` lying
+        between ``lower`` and ``upper`` exclusive by their image in the
+        ``positions`` mapping."""
+        set_committed_value = sqlalchemy.orm.attributes.set_committed_value
+        left_name = self._field_names['left']
+        right_name = self._field_names['right']
+        for node in self.left_between(tree_id, lower + 1, upper - 1):
+            set_committed_value(
+                node, left_name, positions[getattr(node, left_name)])
+            set_committed_value(
+                node, right_name, positions[getattr(node, right_name)])
+        self._sorted.pop(tree_id, None)
+
 
 class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
 
@@ -38,6 +532,10 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
         super(TreeMapperExtension, self).__init__()
         # Save the options for future use.
         self._tree_options = options
+        # The statements moving nodes around, built once (see
+        # :meth:`_get_statement`), and their compiled forms:
+        self._statements = {}
+        self._compiled_cache = {}
 
     def __clause_element__(self):
         """Allows to use instances of ``TreeMapperExtension`` directly as argument
@@ -48,39 +546,51 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
         of relationships."""
         return self._tree_options.order_by_clause()
 
-    def _reload_tree_parameters(self, connection, *args):
-        "Forcibly loads tree parameters for passed in nodes from the database."
-        options = self._tree_options
+    def _reload_tree_parameters(self, connection, session_index, *args):
+        """Forcibly loads tree parameters for passed in nodes from the database.
 
-        for node in args:
-            if node is None:
-                continue
+        The session extension queues every node taking part in the flush (and
+        every target) with the session index, so the first call of a flush loads
+        them all with a single ``IN (...)`` query per ``RELOAD_CHUNK_SIZE`` nodes.
+        As every change made to the tree after that is mirrored in memory, later
+        calls only go to the database for nodes not loaded yet."""
+        options = self._tree_options
 
-            node_pk = getattr(node, options.pk_field.name)
-            if node_pk is None:
-                continue
+        nodes = {}
+        for node in session_index.pop_stale(*args):
+            # Take the primary key from the identity key, so that expired nodes
+            # aren't refreshed one at a time just to read it.
+            key = sqlalchemy.orm.attributes.instance_state(node).key
+            if key is not None:
+                nodes[key[1][0]] = node
+        if not nodes:
+            return
 
-            parent_id, tree_id, left, right, depth = connection.execute(
-                sqlalchemy.select([
-                    options.parent_id_field,
-                    options.tree_id_field,
-                    options.left_field,
-                    options.right_field,
-                    options.depth_field,
-                ])
-                .where(options.pk_field == node_pk)
-            ).fetchone()
-
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.parent_id_field.name, parent_id)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.tree_id_field.name, tree_id)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.left_field.name, left)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.right_field.name, right)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.depth_field.name, depth)
+        fields = [options.pk_field, options.parent_id_field,
+                  options.tree_id_field, options.left_field,
+                  options.right_field, options.depth_field]
+        extra_names = []
+        if options.path_field is not None:
+            fields.append(options.path_field)
+            extra_names.append('path')
+        if options.root_order_field is not None:
+            fields.append(options.root_order_field)
+            extra_names.append('root_order')
+        node_pks = list(nodes)
+        for offset in range(0, len(node_pks), RELOAD_CHUNK_SIZE):
+            for row in connection.execute(
+                    sqlalchemy.select(fields)
+                    .where(options.pk_field.in_(
+                        node_pks[offset:offset + RELOAD_CHUNK_SIZE]))):
+                pk, parent_id, tree_id, left, right, depth = row[:6]
+                node = nodes[pk]
+                state = sqlalchemy.orm.attributes.instance_state(node)
+                if options.pk_field.name not in state.dict:
+                    sqlalchemy.orm.attributes.set_committed_value(
+                        node, options.pk_field.name, pk)
+                session_index.set_values(
+                    node, parent_id=parent_id, tree_id=tree_id, left=left,
+                    right=right, depth=depth, **dict(zip(extra_names, row[6:])))
 
     def before_insert(self, mapper, connection, node):
         """Just prior to a previously non-existent node being inserted into the
@@ -110,101 +620,744 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
         """
         options = self._tree_options
 
-        params, session_objs = getattr(node, options.delayed_op_attr)
+        params, session_index = getattr(node, options.delayed_op_attr)
         target, position = params
 
-        self._reload_tree_parameters(connection, node, target)
+        if session_index.is_placed(node):
+            # Space was made for this node, and its tree fields were set, by the
+            # first insert of its run.
+            return
+
+        self._reload_tree_parameters(connection, session_index, node, target)
+
+        # With spacing, new root nodes are left that many free positions inside.
+        root_right = 2 + (options.spacing or 0)
 
         if target is None:
             # Easy: no target is specified, so place it as the root node of a new
             # tree. This requires just one query (to find the id of the new tree)
             # and no row updates.
-            tree_id = self._get_next_tree_id(connection, session_objs)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.parent_id_field.name, None)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.tree_id_field.name, tree_id)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.left_field.name, 1)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.right_field.name, 2)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.depth_field.name, 0)
+            nodes = [node]
+            tree_id = self._get_next_tree_id(connection, session_index)
+            session_index.set_values(
+                node, parent_id=None, tree_id=tree_id, left=1, right=root_right,
+                depth=0, **self._get_path_values(None, None))
+            if options.root_order_field is not None:
+                [root_order] = self._get_root_orders(
+                    connection, session_index, None, None, 1)
+                session_index.set_values(node, root_order=root_order)
 
         elif (getattr(target, options.left_field.name) == 1 and
               position in [options.class_manager.POSITION_LEFT,
                            options.class_manager.POSITION_RIGHT]):
             # Almost as easy as the last case: the node will become a root node, so
-            # we need only shift up by one the id value of any trees we are
-            # displacing.
+            # we need only shift up the id value of any trees we are displacing.
+            # Every other node of the flush headed for the same position is
+            # placed along with this one, as inserting them one by one would have
+            # done.
+            nodes = self._get_insert_run(session_index, node, position)
+            if options.root_order_field is not None:
+                # Root nodes are ordered by their root order instead, so the
+                # new trees are numbered like any other and no tree moves.
+                root_orders = self._get_root_orders(
+                    connection, session_index, target, position, len(nodes))
+                for obj, root_order in zip(nodes, root_orders):
+                    session_index.set_values(
+                        obj, parent_id=None,
+                        tree_id=self._get_next_tree_id(
+                            connection, session_index),
+                        left=1, right=root_right, depth=0,
+                        root_order=root_order,
+                        **self._get_path_values(None, None))
+                return
+
             target_tree_id = getattr(target, options.tree_id_field.name)
             if position == options.class_manager.POSITION_LEFT:
                 node_tree_id = target_tree_id
                 target_tree_id = target_tree_id - 1
             else:
                 node_tree_id = target_tree_id + 1
-            self._manage_tree_gap(connection, session_objs, target_tree_id, 1)
-
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.parent_id_field.name, None)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.tree_id_field.name, node_tree_id)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.left_field.name, 1)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.right_field.name, 2)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.depth_field.name, 0)
+            self._manage_tree_gap(
+                connection, session_index, target_tree_id, len(nodes))
+
+            for tree_id, obj in enumerate(nodes, node_tree_id):
+                session_index.set_values(
+                    obj, parent_id=None, tree_id=tree_id, left=1,
+                    right=root_right, depth=0,
+                    **self._get_path_values(None, None))
+
+        elif options.spacing:
+            # The tree is numbered sparsely, so the nodes can usually be put in
+            # free positions next to their siblings without touching any other
+            # row.
+            nodes = self._get_insert_run(session_index, node, position)
+            self._insert_with_spacing(
+                connection, session_index, nodes, target, position)
+
+        elif options.encoding == 'rational':
+            # The nodes are given values between those of their neighbours, so
+            # that no other row is usually touched.
+            nodes = self._get_insert_run(session_index, node, position)
+            tree_id, parent_id, depth, values = self._make_rational_room(
+                connection, session_index, target, position, len(nodes))
+            paths = self._get_path_values(target, position)
+            for obj, left, right in zip(nodes, values[::2], values[1::2]):
+                session_index.set_values(
+                    obj, parent_id=parent_id, tree_id=tree_id, left=left,
+                    right=right, depth=depth, **paths)
 
         else:
             # Otherwise our business is only slightly more messy. We need to
             # allocate space in the tree structure for our new node by shifting all
-            # nodes to the right up by two spaces.
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.left_field.name, 0)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.right_field.name, 1)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.depth_field.name, 0)
+            # nodes to the right up by two spaces--or, for a run of nodes headed
+            # for the same position, by two spaces for each of them, with a single
+            # update.
+            nodes = self._get_insert_run(session_index, node, position)
+            for obj in nodes:
+                session_index.set_values(obj, left=0, right=1, depth=0)
 
             gap_target, depth, left, parent_id, right_shift = \
                 self._calculate_inter_tree_move_values(node, target, position)
             if parent_id is None:
                 tree_id = None
             else:
-                tree_id = connection.execute(
-                    sqlalchemy.select([
-                        options.tree_id_field,
-                    ])
-                    .where(options.pk_field == parent_id)
-                ).fetchone()[0]
+                # The parent is either the target or the target's parent, so
+                # they share a tree.
+                tree_id = getattr(target, options.tree_id_field.name)
+
+            self._manage_position_gap(
+                connection, session_index, tree_id, gap_target,
+                right_shift * len(nodes))
+
+            paths = self._get_path_values(target, position)
+            for obj in nodes:
+                session_index.set_values(
+                    obj, parent_id=parent_id, tree_id=tree_id, left=left,
+                    right=left + 1, depth=depth, **paths)
+                left += 2
+
+        if options.root_order_field is not None:
+            # Only root nodes are ordered by it, but the column is not nullable:
+            for obj in nodes:
+                if getattr(obj, options.root_order_field.name) is None:
+                    session_index.set_values(obj, root_order=0)
+
+    def _get_insert_run(self, session_index, node, position):
+        """Returns the pending nodes of the flush to be inserted at the same
+        place as ``node``, in the order they will end up in the tree. Inserting
+        them one after the other as the first child of, or to the right of, a
+        target leaves them in the reverse of the order they were processed in."""
+        options = self._tree_options
+        nodes = session_index.pop_insert_run(node)
+        if position in (options.class_manager.POSITION_FIRST_CHILD,
+                        options.class_manager.POSITION_RIGHT):
+            nodes.reverse()
+        return nodes
+
+    def _get_path(self, target, position):
+        """Returns the path of a node put at ``position`` relative to
+        ``target``, or made a root node if ``target`` is ``None``, which is
+        empty if paths are not kept."""
+        options = self._tree_options
+        if target is None or options.path_field is None:
+            return ''
+        path = getattr(target, options.path_field.name)
+        if position in (options.class_manager.POSITION_FIRST_CHILD,
+                        options.class_manager.POSITION_LAST_CHILD):
+            path += options.path_segment(getattr(target, options.pk_field.name))
+        return path
+
+    def _get_path_values(self, target, position):
+        """Returns the keywords for :meth:`TreeSessionIndex.set_values` giving
+        a node put at ``position`` relative to ``target`` its path, which are
+        none if paths are not kept."""
+        if self._tree_options.path_field is None:
+            return {}
+        return {'path': self._get_path(target, position)}
+
+    def _get_repath_values(self, obj, old_path, new_path):
+        """Returns the keywords for :meth:`TreeSessionIndex.set_values` changing
+        the beginning of the path of ``obj`` from ``old_path`` to ``new_path``,
+        which are none if paths are not kept."""
+        options = self._tree_options
+        if options.path_field is None:
+            return {}
+        path = getattr(obj, options.path_field.name)
+        return {'path': new_path + path[len(old_path):]}
+
+    def _repath(self, old_path, new_path):
+        """Returns the SQL expression changing the beginning of the path of a
+        row from ``old_path`` to ``new_path``."""
+        path = sqlalchemy.func.substr(
+            self._tree_options.path_field, len(old_path) + 1)
+        if new_path:
+            path = sqlalchemy.literal(new_path) + path
+        return path
+
+    def _bound_repath(self):
+        """Returns the SQL expression of :meth:`_repath` for cached statements,
+        taking the paths from the bind parameters given by
+        :meth:`_get_repath_params`."""
+        path_field = self._tree_options.path_field
+        return sqlalchemy.bindparam('_new_path', type_=path_field.type) + \
+            sqlalchemy.func.substr(path_field, sqlalchemy.bindparam(
+                '_path_start', type_=sqlalchemy.Integer))
+
+    def _get_repath_params(self, old_path, new_path):
+        """Returns the parameters of the expression of :meth:`_bound_repath`
+        changing the beginning of paths from ``old_path`` to ``new_path``,
+        which are none if paths are not kept."""
+        if self._tree_options.path_field is None:
+            return {}
+        return {'_new_path': new_path, '_path_start': len(old_path) + 1}
+
+    def _get_root_orders(self, connection, session_index, target, position,
+                         count):
+        """Returns ``count`` increasing root orders for root nodes put at
+        ``position`` (left or right) relative to the root node ``target``, or
+        after the last root node if ``target`` is ``None``. They are spread
+        evenly between the root orders of the neighbouring root nodes, found
+        with a single query; only when there are not enough free values left
+        between them are the root orders of the root nodes right after the
+        position increased to make room (see
+        :meth:`_get_root_order_run_end`)."""
+        order = None
+        if target is not None:
+            order = getattr(target, self._tree_options.root_order_field.name)
+        return self._get_root_orders_at(
+            connection, session_index, order, position, count)
+
+    def _get_root_orders_at(self, connection, session_index, order, position,
+                            count):
+        """Returns the root orders of :meth:`_get_root_orders`, for root nodes
+        put at ``position`` relative to the root node whose root order is
+        ``order``, or after the last root node if ``order`` is ``None``."""
+        options = self._tree_options
+        field = options.root_order_field
+        roots = options.left_field == 1
+        # Root nodes inserted earlier in the flush are not in the table yet:
+        pending = [
+            getattr(obj, field.name) for obj in session_index.roots()
+            if sqlalchemy.orm.attributes.instance_state(obj).key is None and
+            getattr(obj, field.name) is not None]
+
+        def _query(aggregate, where):
+            return connection.execute(
+                sqlalchemy.select([aggregate(field)]).where(where)).scalar()
+
+        if order is None:
+            lower = max([_query(sqlalchemy.func.max, roots) or 0] + pending)
+            return [lower + ROOT_ORDER_SPACING * idx
+                    for idx in range(1, count + 1)]
+
+        if position == options.class_manager.POSITION_LEFT:
+            upper = order
+            lower = [value for value in pending if value < order] + [
+                _query(sqlalchemy.func.max, roots & (field < order))]
+            lower = [value for value in lower if value is not None]
+            lower = max(lower) if lower else \
+                order - ROOT_ORDER_SPACING * (count + 1)
+        else:
+            lower = order
+            upper = [value for value in pending if value > order] + [
+                _query(sqlalchemy.func.min, roots & (field > order))]
+            upper = [value for value in upper if value is not None]
+            upper = min(upper) if upper else \
+                order + ROOT_ORDER_SPACING * (count + 1)
+
+        if upper - lower <= count:
+            # Make room by moving the root nodes from ``upper`` on, up to the
+            # first gap wide enough to take the shift, which is usually well
+            # before the last root node:
+            shift = max(ROOT_ORDER_SPACING // 2, 2 * (count + 1))
+            end = self._get_root_order_run_end(
+                connection, session_index, upper, shift)
+            where = roots & (field >= upper)
+            if end is not None:
+                where &= field <= end
+            connection.execute(
+                options.table.update()
+                .values({field: field + shift})
+                .where(where))
+            for obj in session_index.roots():
+                value = getattr(obj, field.name)
+                if (value is not None and value >= upper and
+                        (end is None or value <= end)):
+                    session_index.set_values(obj, root_order=value + shift)
+            upper += shift
+
+        step = (upper - lower) // (count + 1)
+        return [lower + step * idx for idx in range(1, count + 1)]
+
+    def _get_root_order_run_end(self, connection, session_index, lower,
+                                shift):
+        """Returns the last root order of the run of root nodes from
+        ``lower`` on which have to be moved by ``shift`` to make room before
+        them: the first one followed by a gap greater than ``shift``, or
+        ``None`` if there is none. The root orders are read in chunks of
+        ``RELOAD_CHUNK_SIZE``."""
+        options = self._tree_options
+        field = options.root_order_field
+        pending = sorted(
+            getattr(obj, field.name) for obj in session_index.roots()
+            if sqlalchemy.orm.attributes.instance_state(obj).key is None and
+            getattr(obj, field.name) is not None and
+            getattr(obj, field.name) >= lower)
+
+        def _iter_stored():
+            value = lower - 1
+            while True:
+                values = [row[0] for row in connection.execute(
+                    sqlalchemy.select([field])
+                    .where((options.left_field == 1) & (field > value))
+                    .order_by(field).limit(RELOAD_CHUNK_SIZE))]
+                for value in values:
+                    yield value
+                if len(values) < RELOAD_CHUNK_SIZE:
+                    return
+
+        previous = None
+        for value in merge(pending, _iter_stored()):
+            if previous is not None and value - previous > shift:
+                return previous
+            previous = value
+        return None
+
+    def _set_root_orders(self, connection, session_index, root_orders):
+        """Gives the root nodes of the trees in the ``root_orders`` mapping of
+        tree ids to root orders their root order, with a single statement."""
+        options = self._tree_options
+        field = options.root_order_field
+        connection.execute(
+            options.table.update()
+            .values({field: sqlalchemy.case(
+                [(options.tree_id_field == tree_id, root_order)
+                 for tree_id, root_order in root_orders.items()],
+                else_=field)})
+            .where((options.left_field == 1) &
+                   options.tree_id_field.in_(list(root_orders))))
+        for tree_id, root_order in root_orders.items():
+            for obj in session_index.tree(tree_id):
+                if getattr(obj, options.left_field.name) == 1:
+                    session_index.set_values(obj, root_order=root_order)
+
+    def _rebuild_root_orders(self, connection):
+        """Orders the root nodes by tree id, once the trees have been numbered
+        by a complete rebuild."""
+        options = self._tree_options
+        if options.root_order_field is not None:
+            connection.execute(
+                options.table.update()
+                .values({options.root_order_field:
+                         options.tree_id_field * ROOT_ORDER_SPACING})
+                .where(options.left_field == 1))
+
+    def _insert_with_spacing(
+            self, connection, session_index, nodes, target, position):
+        """Places the run of pending ``nodes`` at ``position`` relative to
+        ``target`` in a tree numbered with spacing.
+
+        The nodes are put in the free positions found between the neighbours of
+        the insertion point, which takes no row updates at all. If there aren't
+        enough of them, the nodes of the enclosing subtree are spread out evenly
+        over its interval, which only updates the rows of that subtree unless
+        the interval has to be widened first (see :meth:`_respace_subtree`)."""
+        options = self._tree_options
+        class_manager = options.class_manager
+
+        tree_id, lower, upper, parent_id, depth = self._get_insert_range(
+            connection, session_index, target, position)
+        target_left = getattr(target, options.left_field.name)
+        target_right = getattr(target, options.right_field.name)
+        append = position in (class_manager.POSITION_LAST_CHILD,
+                              class_manager.POSITION_RIGHT)
+
+        container = None
+        if upper - lower - 1 < 2 * len(nodes):
+            if parent_id == getattr(target, options.pk_field.name):
+                container = (target_left, target_right)
+            else:
+                container = connection.execute(
+                    sqlalchemy.select([options.left_field,
+                                       options.right_field])
+                    .where(options.pk_field == parent_id)).fetchone()
+
+        if upper - lower - 1 >= 2 * len(nodes):
+            positions = self._get_spaced_positions(
+                lower, upper, len(nodes), append)
+        elif container is not None:
+            positions = self._respace_subtree(
+                connection, session_index, tree_id, container[0],
+                container[1], lower, len(nodes))
+        else:
+            # The parent isn't in the database yet, so just make room here.
+            size = 2 * (options.spacing + 1) * len(nodes)
+            self._manage_position_gap(
+                connection, session_index, tree_id, lower, size)
+            positions = self._get_spaced_positions(
+                lower, upper + size, len(nodes), append)
+
+        paths = self._get_path_values(target, position)
+        for obj, (left, right) in zip(nodes, positions):
+            session_index.set_values(
+                obj, parent_id=parent_id, tree_id=tree_id, left=left,
+                right=right, depth=depth, **paths)
+
+    def _get_insert_range(self, connection, session_index, target, position):
+        """Returns the id of the tree of ``target``, the values ``lower`` and
+        ``upper`` bounding the free positions at ``position`` relative to
+        ``target`` in a sparse tree (see :meth:`_get_boundary_below` and
+        :meth:`_get_boundary_above`), and the parent id and depth of nodes put
+        there, as a tuple ``(tree_id, lower, upper, parent_id, depth)``."""
+        options = self._tree_options
+        class_manager = options.class_manager
+
+        tree_id = getattr(target, options.tree_id_field.name)
+        target_left = getattr(target, options.left_field.name)
+        target_right = getattr(target, options.right_field.name)
+        if position == class_manager.POSITION_LAST_CHILD:
+            upper = target_right
+            lower = self._get_boundary_below(
+                connection, session_index, tree_id, upper)
+        elif position == class_manager.POSITION_FIRST_CHILD:
+            lower = target_left
+            upper = self._get_boundary_above(
+                connection, session_index, tree_id, lower)
+        elif position == class_manager.POSITION_LEFT:
+            upper = target_left
+            lower = self._get_boundary_below(
+                connection, session_index, tree_id, upper)
+        elif position == class_manager.POSITION_RIGHT:
+            lower = target_right
+            upper = self._get_boundary_above(
+                connection, session_index, tree_id, lower)
+        else:
+            raise ValueError(u"an invalid position was given: %s" % position)
+
+        depth = getattr(target, options.depth_field.name)
+        if position in (class_manager.POSITION_FIRST_CHILD,
+                        class_manager.POSITION_LAST_CHILD):
+            parent_id = getattr(target, options.pk_field.name)
+            depth += 1
+        else:
+            parent_id = getattr(target, options.parent_id_field.name)
+        return tree_id, lower, upper, parent_id, depth
 
+    def _get_boundary_below(self, connection, session_index, tree_id, target):
+        """Returns the greatest ``left`` or ``right`` value in the tree identified
+        by ``tree_id`` less than ``target``, including those of nodes of the
+        flush not yet inserted."""
+        options = self._tree_options
+        in_tree = options.tree_id_field == tree_id
+        values = list(connection.execute(sqlalchemy.select([
+            sqlalchemy.select([sqlalchemy.func.max(field)])
+            .where(in_tree & (field < target)).as_scalar()
+            for field in (options.left_field, options.right_field)
+        ])).fetchone())
+        values.append(session_index.boundary_below(tree_id, target))
+        return max(value for value in values if value is not None)
+
+    def _get_boundary_above(self, connection, session_index, tree_id, target):
+        """Returns the least ``left`` or ``right`` value in the tree identified
+        by ``tree_id`` greater than ``target``, including those of nodes of the
+        flush not yet inserted."""
+        options = self._tree_options
+        in_tree = options.tree_id_field == tree_id
+        values = list(connection.execute(sqlalchemy.select([
+            sqlalchemy.select([sqlalchemy.func.min(field)])
+            .where(in_tree & (field > target)).as_scalar()
+            for field in (options.left_field, options.right_field)
+        ])).fetchone())
+        values.append(session_index.boundary_above(tree_id, target))
+        return min(value for value in values if value is not None)
+
+    def _get_spaced_positions(self, lower, upper, count, append):
+        """Returns the ``(left, right)`` values of ``count`` sibling leaf nodes
+        placed between ``lower`` and ``upper`` exclusive, of which there must be
+        at least two per node. Each node takes a cell of up to ``2 * (spacing +
+        1)`` positions, about half of them free inside the node and the rest
+        free after it. With ``append`` the cells follow ``lower``, leaving the
+        free positions of the range after them, and otherwise they precede
+        ``upper``."""
+        spacing = self._tree_options.spacing
+        cell = min(2 * (spacing + 1), (upper - lower - 1) // count)
+        width = 2 + (cell - 2) // 2
+        if append:
+            start = lower + 1 + cell - width
+        else:
+            start = upper - count * cell
+        return [(start + idx * cell, start + idx * cell + width - 1)
+                for idx in range(count)]
+
+    def _respace_subtree(self, connection, session_index, tree_id, left, right,
+                         target, count):
+        """Spreads the nodes lying between ``left`` and ``right`` of the tree
+        identified by ``tree_id`` evenly over that interval, keeping them in
+        order, along with ``count`` new sibling leaf nodes placed right after
+        the ``target`` position, and returns the ``(left, right)`` values for
+        the new nodes.
+
+        If that would leave less than two free positions between neighbouring
+        values, the interval is first widened by shifting the rest of the tree,
+        to ``spacing + 1`` positions per value and at least twice its size, so
+        that the number of shifts stays logarithmic in the number of nodes
+        inserted into it."""
+        options = self._tree_options
+        rows = connection.execute(
+            sqlalchemy.select([options.pk_field,
+                               options.left_field,
+                               options.right_field])
+            .where((options.tree_id_field == tree_id) &
+                   (options.left_field > left) &
+                   (options.left_field < right))).fetchall()
+        values = [value for row in rows for value in row[1:]]
+        for node in session_index.left_between(tree_id, left + 1, right - 1):
+            if sqlalchemy.orm.attributes.instance_state(node).key is None:
+                values.extend((getattr(node, options.left_field.name),
+                               getattr(node, options.right_field.name)))
+        total = len(values) + 2 * count
+        if right - left < 3 * (total + 1):
+            size = max((options.spacing + 1) * (total + 1),
+                       2 * (right - left)) - (right - left)
             self._manage_position_gap(
-                connection, session_objs, tree_id, gap_target, right_shift)
-
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.parent_id_field.name, parent_id)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.left_field.name, left)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.right_field.name, left + 1)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.depth_field.name, depth)
-            sqlalchemy.orm.attributes.set_committed_value(
-                node, options.tree_id_field.name, tree_id)
+                connection, session_index, tree_id, right - 1, size)
+            right += size
+
+        values.sort()
+        spread = [left + (idx + 1) * (right - left) // (total + 1)
+                  for idx in range(total)]
+        split = bisect_right(values, target)
+        positions = dict(zip(values[:split], spread[:split]))
+        positions.update(zip(values[split:], spread[split + 2 * count:]))
+
+        if rows:
+            connection.execute(
+                options.table.update()
+                .values({options.left_field: sqlalchemy.bindparam('_left'),
+                         options.right_field: sqlalchemy.bindparam('_right')})
+                .where(options.pk_field == sqlalchemy.bindparam('_pk')),
+                [{'_pk': pk, '_left': positions[node_left],
+                  '_right': positions[node_right]}
+                 for pk, node_left, node_right in rows])
+        session_index.remap_positions(tree_id, left, right, positions)
+
+        run = spread[split:split + 2 * count]
+        return list(zip(run[::2], run[1::2]))
+
+    def _make_rational_room(
+            self, connection, session_index, target, position, count):
+        """Finds ``2 * count`` free values at ``position`` relative to ``target``
+        in a tree with rational encoding, for ``count`` nodes or the nodes of a
+        subtree of that size, and returns the id of the tree, the parent id and
+        depth of nodes put there, and the values in increasing order.
+
+        The values are mediants of the neighbouring values, so that no row has
+        to be updated. Only if they would be too precise to be stored is the
+        tree renumbered with whole numbers first (see :meth:`_normalize_tree`),
+        and should that not be enough either, the rest of the tree is shifted
+        to make room."""
+        tree_id, lower, upper, parent_id, depth = self._get_insert_range(
+            connection, session_index, target, position)
+        values = _get_mediants(lower, upper, 2 * count)
+        if values is None:
+            self._normalize_tree(connection, session_index, tree_id)
+            tree_id, lower, upper, parent_id, depth = self._get_insert_range(
+                connection, session_index, target, position)
+            values = _get_mediants(lower, upper, 2 * count)
+        if values is None:
+            self._manage_position_gap(
+                connection, session_index, tree_id, lower, 2 * count)
+            values = [lower + idx for idx in range(1, 2 * count + 1)]
+        return tree_id, parent_id, depth, values
+
+    def _normalize_tree(self, connection, session_index, tree_id):
+        """Renumbers the tree identified by ``tree_id``, which has rational
+        encoding, with the whole numbers from 1, keeping the order of its
+        values."""
+        rows, values = self._get_tree_values(connection, session_index, tree_id)
+        self._renumber_nodes(
+            connection, session_index, tree_id, None, None, rows,
+            dict((value, idx) for idx, value in enumerate(values, 1)))
+
+    def _get_tree_values(self, connection, session_index, tree_id,
+                         lower=None, upper=None):
+        """Returns the rows ``(pk, left, right, depth)`` of the nodes of the tree
+        identified by ``tree_id`` with a ``left`` value between ``lower`` and
+        ``upper`` inclusive (all of them, if these are ``None``), and the sorted
+        ``left`` and ``right`` values of those nodes, along with those of the
+        nodes of the flush without a row in the database."""
+        options = self._tree_options
+        condition = options.tree_id_field == tree_id
+        if lower is not None:
+            condition &= (options.left_field >= lower) & \
+                (options.left_field <= upper)
+        rows = connection.execute(
+            sqlalchemy.select([options.pk_field,
+                               options.left_field,
+                               options.right_field,
+                               options.depth_field])
+            .where(condition)).fetchall()
+        values = [value for row in rows for value in row[1:3]]
+        # Nodes inserted by the flush have no identity key until it ends, but
+        # have their rows, and primary keys, already. Those without a row are
+        # yet to be inserted, or deleted by the flush but not yet removed from
+        # the tree, and keep their place among the others:
+        pks = set(row[0] for row in rows)
+        for node in self._get_tracked_nodes(
+                session_index, tree_id, lower, upper):
+            if getattr(node, options.pk_field.name) not in pks:
+                values.extend((getattr(node, options.left_field.name),
+                               getattr(node, options.right_field.name)))
+        values.sort()
+        return rows, values
+
+    def _get_tracked_nodes(self, session_index, tree_id, lower, upper):
+        """Returns the tracked nodes of the tree identified by ``tree_id`` with a
+        ``left`` value between ``lower`` and ``upper`` inclusive, or all of
+        them if these are ``None``."""
+        if lower is None:
+            return [node for node in session_index.tree(tree_id)
+                    if getattr(node, self._tree_options.left_field.name)
+                    is not None]
+        return session_index.left_between(tree_id, lower, upper)
+
+    def _renumber_nodes(self, connection, session_index, tree_id, lower, upper,
+                        rows, positions, new_tree_id=None, depth_change=0,
+                        node=None, parent_id=None, paths=None):
+        """Replaces the ``left`` and ``right`` values of the nodes of the tree
+        identified by ``tree_id`` with a ``left`` value between ``lower`` and
+        ``upper`` inclusive (all of them, if these are ``None``) by their image
+        in the ``positions`` mapping, with one executemany ``UPDATE`` of the
+        ``rows`` of these nodes (as returned by :meth:`_get_tree_values`).
+        The nodes are moved to the tree ``new_tree_id`` if given and their
+        depth changed by ``depth_change``, the beginning of their paths changed
+        from the first to the second of the ``paths`` pair (if given), and the
+        parent id of ``node`` (if given) is set to ``parent_id``."""
+        options = self._tree_options
+        values = {options.left_field: sqlalchemy.bindparam('_left'),
+                  options.right_field: sqlalchemy.bindparam('_right')}
+        in_memory = {}
+        if new_tree_id is not None:
+            values[options.tree_id_field] = new_tree_id
+            in_memory['tree_id'] = new_tree_id
+        if depth_change:
+            values[options.depth_field] = options.depth_field + depth_change
+        if paths is not None and options.path_field is not None:
+            values[options.path_field] = self._repath(*paths)
+        if node is not None:
+            values[options.parent_id_field] = sqlalchemy.case(
+                [(options.pk_field == getattr(node, options.pk_field.name),
+                  parent_id)],
+                else_=options.parent_id_field)
+
+        if rows:
+            connection.execute(
+                options.table.update()
+                .values(values)
+                .where(options.pk_field == sqlalchemy.bindparam('_pk')),
+                [{'_pk': pk, '_left': positions[left],
+                  '_right': positions[right]}
+                 for pk, left, right, depth in rows])
+        for obj in self._get_tracked_nodes(
+                session_index, tree_id, lower, upper):
+            if paths is not None:
+                in_memory.update(self._get_repath_values(obj, *paths))
+            session_index.set_values(
+                obj,
+                left=positions[getattr(obj, options.left_field.name)],
+                right=positions[getattr(obj, options.right_field.name)],
+                depth=getattr(obj, options.depth_field.name) + depth_change,
+                **in_memory)
+        if node is not None:
+            session_index.set_values(node, parent_id=parent_id)
 
     def after_insert(self, mapper, connection, node):
         "Just after a previously non-existent node is inserted into the tree."
         options = self._tree_options
+        params, session_index = getattr(node, options.delayed_op_attr)
         delattr(node, options.delayed_op_attr)
+        session_index.mark_fresh(node)
+        if options.closure_table is not None:
+            self._insert_closure(connection, node)
+
+    def _insert_closure(self, connection, node):
+        """Adds the rows of the closure table linking ``node``, which has just
+        been inserted, to itself and to its parent's ancestors, with one
+        ``INSERT ... SELECT``."""
+        options = self._tree_options
+        closure = options.closure_table
+        pk = getattr(node, options.pk_field.name)
+
+        def _pk():
+            return sqlalchemy.literal(pk, type_=options.pk_field.type)
+        rows = sqlalchemy.select([
+            _pk().label('ancestor_id'), _pk().label('descendant_id'),
+            sqlalchemy.literal(0).label('distance')])
+        parent_id = getattr(node, options.parent_id_field.name)
+        if parent_id is not None:
+            rows = sqlalchemy.union_all(rows, sqlalchemy.select([
+                closure.c.ancestor_id, _pk(), closure.c.distance + 1,
+            ]).where(closure.c.descendant_id == parent_id))
+        connection.execute(closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'distance'], rows))
+
+    def _move_closure(self, connection, node, parent_id):
+        """Moves the subtree of ``node`` under the node ``parent_id`` (or makes
+        it a tree of its own if that is ``None``) in the closure table: the
+        rows linking its nodes to the former ancestors of ``node`` are deleted,
+        and rows linking them to ``parent_id`` and its ancestors inserted, with
+        one statement each."""
+        options = self._tree_options
+        closure = options.closure_table
+        pk = getattr(node, options.pk_field.name)
+        # The subqueries are on aliases, so as not to be correlated with the
+        # statement:
+        subtree, ancestors = closure.alias(), closure.alias()
+        connection.execute(closure.delete().where(
+            closure.c.descendant_id.in_(
+                sqlalchemy.select([subtree.c.descendant_id])
+                .where(subtree.c.ancestor_id == pk)) &
+            closure.c.ancestor_id.in_(
+                sqlalchemy.select([ancestors.c.ancestor_id])
+                .where((ancestors.c.descendant_id == pk) &
+                       (ancestors.c.distance > 0)))))
+        if parent_id is not None:
+            connection.execute(closure.insert().from_select(
+                ['ancestor_id', 'descendant_id', 'distance'],
+                sqlalchemy.select([
+                    ancestors.c.ancestor_id, subtree.c.descendant_id,
+                    ancestors.c.distance + subtree.c.distance + 1,
+                ]).where((ancestors.c.descendant_id == parent_id) &
+                         (subtree.c.ancestor_id == pk))))
+
+    def _delete_closure(self, connection, node):
+        """Removes ``node`` from the closure table ahead of its deletion. Its
+        children take its place under its parent, so the distances between
+        its descendants and ancestors shrink by one."""
+        options = self._tree_options
+        closure = options.closure_table
+        pk = getattr(node, options.pk_field.name)
+        ancestors, descendants = closure.alias(), closure.alias()
+        connection.execute(closure.update().values(
+            {closure.c.distance: closure.c.distance - 1}).where(
+            closure.c.ancestor_id.in_(
+                sqlalchemy.select([ancestors.c.ancestor_id])
+                .where((ancestors.c.descendant_id == pk) &
+                       (ancestors.c.distance > 0))) &
+            closure.c.descendant_id.in_(
+                sqlalchemy.select([descendants.c.descendant_id])
+                .where((descendants.c.ancestor_id == pk) &
+                       (descendants.c.distance > 0)))))
+        connection.execute(closure.delete().where(
+            (closure.c.ancestor_id == pk) | (closure.c.descendant_id == pk)))
 
     def before_delete(self, mapper, connection, node):
         "Just prior to an existent node being deleted."
         options = self._tree_options
 
-        session_objs = getattr(node, options.delayed_op_attr)
+        session_index = getattr(node, options.delayed_op_attr)
 
-        self._reload_tree_parameters(connection, node)
+        self._reload_tree_parameters(connection, session_index, node)
 
         # To prevent any cascade effects, we NULL-out any adjacency-list links to
         # the node being deleted. These links will be replaced with proper values
@@ -215,25 +1368,43 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
             .values({options.parent_id_field: None})
             .where(options.parent_id_field == pk)
         )
-        for obj in session_objs:
+        for obj in session_index.left_between(
+                getattr(node, options.tree_id_field.name),
+                getattr(node, options.left_field.name),
+                getattr(node, options.right_field.name)):
             if getattr(obj, options.parent_id_field.name) == pk:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.parent_id_field.name, None)
+                session_index.set_values(obj, parent_id=None)
+        if options.closure_table is not None:
+            self._delete_closure(connection, node)
 
     def after_delete(self, mapper, connection, node):
         "Just after an existent node is updated."
         options = self._tree_options
 
-        session_objs = getattr(node, options.delayed_op_attr)
+        session_index = getattr(node, options.delayed_op_attr)
         delattr(node, options.delayed_op_attr)
+        session_index.discard(node)
 
         parent_id = getattr(node, options.parent_id_field.name)
         tree_id = getattr(node, options.tree_id_field.name)
         left = getattr(node, options.left_field.name)
         right = getattr(node, options.right_field.name)
         depth = getattr(node, options.depth_field.name)
-
-        if left == 1:
+        # The paths of the descendants of the node lose its segment:
+        paths = ('', '')
+        if options.path_field is not None:
+            path = getattr(node, options.path_field.name)
+            paths = (path + options.path_segment(
+                getattr(node, options.pk_field.name)), path)
+
+        if left == 1 and options.encoding == 'rational':
+            # Root node of a tree with rational encoding. Shifting the values of
+            # the children down to 1, as is done below, could lose precision, so
+            # each subtree is renumbered from 1 instead.
+            self._promote_rational_children(
+                connection, session_index, node, paths)
+
+        elif left == 1:
             # Root node! Any children will be promoted to be root nodes
             # themselves.
 
@@ -251,102 +1422,164 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
                     sqlalchemy.asc(options.left_field))
             ).fetchall()
 
-            # We either close the gap formed by removing the tree (if there are no
-            # children), or make room for a separate tree for each child:
-            self._manage_tree_gap(
-                connection, session_objs, tree_id, len(children) - 1)
-
-            # Now for each child we promote that child to be root node of a new
-            # tree, updating all of it and its children's tree parameters:
-            next_tree_id = tree_id
-            for child_left, child_right in children:
-                # The shift is how much the positional fields (left/right) will have
-                # to be adjusted so that the new root node starts from 1.
-                shift = child_left - 1
-                # Assign the new tree parameters:
+            child_lefts = [child_left for child_left, child_right in children]
+            child_rights = [child_right for child_left, child_right in children]
+
+            # New nodes which are to be promoted to root themselves are picked
+            # out before the first child's subtree, which keeps the tree id,
+            # takes their place:
+            stored_lefts = set(child_lefts)
+            new_children = [
+                obj for obj in session_index.left_between(
+                    tree_id, left + 1, right - 1)
+                if getattr(obj, options.right_field.name) < right and
+                getattr(obj, options.depth_field.name) == depth + 1 and
+                getattr(obj, options.left_field.name) not in stored_lefts]
+
+            tree_ids, root_orders = self._get_promoted_trees(
+                connection, session_index, node,
+                len(children) + len(new_children))
+
+            # Now every child is promoted to be the root node of a new tree,
+            # with a single update of all of their subtrees. The subtree a row
+            # belongs to is the first whose ``right`` value is not less than
+            # its ``left`` value, as the subtrees are in order, and the shift is
+            # how much the positional fields (left/right) will have to be
+            # adjusted so that its new root node starts from 1.
+            if children:
+                shift = self._case_by_subtree(
+                    child_rights, [child_left - 1 for child_left in child_lefts])
+                values = {
+                    options.tree_id_field: self._case_by_subtree(
+                        child_rights, tree_ids),
+                    options.left_field: options.left_field - shift,
+                    options.right_field: options.right_field - shift,
+                    options.depth_field: options.depth_field - 1}
+                if options.path_field is not None:
+                    values[options.path_field] = self._repath(*paths)
+                if root_orders:
+                    values[options.root_order_field] = sqlalchemy.case(
+                        [(options.depth_field != depth + 1,
+                          options.root_order_field)],
+                        else_=self._case_by_subtree(
+                            child_rights, [root_orders[child_tree_id]
+                                           for child_tree_id in tree_ids]))
                 connection.execute(
-                    options.table.update().values(
-                        {options.tree_id_field: next_tree_id, options.left_field:
-                         options.left_field - shift, options.right_field: options.
-                         right_field - shift, options.depth_field: options.
-                         depth_field - 1}).where(
-                        (options.tree_id_field == tree_id) &
-                        (options.left_field >= child_left) &
-                        (options.left_field <= child_right)))
-                # Handle new nodes which are part of the subtree being promoted to
-                # root:
-                for obj in session_objs:
-                    obj_tree_id = getattr(obj, options.tree_id_field.name)
-                    if obj_tree_id != tree_id:
-                        continue
-                    obj_left = getattr(obj, options.left_field.name)
-                    obj_right = getattr(obj, options.right_field.name)
-                    obj_depth = getattr(obj, options.depth_field.name)
-                    if obj_left >= child_left and obj_right <= child_right:
-                        # Assign the new tree parameters:
-                        sqlalchemy.orm.attributes.set_committed_value(
-                            obj, options.tree_id_field.name, next_tree_id)
-                        sqlalchemy.orm.attributes.set_committed_value(
-                            obj, options.left_field.name, obj_left - shift)
-                        sqlalchemy.orm.attributes.set_committed_value(
-                            obj, options.right_field.name, obj_right - shift)
-                        sqlalchemy.orm.attributes.set_committed_value(
-                            obj, options.depth_field.name, obj_depth - 1)
-                # Increment the tree_id for the next time through the loop:
-                next_tree_id += 1
-            # Handle new nodes which are to be promoted to root themselves:
-            for obj in session_objs:
-                obj_tree_id = getattr(obj, options.tree_id_field.name)
-                if obj_tree_id != tree_id:
-                    continue
+                    options.table.update().values(values).where(
+                        options.tree_id_field == tree_id))
+
+            # The nodes of the session are patched in a single pass too. New
+            # nodes which are to be promoted to root themselves come after the
+            # children in the database, as they were left out of the query.
+            new_children = dict(
+                (sqlalchemy.orm.attributes.instance_state(obj), idx)
+                for idx, obj in enumerate(new_children, len(children)))
+            for obj in session_index.left_between(tree_id, left + 1, right - 1):
                 obj_left = getattr(obj, options.left_field.name)
                 obj_right = getattr(obj, options.right_field.name)
                 obj_depth = getattr(obj, options.depth_field.name)
-                if obj_left > left and obj_right < right and obj_depth == depth + 1:
-                    # The shift is how much the positional fields (left/right) will have
-                    # to be adjusted so that the new root node starts from 1.
+                idx = new_children.get(
+                    sqlalchemy.orm.attributes.instance_state(obj))
+                if idx is not None:
                     shift = obj_left - 1
-                    # Assign the new tree parameters:
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.tree_id_field.name, next_tree_id)
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.left_field.name, obj_left - shift)
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.right_field.name, obj_right - shift)
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.depth_field.name, obj_depth - 1)
-                    # Increment the tree_id for the next time through the loop:
-                    next_tree_id += 1
+                else:
+                    idx = bisect_right(child_lefts, obj_left) - 1
+                    if idx < 0 or obj_right > child_rights[idx]:
+                        continue
+                    shift = child_lefts[idx] - 1
+                values = {}
+                if root_orders and obj_depth == depth + 1:
+                    values['root_order'] = root_orders[tree_ids[idx]]
+                values.update(self._get_repath_values(obj, *paths))
+                # Assign the new tree parameters:
+                session_index.set_values(
+                    obj, tree_id=tree_ids[idx], left=obj_left - shift,
+                    right=obj_right - shift, depth=obj_depth - 1, **values)
 
         else:
             # Child node, which is much simper than the root node case. We simply
             # update the tree parameters of the children and eliminate the two gaps
             # where the old node's left and right values were.
 
-            # First, we need to update the parent before touching the borns
-            values = {
-                # if left > node.left and left < node.right and depth == node.depth + 1:
-                #   parent = node.parent
-                # else:
-                #   parent = parent
-                options.parent_id_field: sqlalchemy.case([
-                    ((options.left_field > left) & (options.left_field < right) & (options.depth_field == depth + 1), parent_id)
-                ], else_=options.parent_id_field)
-            }
-            # Only update the tree the original node was a part of:
-            connection.execute(options.table.update()
-                                      .values(values)
-                                      .where((options.tree_id_field == tree_id)))
-
-            # Then we can update the left/right/depth fields
-            values = {
-                # if left > node.left and left < node.right:
-                #   depth = depth - 1
-                # else:
-                #   depth = depth
-                options.depth_field: sqlalchemy.case(
-                    [((options.left_field > left) & (options.left_field < right), options.depth_field - 1)],
-                    else_=options.depth_field),
+            # Only update the tree the original node was a part of, if there is
+            # anything to update: a sparse node with no position free inside
+            # has no descendants.
+            returned = frozenset()
+            if not (options.sparse and options.encoding == 'integer' and
+                    right == left + 1):
+                # The parent, depth and path of the descendants and the
+                # positions of the rows past the node are all set by a single
+                # update:
+                params = {'_tree_id': tree_id, '_left': left, '_right': right,
+                          '_depth': depth, '_parent_id': parent_id}
+                params.update(self._get_repath_params(*paths))
+                returned = self._execute_shift(
+                    connection, session_index, 'delete_child', params)
+            for obj in session_index.right_of(tree_id, left):
+                if sqlalchemy.orm.attributes.instance_state(obj) in returned:
+                    continue
+                obj_left = getattr(obj, options.left_field.name)
+                obj_right = getattr(obj, options.right_field.name)
+                obj_depth = getattr(obj, options.depth_field.name)
+                values = {}
+                if (obj_left > left and
+                        obj_left < right and
+                        obj_depth == depth + 1):
+                    values['parent_id'] = parent_id
+                if (obj_left > left and
+                        obj_left < right):
+                    values['depth'] = obj_depth - 1
+                    values.update(self._get_repath_values(obj, *paths))
+                if not options.sparse:
+                    if (obj_left > left and
+                            obj_left < right):
+                        values['left'] = obj_left - 1
+                    elif (obj_left > right):
+                        values['left'] = obj_left - 2
+                    if (obj_right > left and
+                            obj_right < right):
+                        values['right'] = obj_right - 1
+                    elif (obj_right > right):
+                        values['right'] = obj_right - 2
+                if values:
+                    session_index.set_values(obj, **values)
+
+    def _build_delete_child_statement(self):
+        """Builds the statement of :meth:`after_delete` updating the descendants
+        of a deleted child node and, unless the tree is sparse, the rows past
+        it."""
+        options = self._tree_options
+        left = sqlalchemy.bindparam('_left')
+        right = sqlalchemy.bindparam('_right')
+        depth = sqlalchemy.bindparam('_depth', type_=options.depth_field.type)
+        parent_id = sqlalchemy.bindparam(
+            '_parent_id', type_=options.parent_id_field.type)
+        values = {
+            # if left > node.left and left < node.right and depth == node.depth + 1:
+            #   parent = node.parent
+            # else:
+            #   parent = parent
+            options.parent_id_field: sqlalchemy.case([
+                ((options.left_field > left) & (options.left_field < right) & (options.depth_field == depth + 1), parent_id)
+            ], else_=options.parent_id_field),
+            # if left > node.left and left < node.right:
+            #   depth = depth - 1
+            # else:
+            #   depth = depth
+            options.depth_field: sqlalchemy.case(
+                [((options.left_field > left) & (options.left_field < right), options.depth_field - 1)],
+                else_=options.depth_field),
+        }
+        if options.path_field is not None:
+            values[options.path_field] = sqlalchemy.case(
+                [((options.left_field > left) & (options.left_field < right), self._bound_repath())],
+                else_=options.path_field)
+        if options.sparse:
+            # In sparse trees, the positions of the old node are just left
+            # free, so only its descendants are written:
+            where = (options.left_field > left) & (options.left_field < right)
+        else:
+            values.update({
                 # if left > node.left and left < node.right:
                 #   left = left - 1
                 # elif left > right:
@@ -367,42 +1600,96 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
                     ((options.right_field > left) & (options.right_field < right), options.right_field - 1),
                     ((options.right_field > right),                                options.right_field - 2)
                 ], else_=options.right_field)
-            }
-            # Only update the tree the original node was a part of:
-            connection.execute(options.table.update()
-                               .values(values)
-                               # Only update the tree the original node was a part of:
-                               .where((options.tree_id_field == tree_id)))
-            for obj in session_objs:
-                obj_tree_id = getattr(obj, options.tree_id_field.name)
-                if obj_tree_id != tree_id:
-                    continue
-                obj_left = getattr(obj, options.left_field.name)
-                obj_right = getattr(obj, options.right_field.name)
-                obj_depth = getattr(obj, options.depth_field.name)
-                if (obj_left > left and
-                        obj_left < right and
-                        obj_depth == depth + 1):
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.parent_id_field.name, parent_id)
-                if (obj_left > left and
-                        obj_left < right):
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.left_field.name, obj_left - 1)
-                elif (obj_left > right):
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.left_field.name, obj_left - 2)
-                if (obj_right > left and
-                        obj_right < right):
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.right_field.name, obj_right - 1)
-                elif (obj_right > right):
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.right_field.name, obj_right - 2)
-                if (obj_left > left and
-                        obj_left < right):
-                    sqlalchemy.orm.attributes.set_committed_value(
-                        obj, options.depth_field.name, obj_depth - 1)
+            })
+            # The descendants and the rows to the right of the node, and
+            # its ancestors, whose right values lie past it:
+            where = (options.left_field > left) | (options.right_field > right)
+        return options.table.update().values(values).where(
+            (options.tree_id_field == sqlalchemy.bindparam('_tree_id')) & where)
+
+    def _case_by_subtree(self, rights, values, lower=0, upper=None):
+        """Returns the SQL expression giving the rows of each of the subtrees
+        whose ``right`` values are listed in order in ``rights`` the matching
+        value of ``values``. Rows are not compared with every subtree, but
+        located by bisection with nested ``CASE`` expressions, and the values
+        are written as literals, as there may be too many to bind."""
+        if upper is None:
+            upper = len(rights)
+        if upper - lower == 1:
+            return _literal(values[lower])
+        middle = (lower + upper) // 2
+        return sqlalchemy.case(
+            [(self._tree_options.left_field <= _literal(rights[middle - 1]),
+              self._case_by_subtree(rights, values, lower, middle))],
+            else_=self._case_by_subtree(rights, values, middle, upper))
+
+    def _promote_rational_children(
+            self, connection, session_index, node, paths=None):
+        """Makes each child of the deleted root node ``node`` of a tree with
+        rational encoding the root node of a new tree, renumbering its subtree
+        with the whole numbers from 1 (and changing the paths as given by
+        ``paths``, see :meth:`_renumber_nodes`)."""
+        options = self._tree_options
+        tree_id = getattr(node, options.tree_id_field.name)
+        left = getattr(node, options.left_field.name)
+        right = getattr(node, options.right_field.name)
+        depth = getattr(node, options.depth_field.name)
+        rows, values = self._get_tree_values(
+            connection, session_index, tree_id, left, right)
+        rows.sort(key=lambda row: row[1])
+        lefts = [row[1] for row in rows]
+        # Children inserted by the flush are among the rows already: the
+        # nodes of a flush are inserted before any is deleted.
+        children = [(row[1], row[2]) for row in rows if row[3] == depth + 1]
+
+        tree_ids, root_orders = self._get_promoted_trees(
+            connection, session_index, node, len(children))
+
+        # The first child stays in the tree, so it is renumbered last, once
+        # the nodes of the others are out of the way.
+        for new_tree_id, (child_left, child_right) in reversed(list(zip(
+                tree_ids, children))):
+            subtree = values[bisect_left(values, child_left):
+                             bisect_right(values, child_right)]
+            self._renumber_nodes(
+                connection, session_index, tree_id, child_left, child_right,
+                rows[bisect_left(lefts, child_left):
+                     bisect_right(lefts, child_right)],
+                dict((value, idx) for idx, value in enumerate(subtree, 1)),
+                new_tree_id, -1, paths=paths)
+        if root_orders:
+            self._set_root_orders(connection, session_index, root_orders)
+
+    def _get_promoted_trees(self, connection, session_index, node, count):
+        """Returns the tree ids of the ``count`` trees made of the subtrees of
+        the children of the deleted root node ``node``, in order, the first
+        keeping the tree id of ``node``, along with a mapping of their tree ids
+        to the root orders of their new root nodes, which is empty unless root
+        orders are kept.
+
+        Without root orders, the tree ids after that of ``node`` are shifted to
+        make room for the others (or to close the gap the tree leaves, if there
+        are no children and gaps are closed). With them, the others are numbered
+        like new trees and ordered between ``node`` and the root node after it,
+        so that no other tree is touched."""
+        options = self._tree_options
+        tree_id = getattr(node, options.tree_id_field.name)
+        if options.root_order_field is None:
+            if count or options.close_gaps:
+                self._manage_tree_gap(
+                    connection, session_index, tree_id, count - 1)
+            return list(range(tree_id, tree_id + count)), {}
+        if not count:
+            return [], {}
+        tree_ids = [tree_id] + options.tree_id_allocator.next_tree_ids(
+            connection, session_index, count - 1)
+        # The root orders are found while the children are not root nodes yet:
+        root_orders = [getattr(node, options.root_order_field.name)]
+        if count > 1:
+            root_orders += self._get_root_orders(
+                connection, session_index, node,
+                options.class_manager.POSITION_RIGHT, count - 1)
+        return tree_ids, dict(zip(tree_ids, root_orders))
 
     def before_update(self, mapper, connection, node):
         """Called just prior to an existent node being updated.
@@ -437,32 +1724,88 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
         if not hasattr(node, options.delayed_op_attr):
             return
 
-        params, session_objs = getattr(node, options.delayed_op_attr)
+        params, session_index = getattr(node, options.delayed_op_attr)
         target, position = params
         delattr(node, options.delayed_op_attr)
 
-        self._reload_tree_parameters(connection, node, target)
+        self._reload_tree_parameters(connection, session_index, node, target)
+
+        if self._is_in_place(node, target, position):
+            # A move cancelled by a later one, or by the moves made since.
+            return
 
         node_is_root_node = getattr(node, options.left_field.name) == 1
 
         if target is None:
             if not node_is_root_node:
-                self._make_child_into_root_node(connection, session_objs, node)
+                self._make_child_into_root_node(connection, session_index, node)
 
         elif (getattr(target, options.left_field.name) == 1 and
               position in [options.class_manager.POSITION_LEFT,
                            options.class_manager.POSITION_RIGHT]):
             self._make_sibling_of_root_node(
-                connection, session_objs, node, target, position)
+                connection, session_index, node, target, position)
+
+        elif options.encoding == 'rational':
+            self._move_rational_node(
+                connection, session_index, node, target, position)
 
         else:
             if node_is_root_node:
                 self._move_root_node(
-                    connection, session_objs, node, target, position)
+                    connection, session_index, node, target, position)
 
             else:
                 self._move_child_node(
-                    connection, session_objs, node, target, position)
+                    connection, session_index, node, target, position)
+
+        if options.closure_table is not None:
+            # The parent id of the node before the move can't tell whether it
+            # changed parents: depending on the order the flush saves nodes in,
+            # it may have been synchronized from the relationships already (or
+            # cleared, the parent being deleted). The closure rows of the
+            # subtree are moved every time, unless a root node stays one, which
+            # has none.
+            parent_id = getattr(node, options.parent_id_field.name)
+            if not (node_is_root_node and parent_id is None):
+                self._move_closure(connection, node, parent_id)
+
+    def _is_in_place(self, node, target, position):
+        """Returns whether ``node`` already is at ``position`` relative to
+        ``target``, next to it with no position between them, so that moving
+        it there would write the rows it is read from. Rational intervals are
+        never next to one another, and root orders are not compared."""
+        options = self._tree_options
+        class_manager = options.class_manager
+        if target is None or options.encoding == 'rational':
+            return False
+
+        def _get(obj, name):
+            return getattr(obj, getattr(options, '%s_field' % name).name)
+
+        if position in (class_manager.POSITION_LEFT,
+                        class_manager.POSITION_RIGHT):
+            if _get(target, 'left') == 1:
+                first, second = (node, target) \
+                    if position == class_manager.POSITION_LEFT \
+                    else (target, node)
+                return (options.root_order_field is None and
+                        _get(node, 'left') == 1 and
+                        _get(first, 'tree_id') + 1 == _get(second, 'tree_id'))
+            if _get(node, 'tree_id') != _get(target, 'tree_id'):
+                return False
+            if position == class_manager.POSITION_LEFT:
+                return _get(node, 'right') + 1 == _get(target, 'left')
+            return _get(target, 'right') + 1 == _get(node, 'left')
+
+        if (_get(node, 'tree_id') != _get(target, 'tree_id') or
+                _get(node, 'parent_id') != _get(target, 'pk')):
+            return False
+        if position == class_manager.POSITION_FIRST_CHILD:
+            return _get(target, 'left') + 1 == _get(node, 'left')
+        if position == class_manager.POSITION_LAST_CHILD:
+            return _get(node, 'right') + 1 == _get(target, 'right')
+        return False
 
     def after_update(self, mapper, connection, node):
         "Just after an existent node is updated."
@@ -470,69 +1813,98 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
         if hasattr(node, options.delayed_op_attr):
             delattr(node, options.delayed_op_attr)
 
-    def _get_next_tree_id(self, connection, session_objs):
-        """Determines the next largest unused tree id."""
+    def _get_next_tree_id(self, connection, session_index):
+        """Determines the next largest unused tree id, with the tree id
+        allocator of the tree."""
+        return self._tree_options.tree_id_allocator.next_tree_id(
+            connection, session_index)
+
+    def _get_statement(self, name, returning=()):
+        """Returns the statement built by the ``_build_<name>_statement``
+        method, made to return the ``returning`` columns if any. Statements
+        take the values of each operation as bind parameters, so that they
+        are built once for these tree options and, executed with
+        :meth:`_execute`, compiled once for each dialect."""
+        key = (name, tuple(returning))
+        statement = self._statements.get(key)
+        if statement is None:
+            if returning:
+                statement = self._get_statement(name).returning(*returning)
+            else:
+                statement = getattr(self, '_build_%s_statement' % name)()
+            self._statements[key] = statement
+        return statement
+
+    def _execute(self, connection, statement, params):
+        """Executes the cached ``statement`` with ``params``, reusing its
+        compiled form."""
+        return connection.execution_options(
+            compiled_cache=self._compiled_cache).execute(statement, params)
+
+    def _execute_shift(self, connection, session_index, name, params):
+        """Executes the cached ``UPDATE`` statement ``name`` moving nodes around
+        with ``params``. With the ``returning`` option, and if the database
+        supports it, the statement returns the tree fields of the rows it
+        changes, which are set on the persistent nodes of the session. Returns
+        the set of the states of the nodes so patched, which the caller has to
+        leave alone. The others, pending or whose rows were deleted earlier in
+        the flush, are left for it to patch."""
         options = self._tree_options
+        if not (options.returning and
+                _supports_update_returning(connection.dialect)):
+            self._execute(connection, self._get_statement(name), params)
+            return frozenset()
+        field_names = session_index.field_names
+        names = sorted(field_names)
+        columns = [options.pk_field] + [
+            options.table.c[field_names[name_]] for name_ in names]
+        rows = self._execute(
+            connection, self._get_statement(name, columns), params).fetchall()
+        return session_index.patch_rows(names, rows)
+
+    def _build_tree_gap_statement(self):
+        "Builds the statement of :meth:`_manage_tree_gap`."
+        options = self._tree_options
+        return options.table.update() \
+            .values({options.tree_id_field:
+                     options.tree_id_field + sqlalchemy.bindparam('_size')}) \
+            .where(options.tree_id_field > sqlalchemy.bindparam('_target'))
 
-        # tree_ids = filter(
-            # lambda tree_id: tree_id is not None, [
-                # getattr(n, options.tree_id_field.name)
-                # for n in session_objs])
-
-        tree_ids = [
-            tree_id for tree_id in [
-                getattr(n, options.tree_id_field.name)
-                for n in session_objs
-            ] if tree_id is not None
-        ]
-
-        return max(tree_ids + [connection.execute(
-            sqlalchemy.select([
-                (sqlalchemy.func.max(options.tree_id_field)).label('tree_id')
-            ])).fetchone()[0] or 0]) + 1
-
-    def _manage_tree_gap(self, connection, session_objs, target_tree_id, size):
+    def _manage_tree_gap(self, connection, session_index, target_tree_id, size):
         """Creates space for a new tree *after* the target by adding ``size`` to
         all tree id's greater than ``target_tree_id``."""
         options = self._tree_options
-        connection.execute(
-            options.table.update()
-            .values({options.tree_id_field: options.tree_id_field + size})
-            .where(options.tree_id_field > target_tree_id))
-        for obj in session_objs:
-            obj_tree_id = getattr(obj, options.tree_id_field.name)
-            if obj_tree_id > target_tree_id:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.tree_id_field.name, obj_tree_id + size)
+        returned = self._execute_shift(
+            connection, session_index, 'tree_gap',
+            {'_target': target_tree_id, '_size': size})
+        session_index.shift_tree_ids(target_tree_id, size, returned)
+        if size > 0:
+            options.tree_id_allocator.shifted(connection, size)
+
+    def _build_position_gap_statement(self):
+        "Builds the statement of :meth:`_manage_position_gap`."
+        options = self._tree_options
+        target = sqlalchemy.bindparam('_target')
+        size = sqlalchemy.bindparam('_size')
+        return options.table.update().values(
+            {options.left_field: sqlalchemy.case(
+                [(options.left_field > target, options.left_field + size)],
+                else_=options.left_field), options.right_field: sqlalchemy.case(
+                [
+                    (options.right_field > target, options.right_field + size)],
+                else_=options.right_field), }).where(
+            (options.tree_id_field == sqlalchemy.bindparam('_tree_id')) &
+            ((options.left_field > target) | (options.right_field > target)))
 
     def _manage_position_gap(
-            self, connection, session_objs, tree_id, target, size):
+            self, connection, session_index, tree_id, target, size):
         """Manages spaces in the tree identified by ``tree_id`` by changing the
         values of the left and right columns by ``size`` after the given
         ``target`` point."""
-        options = self._tree_options
-        connection.execute(
-            options.table.update().values(
-                {options.left_field: sqlalchemy.case(
-                    [(options.left_field > target, options.left_field + size)],
-                    else_=options.left_field), options.right_field: sqlalchemy.case(
-                    [
-                        (options.right_field > target, options.right_field + size)],
-                    else_=options.right_field), }).where(
-                (options.tree_id_field == tree_id) &
-                ((options.left_field > target) | (options.right_field > target))))
-        for obj in session_objs:
-            obj_tree_id = getattr(obj, options.tree_id_field.name)
-            if obj_tree_id != tree_id:
-                continue
-            obj_left = getattr(obj, options.left_field.name)
-            obj_right = getattr(obj, options.right_field.name)
-            if obj_left > target:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.left_field.name, obj_left + size)
-            if obj_right > target:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.right_field.name, obj_right + size)
+        returned = self._execute_shift(
+            connection, session_index, 'position_gap',
+            {'_tree_id': tree_id, '_target': target, '_size': size})
+        session_index.shift_positions(tree_id, target, size, returned)
 
     def _calculate_inter_tree_move_values(self, node, target, position):
         """Calculates values required when moving ``node`` relative to ``target``
@@ -576,33 +1948,28 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
 
         return gap_target, depth_change, left_right_change, parent_id, right_shift
 
-    def _inter_tree_move_and_close_gap(
-            self, connection, session_objs, node, new_tree_id,
-            left_right_change, depth_change, parent_id=None):
-        """Removes ``node`` from its current tree, with the given set of changes
-        being applied to ``node`` and its descendants, closing the gap left by
-        moving ``node`` as it does so.
-
-        If ``parent_id`` is ``None``, this indicates that ``node`` is being moved
-        to a brand new tree as its root node, and will thus have its parent field
-        set to ``NULL``. Otherwise, ``node`` will have ``parent_id`` set for its
-        parent field."""
+    def _build_inter_tree_move_statement(self):
+        "Builds the statement of :meth:`_inter_tree_move_and_close_gap`."
         options = self._tree_options
-
-        tree_id = getattr(node, options.tree_id_field.name)
-        left = getattr(node, options.left_field.name)
-        right = getattr(node, options.right_field.name)
-        depth = getattr(node, options.depth_field.name)
-        gap_size = right - left + 1
-
-        connection.execute(
-            options.table.update()
+        left = sqlalchemy.bindparam('_left')
+        right = sqlalchemy.bindparam('_right')
+        left_right_change = sqlalchemy.bindparam('_left_right_change')
+        gap_size = sqlalchemy.bindparam('_gap_size')
+        values = {}
+        if options.path_field is not None:
+            values[options.path_field] = sqlalchemy.case(
+                [((options.left_field >= left) & (options.left_field <= right), self._bound_repath())],
+                else_=options.path_field)
+        return options.table.update() \
+            .values(values) \
             .values({
                 options.parent_id_field: sqlalchemy.case(
-                    [(options.pk_field == getattr(node, options.pk_field.name), parent_id)],
+                    [(options.pk_field == sqlalchemy.bindparam('_pk'),
+                      sqlalchemy.bindparam('_parent_id', type_=options.parent_id_field.type))],
                     else_=options.parent_id_field),
                 options.tree_id_field:   sqlalchemy.case(
-                    [((options.left_field >= left) & (options.left_field <= right), new_tree_id)],
+                    [((options.left_field >= left) & (options.left_field <= right),
+                      sqlalchemy.bindparam('_new_tree_id', type_=options.tree_id_field.type))],
                     else_=options.tree_id_field),
                 options.left_field:      sqlalchemy.case(
                     [((options.left_field >= left) & (options.left_field <= right), options.left_field + left_right_change),
@@ -613,58 +1980,106 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
                      ((options.right_field > right),                                 options.right_field - gap_size)],
                     else_=options.right_field),
                 options.depth_field:     sqlalchemy.case(
-                    [((options.left_field >= left) & (options.left_field <= right), options.depth_field + depth_change)],
+                    [((options.left_field >= left) & (options.left_field <= right),
+                      options.depth_field + sqlalchemy.bindparam('_depth_change'))],
                     else_=options.depth_field),
-            })
-            .where(options.tree_id_field == tree_id))
-        for obj in session_objs:
-            obj_tree_id = getattr(obj, options.tree_id_field.name)
-            if obj_tree_id != tree_id:
+            }) \
+            .where((options.tree_id_field == sqlalchemy.bindparam('_tree_id')) &
+                   # Only the subtree, the rows to its right and its ancestors
+                   # change:
+                   ((options.left_field >= left) |
+                    (options.right_field > right)))
+
+    def _inter_tree_move_and_close_gap(
+            self, connection, session_index, node, new_tree_id,
+            left_right_change, depth_change, parent_id=None, path=''):
+        """Removes ``node`` from its current tree, with the given set of changes
+        being applied to ``node`` and its descendants, closing the gap left by
+        moving ``node`` as it does so.
+
+        If ``parent_id`` is ``None``, this indicates that ``node`` is being moved
+        to a brand new tree as its root node, and will thus have its parent field
+        set to ``NULL``. Otherwise, ``node`` will have ``parent_id`` set for its
+        parent field, and ``path`` for its new path."""
+        options = self._tree_options
+
+        tree_id = getattr(node, options.tree_id_field.name)
+        left = getattr(node, options.left_field.name)
+        right = getattr(node, options.right_field.name)
+        gap_size = right - left + 1
+        paths = ('', '')
+        if options.path_field is not None:
+            paths = (getattr(node, options.path_field.name), path)
+        params = {
+            '_pk': getattr(node, options.pk_field.name),
+            '_parent_id': parent_id, '_tree_id': tree_id,
+            '_new_tree_id': new_tree_id, '_left': left, '_right': right,
+            '_left_right_change': left_right_change, '_gap_size': gap_size,
+            '_depth_change': depth_change}
+        params.update(self._get_repath_params(*paths))
+        returned = self._execute_shift(
+            connection, session_index, 'inter_tree_move', params)
+        for obj in session_index.left_between(tree_id, left, right):
+            if sqlalchemy.orm.attributes.instance_state(obj) in returned:
                 continue
-            obj_left = getattr(obj, options.left_field.name)
-            obj_right = getattr(obj, options.right_field.name)
-            obj_depth = getattr(obj, options.depth_field.name)
-            if obj_left >= left and obj_left <= right:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.tree_id_field.name, new_tree_id)
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.left_field.name, obj_left + left_right_change)
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.depth_field.name, obj_depth + depth_change)
-            elif obj_left > right:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.left_field.name, obj_left - gap_size)
-            if obj_right >= left and obj_right <= right:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.right_field.name, obj_right +
-                    left_right_change)
-            elif obj_right > right:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.right_field.name, obj_right - gap_size)
-        sqlalchemy.orm.attributes.set_committed_value(
-            node, options.parent_id_field.name, parent_id)
-
-    def _make_child_into_root_node(self, connection, session_objs, node,
-                                   new_tree_id=None):
+            path_values = {}
+            if options.path_field is not None:
+                path_values = self._get_repath_values(obj, *paths)
+            session_index.set_values(
+                obj, tree_id=new_tree_id,
+                left=getattr(obj, options.left_field.name) + left_right_change,
+                right=getattr(obj, options.right_field.name) + left_right_change,
+                depth=getattr(obj, options.depth_field.name) + depth_change,
+                **path_values)
+        session_index.shift_positions(tree_id, right, -gap_size, returned)
+        session_index.set_values(node, parent_id=parent_id)
+
+    def _make_child_into_root_node(self, connection, session_index, node,
+                                   new_tree_id=None, root_order=None):
         """Removes ``node`` from its tree, making it the root node of a new tree.
-        If ``new_tree_id`` is not specified a new tree id will be generated."""
+        If ``new_tree_id`` is not specified a new tree id will be generated, and
+        if root orders are kept and ``root_order`` is not specified the new tree
+        comes last."""
         options = self._tree_options
 
         if not new_tree_id:
-            new_tree_id = self._get_next_tree_id(connection, session_objs)
+            new_tree_id = self._get_next_tree_id(connection, session_index)
+        if options.root_order_field is not None and root_order is None:
+            [root_order] = self._get_root_orders(
+                connection, session_index, None, None, 1)
 
         left = getattr(node, options.left_field.name)
         right = getattr(node, options.right_field.name)
         depth = getattr(node, options.depth_field.name)
-        left_right_change = 1 - left
-        depth_change = -depth
 
-        self._inter_tree_move_and_close_gap(connection, session_objs, node,
-                                            new_tree_id, left_right_change,
-                                            depth_change)
+        if options.encoding == 'rational':
+            # Renumber the subtree with the whole numbers from 1, leaving its
+            # old positions free.
+            rows, values = self._get_tree_values(
+                connection, session_index,
+                getattr(node, options.tree_id_field.name), left, right)
+            # (The path of a node is that of a node put to its left.)
+            self._renumber_nodes(
+                connection, session_index,
+                getattr(node, options.tree_id_field.name), left, right, rows,
+                dict((value, idx) for idx, value in enumerate(values, 1)),
+                new_tree_id, -depth, node, None,
+                (self._get_path(node, options.class_manager.POSITION_LEFT), ''))
+
+        else:
+            left_right_change = 1 - left
+            depth_change = -depth
+
+            self._inter_tree_move_and_close_gap(connection, session_index, node,
+                                                new_tree_id, left_right_change,
+                                                depth_change)
+
+        if root_order is not None:
+            self._set_root_orders(
+                connection, session_index, {new_tree_id: root_order})
 
     def _make_sibling_of_root_node(
-            self, connection, session_objs, node, target, position):
+            self, connection, session_index, node, target, position):
         """Moves ``node``, making it a sibling of the given ``target`` root node
         as specified by ``position``.
 
@@ -681,6 +2096,23 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
         tree_id = getattr(node,   options.tree_id_field.name)
         target_tree_id = getattr(target, options.tree_id_field.name)
 
+        if options.root_order_field is not None:
+            # Root nodes are ordered by their root order instead, so only that
+            # of the node changes, and no tree moves.
+            if position not in (options.class_manager.POSITION_LEFT,
+                                options.class_manager.POSITION_RIGHT):
+                raise ValueError(
+                    u"an invalid position was given: %s" % position)
+            [root_order] = self._get_root_orders(
+                connection, session_index, target, position, 1)
+            if getattr(node, options.left_field.name) > 1:
+                self._make_child_into_root_node(
+                    connection, session_index, node, root_order=root_order)
+            else:
+                self._set_root_orders(
+                    connection, session_index, {tree_id: root_order})
+            return
+
         if getattr(node, options.left_field.name) > 1:
             if position == options.class_manager.POSITION_LEFT:
                 gap_target = target_tree_id - 1
@@ -692,9 +2124,9 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
                 raise ValueError(
                     u"an invalid position was given: %s" % position)
 
-            self._manage_tree_gap(connection, session_objs, gap_target, 1)
+            self._manage_tree_gap(connection, session_index, gap_target, 1)
             self._make_child_into_root_node(
-                connection, session_objs, node, new_tree_id)
+                connection, session_index, node, new_tree_id)
 
         else:
             if position == options.class_manager.POSITION_LEFT:
@@ -734,19 +2166,21 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
                     (options.tree_id_field >= lower_bound) &
                     (options.tree_id_field <= upper_bound)
                 ))
-            for obj in session_objs:
-                obj_tree_id = getattr(obj, options.tree_id_field.name)
-                if obj_tree_id >= lower_bound and obj_tree_id <= upper_bound:
-                    if obj_tree_id == tree_id:
-                        sqlalchemy.orm.attributes.set_committed_value(
-                            obj, options.tree_id_field.name, new_tree_id)
-                    else:
-                        sqlalchemy.orm.attributes.set_committed_value(
-                            obj, options.tree_id_field.name, obj_tree_id +
-                            shift)
+            # Every tree is read before any is changed, since the nodes of one
+            # move into the bucket of another:
+            trees = [(obj_tree_id, session_index.tree(obj_tree_id))
+                     for obj_tree_id in session_index.tree_ids(
+                         lower_bound, upper_bound)]
+            for obj_tree_id, objs in trees:
+                if obj_tree_id == tree_id:
+                    new_obj_tree_id = new_tree_id
+                else:
+                    new_obj_tree_id = obj_tree_id + shift
+                for obj in objs:
+                    session_index.set_values(obj, tree_id=new_obj_tree_id)
 
     def _move_root_node(
-            self, connection, session_objs, node, target, position):
+            self, connection, session_index, node, target, position):
         """Moves root node``node`` to a different tree, inserting it relative to
         the given ``target`` node as specified by ``position``."""
         options = self._tree_options
@@ -768,11 +2202,15 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
 
         # Create space for the tree which will be inserted
         self._manage_position_gap(
-            connection, session_objs, new_tree_id, gap_target, right_shift)
+            connection, session_index, new_tree_id, gap_target, right_shift)
 
         # Move the root node, making it a child node
+        paths = ('', self._get_path(target, position))
+        values = {}
+        if options.path_field is not None:
+            values[options.path_field] = self._repath(*paths)
         connection.execute(
-            options.table.update().values(
+            options.table.update().values(values).values(
                 {options.parent_id_field: sqlalchemy.case(
                  [
                      (options.pk_field == getattr(node, options.pk_field.name),
@@ -783,33 +2221,81 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
                  depth_field + depth_change, }).where(
                 (options.tree_id_field == tree_id) &
                 (options.left_field >= left) & (options.left_field <= right)))
-        for obj in session_objs:
-            obj_tree_id = getattr(obj, options.tree_id_field.name)
-            if obj_tree_id != tree_id:
-                continue
+        for obj in session_index.left_between(tree_id, left, right):
             obj_left = getattr(obj, options.left_field.name)
             obj_right = getattr(obj, options.right_field.name)
             obj_depth = getattr(obj, options.depth_field.name)
-            if obj_left >= left and obj_left <= right:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.tree_id_field.name, new_tree_id)
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.left_field.name, obj_left + left_right_change)
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.right_field.name, obj_right +
-                    left_right_change)
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.depth_field.name, obj_depth + depth_change)
+            session_index.set_values(
+                obj, tree_id=new_tree_id, left=obj_left + left_right_change,
+                right=obj_right + left_right_change,
+                depth=obj_depth + depth_change,
+                **self._get_repath_values(obj, *paths))
         # Update the former root node to be consistent with the updated
         # tree in the database:
-        sqlalchemy.orm.attributes.set_committed_value(
-            node, options.parent_id_field.name, parent_id)
+        session_index.set_values(node, parent_id=parent_id)
+
+        # Remove the gap previously occupied by the tree, unless root nodes are
+        # ordered by their root order:
+        if options.root_order_field is None:
+            self._manage_tree_gap(connection, session_index, tree_id - 1, -1)
+
+    def _move_rational_node(
+            self, connection, session_index, node, target, position):
+        """Moves ``node``, root or child node of a tree with rational encoding,
+        relative to the given ``target`` node as specified by ``position``
+        (unless it is made a sibling of a root node). Its subtree is given
+        values between those of its new neighbours (see
+        :meth:`_make_rational_room`), which only updates the rows of the
+        subtree, and the values it leaves are just left free."""
+        options = self._tree_options
 
-        # Remove the gap previously occupied by the tree
-        self._manage_tree_gap(connection, session_objs, tree_id - 1, -1)
+        tree_id = getattr(node,   options.tree_id_field.name)
+        left = getattr(node,   options.left_field.name)
+        right = getattr(node,   options.right_field.name)
+        depth = getattr(node,   options.depth_field.name)
+        target_left = getattr(target, options.left_field.name)
+
+        if left == 1 or position in [options.class_manager.POSITION_FIRST_CHILD,
+                                     options.class_manager.POSITION_LAST_CHILD]:
+            relation = u"child"
+        else:
+            relation = u"sibling"
+        if node == target:
+            raise InvalidMoveError(
+                u"a node may not be made a %s of itself" % relation)
+        elif (getattr(target, options.tree_id_field.name) == tree_id and
+              left < target_left < right):
+            raise InvalidMoveError(
+                u"a node may not be made a %s of any of its descendants" %
+                relation)
+
+        # The path of a node is that of a node put to its left:
+        paths = (self._get_path(node, options.class_manager.POSITION_LEFT),
+                 self._get_path(target, position))
+        rows, values = self._get_tree_values(
+            connection, session_index, tree_id, left, right)
+        new_tree_id, parent_id, new_depth, positions = \
+            self._make_rational_room(
+                connection, session_index, target, position, len(values) // 2)
+        if (getattr(node, options.left_field.name),
+                getattr(node, options.right_field.name)) != (left, right):
+            # Making room renumbered the tree of the subtree as well.
+            left = getattr(node, options.left_field.name)
+            right = getattr(node, options.right_field.name)
+            rows, values = self._get_tree_values(
+                connection, session_index, tree_id, left, right)
+
+        self._renumber_nodes(
+            connection, session_index, tree_id, left, right, rows,
+            dict(zip(values, positions)), new_tree_id, new_depth - depth, node,
+            parent_id, paths)
+
+        if left == 1 and options.root_order_field is None:
+            # Remove the gap previously occupied by the tree
+            self._manage_tree_gap(connection, session_index, tree_id - 1, -1)
 
     def _move_child_node(
-            self, connection, session_objs, node, target, position):
+            self, connection, session_index, node, target, position):
         """Calls the appropriate method to move child node ``node`` relative to
         the given ``target`` node as specified by ``position``."""
         options = self._tree_options
@@ -819,13 +2305,13 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
 
         if tree_id == new_tree_id:
             self._move_child_within_tree(
-                connection, session_objs, node, target, position)
+                connection, session_index, node, target, position)
         else:
             self._move_child_to_new_tree(
-                connection, session_objs, node, target, position)
+                connection, session_index, node, target, position)
 
     def _move_child_to_new_tree(
-            self, connection, session_objs, node, target, position):
+            self, connection, session_index, node, target, position):
         """Moves child node ``node`` to a different tree, inserting it relative to
         the given ``target`` node in the new tree as specified by ``position``."""
         options = self._tree_options
@@ -841,15 +2327,57 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
 
         # Make space for the subtree which will be moved
         self._manage_position_gap(
-            connection, session_objs, new_tree_id, gap_target, width)
+            connection, session_index, new_tree_id, gap_target, width)
 
         # Move the subtree
         self._inter_tree_move_and_close_gap(
-            connection, session_objs, node, new_tree_id, left_right_change,
-            depth_change, parent_id)
+            connection, session_index, node, new_tree_id, left_right_change,
+            depth_change, parent_id, self._get_path(target, position))
+
+    def _build_move_within_tree_statement(self):
+        "Builds the statement of :meth:`_move_child_within_tree`."
+        options = self._tree_options
+        left = sqlalchemy.bindparam('_left')
+        right = sqlalchemy.bindparam('_right')
+        left_boundary = sqlalchemy.bindparam('_left_boundary')
+        right_boundary = sqlalchemy.bindparam('_right_boundary')
+        left_right_change = sqlalchemy.bindparam('_left_right_change')
+        gap_size = sqlalchemy.bindparam('_gap_size')
+        values = {}
+        if options.path_field is not None:
+            values[options.path_field] = sqlalchemy.case(
+                [((options.left_field >= left) & (options.left_field <= right), self._bound_repath())],
+                else_=options.path_field)
+        return options.table.update() \
+            .values(values) \
+            .values({
+                options.parent_id_field: sqlalchemy.case(
+                    [(options.pk_field == sqlalchemy.bindparam('_pk'),
+                      sqlalchemy.bindparam('_parent_id', type_=options.parent_id_field.type))],
+                    else_=options.parent_id_field),
+                options.left_field:      sqlalchemy.case(
+                    [((options.left_field >= left) & (options.left_field <= right),          options.left_field + left_right_change),
+                     ((options.left_field >= left_boundary) & (options.left_field <= right_boundary), options.left_field + gap_size)],
+                    else_=options.left_field),
+                options.right_field:     sqlalchemy.case(
+                    [((options.right_field >= left) & (options.right_field <= right),          options.right_field + left_right_change),
+                     ((options.right_field >= left_boundary) & (options.right_field <= right_boundary), options.right_field + gap_size)],
+                    else_=options.right_field),
+                options.depth_field:     sqlalchemy.case(
+                    [((options.left_field >= left) & (options.left_field <= right),
+                      options.depth_field + sqlalchemy.bindparam('_depth_change'))],
+                    else_=options.depth_field),
+            }) \
+            .where((options.tree_id_field == sqlalchemy.bindparam('_tree_id')) &
+                   # Only the rows with a left or right value between the old
+                   # and the new position of the subtree change:
+                   (((options.left_field >= left_boundary) &
+                     (options.left_field <= right_boundary)) |
+                    ((options.right_field >= left_boundary) &
+                     (options.right_field <= right_boundary))))
 
     def _move_child_within_tree(
-            self, connection, session_objs, node, target, position):
+            self, connection, session_index, node, target, position):
         """Moves child node ``node`` within its current tree relative to the given
         ``target`` node as specified by ``position``."""
         options = self._tree_options
@@ -924,51 +2452,40 @@ class TreeMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
         gap_size = width
         if left_right_change > 0:
             gap_size = -gap_size
-
-        connection.execute(
-            options.table.update()
-            .values({
-                options.parent_id_field: sqlalchemy.case(
-                    [(options.pk_field == getattr(node, options.pk_field.name), parent_id)],
-                    else_=options.parent_id_field),
-                options.left_field:      sqlalchemy.case(
-                    [((options.left_field >= left) & (options.left_field <= right),          options.left_field + left_right_change),
-                     ((options.left_field >= left_boundary) & (options.left_field <= right_boundary), options.left_field + gap_size)],
-                    else_=options.left_field),
-                options.right_field:     sqlalchemy.case(
-                    [((options.right_field >= left) & (options.right_field <= right),          options.right_field + left_right_change),
-                     ((options.right_field >= left_boundary) & (options.right_field <= right_boundary), options.right_field + gap_size)],
-                    else_=options.right_field),
-                options.depth_field:     sqlalchemy.case(
-                    [((options.left_field >= left) & (options.left_field <= right), options.depth_field + depth_change)],
-                    else_=options.depth_field),
-            })
-            .where(options.tree_id_field == tree_id))
-        for obj in session_objs:
-            obj_tree_id = getattr(obj, options.tree_id_field.name)
-            if obj_tree_id != tree_id:
+        # The path of a node is that of a node put to its left:
+        paths = (self._get_path(node, options.class_manager.POSITION_LEFT),
+                 self._get_path(target, position))
+        params = {
+            '_pk': getattr(node, options.pk_field.name),
+            '_parent_id': parent_id, '_tree_id': tree_id, '_left': left,
+            '_right': right, '_left_boundary': left_boundary,
+            '_right_boundary': right_boundary,
+            '_left_right_change': left_right_change, '_gap_size': gap_size,
+            '_depth_change': depth_change}
+        params.update(self._get_repath_params(*paths))
+        returned = self._execute_shift(
+            connection, session_index, 'move_within_tree', params)
+        for obj in session_index.right_of(tree_id, left_boundary - 1):
+            if sqlalchemy.orm.attributes.instance_state(obj) in returned:
                 continue
             obj_left = getattr(obj, options.left_field.name)
             obj_right = getattr(obj, options.right_field.name)
             obj_depth = getattr(obj, options.depth_field.name)
+            values = {}
             if obj_left >= left and obj_left <= right:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.left_field.name, obj_left + left_right_change)
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.depth_field.name, obj_depth + depth_change)
+                values['left'] = obj_left + left_right_change
+                values['depth'] = obj_depth + depth_change
+                values.update(self._get_repath_values(obj, *paths))
             elif obj_left >= left_boundary and obj_left <= right_boundary:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.left_field.name, obj_left + gap_size)
+                values['left'] = obj_left + gap_size
             if obj_right >= left and obj_right <= right:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.right_field.name, obj_right +
-                    left_right_change)
+                values['right'] = obj_right + left_right_change
             elif obj_right >= left_boundary and obj_right <= right_boundary:
-                sqlalchemy.orm.attributes.set_committed_value(
-                    obj, options.right_field.name, obj_right + gap_size)
+                values['right'] = obj_right + gap_size
+            if values:
+                session_index.set_values(obj, **values)
         # Update the node object to be consistent with database.
-        sqlalchemy.orm.attributes.set_committed_value(
-            node, options.parent_id_field.name, parent_id)
+        session_index.set_values(node, parent_id=parent_id)
 
 
 class TreeSessionExtension(sqlalchemy.orm.interfaces.SessionExtension):
@@ -988,25 +2505,117 @@ class TreeSessionExtension(sqlalchemy.orm.interfaces.SessionExtension):
         # Save the options for future use.
         self._tree_options = options
         self._node_class = node_class
+        # session -> TreeSessionIndex
+        self._session_indices = WeakKeyDictionary()
+        # Whether flushes may apply their moves through a TreeBatch (see
+        # _coalesce_moves), which numbers trees as they would be numbered one
+        # move at a time only if they are dense, and has to rebuild the
+        # closure table rather than patch it, and to find root orders afresh.
+        self._coalesces_moves = (
+            not options.sparse and options.closure_table is None and
+            options.root_order_field is None)
+
+    def session_index(self, session):
+        "Returns the :class:`TreeSessionIndex` of ``session``, creating it if need be."
+        session_index = self._session_indices.get(session)
+        if session_index is None:
+            session_index = self._session_indices[session] = TreeSessionIndex(
+                self._tree_options, session)
+        return session_index
+
+    def after_attach(self, session, instance):
+        "A node has been added to ``session``, or merged into it."
+        if isinstance(instance, self._node_class):
+            self.session_index(session).add(instance)
+
+    def load(self, node, context):
+        "A node has been loaded from the database by a query."
+        self.session_index(context.session).add(node)
+
+    def refresh(self, node, context, attrs):
+        "Expired or deferred attributes of a node have been loaded from the database."
+        self.session_index(context.session).add(node)
+
+    def _coalesce_moves(self, session):
+        """Applies the moves of the flush of ``session`` together, through a
+        :class:`TreeBatch`, writing only their net effect, if at least
+        ``COALESCE_MIN_MOVES`` of them touch the same tree (and none touches a
+        root node, see :meth:`TreeBatch.has_overlapping_moves`). The nodes of
+        a flush are saved in an order following their relationships, so this
+        is only done if the trees are changed by nothing but moves of
+        persistent nodes made with :meth:`TreeClassManager.insert`, which are
+        saved in the order of their primary keys, as the batch applies
+        them.
+
+        Successive moves of one node are already one: the last call of
+        :meth:`TreeClassManager.insert` before a flush replaces the others.
+        The moves of different nodes are neither reordered nor merged, only
+        written together."""
+        options = self._tree_options
+        node_class = self._node_class
+        if [node for node in session.new if isinstance(node, node_class)] or \
+                [node for node in session.deleted
+                 if isinstance(node, node_class)]:
+            return
+        for node in session.dirty:
+            if (isinstance(node, node_class) and
+                    sqlalchemy.orm.attributes.get_history(
+                        node, options.parent_field_name,
+                        sqlalchemy.orm.attributes.PASSIVE_NO_INITIALIZE)
+                    .has_changes()):
+                return
+        batch = options.class_manager.batch(session)
+        if batch.has_overlapping_moves(COALESCE_MIN_MOVES):
+            batch.apply()
+
+    def _get_nodes(self, session, pks):
+        """Returns the nodes with the primary keys ``pks`` by primary key, taking
+        those in the identity map of ``session`` from there, and loading the
+        others with one ``IN (...)`` query per ``RELOAD_CHUNK_SIZE`` of them.
+        Primary keys of no node are left out."""
+        options = self._tree_options
+        mapper = sqlalchemy.orm.class_mapper(options.node_class)
+        nodes, missing = {}, []
+        for pk in pks:
+            node = session.identity_map.get(
+                mapper.identity_key_from_primary_key([pk]))
+            if node is None:
+                missing.append(pk)
+            else:
+                nodes[pk] = node
+        for offset in range(0, len(missing), RELOAD_CHUNK_SIZE):
+            for node in session.query(options.node_class).filter(
+                    options.pk_field.in_(
+                        missing[offset:offset + RELOAD_CHUNK_SIZE])):
+                nodes[getattr(node, options.pk_field.name)] = node
+        return nodes
 
     def before_flush(self, session, flush_context, instances):
         "Just prior to a flush event, while we still have time to modify the flush plan."
         options = self._tree_options
 
-        session_objs = [
-            n for n in session.new.union(session.identity_map.values())
-            if isinstance(n, options.node_class)
-        ]
+        session_index = self.session_index(session)
+        if session_index.batch is not None:
+            # The changes collected by an open batch so far come first.
+            session_index.batch.apply()
+        session_index.reset()
 
-        for node in session.new.union(session.dirty):
+        if self._coalesces_moves:
+            self._coalesce_moves(session)
+
+        new = session.new
+        changes, target_ids = [], set()
+        for node in new.union(session.dirty):
             if not isinstance(node, self._node_class):
                 continue
 
+            session_index.add(node)
+
+            target_id = None
             if hasattr(node, options.delayed_op_attr):
-                setattr(node, options.delayed_op_attr,
-                        (getattr(node, options.delayed_op_attr), session_objs))
+                target, position = getattr(node, options.delayed_op_attr)
 
-            elif (node in session.new or
+            elif (node in new or
                   sqlalchemy.orm.attributes.get_history(
                     node, options.parent_field_name).has_changes()):
 
@@ -1017,21 +2626,37 @@ class TreeSessionExtension(sqlalchemy.orm.interfaces.SessionExtension):
                 else:
                     position = options.class_manager.POSITION_LAST_CHILD
                     target = getattr(node, options.parent_field_name)
-                    target_id = getattr(node, options.parent_id_field.name)
-                    if not target or target.id != target_id:
-                        # If the parent relationship is not set, or changed,
-                        # try to get it from the parent id column.
-                        if target_id is None:
-                            target = None
-                        else:
-                            target = session.query(options.node_class).get(target_id)
-
-                setattr(
-                    node, options.delayed_op_attr,
-                    ((target, position), session_objs))
+                    if target is None and node in new:
+                        # If the parent relationship of a new node is not set,
+                        # try to get it from the parent id column, below. The
+                        # relationship of a persistent node has changed to get
+                        # here, so its parent id column is not synced yet and
+                        # the relationship is what the node is moved to.
+                        target_id = getattr(node, options.parent_id_field.name)
+                        if target_id is not None:
+                            target_ids.add(target_id)
+
+            else:
+                continue
+
+            changes.append((node, target, target_id, position))
+
+        targets = self._get_nodes(session, target_ids)
+        for node, target, target_id, position in changes:
+            if target_id is not None:
+                target = targets.get(target_id)
+            setattr(node, options.delayed_op_attr,
+                    ((target, position), session_index))
+
+            session_index.mark_stale(node)
+            session_index.mark_stale(target)
+            if node in new and target is not None:
+                session_index.queue_insert(node, target, position)
 
         for node in filter(lambda n: isinstance(n, options.node_class), session.deleted):
-            setattr(node, options.delayed_op_attr, session_objs)
+            session_index.add(node)
+            session_index.mark_stale(node)
+            setattr(node, options.delayed_op_attr, session_index)
 
 
 class DeclarativeMeta(BaseDeclarativeMeta):
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Allocators
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, Unicode, ForeignKey
+from sqlalchemy.orm import mapper, relationship, backref
+
+from sqlalchemy_tree import TreeManager, CounterTreeIdAllocator, \
+    SequenceTreeIdAllocator
+
+from .helper import unittest, db
+from .Named import NamedTestCase
+
+REGISTRY = 'sqlalchemy_tree__tests__registry'
+
+
+def _map_node_class(name, allocator):
+    "Maps a node class to a table of its own numbering its trees with ``allocator``."
+    node_class = type(str(name.title()), (object,), {})
+    table = Table('sqlalchemy_tree__tests__%s' % name, db.metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', Unicode, nullable=False, unique=True),
+                  Column('parent_id', Integer, ForeignKey(
+                      'sqlalchemy_tree__tests__%s.id' % name)),
+                  )
+    node_class.tree = TreeManager(table, tree_id_allocator=allocator)
+    mapper(node_class, table, properties={
+        'parent': relationship(node_class,
+                               backref=backref('children', lazy='dynamic'),
+                               remote_side=table.c.id),
+    })
+    node_class.tree.register()
+    return node_class, table
+
+Counted, counted = _map_node_class(
+    'counted', CounterTreeIdAllocator(REGISTRY))
+Blocked, blocked = _map_node_class(
+    'blocked', CounterTreeIdAllocator(REGISTRY, block_size=5))
+Sequenced, sequenced = _map_node_class(
+    'sequenced', SequenceTreeIdAllocator())
+
+
+class CounterTreeIdAllocatorTestCase(unittest.TestCase):
+
+    "Provides tests of tree id allocation, using the `counted` table."
+    name_pattern = NamedTestCase.name_pattern
+    node_class = Counted
+    table = counted
+
+    def setUp(self):
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+        # The tree ids left in a block were reserved in the dropped registry:
+        allocator = self.node_class.tree._tree_options.tree_id_allocator
+        if hasattr(allocator, '_local'):
+            allocator._local.block = None
+
+        def _process_node(pattern, parent=None):
+            name, fields, children = pattern
+            node = self.node_class()
+            node.name = name
+            self.node_class.tree.insert(node, parent)
+            db.session.add(node)
+            db.session.commit()
+            for child in children:
+                _process_node(child, node)
+        for root in self.name_pattern:
+            _process_node(root)
+
+    def tearDown(self):
+        db.session.close()
+
+    def _get(self, name):
+        return db.session.query(self.node_class) \
+            .filter(self.table.c.name == name).one()
+
+    def _add_root(self, name, target=None, position=None):
+        node = self.node_class()
+        node.name = name
+        self.node_class.tree.insert(node, target and self._get(target),
+                                    position)
+        db.session.add(node)
+        db.session.commit()
+
+    def _get_roots(self):
+        """Returns the names of the root nodes by tree id, checking that every
+        node has the tree id of its root."""
+        roots = db.session.query(self.node_class) \
+            .filter(self.node_class.tree.filter_root_nodes()) \
+            .order_by(self.table.c.tree_id).all()
+        tree_ids = [root.tree_id for root in roots]
+        self.assertEqual(len(set(tree_ids)), len(tree_ids))
+        for root in roots:
+            self.assertEqual(
+                set(node.tree_id for node in root.tree.query_descendants()),
+                set([root.tree_id]) if root.tree_right > 2 else set())
+        return [root.name for root in roots]
+
+    def test_insert(self):
+        self.assertEqual(self._get_roots(), ['root1', 'root2', 'root3'])
+        for name in ('root4', 'root5', 'root6'):
+            self._add_root(name)
+        tree = self.node_class.tree
+        self._add_root('before1', 'root1', tree.POSITION_LEFT)
+        self._add_root('after2', 'root2', tree.POSITION_RIGHT)
+        self._add_root('root7')
+        self.assertEqual(self._get_roots(), [
+            'before1', 'root1', 'root2', 'after2', 'root3', 'root4', 'root5',
+            'root6', 'root7'])
+
+    def test_insert_many(self):
+        for idx in range(12):
+            node = self.node_class()
+            node.name = 'root%02d' % idx
+            db.session.add(node)
+        db.session.commit()
+        roots = self._get_roots()
+        self.assertEqual(roots[:3], ['root1', 'root2', 'root3'])
+        self.assertEqual(sorted(roots[3:]), roots[3:])
+
+    def test_move_and_delete(self):
+        tree = self.node_class.tree
+        # Children of deleted roots are made roots in their place:
+        db.session.delete(self._get('root2'))
+        db.session.commit()
+        self._add_root('root4')
+        # Moved nodes are made roots of new trees:
+        tree.insert(self._get('child212'), None)
+        db.session.commit()
+        tree.insert(self._get('child2121'), self._get('root1'),
+                    tree.POSITION_RIGHT)
+        db.session.commit()
+        self._add_root('root5')
+        self.assertEqual(self._get_roots(), [
+            'root1', 'child2121', 'child21', 'child22', 'child23', 'root3',
+            'root4', 'child212', 'root5'])
+
+    def test_insert_subtree(self):
+        node = self.node_class()
+        node.name = 'root4'
+        child = self.node_class()
+        child.name, child.parent = 'child41', node
+        self.node_class.tree.insert_subtree(node, session=db.session)
+        db.session.commit()
+        self._add_root('root5')
+        self.assertEqual(self._get_roots(),
+                         ['root1', 'root2', 'root3', 'root4', 'root5'])
+
+    def test_rebuild(self):
+        self._add_root('root4')
+        db.session.execute(self.table.insert(), [
+            {'name': 'new%d' % idx, 'tree_id': 0, 'tree_left': 0,
+             'tree_right': 0, 'tree_depth': 0} for idx in range(10)])
+        db.session.commit()
+        self.node_class.tree.bulk_rebuild(db.session)
+        self._add_root('root5')
+        self.assertEqual(self._get_roots()[-1], 'root5')
+        self.node_class.tree.rebuild(session=db.session)
+        self._add_root('root6')
+        self.assertEqual(self._get_roots()[-2:], ['root5', 'root6'])
+
+    def test_queries(self):
+        "New trees are numbered without querying the table."
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            for idx in range(4):
+                self._add_root('root%d' % (idx + 4))
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertFalse([statement for statement in statements
+                          if 'max(' in statement.lower()])
+        self.assertEqual(
+            len([statement for statement in statements
+                 if statement.startswith('UPDATE %s' % REGISTRY)]),
+            self.reservations)
+        self.assertEqual(self._get_roots()[-4:],
+                         ['root4', 'root5', 'root6', 'root7'])
+
+    # The number of times the counter is updated by test_queries:
+    reservations = 4
+
+
+class BlockTreeIdAllocatorTestCase(CounterTreeIdAllocatorTestCase):
+
+    "Provides tests of tree id allocation by blocks, using the `blocked` table."
+    node_class = Blocked
+    table = blocked
+    # The setUp has used three of the five tree ids of the first block:
+    reservations = 1
+
+    def test_rollback(self):
+        self._add_root('root4')
+        node = self.node_class()
+        node.name = 'root5'
+        db.session.add(node)
+        db.session.flush()
+        db.session.rollback()
+        self._add_root('root5')
+        self._add_root('root6')
+        self.assertEqual(self._get_roots(), [
+            'root1', 'root2', 'root3', 'root4', 'root5', 'root6'])
+        self.assertEqual(
+            db.session.execute(sqlalchemy.select([
+                sqlalchemy.column('next_tree_id')]).select_from(
+                    sqlalchemy.table(REGISTRY)).where(
+                        sqlalchemy.column('table_name') ==
+                        self.table.name)).scalar(), 11)
+
+
+class SequenceTreeIdAllocatorTestCase(CounterTreeIdAllocatorTestCase):
+
+    """Provides tests of tree id allocation, using the `sequenced` table,
+    which SQLite numbers as without an allocator, having no sequences."""
+    node_class = Sequenced
+    table = sequenced
+
+    def test_queries(self):
+        pass
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CounterTreeIdAllocatorTestCase))
+    suite.addTest(unittest.makeSuite(BlockTreeIdAllocatorTestCase))
+    suite.addTest(unittest.makeSuite(SequenceTreeIdAllocatorTestCase))
+    return suite
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Batch
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+
+import sqlalchemy
+
+from sqlalchemy_tree import InvalidMoveError
+
+from .helper import unittest, db, Named
+from .Named import NamedTestCase
+from .Closure import Closured
+from .Compaction import Holed
+from .Path import Pathed
+from .Rational import Rational
+from .RootOrder import Ordered
+from .Spacing import Spaced
+
+
+class ChangesTestCase(unittest.TestCase):
+
+    """Provides the fixture of tests applying random changes to the trees, and
+    helpers reading the trees back, using the `named` table."""
+    node_class = Named
+    name_pattern = NamedTestCase.name_pattern
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all(bind=self.engine)
+        db.metadata.create_all(bind=self.engine)
+        db.session = db.Session(bind=self.engine)
+
+        def _process_node(pattern, parent=None):
+            name, fields, children = pattern
+            node = self.node_class(name=name)
+            self.node_class.tree.insert(node, parent)
+            db.session.add(node)
+            db.session.commit()
+            for child in children:
+                _process_node(child, node)
+        for root in self.name_pattern:
+            _process_node(root)
+
+        self.statements = []
+        self.new_nodes = {}
+
+        @sqlalchemy.event.listens_for(self.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            self.statements.append(statement)
+        self._count = count
+
+    def tearDown(self):
+        sqlalchemy.event.remove(self.engine, 'before_cursor_execute',
+                                self._count)
+        db.session.close()
+
+    @property
+    def engine(self):
+        return db.engine
+
+    @property
+    def table(self):
+        return self.node_class.tree._tree_options.table
+
+    def _get(self, name):
+        # Nodes inserted within a batch are not in the table yet.
+        if name in self.new_nodes:
+            return self.new_nodes[name]
+        return db.session.query(self.node_class) \
+            .filter(self.table.c.name == name).one()
+
+    def _apply(self, op):
+        tree = self.node_class.tree
+        if op[0] == 'delete':
+            db.session.delete(self._get(op[1]))
+            return
+        kind, name, target, position = op
+        if kind == 'insert':
+            node = self.new_nodes[name] = self.node_class(name=name)
+        else:
+            node = self._get(name)
+        tree.insert(node, target and self._get(target), position)
+        if kind == 'insert':
+            db.session.add(node)
+
+    def _run_one_by_one(self, seed, count):
+        """Applies ``count`` random changes with a flush each, and returns them,
+        leaving out the moves which were not valid."""
+        tree = self.node_class.tree
+        positions = [tree.POSITION_LEFT, tree.POSITION_RIGHT,
+                     tree.POSITION_FIRST_CHILD, tree.POSITION_LAST_CHILD]
+        rng = random.Random(seed)
+        names = [row[0] for row in db.session.execute(
+            sqlalchemy.select([self.table.c.name]))]
+        # Nodes inserted by a batch can't be deleted within it:
+        deletable = list(names)
+        ops = []
+        for idx in range(count):
+            kind = rng.choice(['insert', 'move', 'move', 'move', 'delete'])
+            if kind == 'delete':
+                if len(deletable) < 4:
+                    continue
+                op = ('delete', deletable.pop(rng.randrange(len(deletable))))
+                names.remove(op[1])
+            elif kind == 'insert':
+                op = ('insert', 'new%d' % idx, rng.choice(names + [None]),
+                      rng.choice(positions))
+            else:
+                op = ('move', rng.choice(names), rng.choice(names + [None]),
+                      rng.choice(positions))
+            self._apply(op)
+            self.new_nodes.clear()
+            try:
+                db.session.commit()
+            except (InvalidMoveError, ValueError):
+                db.session.rollback()
+                node = self._get(op[1])
+                if hasattr(node, tree._tree_options.delayed_op_attr):
+                    delattr(node, tree._tree_options.delayed_op_attr)
+                continue
+            if kind == 'insert':
+                names.append(op[1])
+            ops.append(op)
+        return ops
+
+    def _get_rows(self):
+        return dict((row.name, row) for row in db.session.execute(
+            sqlalchemy.select([self.table])))
+
+    def _get_values(self):
+        """Returns the rows by name, naming the parents rather than giving
+        their primary keys, which new nodes may be given in another order (the
+        paths, made of primary keys, are checked by :meth:`_get_structure`)."""
+        options = self.node_class.tree._tree_options
+        rows = self._get_rows()
+        names = dict((row.id, name) for name, row in rows.items())
+        values = {}
+        for name, row in rows.items():
+            values[name] = dict(row, id=None, parent_id=names.get(row.parent_id))
+            if options.path_field is not None:
+                del values[name][options.path_field.name]
+        return values
+
+    def _get_structure(self):
+        """Reads the trees back as nested ``(name, children)`` pairs, checking
+        on the way that the parent ids, depths, paths and closure table agree
+        with the intervals."""
+        options = self.node_class.tree._tree_options
+        rows = sorted(self._get_rows().values(), key=lambda row: (
+            row.tree_id, row[options.left_field.name]))
+        roots, stack, by_pk, pairs = [], [], {}, set()
+        for row in rows:
+            left = row[options.left_field.name]
+            while stack and (stack[-1][0].tree_id != row.tree_id or
+                             stack[-1][0][options.right_field.name] < left):
+                stack.pop()
+            node = (row.name, [])
+            if stack:
+                parent = stack[-1][0]
+                stack[-1][1].append(node)
+                self.assertEqual(row.parent_id, parent.id)
+            else:
+                roots.append((row, node))
+                self.assertEqual(row.parent_id, None)
+            self.assertEqual(row[options.depth_field.name], len(stack))
+            if options.path_field is not None:
+                self.assertEqual(row[options.path_field.name], ''.join(
+                    options.path_segment(ancestor.id)
+                    for ancestor, children in stack))
+            pairs.add((row.id, row.id, 0))
+            pairs.update((ancestor.id, row.id, len(stack) - idx)
+                         for idx, (ancestor, children) in enumerate(stack))
+            stack.append((row, node[1]))
+            by_pk[row.id] = row
+        if options.closure_table is not None:
+            self.assertEqual(set(tuple(row) for row in db.session.execute(
+                sqlalchemy.select([options.closure_table]))), pairs)
+        if options.root_order_field is not None:
+            roots.sort(key=lambda root: root[0][options.root_order_field.name])
+        else:
+            self.assertEqual(len(set(root.tree_id for root, node in roots)),
+                             len(roots))
+        return [node for root, node in roots]
+
+    def _reset(self):
+        self.tearDown()
+        self.setUp()
+
+
+class BatchTestCase(ChangesTestCase):
+
+    """Provides tests of batches of changes, checking that they leave the trees
+    as applying the changes one flush at a time would."""
+    # Whether the trees are numbered the same way as well:
+    same_values = True
+
+    def _check_batch(self, seed, count):
+        self._reset()
+        ops = self._run_one_by_one(seed, count)
+        expected, expected_values = self._get_structure(), self._get_values()
+        self._reset()
+
+        # The nodes held by the session are kept in step:
+        nodes = db.session.query(self.node_class).all()
+        with self.node_class.tree.batch(db.session):
+            for op in ops:
+                self._apply(op)
+        rows = self._get_rows()
+        for node in nodes:
+            if node in db.session:
+                for column in self.table.c:
+                    self.assertEqual(getattr(node, column.name),
+                                     rows[node.name][column.name])
+        db.session.commit()
+
+        self.assertEqual(self._get_structure(), expected)
+        if self.same_values:
+            self.assertEqual(self._get_values(), expected_values)
+
+    def test_random_changes(self):
+        for seed in range(8):
+            self._check_batch(seed, 30)
+
+    def test_nothing_is_written_in_the_block(self):
+        tree = self.node_class.tree
+        with tree.batch(db.session):
+            tree.insert(self._get('root3'), self._get('child11'))
+            node = self.node_class(name='new')
+            tree.insert(node, self._get('child21'), tree.POSITION_LEFT)
+            db.session.add(node)
+            db.session.delete(self._get('child22'))
+            db.session.query(self.node_class).all()
+            self.assertFalse([statement for statement in self.statements
+                              if not statement.startswith('SELECT')])
+        self.assertEqual(self._get_structure()[:2], [
+            ('root1', [
+                ('child11', [('root3', [])]), ('child12', []),
+                ('child13', [])]),
+            ('root2', [
+                ('new', []),
+                ('child21', [
+                    ('child211', []),
+                    ('child212', [
+                        ('child2121', []), ('child2122', [
+                            ('child21221', []), ('child21222', [])])])]),
+                ('child23', [])])])
+        self.assertEqual(node.parent.name, 'root2')
+        self.assertEqual(
+            [child.name for child in self._get('child11').children],
+            ['root3'])
+
+    def test_invalid_move(self):
+        tree = self.node_class.tree
+        expected = self._get_structure()
+        del self.statements[:]
+        with self.assertRaises(InvalidMoveError):
+            with tree.batch(db.session):
+                tree.insert(self._get('child13'), self._get('child21'))
+                tree.insert(self._get('root2'), self._get('child2122'),
+                            tree.POSITION_LEFT)
+        self.assertFalse([statement for statement in self.statements
+                          if not statement.startswith('SELECT')])
+        db.session.rollback()
+        self.assertEqual(self._get_structure(), expected)
+
+    def test_parent_relationship(self):
+        # As in a flush, nodes given a new parent are moved to it:
+        root3 = self._get('root3')
+        with self.node_class.tree.batch(db.session):
+            root3.parent = self._get('child11')
+        db.session.commit()
+        self.assertEqual(self._get_structure()[0], (
+            'root1', [('child11', [('root3', [])]), ('child12', []),
+                      ('child13', [])]))
+
+    def test_flush_within_the_block(self):
+        tree = self.node_class.tree
+        with tree.batch(db.session):
+            node = self.node_class(name='new')
+            tree.insert(node, self._get('child12'))
+            db.session.add(node)
+            db.session.flush()
+            self.assertEqual(node.parent_id, self._get('child12').id)
+            tree.insert(self._get('child11'), node)
+        db.session.commit()
+        self.assertEqual(self._get_structure()[0], (
+            'root1', [('child12', [('new', [('child11', [])])]),
+                      ('child13', [])]))
+
+
+class NamedBatchTestCase(BatchTestCase):
+
+    def test_statements(self):
+        tree = self.node_class.tree
+        nodes = dict((name, self._get(name)) for name in (
+            'child211', 'child2121', 'child21221', 'child22', 'child23',
+            'child21'))
+        del self.statements[:]
+        with tree.batch(db.session):
+            for name in ('child211', 'child2121', 'child21221', 'child22'):
+                tree.insert(nodes[name], nodes['child23'], tree.POSITION_LEFT)
+            tree.insert(nodes['child23'], nodes['child21'],
+                        tree.POSITION_FIRST_CHILD)
+        # Two queries to read the tree, and one to write the rows which
+        # changed:
+        self.assertEqual(
+            [statement.split()[0] for statement in self.statements],
+            ['SELECT', 'SELECT', 'UPDATE'])
+
+    def test_root_positions(self):
+        tree = self.node_class.tree
+        for name in ('root4', 'root5'):
+            node = self.node_class(name=name)
+            tree.insert(node)
+            db.session.add(node)
+        db.session.commit()
+        with tree.batch(db.session):
+            tree.insert(self._get('root5'), self._get('root2'),
+                        tree.POSITION_LEFT)
+            tree.insert(self._get('child13'), self._get('root1'),
+                        tree.POSITION_LEFT)
+            db.session.delete(self._get('root2'))
+        db.session.commit()
+        self.assertEqual(
+            [(node.name, node.tree_id) for node in
+             db.session.query(self.node_class)
+             .filter(tree.filter_root_nodes()).order_by(tree.tree_id_field)],
+            [('child13', 1), ('root1', 2), ('root5', 3), ('child21', 4),
+             ('child22', 5), ('child23', 6), ('root3', 7), ('root4', 8)])
+
+
+class HoledBatchTestCase(BatchTestCase):
+    node_class = Holed
+    same_values = False
+
+
+class SpacedBatchTestCase(BatchTestCase):
+    node_class = Spaced
+    same_values = False
+
+
+class PathedBatchTestCase(BatchTestCase):
+    node_class = Pathed
+
+
+class ClosuredBatchTestCase(BatchTestCase):
+    node_class = Closured
+
+
+class OrderedBatchTestCase(BatchTestCase):
+    node_class = Ordered
+    same_values = False
+
+
+class RationalBatchTestCase(BatchTestCase):
+    node_class = Rational
+    same_values = False
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(NamedBatchTestCase))
+    suite.addTest(unittest.makeSuite(HoledBatchTestCase))
+    suite.addTest(unittest.makeSuite(SpacedBatchTestCase))
+    suite.addTest(unittest.makeSuite(PathedBatchTestCase))
+    suite.addTest(unittest.makeSuite(ClosuredBatchTestCase))
+    suite.addTest(unittest.makeSuite(OrderedBatchTestCase))
+    suite.addTest(unittest.makeSuite(RationalBatchTestCase))
+    return suite
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Closure
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, Unicode, ForeignKey
+from sqlalchemy.orm import mapper, relationship, backref
+
+from sqlalchemy_tree import TreeManager
+
+from .helper import unittest, db
+from .Named import NamedTestCase
+
+
+class Closured(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+closured = Table('sqlalchemy_tree__tests__closured', db.metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('name', Unicode, nullable=False, unique=True),
+                 Column('parent_id', Integer,
+                        ForeignKey('sqlalchemy_tree__tests__closured.id')),
+                 )
+Closured.tree = TreeManager(closured, closure_table=True)
+mapper(Closured, closured, properties={
+    'parent': relationship(Closured,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=closured.c.id),
+})
+Closured.tree.register()
+
+
+class RationalClosured(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+rational_closured = Table(
+    'sqlalchemy_tree__tests__rational_closured', db.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', Unicode, nullable=False, unique=True),
+    Column('parent_id', Integer,
+           ForeignKey('sqlalchemy_tree__tests__rational_closured.id')),
+)
+RationalClosured.tree = TreeManager(
+    rational_closured, encoding='rational',
+    closure_table='sqlalchemy_tree__tests__rational_closure')
+mapper(RationalClosured, rational_closured, properties={
+    'parent': relationship(RationalClosured,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=rational_closured.c.id),
+})
+RationalClosured.tree.register()
+
+
+amount = Table('sqlalchemy_tree__tests__amount', db.metadata,
+               Column('id', Integer, primary_key=True),
+               Column('node_id', Integer,
+                      ForeignKey('sqlalchemy_tree__tests__closured.id'),
+                      nullable=False),
+               Column('value', Integer, nullable=False),
+               )
+
+
+class ClosureTestCase(unittest.TestCase):
+
+    "Provides tests of the closure table, using the `closured` table."
+    name_pattern = NamedTestCase.name_pattern
+    node_class = Closured
+    table = closured
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+
+        def _process_node(pattern, parent=None):
+            name, fields, children = pattern
+            node = self.node_class(name=name)
+            self.node_class.tree.insert(node, parent)
+            db.session.add(node)
+            db.session.commit()
+            for child in children:
+                _process_node(child, node)
+        for root in self.name_pattern:
+            _process_node(root)
+
+    def tearDown(self):
+        db.session.close()
+
+    def _get(self, name):
+        return db.session.query(self.node_class) \
+            .filter(self.table.c.name == name).one()
+
+    def _insert(self, name, target, position):
+        node = self.node_class(name=name)
+        self.node_class.tree.insert(node, self._get(target), position)
+        db.session.add(node)
+        db.session.commit()
+
+    def _check_closure(self):
+        "Checks the closure table against the adjacency list."
+        parents = dict(db.session.execute(sqlalchemy.select(
+            [self.table.c.id, self.table.c.parent_id])).fetchall())
+        expected = set()
+        for pk in parents:
+            ancestor_id, distance = pk, 0
+            while ancestor_id is not None:
+                expected.add((ancestor_id, pk, distance))
+                ancestor_id, distance = parents[ancestor_id], distance + 1
+        closure = self.node_class.tree.closure_table
+        self.assertEqual(
+            set(tuple(row) for row in db.session.execute(
+                sqlalchemy.select([closure.c.ancestor_id,
+                                   closure.c.descendant_id,
+                                   closure.c.distance]))),
+            expected)
+
+    def test_closure_table(self):
+        closure = self.node_class.tree.closure_table
+        self.assertTrue(closure is
+                        self.node_class.tree._tree_options.closure_table)
+        self.assertTrue(closure.metadata is db.metadata)
+        self.assertEqual(
+            [column.name for column in closure.primary_key.columns],
+            ['ancestor_id', 'descendant_id'])
+        self._check_closure()
+
+    def test_filters(self):
+        tree = self.node_class.tree
+        for name in ('root1', 'root2', 'child21', 'child212', 'child2122',
+                     'child22'):
+            node = self._get(name)
+            for include_self in (False, True):
+                self.assertEqual(
+                    [n.name for n in node.tree.query_descendants(
+                        include_self=include_self, by_closure=True)],
+                    [n.name for n in node.tree.query_descendants(
+                        include_self=include_self)])
+                self.assertEqual(
+                    [n.name for n in node.tree.query_ancestors(
+                        include_self=include_self, by_closure=True)
+                     .order_by(tree)],
+                    [n.name for n in node.tree.query_ancestors(
+                        include_self=include_self).order_by(tree)])
+        child212, child22 = self._get('child212'), self._get('child22')
+        self.assertEqual(
+            sorted(node.name for node in db.session.query(self.node_class)
+                   .filter(tree.filter_descendants_of_node(
+                       child212, child22, by_closure=True))),
+            ['child2121', 'child2122', 'child21221', 'child21222'])
+
+    def test_insert(self):
+        tree = self.node_class.tree
+        self._insert('first', 'root1', tree.POSITION_FIRST_CHILD)
+        self._insert('left', 'child2122', tree.POSITION_LEFT)
+        self._insert('right', 'root2', tree.POSITION_RIGHT)
+        self._insert('last', 'child21222', tree.POSITION_LAST_CHILD)
+        self._check_closure()
+        root3 = self._get('root3')
+        for idx in range(5):
+            node = self.node_class(name='node%02d' % idx)
+            tree.insert(node, root3, tree.POSITION_FIRST_CHILD)
+            db.session.add(node)
+        db.session.commit()
+        self._check_closure()
+
+    def test_move(self):
+        tree = self.node_class.tree
+        moves = [
+            ('child212', 'root1', tree.POSITION_FIRST_CHILD),
+            ('child2122', 'child13', tree.POSITION_LEFT),
+            ('child21', 'child11', tree.POSITION_LAST_CHILD),
+            ('child22', 'root3', tree.POSITION_RIGHT),
+            ('root2', 'child21221', tree.POSITION_LAST_CHILD),
+            ('child21', None, tree.POSITION_LAST_CHILD),
+            ('child2121', 'child23', tree.POSITION_RIGHT),
+            ('child12', 'child211', tree.POSITION_FIRST_CHILD),
+        ]
+        for name, target, position in moves:
+            tree.insert(self._get(name), target and self._get(target),
+                        position)
+            db.session.commit()
+            self._check_closure()
+
+    def test_mixed_flush(self):
+        tree = self.node_class.tree
+        # Whether the closure rows of a moved node were moved depended on the
+        # order the flush saved the nodes in, which varies from run to run:
+        for idx in range(10):
+            if idx:
+                self.tearDown()
+                self.setUp()
+            for name, parent in (('n4', None), ('n6', None), ('n11', None),
+                                 ('n12', 'n4'), ('n3', 'n12'), ('n1', 'n3')):
+                node = self.node_class(name=name)
+                tree.insert(node, parent and self._get(parent))
+                db.session.add(node)
+                db.session.commit()
+            db.session.close()
+            db.session = db.Session()
+            nodes = dict((name, self._get(name)) for name in (
+                'n4', 'n6', 'n11', 'n12', 'n3', 'n1'))
+            tree.insert(nodes['n3'], nodes['n6'], tree.POSITION_LEFT)
+            node = self.node_class(name='new')
+            tree.insert(node, nodes['n4'])
+            db.session.add(node)
+            tree.insert(nodes['n11'], nodes['n6'])
+            db.session.delete(nodes['n12'])
+            db.session.commit()
+            self._check_closure()
+
+    def test_delete(self):
+        for name in ('child212', 'root2', 'child11'):
+            db.session.delete(self._get(name))
+            db.session.commit()
+            self._check_closure()
+
+
+    def test_delete_subtree(self):
+        for name in ('child212', 'root1'):
+            self.node_class.tree.delete_subtree(self._get(name))
+            db.session.commit()
+            self._check_closure()
+
+    def test_insert_subtree(self):
+        tree = self.node_class.tree
+        node = self.node_class(name='sub')
+        sub1 = self.node_class(name='sub1', parent=node)
+        self.node_class(name='sub11', parent=sub1)
+        self.node_class(name='sub2', parent=node)
+        tree.insert_subtree(node, self._get('child212'), tree.POSITION_RIGHT,
+                            session=db.session)
+        db.session.commit()
+        self._check_closure()
+        node = self.node_class(name='root4')
+        self.node_class(name='child41', parent=node)
+        tree.insert_subtree(node, session=db.session)
+        db.session.commit()
+        self._check_closure()
+
+    def test_rebuild(self):
+        tree = self.node_class.tree
+        closure = tree.closure_table
+        db.session.execute(closure.delete())
+        db.session.commit()
+        tree.rebuild_closure(db.session)
+        self._check_closure()
+        # Rebuilding a subtree rewrites the rows of its descendants:
+        db.session.execute(closure.delete().where(
+            closure.c.descendant_id == self._get('child2122').id))
+        db.session.commit()
+        tree.rebuild(self._get('child212'))
+        self._check_closure()
+        db.session.execute(closure.delete())
+        db.session.commit()
+        tree.rebuild(session=db.session)
+        self._check_closure()
+        db.session.execute(closure.delete())
+        db.session.commit()
+        tree.bulk_rebuild(db.session)
+        self._check_closure()
+
+    def test_aggregate(self):
+        if self.node_class is not Closured:
+            return
+        values = {'child11': 1, 'child13': 2, 'child211': 4, 'child21221': 8,
+                  'child23': 16, 'root3': 32}
+        db.session.execute(amount.insert(), [
+            {'node_id': self._get(name).id, 'value': value}
+            for name, value in values.items()])
+        closure = self.node_class.tree.closure_table
+        totals = dict(
+            db.session.query(self.node_class.name,
+                             sqlalchemy.func.sum(amount.c.value))
+            .join(closure, closure.c.ancestor_id == self.node_class.id)
+            .join(amount, amount.c.node_id == closure.c.descendant_id)
+            .group_by(self.node_class.name))
+        self.assertEqual(totals, {
+            'root1': 3, 'child11': 1, 'child13': 2, 'root2': 28,
+            'child21': 12, 'child211': 4, 'child212': 8, 'child2122': 8,
+            'child21221': 8, 'child23': 16, 'root3': 32})
+
+
+class RationalClosureTestCase(ClosureTestCase):
+
+    "Runs the tests of the closure table with rational encoding."
+    node_class = RationalClosured
+    table = rational_closured
+
+    def test_closure_table(self):
+        self.assertEqual(self.node_class.tree.closure_table.name,
+                         'sqlalchemy_tree__tests__rational_closure')
+        super(RationalClosureTestCase, self).test_closure_table()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ClosureTestCase))
+    suite.addTest(unittest.makeSuite(RationalClosureTestCase))
+    return suite
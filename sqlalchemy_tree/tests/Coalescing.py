@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Coalescing
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import random
+
+import sqlalchemy
+
+from sqlalchemy_tree import InvalidMoveError
+
+from .helper import unittest, db
+from .Batch import ChangesTestCase
+from .Compaction import Holed
+from .Path import Pathed
+
+
+class CoalescingTestCase(ChangesTestCase):
+
+    """Provides tests of flushes applying several moves together, checking
+    that they leave the trees as applying the moves one at a time, in the
+    order of the flush, would."""
+
+    def setUp(self):
+        super(CoalescingTestCase, self).setUp()
+        self._coalesces = self.node_class.tree.session_extension \
+            ._coalesces_moves
+
+    def tearDown(self):
+        self._set_coalescing(self._coalesces)
+        super(CoalescingTestCase, self).tearDown()
+
+    def _set_coalescing(self, coalesces):
+        self.node_class.tree.session_extension._coalesces_moves = coalesces
+
+    def _run_in_flushes(self, seed, count, size, groups=None):
+        """Applies ``count`` random changes, flushing after every ``size`` moves
+        or every insert or delete, or only the ``groups`` of changes given.
+        Returns the groups which could be applied."""
+        tree = self.node_class.tree
+        positions = [tree.POSITION_LEFT, tree.POSITION_RIGHT,
+                     tree.POSITION_FIRST_CHILD, tree.POSITION_LAST_CHILD]
+        if groups is None:
+            rng = random.Random(seed)
+            names = [row[0] for row in db.session.execute(
+                sqlalchemy.select([self.table.c.name]))]
+            deletable, groups = list(names), []
+            for idx in range(count):
+                # Only flushes moving nodes and nothing else are applied
+                # together.
+                kind = rng.choice(['insert', 'move', 'move', 'move', 'move',
+                                   'move', 'delete'])
+                if (kind != 'move' or not groups or groups[-1][-1][0] != 'move'
+                        or len(groups[-1]) == size):
+                    groups.append([])
+                if kind == 'delete' and len(deletable) > 4:
+                    op = ('delete',
+                          deletable.pop(rng.randrange(len(deletable))))
+                    names.remove(op[1])
+                elif kind == 'insert':
+                    op = ('insert', 'new%d' % idx, rng.choice(names + [None]),
+                          rng.choice(positions))
+                    names.append(op[1])
+                else:
+                    op = ('move', rng.choice(names), rng.choice(names + [None]),
+                          rng.choice(positions))
+                groups[-1].append(op)
+
+        delayed_op_attr = self.node_class.tree._tree_options.delayed_op_attr
+        applied = []
+        for group in groups:
+            with db.session.no_autoflush:
+                for op in group:
+                    self._apply(op)
+            self.new_nodes.clear()
+            try:
+                db.session.commit()
+            except (InvalidMoveError, ValueError):
+                db.session.rollback()
+                for node in db.session:
+                    if hasattr(node, delayed_op_attr):
+                        delattr(node, delayed_op_attr)
+                continue
+            applied.append(group)
+        return applied
+
+    def _check_flushes(self, seed, count, size):
+        self._reset()
+        self._set_coalescing(False)
+        groups = self._run_in_flushes(seed, count, size)
+        expected, expected_values = self._get_structure(), self._get_values()
+        self._reset()
+        self._set_coalescing(self._coalesces)
+        self.assertEqual(self._run_in_flushes(seed, count, size, groups),
+                         groups)
+        self.assertEqual(self._get_structure(), expected)
+        self.assertEqual(self._get_values(), expected_values)
+
+    def test_random_flushes(self):
+        for seed in range(8):
+            self._check_flushes(seed, 50, 5)
+
+    def test_moves_into_one_place(self):
+        tree = self.node_class.tree
+        nodes = dict((name, self._get(name)) for name in (
+            'child12', 'child211', 'child212', 'child22', 'child23'))
+        del self.statements[:]
+        for name in ('child211', 'child22', 'child23'):
+            tree.insert(nodes[name], nodes['child12'])
+        db.session.flush()
+        # Two queries to read the trees, and one to write the rows which
+        # changed:
+        self.assertEqual(
+            [statement.split()[0] for statement in self.statements],
+            ['SELECT', 'SELECT', 'UPDATE'])
+        db.session.commit()
+        self.assertEqual(self._get_structure()[:2], [
+            ('root1', [
+                ('child11', []),
+                ('child12', [('child211', []), ('child22', []),
+                             ('child23', [])]),
+                ('child13', [])]),
+            ('root2', [
+                ('child21', [
+                    ('child212', [
+                        ('child2121', []), ('child2122', [
+                            ('child21221', []), ('child21222', [])])])])])])
+
+    def test_cancelled_move(self):
+        tree = self.node_class.tree
+        expected = self._get_values()
+        nodes = dict((name, self._get(name)) for name in (
+            'root1', 'child11', 'child12', 'child13', 'child22', 'child23',
+            'root2', 'root3'))
+        del self.statements[:]
+        # Moved away and back, the nodes are found in their place and nothing
+        # is written:
+        tree.insert(nodes['child12'], nodes['child23'])
+        tree.insert(nodes['child12'], nodes['child13'], tree.POSITION_LEFT)
+        db.session.flush()
+        tree.insert(nodes['child13'], nodes['child11'])
+        tree.insert(nodes['child13'], nodes['root1'])
+        db.session.flush()
+        tree.insert(nodes['child22'], nodes['child23'], tree.POSITION_LEFT)
+        tree.insert(nodes['root2'], nodes['root3'], tree.POSITION_LEFT)
+        db.session.flush()
+        self.assertFalse([statement for statement in self.statements
+                          if not statement.startswith('SELECT')])
+        db.session.commit()
+        self.assertEqual(self._get_values(), expected)
+
+    def test_repeated_moves(self):
+        tree = self.node_class.tree
+        moves = [('child211', 'child12', tree.POSITION_LAST_CHILD),
+                 ('child211', 'root3', tree.POSITION_LEFT),
+                 ('child211', 'child22', tree.POSITION_FIRST_CHILD)]
+        # Only the last move of a node before a flush is applied, with the
+        # statements of that move alone:
+        statements = []
+        for count in (1, len(moves)):
+            self._reset()
+            nodes = dict((name, self._get(name)) for name in (
+                'child211', 'child12', 'root3', 'child22'))
+            del self.statements[:]
+            for name, target, position in moves[-count:]:
+                tree.insert(nodes[name], nodes[target], position)
+            db.session.commit()
+            statements.append(list(self.statements))
+            self.assertEqual(self._get_structure()[1][1][1],
+                             ('child22', [('child211', [])]))
+        self.assertEqual(statements[1], statements[0])
+
+    def test_unrelated_moves(self):
+        tree = self.node_class.tree
+        nodes = dict((name, self._get(name)) for name in (
+            'child11', 'child13', 'child22', 'root2', 'root3'))
+        tree.insert(nodes['child11'], nodes['child13'])
+        tree.insert(nodes['child22'], nodes['root2'],
+                    tree.POSITION_FIRST_CHILD)
+        # Moves in different trees are applied one at a time:
+        del self.statements[:]
+        db.session.flush()
+        self.assertFalse([statement for statement in self.statements
+                          if statement.startswith('SELECT DISTINCT')])
+
+
+class PathedCoalescingTestCase(CoalescingTestCase):
+    node_class = Pathed
+
+
+class HoledCoalescingTestCase(CoalescingTestCase):
+    node_class = Holed
+
+    def test_moves_into_one_place(self):
+        tree = self.node_class.tree
+        nodes = dict((name, self._get(name)) for name in (
+            'child12', 'child211', 'child22'))
+        tree.insert(nodes['child211'], nodes['child12'])
+        tree.insert(nodes['child22'], nodes['child12'])
+        # Sparse trees are not renumbered, the moves are applied one at a
+        # time:
+        del self.statements[:]
+        db.session.flush()
+        self.assertFalse([statement for statement in self.statements
+                          if statement.startswith('SELECT DISTINCT')])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CoalescingTestCase))
+    suite.addTest(unittest.makeSuite(PathedCoalescingTestCase))
+    suite.addTest(unittest.makeSuite(HoledCoalescingTestCase))
+    return suite
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Compaction
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, Unicode, ForeignKey
+from sqlalchemy.orm import mapper, relationship, backref
+
+from sqlalchemy_tree import TreeManager
+
+from .helper import unittest, db
+from .Named import NamedTestCase
+
+
+class Holed(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+holed = Table('sqlalchemy_tree__tests__holed', db.metadata,
+              Column('id', Integer, primary_key=True),
+              Column('name', Unicode, nullable=False, unique=True),
+              Column('parent_id', Integer,
+                     ForeignKey('sqlalchemy_tree__tests__holed.id')),
+              )
+Holed.tree = TreeManager(holed, close_gaps=False)
+mapper(Holed, holed, properties={
+    'parent': relationship(Holed,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=holed.c.id),
+})
+Holed.tree.register()
+
+
+class CompactionTestCase(unittest.TestCase):
+
+    """Provides tests of trees whose deletes leave their positions free, using
+    the `holed` table."""
+    name_pattern = NamedTestCase.name_pattern
+
+    def setUp(self):
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+
+        def _process_node(pattern, parent=None):
+            name, fields, children = pattern
+            node = Holed(name=name)
+            Holed.tree.insert(node, parent)
+            db.session.add(node)
+            db.session.commit()
+            for child in children:
+                _process_node(child, node)
+        for root in self.name_pattern:
+            _process_node(root)
+
+        self.rowcounts = []
+
+        @sqlalchemy.event.listens_for(db.engine, 'after_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE') and 'tree_left' in statement:
+                self.rowcounts.append(cursor.rowcount)
+        self._count = count
+
+    def tearDown(self):
+        sqlalchemy.event.remove(db.engine, 'after_cursor_execute',
+                                self._count)
+        db.session.close()
+
+    def _get(self, name):
+        return db.session.query(Holed).filter(holed.c.name == name).one()
+
+    def _delete(self, *names):
+        for name in names:
+            db.session.delete(self._get(name))
+        db.session.commit()
+
+    def _get_fields(self):
+        return dict((row.name, (row.tree_id, row.tree_left, row.tree_right,
+                                row.tree_depth))
+                    for row in db.session.execute(sqlalchemy.select([holed])))
+
+    def _get_structure(self):
+        "Reads the trees back through the tree filters, by tree id and left."
+        def _get_subtree(parent):
+            if parent is None:
+                query = db.session.query(Holed) \
+                    .filter(Holed.tree.filter_root_nodes())
+            else:
+                query = db.session.query(Holed) \
+                    .filter(parent.tree.filter_children())
+            return [(node.name, _get_subtree(node))
+                    for node in query.order_by(Holed.tree).all()]
+        return _get_subtree(None)
+
+    def test_delete_leaf(self):
+        fields = self._get_fields()
+        self._delete('child11', 'child22')
+        self.assertEqual(self.rowcounts, [])
+        del fields['child11'], fields['child22']
+        self.assertEqual(self._get_fields(), fields)
+        root1 = self._get('root1')
+        self.assertEqual(root1.tree.get_descendant_count(), 2)
+        self.assertEqual(
+            [node.name for node in root1.tree.query_leaf_nodes()],
+            ['child12', 'child13'])
+        child12 = self._get('child12')
+        self.assertTrue(child12.tree.is_leaf_node)
+
+    def test_delete_child(self):
+        fields = self._get_fields()
+        self._delete('child212')
+        # Only the descendants of the node are written:
+        self.assertEqual(self.rowcounts, [4])
+        self.assertEqual(self._get_structure()[1], (
+            'root2', [
+                ('child21', [
+                    ('child211', []), ('child2121', []), ('child2122', [
+                        ('child21221', []), ('child21222', [])])]),
+                ('child22', []), ('child23', [])]))
+        self.assertEqual(self._get_fields()['child23'], fields['child23'])
+        self.assertEqual(self._get_fields()['child2122'][3], 2)
+
+    def test_delete_root(self):
+        self._delete('root3')
+        self.assertEqual(self.rowcounts, [])
+        self.assertEqual(
+            [(name, fields[0]) for name, fields in
+             sorted(self._get_fields().items()) if fields[1] == 1],
+            [('root1', 1), ('root2', 2)])
+        self._delete('root1')
+        self.assertEqual(
+            [name for name, children in self._get_structure()],
+            ['child11', 'child12', 'child13', 'root2'])
+
+    def test_insert(self):
+        self._delete('child12', 'child2121')
+        node = Holed(name='new')
+        Holed.tree.insert(node, self._get('child212'),
+                          Holed.tree.POSITION_FIRST_CHILD)
+        db.session.add(node)
+        db.session.commit()
+        child212 = self._get('child212')
+        self.assertEqual(
+            [node.name for node in child212.tree.query_children()],
+            ['new', 'child2122'])
+
+    def test_compact(self):
+        self._delete('child11', 'child212')
+        del self.rowcounts[:]
+        Holed.tree.compact(db.session)
+        self.assertEqual(self._get_fields(), {
+            'root1':      (1, 1, 6, 0),
+            'child12':    (1, 2, 3, 1),
+            'child13':    (1, 4, 5, 1),
+            'root2':      (2, 1, 18, 0),
+            'child21':    (2, 2, 13, 1),
+            'child211':   (2, 3, 4, 2),
+            'child2121':  (2, 5, 6, 2),
+            'child2122':  (2, 7, 12, 2),
+            'child21221': (2, 8, 9, 3),
+            'child21222': (2, 10, 11, 3),
+            'child22':    (2, 14, 15, 1),
+            'child23':    (2, 16, 17, 1),
+            'root3':      (3, 1, 2, 0),
+        })
+        # Only the rows which had to move are written:
+        self.assertEqual(self.rowcounts, [3, 8])
+        del self.rowcounts[:]
+        Holed.tree.compact(db.session, 1)
+        self.assertEqual(self.rowcounts, [])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CompactionTestCase))
+    return suite
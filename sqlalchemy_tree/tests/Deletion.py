@@ -12,6 +12,8 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement, unicode_literals
 
+import sqlalchemy
+
 from .helper import unittest, db, Named, get_tree_details
 from .Named import NamedTestCase
 
@@ -471,6 +473,159 @@ class DeletionTestCase(NamedTestCase):
         db.session.commit()
         self.assertEqual(get_tree_details(), self.combined_del_result)
 
+    def test_del_root_updates_loaded_nodes(self):
+        # The grandchildren of a deleted root node which are loaded in the
+        # session stay in the subtree of their parent, which takes over the
+        # tree id of the root node.
+        nodes = db.session.query(Named).all()
+        db.session.delete(
+            db.session.query(Named).filter_by(name=u"root2").one())
+        db.session.flush()
+        for node in nodes:
+            if node.name == u"root2":
+                continue
+            row = db.session.execute(
+                sqlalchemy.select([Named.tree.tree_id_field,
+                                   Named.tree.left_field,
+                                   Named.tree.right_field,
+                                   Named.tree.depth_field])
+                .where(Named.tree.pk_field == node.id)).fetchone()
+            self.assertEqual(
+                (node.tree.tree_id, node.tree.left, node.tree.right,
+                 node.tree.depth), tuple(row), node.name)
+
+    def test_del_root_statements(self):
+        # The children of a deleted root node are all promoted with a single
+        # update, however many there are.
+        root = db.session.query(Named).filter_by(name=u"root3").one()
+        for idx in range(20):
+            node = Named(name=u"child3%02d" % idx)
+            Named.tree.insert(node, root)
+            db.session.add(node)
+        db.session.commit()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE') and 'tree_left' in statement:
+                statements.append(statement)
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            db.session.delete(root)
+            db.session.commit()
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(
+            [(node.name, node.tree.tree_id, node.tree.left, node.tree.right)
+             for node in db.session.query(Named)
+             .filter(Named.tree.filter_root_nodes())
+             .order_by(Named.tree.tree_id_field)],
+            [(u"root1", 1, 1, 8), (u"root2", 2, 1, 20)] +
+            [(u"child3%02d" % idx, idx + 3, 1, 2) for idx in range(20)])
+
+    def test_del_child_rows(self):
+        # Deleting a child node only updates its descendants, the nodes to its
+        # right and its ancestors, with a single statement.
+        rowcounts = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE') and 'tree_left' in statement:
+                rowcounts.append(cursor.rowcount)
+        sqlalchemy.event.listen(db.engine, 'after_cursor_execute', record)
+        try:
+            for name in (u"child23", u"child21222"):
+                node = db.session.query(Named).filter_by(name=name).one()
+                db.session.delete(node)
+                db.session.commit()
+        finally:
+            sqlalchemy.event.remove(db.engine, 'after_cursor_execute', record)
+        # root2, then child2122, child212, child21, root2 and child22:
+        self.assertEqual(rowcounts, [1, 5])
+    def _delete_subtree_helper(self, name, result):
+        node = db.session.query(Named).filter_by(name=name).one()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            Named.tree.delete_subtree(node)
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+        # The parameters of the node are reloaded, then the subtree deleted
+        # and the gap it leaves closed:
+        self.assertEqual([statement.split(None, 1)[0] for statement in statements],
+                         ['SELECT', 'DELETE', 'UPDATE'])
+        self.assertFalse(node in db.session)
+        db.session.commit()
+        self.assertEqual(get_tree_details(), result)
+
+    def test_delete_subtree_child212(self):
+        self._delete_subtree_helper(u"child212", [
+            (u"root1", {'id': 1, 'left': 1, 'right': 8, 'depth': 0}, [
+                (u"child11", {'id': 1, 'left': 2, 'right': 3, 'depth': 1}, []),
+                (u"child12", {'id': 1, 'left': 4, 'right': 5, 'depth': 1}, []),
+                (u"child13", {'id': 1, 'left': 6, 'right': 7, 'depth': 1}, []),
+            ]),
+            (u"root2", {'id': 2, 'left': 1, 'right': 10, 'depth': 0}, [
+                (u"child21", {'id': 2, 'left': 2, 'right': 5, 'depth': 1}, [
+                    (u"child211", {'id': 2, 'left': 3, 'right': 4, 'depth': 2}, []),
+                ]),
+                (u"child22", {'id': 2, 'left': 6, 'right': 7, 'depth': 1}, []),
+                (u"child23", {'id': 2, 'left': 8, 'right': 9, 'depth': 1}, []),
+            ]),
+            (u"root3", {'id': 3, 'left': 1, 'right': 2, 'depth': 0}, []),
+        ])
+
+    def test_delete_subtree_root2(self):
+        self._delete_subtree_helper(u"root2", [
+            (u"root1", {'id': 1, 'left': 1, 'right': 8, 'depth': 0}, [
+                (u"child11", {'id': 1, 'left': 2, 'right': 3, 'depth': 1}, []),
+                (u"child12", {'id': 1, 'left': 4, 'right': 5, 'depth': 1}, []),
+                (u"child13", {'id': 1, 'left': 6, 'right': 7, 'depth': 1}, []),
+            ]),
+            (u"root3", {'id': 2, 'left': 1, 'right': 2, 'depth': 0}, []),
+        ])
+
+    def test_delete_subtree_updates_loaded_nodes(self):
+        nodes = dict((node.name, node) for node in db.session.query(Named))
+        Named.tree.delete_subtree(nodes[u"child21"])
+        for name in (u"child21", u"child211", u"child212", u"child21222"):
+            self.assertFalse(nodes[name] in db.session)
+        self.assertEqual(
+            (nodes[u"root2"].tree.left, nodes[u"root2"].tree.right), (1, 6))
+        self.assertEqual(
+            (nodes[u"child23"].tree.left, nodes[u"child23"].tree.right), (4, 5))
+        self.assertEqual([node.name for node in nodes[u"root2"].children],
+                         [u"child22", u"child23"])
+        db.session.commit()
+        self.assertEqual(
+            db.session.query(Named).filter(Named.name.like(u"child21%")).count(), 0)
+
+    def test_delete_subtree_flushes_pending_changes(self):
+        nodes = dict((node.name, node) for node in db.session.query(Named))
+        node = Named(name=u"new")
+        Named.tree.insert(node, nodes[u"child21"])
+        db.session.add(node)
+        Named.tree.insert(nodes[u"child12"], nodes[u"child212"])
+        Named.tree.delete_subtree(nodes[u"child21"])
+        self.assertFalse(node in db.session)
+        db.session.commit()
+        self.assertEqual(get_tree_details(), [
+            (u"root1", {'id': 1, 'left': 1, 'right': 6, 'depth': 0}, [
+                (u"child11", {'id': 1, 'left': 2, 'right': 3, 'depth': 1}, []),
+                (u"child13", {'id': 1, 'left': 4, 'right': 5, 'depth': 1}, []),
+            ]),
+            (u"root2", {'id': 2, 'left': 1, 'right': 6, 'depth': 0}, [
+                (u"child22", {'id': 2, 'left': 2, 'right': 3, 'depth': 1}, []),
+                (u"child23", {'id': 2, 'left': 4, 'right': 5, 'depth': 1}, []),
+            ]),
+            (u"root3", {'id': 3, 'left': 1, 'right': 2, 'depth': 0}, []),
+        ])
+        self.assertEqual(
+            db.session.query(Named).filter(Named.name.in_(
+                [u"new", u"child12"])).count(), 0)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -11,6 +11,8 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement, unicode_literals
 
+import sqlalchemy
+
 from .helper import unittest, Named, db, get_tree_details
 from .Named import NamedTestCase
 
@@ -1534,6 +1536,29 @@ class ExplicitMoveTestCase(NamedTestCase):
         ]
         self._do_insert_and_check(result, node_name, target_name, position)
 
+    def test_move_child_node_rows(self):
+        # Moving a child node within its tree only updates the nodes between
+        # its old and new positions, with a single statement.
+        rowcounts = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE') and 'tree_left' in statement:
+                rowcounts.append(cursor.rowcount)
+        sqlalchemy.event.listen(db.engine, 'after_cursor_execute', record)
+        try:
+            node = db.session.query(Named).filter_by(name=u"platformer_4d").one()
+            target = db.session.query(Named).filter_by(name=u"platformer_2d").one()
+            Named.tree.insert(node, target, Named.tree.POSITION_LEFT)
+            db.session.commit()
+        finally:
+            sqlalchemy.event.remove(db.engine, 'after_cursor_execute', record)
+        self.assertEqual(rowcounts, [3])
+        parent = db.session.query(Named).filter_by(name=u"platformer").one()
+        self.assertEqual(
+            [node.name for node in db.session.query(Named)
+             .filter(Named.tree.filter_children_of_node(parent))
+             .order_by(Named.tree)],
+            [u"platformer_4d", u"platformer_2d", u"platformer_3d"])
 
 def suite():
     suite = unittest.TestSuite()
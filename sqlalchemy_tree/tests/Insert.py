@@ -11,8 +11,10 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement, unicode_literals
 
+import sqlalchemy
+
 from .helper import unittest, Named, db, get_tree_details
-from .Named import TreeTestMixin
+from .Named import NamedTestCase, TreeTestMixin
 
 
 class InsertTestCase(TreeTestMixin, unittest.TestCase):
@@ -29,7 +31,249 @@ class InsertTestCase(TreeTestMixin, unittest.TestCase):
         self.assertEqual(get_tree_details(), result)
 
 
+class _RunInsertTestMixin(TreeTestMixin):
+
+    """Fills the tree of :class:`NamedTestCase` a level at a time, inserting all
+    the children of every node of a level in a single flush, so that
+    ``test_fill_tree`` checks that runs of inserts at the same position end up
+    exactly where inserting them one by one would have put them."""
+
+    name_pattern = NamedTestCase.name_pattern
+
+    def _insert_children(self, parent, names):
+        raise NotImplementedError
+
+    def _fill_tree(self):
+        level = [(None, self.name_pattern)]
+        while level:
+            nodes = {}
+            for parent, patterns in level:
+                names = [pattern[0] for pattern in patterns]
+                if parent is None:
+                    for name in names:
+                        nodes[name] = Named(name=name)
+                        db.session.add(nodes[name])
+                else:
+                    nodes.update(self._insert_children(parent, names))
+            db.session.commit()
+            level = [(nodes[name], children)
+                     for parent, patterns in level
+                     for name, fields, children in patterns
+                     if children]
+
+
+class RunInsertLastChildTestCase(_RunInsertTestMixin, unittest.TestCase):
+
+    def _insert_children(self, parent, names):
+        nodes = {}
+        for name in names:
+            nodes[name] = Named(name=name)
+            Named.tree.insert(nodes[name], parent)
+            db.session.add(nodes[name])
+        return nodes
+
+
+class RunInsertFirstChildTestCase(_RunInsertTestMixin, unittest.TestCase):
+
+    def _insert_children(self, parent, names):
+        nodes = {}
+        for name in reversed(names):
+            nodes[name] = Named(name=name)
+            Named.tree.insert(
+                nodes[name], parent, Named.tree.POSITION_FIRST_CHILD)
+            db.session.add(nodes[name])
+        return nodes
+
+
+class RunInsertLeftTestCase(_RunInsertTestMixin, unittest.TestCase):
+
+    def _insert_children(self, parent, names):
+        nodes = {names[-1]: Named(name=names[-1])}
+        Named.tree.insert(nodes[names[-1]], parent)
+        db.session.add(nodes[names[-1]])
+        db.session.flush()
+        for name in names[:-1]:
+            nodes[name] = Named(name=name)
+            Named.tree.insert(
+                nodes[name], nodes[names[-1]], Named.tree.POSITION_LEFT)
+            db.session.add(nodes[name])
+        return nodes
+
+
+class RunInsertRightTestCase(_RunInsertTestMixin, unittest.TestCase):
+
+    def _insert_children(self, parent, names):
+        nodes = {names[0]: Named(name=names[0])}
+        Named.tree.insert(nodes[names[0]], parent)
+        db.session.add(nodes[names[0]])
+        db.session.flush()
+        for name in reversed(names[1:]):
+            nodes[name] = Named(name=name)
+            Named.tree.insert(
+                nodes[name], nodes[names[0]], Named.tree.POSITION_RIGHT)
+            db.session.add(nodes[name])
+        return nodes
+
+
+class RunInsertRootSiblingTestCase(TreeTestMixin, unittest.TestCase):
+
+    name_pattern = NamedTestCase.name_pattern
+
+    def test_insert_run_around_root(self):
+        root1 = db.session.query(Named).filter_by(name=u"root1").one()
+        for position in (Named.tree.POSITION_LEFT, Named.tree.POSITION_RIGHT):
+            for idx in range(3):
+                node = Named(name=u"%s%d" % (position, idx))
+                Named.tree.insert(node, root1, position)
+                db.session.add(node)
+        db.session.commit()
+        self.assertEqual(
+            [name for name, fields, children in get_tree_details()],
+            [u"left0", u"left1", u"left2", u"root1",
+             u"right2", u"right1", u"right0", u"root2", u"root3"])
+
+
+class RunInsertStatementTestCase(TreeTestMixin, unittest.TestCase):
+
+    name_pattern = NamedTestCase.name_pattern
+
+    def setUp(self):
+        super(RunInsertStatementTestCase, self).setUp()
+        self.statements = []
+        sqlalchemy.event.listen(
+            db.engine, 'before_cursor_execute', self._record_statement)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(
+            db.engine, 'before_cursor_execute', self._record_statement)
+        super(RunInsertStatementTestCase, self).tearDown()
+
+    def _record_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_one_gap_per_run(self):
+        root2 = db.session.query(Named).filter_by(name=u"root2").one()
+        for idx in range(20):
+            node = Named(name=u"new%d" % idx)
+            Named.tree.insert(node, root2)
+            db.session.add(node)
+        del self.statements[:]
+        db.session.flush()
+        self.assertEqual(len([
+            statement for statement in self.statements
+            if statement.lstrip().upper().startswith('UPDATE')]), 1)
+
+
+class InsertSubtreeTestCase(TreeTestMixin, unittest.TestCase):
+
+    "Checks that bulk subtree insertion matches inserting nodes one by one."
+    name_pattern = NamedTestCase.name_pattern
+
+    subtree_pattern = (u"new", [
+        (u"new1", [
+            (u"new11", []),
+            (u"new12", []),
+        ]),
+        (u"new2", []),
+        (u"new3", [
+            (u"new31", []),
+        ]),
+    ])
+
+    def _build_subtree(self, pattern, parent=None):
+        name, children = pattern
+        node = Named(name=name, parent=parent)
+        for child in children:
+            self._build_subtree(child, node)
+        return node
+
+    def _insert_one_by_one(self, pattern, target, position):
+        name, children = pattern
+        node = Named(name=name)
+        Named.tree.insert(node, target, position)
+        db.session.add(node)
+        db.session.commit()
+        for child in children:
+            self._insert_one_by_one(child, node, Named.tree.POSITION_LAST_CHILD)
+
+    def _get_links(self):
+        db.session.expire_all()
+        return sorted((node.name, node.parent and node.parent.name)
+                      for node in db.session.query(Named).all())
+
+    def _check_insert_subtree(self, target_name, position):
+        target = target_name and \
+            db.session.query(Named).filter_by(name=target_name).one()
+        Named.tree.insert_subtree(
+            self._build_subtree(self.subtree_pattern), target, position,
+            session=db.session)
+        self.assertFalse(db.session.new)
+        self.assertFalse(db.session.dirty)
+        db.session.commit()
+        result = get_tree_details(), self._get_links()
+
+        self.tearDown()
+        self.setUp()
+        target = target_name and \
+            db.session.query(Named).filter_by(name=target_name).one()
+        self._insert_one_by_one(self.subtree_pattern, target, position)
+        self.assertEqual(result, (get_tree_details(), self._get_links()))
+
+    def test_insert_subtree_as_new_tree(self):
+        self._check_insert_subtree(None, Named.tree.POSITION_LAST_CHILD)
+
+    def test_insert_subtree_left_of_root(self):
+        self._check_insert_subtree(u"root2", Named.tree.POSITION_LEFT)
+
+    def test_insert_subtree_right_of_root(self):
+        self._check_insert_subtree(u"root2", Named.tree.POSITION_RIGHT)
+
+    def test_insert_subtree_as_last_child(self):
+        self._check_insert_subtree(u"child212", Named.tree.POSITION_LAST_CHILD)
+
+    def test_insert_subtree_as_first_child(self):
+        self._check_insert_subtree(u"child212", Named.tree.POSITION_FIRST_CHILD)
+
+    def test_insert_subtree_left(self):
+        self._check_insert_subtree(u"child212", Named.tree.POSITION_LEFT)
+
+    def test_insert_subtree_right(self):
+        self._check_insert_subtree(u"child212", Named.tree.POSITION_RIGHT)
+
+    def test_insert_subtree_under_leaf(self):
+        self._check_insert_subtree(u"child11", Named.tree.POSITION_LAST_CHILD)
+
+    def test_statements_do_not_depend_on_size(self):
+        statements = []
+
+        def _record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+        target = db.session.query(Named).filter_by(name=u"child212").one()
+        sqlalchemy.event.listen(
+            db.engine, 'before_cursor_execute', _record_statement)
+        try:
+            counts = []
+            for size in (2, 50):
+                node = Named(name=u"big%d" % size)
+                for idx in range(size):
+                    Named(name=u"big%d.%d" % (size, idx), parent=node)
+                del statements[:]
+                Named.tree.insert_subtree(node, target, session=db.session)
+                counts.append(len(statements))
+        finally:
+            sqlalchemy.event.remove(
+                db.engine, 'before_cursor_execute', _record_statement)
+        self.assertEqual(counts[0], counts[1])
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(InsertTestCase))
+    suite.addTest(unittest.makeSuite(RunInsertLastChildTestCase))
+    suite.addTest(unittest.makeSuite(RunInsertFirstChildTestCase))
+    suite.addTest(unittest.makeSuite(RunInsertLeftTestCase))
+    suite.addTest(unittest.makeSuite(RunInsertRightTestCase))
+    suite.addTest(unittest.makeSuite(RunInsertRootSiblingTestCase))
+    suite.addTest(unittest.makeSuite(RunInsertStatementTestCase))
+    suite.addTest(unittest.makeSuite(InsertSubtreeTestCase))
     return suite
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Path
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, Unicode, ForeignKey
+from sqlalchemy.orm import mapper, relationship, backref
+
+from sqlalchemy_tree import TreeManager, TreePathType
+
+from .helper import unittest, db
+from .Named import NamedTestCase
+
+
+class Pathed(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+pathed = Table('sqlalchemy_tree__tests__pathed', db.metadata,
+               Column('id', Integer, primary_key=True),
+               Column('name', Unicode, nullable=False, unique=True),
+               Column('parent_id', Integer,
+                      ForeignKey('sqlalchemy_tree__tests__pathed.id')),
+               )
+Pathed.tree = TreeManager(pathed, path_field=True, path_digits=4)
+mapper(Pathed, pathed, properties={
+    'parent': relationship(Pathed,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=pathed.c.id),
+})
+Pathed.tree.register()
+
+
+class RationalPathed(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+rational_pathed = Table(
+    'sqlalchemy_tree__tests__rational_pathed', db.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', Unicode, nullable=False, unique=True),
+    Column('parent_id', Integer,
+           ForeignKey('sqlalchemy_tree__tests__rational_pathed.id')),
+    Column('path', TreePathType, nullable=False),
+)
+RationalPathed.tree = TreeManager(rational_pathed, encoding='rational')
+mapper(RationalPathed, rational_pathed, properties={
+    'parent': relationship(RationalPathed,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=rational_pathed.c.id),
+})
+RationalPathed.tree.register()
+
+
+def _strip_fields(pattern):
+    return [(name, _strip_fields(children))
+            for name, fields, children in pattern]
+
+
+class PathTestCase(unittest.TestCase):
+
+    "Provides tests of trees keeping the path of each node, using the `pathed` table."
+    name_pattern = NamedTestCase.name_pattern
+    node_class = Pathed
+    table = pathed
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+
+        def _process_node(pattern, parent=None):
+            name, fields, children = pattern
+            node = self.node_class(name=name)
+            self.node_class.tree.insert(node, parent)
+            db.session.add(node)
+            db.session.commit()
+            for child in children:
+                _process_node(child, node)
+        for root in self.name_pattern:
+            _process_node(root)
+
+    def tearDown(self):
+        db.session.close()
+
+    @property
+    def path_field(self):
+        return self.node_class.tree._tree_options.path_field
+
+    def _get(self, name):
+        return db.session.query(self.node_class) \
+            .filter(self.table.c.name == name).one()
+
+    def _insert(self, name, target, position):
+        node = self.node_class(name=name)
+        self.node_class.tree.insert(node, self._get(target), position)
+        db.session.add(node)
+        db.session.commit()
+
+    def _get_structure(self):
+        "Reads the trees back through the tree filters, by tree id and left."
+        def _get_subtree(parent):
+            if parent is None:
+                query = db.session.query(self.node_class) \
+                    .filter(self.node_class.tree.filter_root_nodes()) \
+                    .order_by(self.table.c.tree_id)
+            else:
+                query = db.session.query(self.node_class) \
+                    .filter(parent.tree.filter_children()) \
+                    .order_by(self.node_class.tree)
+            return [(node.name, _get_subtree(node)) for node in query.all()]
+        return _get_subtree(None)
+
+    def _check_paths(self):
+        """Checks the path of every node against the adjacency list, both in
+        the database and on the nodes loaded in the session."""
+        options = self.node_class.tree._tree_options
+        rows = dict((row.id, row) for row in db.session.execute(
+            sqlalchemy.select([self.table])))
+        paths = {}
+
+        def _get_path(pk):
+            if pk not in paths:
+                parent_id = rows[pk].parent_id
+                paths[pk] = parent_id and (
+                    _get_path(parent_id) + options.path_segment(parent_id)) \
+                    or ''
+            return paths[pk]
+        for pk, row in rows.items():
+            self.assertEqual(row[self.path_field.name], _get_path(pk))
+        for node in db.session.identity_map.values():
+            if isinstance(node, self.node_class):
+                self.assertEqual(getattr(node, self.path_field.name),
+                                 _get_path(node.id))
+
+    def test_column_types(self):
+        self.assertTrue(isinstance(self.path_field.type, TreePathType))
+        self.assertTrue(self.path_field in
+                        self.node_class.tree._tree_options.required_fields)
+
+    def test_fill_tree(self):
+        self._check_paths()
+        options = self.node_class.tree._tree_options
+        child2122 = self._get('child2122')
+        self.assertEqual(
+            getattr(child2122, self.path_field.name),
+            ''.join(options.path_segment(self._get(name).id)
+                    for name in ('root2', 'child21', 'child212')))
+
+    def test_ancestors(self):
+        child2122 = self._get('child2122')
+        expected = ['root2', 'child21', 'child212']
+        self.assertEqual(
+            [node.name for node in child2122.tree.query_ancestors()
+             .order_by(self.node_class.tree)], expected)
+        self.assertEqual(
+            [node.name for node in child2122.tree.query_ancestors(
+                include_self=True).order_by(self.node_class.tree)],
+            expected + ['child2122'])
+        self.assertEqual(
+            child2122.tree.get_ancestor_ids(),
+            [self._get(name).id for name in expected])
+        self.assertEqual(
+            child2122.tree.get_ancestor_ids(include_self=True),
+            [self._get(name).id for name in expected + ['child2122']])
+        root1 = self._get('root1')
+        self.assertEqual(root1.tree.query_ancestors().all(), [])
+        self.assertEqual(root1.tree.get_ancestor_ids(), [])
+        # No self-join is needed:
+        self.assertFalse('JOIN' in str(child2122.tree.filter_ancestors()))
+        self.assertEqual(
+            len(str(child2122.tree.filter_ancestors()).split(' FROM ')), 1)
+
+    def test_descendants_by_path(self):
+        for name in ('root1', 'root2', 'child21', 'child212', 'child2122',
+                     'child22'):
+            node = self._get(name)
+            for include_self in (False, True):
+                self.assertEqual(
+                    [n.name for n in node.tree.query_descendants(
+                        include_self=include_self, by_path=True)],
+                    [n.name for n in node.tree.query_descendants(
+                        include_self=include_self)])
+
+    def test_insert(self):
+        self._insert('first', 'root1', self.node_class.tree.POSITION_FIRST_CHILD)
+        self._insert('left', 'child2122', self.node_class.tree.POSITION_LEFT)
+        self._insert('right', 'root2', self.node_class.tree.POSITION_RIGHT)
+        self._insert('last', 'child21222',
+                     self.node_class.tree.POSITION_LAST_CHILD)
+        self._check_paths()
+        root3 = self._get('root3')
+        nodes = [self.node_class(name='node%02d' % idx) for idx in range(5)]
+        for node in nodes:
+            self.node_class.tree.insert(
+                node, root3, self.node_class.tree.POSITION_FIRST_CHILD)
+            db.session.add(node)
+        db.session.commit()
+        self._check_paths()
+
+    def test_path_digits(self):
+        options = self.node_class.tree._tree_options
+        node = self.node_class(name='wide')
+        node.id = 10 ** options.path_digits
+        db.session.add(node)
+        db.session.commit()
+        self.assertRaises(ValueError, options.path_segment, node.id)
+        child = self.node_class(name='child')
+        self.node_class.tree.insert(child, node)
+        db.session.add(child)
+        self.assertRaises(ValueError, db.session.flush)
+        db.session.rollback()
+        table = Table('named', sqlalchemy.MetaData(),
+                      Column('name', Unicode, primary_key=True),
+                      Column('parent_name', Unicode,
+                             ForeignKey('named.name')))
+        self.assertRaises(AssertionError, TreeManager, table, path_field=True)
+
+    def test_move(self):
+        tree = self.node_class.tree
+        moves = [
+            ('child212', 'root1', tree.POSITION_FIRST_CHILD),
+            ('child2122', 'child13', tree.POSITION_LEFT),
+            ('child21', 'child11', tree.POSITION_LAST_CHILD),
+            ('child22', 'root3', tree.POSITION_RIGHT),
+            ('root2', 'child21221', tree.POSITION_LAST_CHILD),
+            ('child21', None, tree.POSITION_LAST_CHILD),
+            ('child2121', 'child23', tree.POSITION_RIGHT),
+            ('child12', 'child211', tree.POSITION_FIRST_CHILD),
+        ]
+        for name, target, position in moves:
+            tree.insert(self._get(name), target and self._get(target),
+                        position)
+            db.session.flush()
+            self._check_paths()
+            db.session.commit()
+            self._check_paths()
+
+    def test_delete(self):
+        db.session.delete(self._get('child212'))
+        db.session.flush()
+        self._check_paths()
+        db.session.commit()
+        self._check_paths()
+        # The nodes loaded in the session are kept up to date as well:
+        nodes = db.session.query(self.node_class).all()
+        db.session.delete(self._get('root2'))
+        db.session.flush()
+        self._check_paths()
+        db.session.commit()
+        self._check_paths()
+        self.assertEqual(
+            [name for name, children in self._get_structure()],
+            ['root1', 'child21', 'child22', 'child23', 'root3'])
+
+    def test_insert_subtree(self):
+        node = self.node_class(name='sub')
+        sub1 = self.node_class(name='sub1', parent=node)
+        self.node_class(name='sub11', parent=sub1)
+        self.node_class(name='sub2', parent=node)
+        self.node_class.tree.insert_subtree(
+            node, self._get('child212'), self.node_class.tree.POSITION_RIGHT,
+            session=db.session)
+        db.session.commit()
+        self._check_paths()
+        node = self.node_class(name='root4')
+        self.node_class(name='child41', parent=node)
+        self.node_class.tree.insert_subtree(node, session=db.session)
+        db.session.commit()
+        self._check_paths()
+
+    # The node rebuilt by test_rebuild, and the ancestors (below the paths
+    # left as they are) then expected in the paths of some nodes:
+    rebuilt_node = 'child212'
+    rebuilt_paths = [
+        ('child212', []),
+        ('child2122', ['child212']),
+        ('child21221', ['child212', 'child2122']),
+        ('child22', []),
+        ('root1', []),
+    ]
+
+    def test_rebuild(self):
+        options = self.node_class.tree._tree_options
+        db.session.execute(self.table.update().values(
+            {self.path_field: 'garbage'}))
+        db.session.commit()
+        # Only the paths under the rebuilt node are rebuilt:
+        self.node_class.tree.rebuild(self._get(self.rebuilt_node))
+        for name, ancestors in self.rebuilt_paths:
+            self.assertEqual(
+                getattr(self._get(name), self.path_field.name),
+                'garbage' + ''.join(options.path_segment(self._get(ancestor).id)
+                                    for ancestor in ancestors))
+        self.node_class.tree.rebuild(session=db.session)
+        self._check_paths()
+        self.assertEqual(self._get_structure(),
+                         _strip_fields(self.name_pattern))
+
+    def test_bulk_rebuild(self):
+        db.session.execute(self.table.update().values(
+            {self.path_field: 'garbage'}))
+        db.session.commit()
+        self.node_class.tree.bulk_rebuild(db.session, batch_size=4)
+        self._check_paths()
+
+
+class RationalPathTestCase(PathTestCase):
+
+    "Runs the tests of paths with rational encoding, using the `rational_pathed` table."
+    node_class = RationalPathed
+    table = rational_pathed
+    # Rebuilding a node rebuilds its whole tree:
+    rebuilt_paths = [
+        ('child212', ['root2', 'child21']),
+        ('child2122', ['root2', 'child21', 'child212']),
+        ('child22', ['root2']),
+        ('root2', []),
+        ('root1', []),
+    ]
+
+    def test_column_types(self):
+        self.assertEqual(self.path_field.name, 'path')
+        super(RationalPathTestCase, self).test_column_types()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PathTestCase))
+    suite.addTest(unittest.makeSuite(RationalPathTestCase))
+    return suite
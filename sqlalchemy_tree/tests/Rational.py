@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Rational
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, Unicode, ForeignKey
+from sqlalchemy.orm import mapper, relationship, backref
+
+from sqlalchemy_tree import TreeManager, TreeRationalLeftType, \
+    TreeRationalRightType
+from sqlalchemy_tree.orm import _to_fraction
+
+from .helper import unittest, db
+from .Named import NamedTestCase
+
+
+class Rational(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+rational = Table('sqlalchemy_tree__tests__rational', db.metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('name', Unicode, nullable=False, unique=True),
+                 Column('parent_id', Integer,
+                        ForeignKey('sqlalchemy_tree__tests__rational.id')),
+                 )
+Rational.tree = TreeManager(rational, encoding='rational')
+mapper(Rational, rational, properties={
+    'parent': relationship(Rational,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=rational.c.id),
+})
+Rational.tree.register()
+
+
+def _strip_fields(pattern):
+    return [(name, _strip_fields(children))
+            for name, fields, children in pattern]
+
+
+class RationalTestCase(unittest.TestCase):
+
+    "Provides tests of trees with rational encoding, using the `rational` table."
+    name_pattern = NamedTestCase.name_pattern
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+
+        def _process_node(pattern, parent=None):
+            name, fields, children = pattern
+            node = Rational(name=name)
+            Rational.tree.insert(node, parent)
+            db.session.add(node)
+            db.session.commit()
+            for child in children:
+                _process_node(child, node)
+        for root in self.name_pattern:
+            _process_node(root)
+
+        self.updates = []
+
+        @sqlalchemy.event.listens_for(db.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE'):
+                self.updates.append(statement)
+        self._count = count
+
+    def tearDown(self):
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                self._count)
+        db.session.close()
+
+    def _get(self, name):
+        return db.session.query(Rational).filter(rational.c.name == name).one()
+
+    def _insert(self, name, target, position):
+        node = Rational(name=name)
+        Rational.tree.insert(node, self._get(target), position)
+        db.session.add(node)
+        db.session.commit()
+
+    def _get_structure(self):
+        "Reads the trees back through the tree filters, by tree id and left."
+        def _get_subtree(parent):
+            if parent is None:
+                query = db.session.query(Rational) \
+                    .filter(Rational.tree.filter_root_nodes()) \
+                    .order_by(rational.c.tree_id)
+            else:
+                query = db.session.query(Rational) \
+                    .filter(parent.tree.filter_children()) \
+                    .order_by(Rational.tree)
+            return [(node.name, _get_subtree(node)) for node in query.all()]
+        return _get_subtree(None)
+
+    def _check_nesting(self):
+        """Checks the tree fields against the adjacency list: every node lies
+        strictly inside its parent, one level deeper, and apart from its
+        siblings, and every value is a fraction which can be recovered."""
+        rows = dict((row.id, row) for row in db.session.execute(
+            sqlalchemy.select([rational])))
+        children = {}
+        for row in rows.values():
+            children.setdefault(row.parent_id, []).append(row)
+            for value in (row.tree_left, row.tree_right):
+                self.assertEqual(float(_to_fraction(value)), value)
+        for parent_id, siblings in children.items():
+            siblings.sort(key=lambda row: (row.tree_id, row.tree_left))
+            for row in siblings:
+                self.assertTrue(row.tree_left < row.tree_right)
+                if parent_id is None:
+                    self.assertEqual((row.tree_left, row.tree_depth), (1, 0))
+                    continue
+                parent = rows[parent_id]
+                self.assertEqual(row.tree_id, parent.tree_id)
+                self.assertEqual(row.tree_depth, parent.tree_depth + 1)
+                self.assertTrue(parent.tree_left < row.tree_left)
+                self.assertTrue(row.tree_right < parent.tree_right)
+            if parent_id is not None:
+                for previous, row in zip(siblings, siblings[1:]):
+                    self.assertTrue(previous.tree_right < row.tree_left)
+
+    def test_column_types(self):
+        self.assertTrue(isinstance(rational.c.tree_left.type,
+                                   TreeRationalLeftType))
+        self.assertTrue(isinstance(rational.c.tree_right.type,
+                                   TreeRationalRightType))
+
+    def test_fill_tree(self):
+        self.assertEqual(self._get_structure(),
+                         _strip_fields(self.name_pattern))
+        self._check_nesting()
+        self.assertEqual(self.updates, [])
+        root1 = self._get('root1')
+        self.assertEqual((root1.tree_left, root1.tree_right), (1, 2))
+        child11 = self._get('child11')
+        self.assertEqual((_to_fraction(child11.tree_left),
+                          _to_fraction(child11.tree_right)),
+                         (_to_fraction(1.5), _to_fraction(5 / 3)))
+
+    def test_insert_without_updates(self):
+        expected = _strip_fields(self.name_pattern)
+        self._insert('first', 'root1', Rational.tree.POSITION_FIRST_CHILD)
+        self._insert('left', 'child12', Rational.tree.POSITION_LEFT)
+        self._insert('right', 'child2121', Rational.tree.POSITION_RIGHT)
+        self._insert('last', 'child21222', Rational.tree.POSITION_LAST_CHILD)
+        self.assertEqual(self.updates, [])
+        expected[0][1][:] = [('first', []), ('child11', []), ('left', []),
+                             ('child12', []), ('child13', [])]
+        self.assertEqual(self._get_structure()[0], expected[0])
+        self._check_nesting()
+        child212 = self._get('child212')
+        self.assertEqual(
+            [node.name for node in child212.tree.query_descendants()],
+            ['child2121', 'right', 'child2122', 'child21221', 'child21222',
+             'last'])
+
+    def test_insert_run(self):
+        root3 = self._get('root3')
+        nodes = [Rational(name='node%02d' % idx) for idx in range(10)]
+        for node in nodes:
+            Rational.tree.insert(node, root3, Rational.tree.POSITION_FIRST_CHILD)
+            db.session.add(node)
+        db.session.commit()
+        self.assertEqual(self.updates, [])
+        self._check_nesting()
+        self.assertEqual(
+            [node.name for node in root3.tree.query_children()],
+            ['node%02d' % idx for idx in range(9, -1, -1)])
+
+    def test_insert_normalizes_tree(self):
+        # Nesting each node as the first child of the last one grows the
+        # denominators exponentially, so the tree has to be renumbered with
+        # whole numbers every so often:
+        parent = 'child13'
+        for idx in range(60):
+            self._insert('node%02d' % idx, parent,
+                         Rational.tree.POSITION_FIRST_CHILD)
+            parent = 'node%02d' % idx
+        self.assertTrue(self.updates)
+        self._check_nesting()
+        node = self._get('node59')
+        self.assertEqual(node.tree_depth, 61)
+        self.assertEqual(
+            [n.name for n in node.tree.query_ancestors().order_by(Rational.tree)],
+            ['root1', 'child13'] + ['node%02d' % idx for idx in range(59)])
+        self.assertEqual(
+            self._get_structure()[1:], _strip_fields(self.name_pattern)[1:])
+
+    def test_move(self):
+        node = self._get('child212')
+        Rational.tree.insert(node, self._get('root1'),
+                             Rational.tree.POSITION_FIRST_CHILD)
+        db.session.commit()
+        # Only the rows of the moved subtree are written, with one statement:
+        self.assertEqual(len(self.updates), 1)
+        self._check_nesting()
+        root1 = self._get('root1')
+        self.assertEqual(
+            [n.name for n in root1.tree.query_descendants()],
+            ['child212', 'child2121', 'child2122', 'child21221',
+             'child21222', 'child11', 'child12', 'child13'])
+        self.assertEqual(self._get('child21221').tree_depth, 3)
+        self._insert('new', 'child2122', Rational.tree.POSITION_LEFT)
+        self._check_nesting()
+
+    def test_move_within_parent(self):
+        node = self._get('child11')
+        Rational.tree.insert(node, self._get('child13'),
+                             Rational.tree.POSITION_RIGHT)
+        db.session.commit()
+        self._check_nesting()
+        root1 = self._get('root1')
+        self.assertEqual(
+            [n.name for n in root1.tree.query_children()],
+            ['child12', 'child13', 'child11'])
+
+    def test_move_roots(self):
+        node = self._get('child21')
+        Rational.tree.insert(node, None)
+        db.session.commit()
+        self._check_nesting()
+        self.assertEqual([name for name, children in self._get_structure()],
+                         ['root1', 'root2', 'root3', 'child21'])
+        node = self._get('root3')
+        Rational.tree.insert(node, self._get('child211'),
+                             Rational.tree.POSITION_LAST_CHILD)
+        db.session.commit()
+        self._check_nesting()
+        self.assertEqual([name for name, children in self._get_structure()],
+                         ['root1', 'root2', 'child21'])
+        self.assertEqual(self._get('root3').tree_depth, 2)
+        node = self._get('child21')
+        Rational.tree.insert(node, self._get('root1'),
+                             Rational.tree.POSITION_LEFT)
+        db.session.commit()
+        self._check_nesting()
+        self.assertEqual([name for name, children in self._get_structure()],
+                         ['child21', 'root1', 'root2'])
+
+    def test_invalid_move(self):
+        from sqlalchemy_tree import InvalidMoveError
+        node = self._get('child21')
+        Rational.tree.insert(node, self._get('child2122'),
+                             Rational.tree.POSITION_LAST_CHILD)
+        self.assertRaises(InvalidMoveError, db.session.flush)
+        db.session.rollback()
+        node = self._get('root2')
+        Rational.tree.insert(node, self._get('child22'),
+                             Rational.tree.POSITION_LEFT)
+        self.assertRaises(InvalidMoveError, db.session.flush)
+
+    def test_delete(self):
+        db.session.delete(self._get('child212'))
+        db.session.commit()
+        self.assertFalse([statement for statement in self.updates
+                          if 'tree_left=' in statement])
+        self._check_nesting()
+        child21 = self._get('child21')
+        self.assertEqual(
+            [node.name for node in child21.tree.query_children()],
+            ['child211', 'child2121', 'child2122'])
+
+    def test_delete_root(self):
+        db.session.delete(self._get('root2'))
+        db.session.commit()
+        self._check_nesting()
+        expected = _strip_fields(self.name_pattern)
+        self.assertEqual(self._get_structure(),
+                         expected[:1] + expected[1][1] + expected[2:])
+
+    def test_delete_root_with_new_child(self):
+        # The child inserted in the same flush is promoted once, along with
+        # the others:
+        root = self._get('root3')
+        node = Rational(name='new')
+        Rational.tree.insert(node, root)
+        db.session.add(node)
+        db.session.delete(root)
+        db.session.commit()
+        self._check_nesting()
+        node = self._get('new')
+        self.assertEqual(
+            (node.tree_left, node.tree_right, node.tree_depth), (1, 2, 0))
+        self.assertEqual(self._get_structure()[-1], ('new', []))
+
+    def test_delete_root_with_descendant(self):
+        # Both are deleted by one flush, the descendant first:
+        nodes = [self._get('child212'), self._get('root2')]
+        for node in nodes:
+            db.session.delete(node)
+        db.session.commit()
+        self._check_nesting()
+        expected = _strip_fields(self.name_pattern)
+        child21 = expected[1][1][0]
+        self.assertEqual(
+            self._get_structure(),
+            expected[:1] +
+            [('child21', child21[1][:1] + child21[1][1][1])] +
+            expected[1][1][1:] + expected[2:])
+
+    def test_filters(self):
+        self.assertEqual(
+            sorted(node.name for node in
+                   db.session.query(Rational)
+                   .filter(Rational.tree.filter_leaf_nodes())),
+            ['child11', 'child12', 'child13', 'child211', 'child2121',
+             'child21221', 'child21222', 'child22', 'child23', 'root3'])
+        root2 = self._get('root2')
+        self.assertEqual(
+            [node.name for node in root2.tree.query_leaf_nodes()],
+            ['child211', 'child2121', 'child21221', 'child21222', 'child22',
+             'child23'])
+        self.assertEqual(root2.tree.get_descendant_count(), 9)
+        self.assertFalse(root2.tree.is_leaf_node)
+        child212 = self._get('child212')
+        child2122 = self._get('child2122')
+        child22 = self._get('child22')
+        self.assertTrue(child22.tree.is_leaf_node)
+        self.assertTrue(Rational.tree.all_leaf_nodes(child22))
+        self.assertFalse(Rational.tree.any_leaf_nodes(child212, root2))
+        self.assertEqual(
+            [node.name for node in
+             child212.tree.query_descendants(include_self=True)],
+            ['child212', 'child2121', 'child2122', 'child21221',
+             'child21222'])
+        self.assertEqual(
+            [node.name for node in
+             child2122.tree.query_ancestors().order_by(Rational.tree)],
+            ['root2', 'child21', 'child212'])
+        self.assertTrue(child212.tree.is_ancestor_of(child2122))
+        self.assertTrue(child212.tree.is_ancestor_of(
+            child212, include_self=True))
+        self.assertFalse(child212.tree.is_ancestor_of(child212))
+        self.assertTrue(child2122.tree.is_descendant_of(child212))
+        self.assertFalse(child22.tree.is_descendant_of(child212))
+
+    def test_insert_subtree(self):
+        node = Rational(name='sub')
+        Rational(name='sub1', parent=node)
+        Rational(name='sub2', parent=node)
+        Rational.tree.insert_subtree(node, self._get('child12'),
+                                     Rational.tree.POSITION_RIGHT,
+                                     session=db.session)
+        db.session.commit()
+        self._check_nesting()
+        self.assertFalse([statement for statement in self.updates
+                          if 'tree_left=' in statement])
+        self.assertEqual(
+            self._get_structure()[0][1],
+            [('child11', []), ('child12', []),
+             ('sub', [('sub1', []), ('sub2', [])]), ('child13', [])])
+
+    def test_rebuild(self):
+        Rational.tree.rebuild(self._get('child212'))
+        self._check_nesting()
+        self.assertEqual(self._get_structure(),
+                         _strip_fields(self.name_pattern))
+        root2 = self._get('root2')
+        self.assertEqual((root2.tree_left, root2.tree_right), (1, 20))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RationalTestCase))
+    return suite
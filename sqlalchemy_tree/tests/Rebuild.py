@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Rebuild
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import os
+import random
+import sys
+import tempfile
+
+import sqlalchemy
+
+from .helper import unittest, TreeTestMixin, db, named, Named, \
+    get_tree_details
+from .Named import NamedTestCase
+
+
+class RebuildTestCase(TreeTestMixin, unittest.TestCase):
+
+    "Provides tests of rebuilding tree parameters from adjacency relations."
+    name_pattern = NamedTestCase.name_pattern
+
+    def _scramble_tree(self):
+        options = Named.tree._tree_options
+        db.session.execute(named.update().values({
+            options.tree_id_field: 0,
+            options.left_field:    0,
+            options.right_field:   0,
+            options.depth_field:   0,
+        }))
+        db.session.commit()
+
+    def test_rebuild(self):
+        self._scramble_tree()
+        Named.tree.rebuild(session=db.session)
+        self.assertEqual(get_tree_details(), self.name_pattern)
+
+    def test_rebuild_batches(self):
+        self._scramble_tree()
+        Named.tree.rebuild(session=db.session, batch_size=2)
+        self.assertEqual(get_tree_details(), self.name_pattern)
+
+    def test_rebuild_cte(self):
+        self._scramble_tree()
+        Named.tree.rebuild(session=db.session, method='cte')
+        self.assertEqual(get_tree_details(), self.name_pattern)
+
+    def test_rebuild_cte_matches_python(self):
+        options = Named.tree._tree_options
+        # Children added out of primary key order, the deepest node first:
+        db.session.execute(named.insert(), [{
+            'id':                         100 + idx,
+            'name':                       'extra%d' % idx,
+            options.parent_id_field.name: parent_id,
+            options.tree_id_field.name:   0,
+            options.left_field.name:      0,
+            options.right_field.name:     0,
+            options.depth_field.name:     0,
+        } for idx, parent_id in enumerate([101, 3, 3, None, 103, 6])])
+        db.session.commit()
+        Named.tree.rebuild(session=db.session)
+        expected = get_tree_details()
+        self._scramble_tree()
+        Named.tree.rebuild(session=db.session, method='cte')
+        self.assertEqual(get_tree_details(), expected)
+
+    def _get_sorted_pattern(self, key, reverse=False):
+        def _sort(patterns, tree_id, left, depth):
+            result = []
+            for name, fields, children in sorted(
+                    patterns, key=key, reverse=reverse):
+                if depth == 0:
+                    tree_id, left = tree_id + 1, 1
+                children = _sort(children, tree_id, left + 1, depth + 1)
+                right = children[-1][1]['right'] + 1 if children else left + 1
+                result.append((name, {'id': tree_id, 'left': left,
+                                      'right': right, 'depth': depth},
+                               children))
+                left = right + 1
+            return result
+        return _sort(self.name_pattern, 0, 1, 0)
+
+    def test_rebuild_order_by(self):
+        expected = self._get_sorted_pattern(lambda x: x[0], reverse=True)
+        for method in ('python', 'cte'):
+            self._scramble_tree()
+            Named.tree.rebuild(session=db.session, method=method,
+                               order_by=named.c.name.desc())
+            self.assertEqual(get_tree_details(), expected)
+
+    def test_rebuild_order_by_list(self):
+        expected = self._get_sorted_pattern(
+            lambda x: (len(x[2]), x[0]))
+        order_by = [sqlalchemy.select([sqlalchemy.func.count()])
+                    .where(named.alias().c.parent_id == named.c.id)
+                    .as_scalar(),
+                    named.c.name]
+        for method in ('python', 'cte'):
+            self._scramble_tree()
+            Named.tree.rebuild(session=db.session, method=method,
+                               order_by=order_by)
+            self.assertEqual(get_tree_details(), expected)
+
+    def test_rebuild_order_by_statements(self):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            Named.tree.rebuild(session=db.session)
+            unordered = len(statements)
+            del statements[:]
+            Named.tree.rebuild(session=db.session,
+                               order_by=named.c.name.desc())
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(len(statements), unordered)
+
+    def _corrupt_subtree(self, name):
+        options = Named.tree._tree_options
+        node = db.session.query(Named).filter_by(name=name).one()
+        db.session.execute(named.update().values({
+            options.left_field:  options.left_field + 1000,
+            options.right_field: options.right_field - 1000,
+            options.depth_field: 0,
+        }).where(node.tree.filter_descendants(include_self=False)))
+        db.session.commit()
+        return node
+
+    def test_rebuild_subtree(self):
+        options = Named.tree._tree_options
+        for method in ('python', 'cte'):
+            node = self._corrupt_subtree('child212')
+            # A corrupted node outside of the subtree is left alone:
+            db.session.execute(named.update()
+                               .where(named.c.name == 'child11')
+                               .values({options.left_field: 99}))
+            db.session.commit()
+            Named.tree.rebuild(node, method=method)
+            child11 = db.session.query(Named).filter_by(name='child11').one()
+            self.assertEqual(getattr(child11, options.left_field.name), 99)
+            db.session.execute(named.update()
+                               .where(named.c.name == 'child11')
+                               .values({options.left_field: 2}))
+            db.session.commit()
+            self.assertEqual(get_tree_details(), self.name_pattern)
+
+    def test_rebuild_subtrees(self):
+        for method in ('python', 'cte'):
+            nodes = [self._corrupt_subtree(name)
+                     for name in ('child2122', 'root1')]
+            Named.tree.rebuild(*nodes, method=method)
+            self.assertEqual(get_tree_details(), self.name_pattern)
+
+    def _add_leaf(self, parent_name):
+        options = Named.tree._tree_options
+        parent = db.session.query(Named).filter_by(name=parent_name).one()
+        db.session.execute(named.insert().values({
+            'id':                         100,
+            'name':                       'new',
+            options.parent_id_field.name: parent.id,
+            options.tree_id_field.name:   0,
+            options.left_field.name:      0,
+            options.right_field.name:     0,
+            options.depth_field.name:     0,
+        }))
+        db.session.commit()
+
+    def test_rebuild_subtree_resized(self):
+        options = Named.tree._tree_options
+        self._add_leaf('child2122')
+        for method in ('python', 'cte'):
+            node = db.session.query(Named).filter_by(name='child212').one()
+            self.assertRaises(ValueError, Named.tree.rebuild, node,
+                              method=method)
+            db.session.rollback()
+            new = db.session.query(Named).filter_by(name='new').one()
+            self.assertEqual(getattr(new, options.left_field.name), 0)
+        node = db.session.query(Named).filter_by(name='child212').one()
+        Named.tree.rebuild(node, allow_resize=True)
+        resized = get_tree_details()
+        self._scramble_tree()
+        Named.tree.rebuild(session=db.session)
+        self.assertEqual(resized, get_tree_details())
+
+    def test_rebuild_subtree_resized_cte(self):
+        self._add_leaf('child21221')
+        node = db.session.query(Named).filter_by(name='child21').one()
+        Named.tree.rebuild(node, method='cte', allow_resize=True)
+        resized = get_tree_details()
+        self._scramble_tree()
+        Named.tree.rebuild(session=db.session)
+        self.assertEqual(resized, get_tree_details())
+
+    def test_rebuild_unknown_method(self):
+        self.assertRaises(ValueError, Named.tree.rebuild,
+                          session=db.session, method='magic')
+
+    def test_rebuild_deep_chain(self):
+        for method in ('python', 'cte'):
+            self._scramble_tree()
+            self._test_rebuild_deep_chain(method)
+            db.session.execute(named.delete().where(named.c.id >= 1000))
+            db.session.commit()
+
+    def _test_rebuild_deep_chain(self, method):
+        options = Named.tree._tree_options
+        depth = sys.getrecursionlimit() + 100
+        root = db.session.query(Named).filter_by(name='root3').one()
+        db.session.execute(named.insert(), [{
+            'id':                        1000 + idx,
+            'name':                      'deep%d' % idx,
+            options.parent_id_field.name: 999 + idx if idx else root.id,
+            options.tree_id_field.name:  0,
+            options.left_field.name:     0,
+            options.right_field.name:    0,
+            options.depth_field.name:    0,
+        } for idx in range(depth)])
+        db.session.commit()
+        Named.tree.rebuild(session=db.session, method=method)
+        deepest = db.session.query(Named) \
+            .filter_by(name='deep%d' % (depth - 1)).one()
+        self.assertEqual(
+            (getattr(deepest, options.tree_id_field.name),
+             getattr(deepest, options.left_field.name),
+             getattr(deepest, options.right_field.name),
+             getattr(deepest, options.depth_field.name)),
+            (3, depth + 1, depth + 2, depth))
+        root = db.session.query(Named).filter_by(name='root3').one()
+        self.assertEqual(getattr(root, options.right_field.name),
+                         2 * depth + 2)
+
+    def test_bulk_rebuild(self):
+        self._scramble_tree()
+        Named.tree.bulk_rebuild(db.session)
+        self.assertEqual(get_tree_details(), self.name_pattern)
+
+    def test_bulk_rebuild_batches(self):
+        self._scramble_tree()
+        calls = []
+        Named.tree.bulk_rebuild(db.session, batch_size=4,
+                                progress=lambda *args: calls.append(args))
+        self.assertEqual(get_tree_details(), self.name_pattern)
+        self.assertEqual(calls, [(4, 15), (8, 15), (12, 15), (15, 15)])
+
+    def test_bulk_rebuild_cycle(self):
+        options = Named.tree._tree_options
+        child11 = db.session.query(Named).filter_by(name='child11').one()
+        db.session.execute(named.update()
+                           .where(named.c.name == 'root1')
+                           .values({options.parent_id_field: child11.id}))
+        db.session.commit()
+        self.assertRaises(ValueError, Named.tree.bulk_rebuild, db.session)
+
+
+    def test_rebuild_parallel_in_memory(self):
+        self.assertRaises(ValueError, Named.tree.rebuild,
+                          session=db.session, parallel=2)
+
+
+class ParallelRebuildTestCase(unittest.TestCase):
+
+    "Provides tests of rebuilding trees in parallel on a database file."
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.engine = sqlalchemy.create_engine('sqlite:///' + self.path)
+        db.metadata.create_all(bind=self.engine)
+        self.session = db.Session(bind=self.engine)
+
+        options = Named.tree._tree_options
+        rng = random.Random(0)
+        rows = []
+        for pk in range(1, 601):
+            offset = (pk - 1) % 30
+            rows.append({
+                'id':                         pk,
+                'name':                       'node%d' % pk,
+                options.parent_id_field.name: pk - rng.randint(1, offset)
+                                              if offset else None,
+                options.tree_id_field.name:   0,
+                options.left_field.name:      0,
+                options.right_field.name:     0,
+                options.depth_field.name:     0,
+            })
+        self.session.execute(named.insert(), rows)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def _get_tree_fields(self):
+        options = Named.tree._tree_options
+        return self.session.execute(sqlalchemy.select([
+            options.pk_field, options.tree_id_field, options.left_field,
+            options.right_field, options.depth_field,
+        ]).order_by(options.pk_field)).fetchall()
+
+    def test_rebuild_parallel(self):
+        Named.tree.rebuild(session=self.session)
+        expected = self._get_tree_fields()
+        self.assertEqual(len(set(row[1] for row in expected)), 20)
+        options = Named.tree._tree_options
+        self.session.execute(named.update().values(dict(
+            (field, 0) for field in options.required_fields)))
+        self.session.commit()
+        Named.tree.rebuild(session=self.session, parallel=4, batch_size=8)
+        self.assertEqual(self._get_tree_fields(), expected)
+
+    def test_rebuild_parallel_cte(self):
+        self.assertRaises(ValueError, Named.tree.rebuild,
+                          session=self.session, parallel=4, method='cte')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RebuildTestCase))
+    suite.addTest(unittest.makeSuite(ParallelRebuildTestCase))
+    return suite
@@ -11,7 +11,10 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement, unicode_literals
 
-from .helper import unittest, db, Named
+import sqlalchemy
+
+from .helper import unittest, db, Named, sqlite_has_returning
+from .Batch import ChangesTestCase
 
 
 class Regression__AddAllDifferentIds(unittest.TestCase):
@@ -35,7 +38,423 @@ class Regression__AddAllDifferentIds(unittest.TestCase):
             sorted(map(lambda x: (x.tree_id, x.tree_left, x.tree_right), nodes)))
 
 
+class Regression__SessionIndexAcrossFlushes(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+
+    def tearDown(self):
+        db.session.close()
+
+    def _assert_in_sync(self):
+        options = Named.tree._tree_options
+        fields = [options.pk_field, options.tree_id_field, options.left_field,
+                  options.right_field, options.depth_field]
+        in_memory = sorted(
+            tuple(getattr(node, field.name) for field in fields)
+            for node in db.session.identity_map.values())
+        in_database = sorted(
+            tuple(row) for row in
+            db.session.execute(sqlalchemy.select(fields)).fetchall())
+        self.assertEqual(in_database, in_memory)
+
+    def test_insert_after_commit(self):
+        roots = [Named(name=u"root%d" % idx) for idx in range(3)]
+        db.session.add_all(roots)
+        db.session.commit()
+        nodes = []
+        for idx in range(3):
+            for root in db.session.query(Named).filter(
+                    Named.tree.filter_root_nodes()).all():
+                node = Named(name=u"%s.%d" % (root.name, idx))
+                Named.tree.insert(node, root, Named.tree.POSITION_FIRST_CHILD)
+                db.session.add(node)
+                nodes.append(node)
+            db.session.flush()
+            self._assert_in_sync()
+            db.session.commit()
+
+    def test_move_with_expired_nodes(self):
+        root = Named(name=u"root")
+        db.session.add(root)
+        db.session.flush()
+        children = []
+        for idx in range(4):
+            child = Named(name=u"child%d" % idx)
+            Named.tree.insert(child, root)
+            db.session.add(child)
+            children.append(child)
+        db.session.flush()
+        db.session.expire(children[1])
+        Named.tree.insert(children[3], children[0],
+                          Named.tree.POSITION_FIRST_CHILD)
+        db.session.flush()
+        self._assert_in_sync()
+        Named.tree.insert(children[0], None)
+        db.session.flush()
+        self._assert_in_sync()
+
+    def test_root_sibling_moves(self):
+        roots = [Named(name=u"root%d" % idx) for idx in range(3)]
+        db.session.add_all(roots)
+        db.session.commit()
+        Named.tree.insert(roots[0], roots[1], Named.tree.POSITION_RIGHT)
+        db.session.flush()
+        self._assert_in_sync()
+        Named.tree.insert(roots[2], roots[1], Named.tree.POSITION_LEFT)
+        child = Named(name=u"child")
+        Named.tree.insert(child, roots[2])
+        db.session.add(child)
+        db.session.flush()
+        self._assert_in_sync()
+        db.session.commit()
+        self.assertEqual(
+            [(node.name, node.tree_id) for node in db.session.query(Named)
+             .order_by(Named.tree_id, Named.tree_left)],
+            [(u"root2", 1), (u"child", 1), (u"root1", 2), (u"root0", 3)])
+
+    def test_parent_relationship_moves(self):
+        roots = [Named(name=u"root%d" % idx) for idx in range(3)]
+        db.session.add_all(roots)
+        db.session.flush()
+        child = Named(name=u"child")
+        Named.tree.insert(child, roots[0])
+        db.session.add(child)
+        db.session.commit()
+        roots[1].parent = child
+        node = Named(name=u"node")
+        Named.tree.insert(node, roots[2])
+        db.session.add(node)
+        db.session.flush()
+        self._assert_in_sync()
+        db.session.commit()
+        self.assertEqual(
+            [(node.name, node.parent and node.parent.name, node.tree_id,
+              node.tree_left, node.tree_right)
+             for node in db.session.query(Named)
+             .order_by(Named.tree_id, Named.tree_left)],
+            [(u"root0", None, 1, 1, 6), (u"child", u"root0", 1, 2, 5),
+             (u"root1", u"child", 1, 3, 4), (u"root2", None, 2, 1, 4),
+             (u"node", u"root2", 2, 2, 3)])
+
+
+class Regression__ReloadRoundTrips(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+        self.statements = None
+        sqlalchemy.event.listen(
+            db.engine, 'before_cursor_execute', self._record_statement)
+
+    def tearDown(self):
+        db.session.close()
+        sqlalchemy.event.remove(
+            db.engine, 'before_cursor_execute', self._record_statement)
+
+    def _record_statement(self, conn, cursor, statement, *args):
+        if self.statements is not None:
+            self.statements.append(statement)
+
+    def _count_selects_moving(self, count):
+        source = Named(name=u"source%d" % count)
+        destination = Named(name=u"destination%d" % count)
+        db.session.add_all([source, destination])
+        db.session.flush()
+        children = []
+        for idx in range(count):
+            child = Named(name=u"child%d.%d" % (count, idx))
+            Named.tree.insert(child, source)
+            db.session.add(child)
+            children.append(child)
+        db.session.commit()
+        for child in children:
+            Named.tree.insert(child, destination)
+        self.statements = []
+        db.session.flush()
+        selects = [statement for statement in self.statements
+                   if statement.lstrip().upper().startswith('SELECT')]
+        self.statements = None
+        return len(selects)
+
+    def test_selects_per_flush_are_constant(self):
+        self.assertEqual(self._count_selects_moving(2),
+                         self._count_selects_moving(20))
+
+
+class Regression__ReturningShifts(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        self.engine = self._create_engine()
+        db.metadata.drop_all(bind=self.engine)
+        db.metadata.create_all(bind=self.engine)
+        db.session = db.Session(bind=self.engine)
+        Named.tree._tree_options.returning = True
+
+    def tearDown(self):
+        Named.tree._tree_options.returning = False
+        db.session.close()
+
+    def _create_engine(self):
+        # SQLite has no ``UPDATE ... RETURNING`` as far as its dialect knows:
+        # the nodes are still patched in Python.
+        return db.engine
+
+    _assert_in_sync = Regression__SessionIndexAcrossFlushes.__dict__[
+        '_assert_in_sync']
+
+    def _assert_roots(self, names):
+        self.assertEqual(
+            [(node.name, node.tree_id) for node in db.session.query(Named)
+             .filter(Named.tree.filter_root_nodes())
+             .order_by(Named.tree_id)],
+            [(name, idx + 1) for idx, name in enumerate(names)])
+
+    def test_update_returning_support(self):
+        from sqlalchemy.dialects import postgresql, sqlite
+        from ..orm import _supports_update_returning
+        self.assertTrue(_supports_update_returning(postgresql.dialect()))
+        self.assertFalse(_supports_update_returning(sqlite.dialect()))
+
+    def test_shifts(self):
+        root = Named(name=u"root")
+        db.session.add(root)
+        db.session.flush()
+        children = []
+        for idx in range(4):
+            child = Named(name=u"child%d" % idx)
+            Named.tree.insert(child, root, Named.tree.POSITION_FIRST_CHILD)
+            db.session.add(child)
+            children.append(child)
+        db.session.flush()
+        self._assert_in_sync()
+        Named.tree.insert(children[0], children[3],
+                          Named.tree.POSITION_LAST_CHILD)
+        db.session.flush()
+        self._assert_in_sync()
+        db.session.delete(children[3])
+        db.session.flush()
+        self._assert_in_sync()
+        Named.tree.insert(children[2], None)
+        db.session.flush()
+        self._assert_in_sync()
+
+    def test_pending_nodes_are_shifted_once(self):
+        root = Named(name=u"root")
+        db.session.add(root)
+        db.session.commit()
+        child = Named(name=u"child")
+        Named.tree.insert(child, root, Named.tree.POSITION_FIRST_CHILD)
+        db.session.add(child)
+        node = Named(name=u"node")
+        Named.tree.insert(node, root, Named.tree.POSITION_LEFT)
+        db.session.add(node)
+        db.session.flush()
+        self._assert_in_sync()
+        self.assertEqual((root.tree_id, child.tree_id), (2, 2))
+
+    def test_deleted_roots(self):
+        roots = [Named(name=u"root%d" % idx) for idx in range(8)]
+        db.session.add_all(roots)
+        db.session.commit()
+        db.session.delete(roots[6])
+        db.session.delete(roots[3])
+        roots.append(Named(name=u"root8"))
+        db.session.add(roots[-1])
+        db.session.flush()
+        self._assert_in_sync()
+        self._assert_roots([u"root0", u"root1", u"root2", u"root4",
+                            u"root5", u"root7", u"root8"])
+
+    def test_patch_rows(self):
+        root = Named(name=u"root")
+        db.session.add(root)
+        db.session.flush()
+        child = Named(name=u"child")
+        Named.tree.insert(child, root)
+        db.session.add(child)
+        db.session.flush()
+        options = Named.tree._tree_options
+        db.session.execute(
+            options.table.update()
+            .values({options.left_field: options.left_field + 10,
+                     options.right_field: options.right_field + 10}))
+        rows = db.session.execute(sqlalchemy.select(
+            [options.pk_field, options.left_field, options.right_field]))
+        session_index = Named.tree.session_extension.session_index(db.session)
+        session_index.patch_rows(['left', 'right'], rows.fetchall())
+        self._assert_in_sync()
+        self.assertEqual(
+            session_index.left_between(1, 12, 12), [child])
+
+
+@unittest.skipUnless(sqlite_has_returning,
+                     'SQLite before 3.35 has no UPDATE ... RETURNING')
+class Regression__ReturningShiftsOnSQLite(Regression__ReturningShifts):
+
+    def _create_engine(self):
+        return sqlalchemy.create_engine('sqlite+returning://')
+
+    def test_rows_are_returned(self):
+        from ..orm import _supports_update_returning
+        self.assertTrue(_supports_update_returning(self.engine.dialect))
+        statements = []
+
+        @sqlalchemy.event.listens_for(self.engine, 'before_cursor_execute')
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        root = Named(name=u"root")
+        db.session.add(root)
+        db.session.flush()
+        child = Named(name=u"child")
+        Named.tree.insert(child, root)
+        db.session.add(child)
+        db.session.flush()
+        self.assertTrue([statement for statement in statements
+                         if statement.startswith('UPDATE') and
+                         'RETURNING' in statement])
+        self._assert_in_sync()
+
+
+class Regression__StatementCache(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+
+    def tearDown(self):
+        db.session.close()
+
+    def test_statements_are_reused(self):
+        extension = Named.tree.mapper_extension
+        root = Named(name=u"root")
+        db.session.add(root)
+        db.session.flush()
+        children = []
+        for idx in range(4):
+            child = Named(name=u"child%d" % idx)
+            Named.tree.insert(child, root)
+            db.session.add(child)
+            children.append(child)
+        db.session.flush()
+
+        def _move_and_delete(child):
+            Named.tree.insert(children[-1], children[0],
+                              Named.tree.POSITION_FIRST_CHILD)
+            db.session.flush()
+            db.session.delete(child)
+            db.session.flush()
+            return (dict(extension._statements),
+                    len(extension._compiled_cache))
+        statements, compiled = _move_and_delete(children.pop(1))
+        self.assertTrue(statements and compiled)
+        self.assertEqual(_move_and_delete(children.pop(1)),
+                         (statements, compiled))
+
+
+class Regression__ParentIdLookups(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+        self.statements = None
+        sqlalchemy.event.listen(
+            db.engine, 'before_cursor_execute', self._record_statement)
+
+    def tearDown(self):
+        db.session.close()
+        sqlalchemy.event.remove(
+            db.engine, 'before_cursor_execute', self._record_statement)
+
+    def _record_statement(self, conn, cursor, statement, *args):
+        if self.statements is not None:
+            self.statements.append(statement)
+
+    def _add_children(self, parent_ids, count):
+        """Adds ``count`` children to each of the nodes ``parent_ids``, setting
+        only their parent id column, and returns the statements of the flush
+        loading nodes (rather than only their tree fields)."""
+        for parent_id in parent_ids:
+            for idx in range(count):
+                node = Named(name=u"child%d.%d" % (parent_id, idx))
+                node.parent_id = parent_id
+                db.session.add(node)
+        self.statements = []
+        db.session.flush()
+        statements, self.statements = self.statements, None
+        return [statement for statement in statements
+                if statement.lstrip().upper().startswith('SELECT') and
+                '%s.name' % Named.tree._tree_options.table.name in statement]
+
+    def test_parents_are_loaded_together(self):
+        roots = [Named(name=u"root%d" % idx) for idx in range(4)]
+        db.session.add_all(roots)
+        db.session.commit()
+        parent_ids = [root.id for root in roots]
+        db.session.close()
+        db.session = db.Session()
+        self.assertEqual(len(self._add_children(parent_ids, 3)), 1)
+        db.session.commit()
+        for root in db.session.query(Named).filter(
+                Named.tree.filter_root_nodes()):
+            self.assertEqual(
+                [child.name for child in root.tree.query_children()],
+                [u"child%d.%d" % (root.id, idx) for idx in range(3)])
+
+    def test_parents_in_the_session_are_reused(self):
+        roots = [Named(name=u"root%d" % idx) for idx in range(4)]
+        db.session.add_all(roots)
+        db.session.commit()
+        for root in roots:
+            root.name
+        self.assertEqual(
+            self._add_children([root.id for root in roots], 3), [])
+
+
+@unittest.skipUnless(sqlite_has_returning,
+                     'SQLite before 3.35 has no UPDATE ... RETURNING')
+class Regression__ReturningRandomChanges(ChangesTestCase):
+    engine = sqlalchemy.create_engine('sqlite+returning://')
+
+    def tearDown(self):
+        Named.tree._tree_options.returning = False
+        super(Regression__ReturningRandomChanges, self).tearDown()
+
+    def test_random_changes(self):
+        for seed in range(8):
+            self._reset()
+            ops = self._run_one_by_one(seed, 40)
+            expected, expected_values = \
+                self._get_structure(), self._get_values()
+            self._reset()
+            Named.tree._tree_options.returning = True
+            for op in ops:
+                self._apply(op)
+                self.new_nodes.clear()
+                db.session.commit()
+            Named.tree._tree_options.returning = False
+            self.assertEqual(self._get_structure(), expected)
+            self.assertEqual(self._get_values(), expected_values)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(Regression__AddAllDifferentIds))
+    suite.addTest(unittest.makeSuite(Regression__SessionIndexAcrossFlushes))
+    suite.addTest(unittest.makeSuite(Regression__ReloadRoundTrips))
+    suite.addTest(unittest.makeSuite(Regression__ReturningShifts))
+    suite.addTest(unittest.makeSuite(Regression__ReturningShiftsOnSQLite))
+    suite.addTest(unittest.makeSuite(Regression__ReturningRandomChanges))
+    suite.addTest(unittest.makeSuite(Regression__StatementCache))
+    suite.addTest(unittest.makeSuite(Regression__ParentIdLookups))
     return suite
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.RootOrder
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, Unicode, ForeignKey
+from sqlalchemy.orm import mapper, relationship, backref
+
+from sqlalchemy_tree import TreeManager, TreeRootOrderType
+from sqlalchemy_tree.orm import ROOT_ORDER_SPACING
+
+from .helper import unittest, db
+from .Named import NamedTestCase
+
+
+class Ordered(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+ordered = Table('sqlalchemy_tree__tests__ordered', db.metadata,
+                Column('id', Integer, primary_key=True),
+                Column('name', Unicode, nullable=False, unique=True),
+                Column('parent_id', Integer,
+                       ForeignKey('sqlalchemy_tree__tests__ordered.id')),
+                )
+Ordered.tree = TreeManager(ordered, root_order_field=True)
+mapper(Ordered, ordered, properties={
+    'parent': relationship(Ordered,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=ordered.c.id),
+})
+Ordered.tree.register()
+
+
+class RationalOrdered(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+rational_ordered = Table(
+    'sqlalchemy_tree__tests__rational_ordered', db.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', Unicode, nullable=False, unique=True),
+    Column('parent_id', Integer,
+           ForeignKey('sqlalchemy_tree__tests__rational_ordered.id')),
+    # The root order field is detected by its type:
+    Column('position', TreeRootOrderType, nullable=False),
+)
+RationalOrdered.tree = TreeManager(rational_ordered, encoding='rational')
+mapper(RationalOrdered, rational_ordered, properties={
+    'parent': relationship(RationalOrdered,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=rational_ordered.c.id),
+})
+RationalOrdered.tree.register()
+
+
+class RootOrderTestCase(unittest.TestCase):
+
+    "Provides tests of root ordering, using the `ordered` table."
+    name_pattern = NamedTestCase.name_pattern
+    node_class = Ordered
+    table = ordered
+
+    def setUp(self):
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+
+        def _process_node(pattern, parent=None):
+            name, fields, children = pattern
+            node = self.node_class(name=name)
+            self.node_class.tree.insert(node, parent)
+            db.session.add(node)
+            db.session.commit()
+            for child in children:
+                _process_node(child, node)
+        for root in self.name_pattern:
+            _process_node(root)
+        self.tree_ids = self._get_tree_ids()
+
+    def tearDown(self):
+        db.session.close()
+
+    def _get(self, name):
+        return db.session.query(self.node_class) \
+            .filter(self.table.c.name == name).one()
+
+    def _insert(self, name, target=None, *args):
+        node = self.node_class(name=name)
+        self.node_class.tree.insert(node, target and self._get(target), *args)
+        db.session.add(node)
+        db.session.commit()
+
+    def _move(self, name, target=None, *args):
+        self.node_class.tree.insert(self._get(name),
+                                    target and self._get(target), *args)
+        db.session.commit()
+
+    def _get_tree_ids(self):
+        return dict(db.session.query(self.table.c.name, self.table.c.tree_id))
+
+    def _get_roots(self):
+        """Returns the names of the root nodes in order, checking that every
+        node has the tree id of its root, and that the sibling queries agree
+        with the order."""
+        tree = self.node_class.tree
+        roots = db.session.query(self.node_class) \
+            .filter(tree.filter_root_nodes()).order_by(tree).all()
+        names = [root.name for root in roots]
+        tree_ids = [root.tree_id for root in roots]
+        self.assertEqual(len(set(tree_ids)), len(tree_ids))
+        for root in roots:
+            self.assertEqual(
+                set(node.tree_id for node in root.tree.query_descendants()),
+                set([root.tree_id]) if root.tree.get_descendant_count() else
+                set())
+        for idx, root in enumerate(roots):
+            self.assertEqual(
+                sorted(node.name for node in root.tree.query_previous_siblings()),
+                sorted(names[:idx]))
+            self.assertEqual(
+                sorted(node.name for node in root.tree.query_next_siblings()),
+                sorted(names[idx + 1:]))
+            previous_sibling = root.tree.previous_sibling
+            self.assertEqual(previous_sibling and previous_sibling.name,
+                             names[idx - 1] if idx else None)
+            next_sibling = root.tree.next_sibling
+            self.assertEqual(next_sibling and next_sibling.name,
+                             names[idx + 1] if idx + 1 < len(names) else None)
+        return names
+
+    def _check_tree_ids(self, *names):
+        "Checks that the trees of the root nodes ``names`` kept their tree id."
+        tree_ids = self._get_tree_ids()
+        for name in names:
+            self.assertEqual(tree_ids[name], self.tree_ids[name])
+
+    def test_root_order_field(self):
+        options = self.node_class.tree._tree_options
+        self.assertTrue(isinstance(options.root_order_field.type,
+                                   TreeRootOrderType))
+        self.assertTrue(options.root_order_field in options.required_fields)
+        self.assertEqual(self._get_roots(), ['root1', 'root2', 'root3'])
+        self.assertEqual(
+            [getattr(self._get(name), options.root_order_field.name)
+             for name in ('root1', 'root2', 'root3')],
+            [ROOT_ORDER_SPACING, 2 * ROOT_ORDER_SPACING,
+             3 * ROOT_ORDER_SPACING])
+
+    def test_insert(self):
+        tree = self.node_class.tree
+        self._insert('before1', 'root1', tree.POSITION_LEFT)
+        self._insert('after1', 'root1', tree.POSITION_RIGHT)
+        self._insert('before3', 'root3', tree.POSITION_LEFT)
+        self._insert('after3', 'root3', tree.POSITION_RIGHT)
+        self._insert('root4')
+        self.assertEqual(self._get_roots(), [
+            'before1', 'root1', 'after1', 'root2', 'before3', 'root3',
+            'after3', 'root4'])
+        self._check_tree_ids('root1', 'root2', 'root3', 'child2122')
+
+    def test_insert_run(self):
+        """Root nodes inserted at the same place in one flush end up as if
+        inserted one at a time."""
+        tree = self.node_class.tree
+        for name in ('new1', 'new2', 'new3'):
+            node = self.node_class(name=name)
+            tree.insert(node, self._get('root2'), tree.POSITION_LEFT)
+            db.session.add(node)
+        for name in ('new4', 'new5'):
+            node = self.node_class(name=name)
+            tree.insert(node, self._get('root2'), tree.POSITION_RIGHT)
+            db.session.add(node)
+        node = self.node_class(name='new6')
+        db.session.add(node)
+        db.session.commit()
+        self.assertEqual(self._get_roots(), [
+            'root1', 'new1', 'new2', 'new3', 'root2', 'new5', 'new4', 'root3',
+            'new6'])
+        self._check_tree_ids('root1', 'root2', 'root3')
+
+    def test_insert_statements(self):
+        "Inserting a root node next to another one updates no row."
+        tree = self.node_class.tree
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self._insert('before1', 'root1', tree.POSITION_LEFT)
+            self._insert('after1', 'root1', tree.POSITION_RIGHT)
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith('UPDATE')])
+        self.assertEqual(self._get_roots(),
+                         ['before1', 'root1', 'after1', 'root2', 'root3'])
+
+    def test_make_room(self):
+        "Root nodes are moved once the values between two are used up."
+        tree = self.node_class.tree
+        names = []
+        for idx in range(40):
+            names.append('new%02d' % idx)
+            self._insert(names[-1], 'root2', tree.POSITION_LEFT)
+        for idx in range(40):
+            names.append('old%02d' % idx)
+            self._insert(names[-1], 'root1', tree.POSITION_RIGHT)
+        self.assertEqual(
+            self._get_roots(),
+            ['root1'] + names[:39:-1] + names[:40] + ['root2', 'root3'])
+        self._check_tree_ids('root1', 'root2', 'root3')
+
+    def test_delete(self):
+        db.session.delete(self._get('root2'))
+        db.session.commit()
+        self.assertEqual(self._get_roots(), [
+            'root1', 'child21', 'child22', 'child23', 'root3'])
+        self._check_tree_ids('root1', 'root3')
+        self.assertEqual(self._get_tree_ids()['child21'],
+                         self.tree_ids['root2'])
+        db.session.delete(self._get('root1'))
+        db.session.delete(self._get('child22'))
+        db.session.commit()
+        self.assertEqual(self._get_roots(), [
+            'child11', 'child12', 'child13', 'child21', 'child23', 'root3'])
+        self._check_tree_ids('root3')
+
+    def test_delete_with_new_child(self):
+        node = self.node_class(name='child14')
+        self.node_class.tree.insert(node, self._get('root1'))
+        db.session.add(node)
+        db.session.delete(self._get('root1'))
+        db.session.commit()
+        self.assertEqual(self._get_roots(), [
+            'child11', 'child12', 'child13', 'child14', 'root2', 'root3'])
+
+
+    def test_delete_subtree(self):
+        self.node_class.tree.delete_subtree(self._get('root2'))
+        db.session.commit()
+        self.assertEqual(self._get_roots(), ['root1', 'root3'])
+        self._check_tree_ids('root1', 'root3')
+
+    def test_move(self):
+        tree = self.node_class.tree
+        self._move('root3', 'root1', tree.POSITION_LEFT)
+        self.assertEqual(self._get_roots(), ['root3', 'root1', 'root2'])
+        self._move('child212', 'root3', tree.POSITION_RIGHT)
+        self._move('child22')
+        self._move('root1', 'child2122')
+        self._move('child21', 'root2', tree.POSITION_RIGHT)
+        self.assertEqual(self._get_roots(), [
+            'root3', 'child212', 'root2', 'child21', 'child22'])
+        root = self._get('child212')
+        self.assertEqual(
+            [node.name for node in
+             root.tree.query_descendants().order_by(tree)],
+            ['child2121', 'child2122', 'child21221', 'child21222', 'root1',
+             'child11', 'child12', 'child13'])
+        self._check_tree_ids('root2', 'root3')
+        self._move('root1', 'root2', tree.POSITION_LEFT)
+        self.assertEqual(self._get_roots(), [
+            'root3', 'child212', 'root1', 'root2', 'child21', 'child22'])
+
+    def test_order_by(self):
+        tree = self.node_class.tree
+        self._move('root2', 'root1', tree.POSITION_LEFT)
+        self._move('child13', 'root3')
+        # Each tree comes whole, in the order of the root nodes:
+        self.assertEqual(
+            [node.name for node in
+             db.session.query(self.node_class).order_by(tree)],
+            ['root2', 'child21', 'child211', 'child212', 'child2121',
+             'child2122', 'child21221', 'child21222', 'child22', 'child23',
+             'root1', 'child11', 'child12', 'root3', 'child13'])
+
+    def test_insert_subtree(self):
+        tree = self.node_class.tree
+        node = self.node_class(name='root4')
+        self.node_class(name='child41', parent=node)
+        tree.insert_subtree(node, self._get('root2'), tree.POSITION_LEFT,
+                            session=db.session)
+        db.session.commit()
+        node = self.node_class(name='root5')
+        self.node_class(name='child51', parent=node)
+        tree.insert_subtree(node, session=db.session)
+        db.session.commit()
+        self.assertEqual(self._get_roots(),
+                         ['root1', 'root4', 'root2', 'root3', 'root5'])
+        root = self._get('root4')
+        self.assertEqual(
+            [child.name for child in root.tree.query_children()], ['child41'])
+        self._check_tree_ids('root1', 'root2', 'root3')
+
+    def test_rebuild(self):
+        tree = self.node_class.tree
+        self._move('root3', 'root1', tree.POSITION_LEFT)
+        tree.rebuild(session=db.session)
+        # A complete rebuild orders the trees by primary key:
+        self.assertEqual(self._get_roots(), ['root1', 'root2', 'root3'])
+        field = tree._tree_options.root_order_field
+        self.assertEqual(
+            db.session.query(self.table.c.tree_id, field)
+            .filter(tree.filter_root_nodes()).order_by(field).all(),
+            [(tree_id, tree_id * ROOT_ORDER_SPACING) for tree_id in (1, 2, 3)])
+        self._insert('root0', 'root1', tree.POSITION_LEFT)
+        self.assertEqual(self._get_roots(),
+                         ['root0', 'root1', 'root2', 'root3'])
+
+
+class RationalRootOrderTestCase(RootOrderTestCase):
+
+    """Provides tests of root ordering in trees with rational encoding, using
+    the `rational_ordered` table."""
+    node_class = RationalOrdered
+    table = rational_ordered
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RootOrderTestCase))
+    suite.addTest(unittest.makeSuite(RationalRootOrderTestCase))
+    return suite
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlalchemy_tree.tests.Spacing
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (C) 2012-2014 the SQLAlchemy-ORM-Tree authors and contributors
+                <see AUTHORS file>.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement, unicode_literals
+
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, Unicode, ForeignKey
+from sqlalchemy.orm import mapper, relationship, backref
+
+from sqlalchemy_tree import TreeManager
+
+from .helper import unittest, db
+from .Named import NamedTestCase
+
+
+class Spaced(object):
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+spaced = Table('sqlalchemy_tree__tests__spaced', db.metadata,
+               Column('id', Integer, primary_key=True),
+               Column('name', Unicode, nullable=False, unique=True),
+               Column('parent_id', Integer,
+                      ForeignKey('sqlalchemy_tree__tests__spaced.id')),
+               )
+Spaced.tree = TreeManager(spaced, spacing=2)
+mapper(Spaced, spaced, properties={
+    'parent': relationship(Spaced,
+                           backref=backref('children', lazy='dynamic'),
+                           remote_side=spaced.c.id),
+})
+Spaced.tree.register()
+
+
+def _strip_fields(pattern):
+    return [(name, _strip_fields(children))
+            for name, fields, children in pattern]
+
+
+class SpacingTestCase(unittest.TestCase):
+
+    "Provides tests of trees numbered with spacing, using the `spaced` table."
+    name_pattern = NamedTestCase.name_pattern
+
+    def setUp(self):
+        self.maxDiff = None
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        db.session = db.Session()
+
+        def _process_node(pattern, parent=None):
+            name, fields, children = pattern
+            node = Spaced(name=name)
+            Spaced.tree.insert(node, parent)
+            db.session.add(node)
+            db.session.commit()
+            for child in children:
+                _process_node(child, node)
+        for root in self.name_pattern:
+            _process_node(root)
+
+        self.updates = []
+
+        @sqlalchemy.event.listens_for(db.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE'):
+                self.updates.append(statement)
+        self._count = count
+
+    def tearDown(self):
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                self._count)
+        db.session.close()
+
+    def _get(self, name):
+        return db.session.query(Spaced).filter(spaced.c.name == name).one()
+
+    def _insert(self, name, target, position):
+        node = Spaced(name=name)
+        Spaced.tree.insert(node, self._get(target), position)
+        db.session.add(node)
+        db.session.commit()
+
+    def _get_structure(self):
+        "Reads the trees back through the tree filters, by tree id and left."
+        def _get_subtree(parent):
+            if parent is None:
+                query = db.session.query(Spaced) \
+                    .filter(Spaced.tree.filter_root_nodes())
+            else:
+                query = db.session.query(Spaced) \
+                    .filter(parent.tree.filter_children())
+            return [(node.name, _get_subtree(node))
+                    for node in query.order_by(Spaced.tree).all()]
+        return _get_subtree(None)
+
+    def _check_nesting(self):
+        """Checks the tree fields against the adjacency list: every node lies
+        strictly inside its parent, one level deeper, and apart from its
+        siblings."""
+        rows = dict((row.id, row) for row in db.session.execute(
+            sqlalchemy.select([spaced])))
+        children = {}
+        for row in rows.values():
+            children.setdefault(row.parent_id, []).append(row)
+        for parent_id, siblings in children.items():
+            siblings.sort(key=lambda row: (row.tree_id, row.tree_left))
+            for row in siblings:
+                self.assertTrue(row.tree_left < row.tree_right)
+                if parent_id is None:
+                    self.assertEqual((row.tree_left, row.tree_depth), (1, 0))
+                    continue
+                parent = rows[parent_id]
+                self.assertEqual(row.tree_id, parent.tree_id)
+                self.assertEqual(row.tree_depth, parent.tree_depth + 1)
+                self.assertTrue(parent.tree_left < row.tree_left)
+                self.assertTrue(row.tree_right < parent.tree_right)
+            if parent_id is not None:
+                for previous, row in zip(siblings, siblings[1:]):
+                    self.assertTrue(previous.tree_right < row.tree_left)
+
+    def test_fill_tree(self):
+        self.assertEqual(self._get_structure(),
+                         _strip_fields(self.name_pattern))
+        self._check_nesting()
+        root1 = self._get('root1')
+        self.assertEqual((root1.tree_left, root1.tree_right), (1, 16))
+
+    def test_insert_without_updates(self):
+        expected = _strip_fields(self.name_pattern)
+        self._insert('first', 'root1', Spaced.tree.POSITION_FIRST_CHILD)
+        self._insert('left', 'child12', Spaced.tree.POSITION_LEFT)
+        self._insert('right', 'child2121', Spaced.tree.POSITION_RIGHT)
+        self._insert('last', 'child21222', Spaced.tree.POSITION_LAST_CHILD)
+        self.assertEqual(self.updates, [])
+        expected[0][1][:] = [('first', []), ('child11', []), ('left', []),
+                             ('child12', []), ('child13', [])]
+        self.assertEqual(self._get_structure()[0], expected[0])
+        self._check_nesting()
+        child212 = self._get('child212')
+        self.assertEqual(
+            [node.name for node in child212.tree.query_descendants()],
+            ['child2121', 'right', 'child2122', 'child21221', 'child21222',
+             'last'])
+
+    def test_insert_respaces_subtree(self):
+        names = ['node%02d' % idx for idx in range(20)]
+        for name in names[:10]:
+            self._insert(name, 'child13', Spaced.tree.POSITION_FIRST_CHILD)
+        for name in names[10:]:
+            self._insert(name, 'child13', Spaced.tree.POSITION_LAST_CHILD)
+        self._check_nesting()
+        child13 = self._get('child13')
+        self.assertEqual(
+            [node.name for node in child13.tree.query_children()],
+            names[9::-1] + names[10:])
+        self.assertEqual(child13.tree.get_descendant_count(), 20)
+        self.assertEqual(
+            self._get_structure()[1:], _strip_fields(self.name_pattern)[1:])
+        # Only widening the subtree shifts the rest of the tree:
+        shifts = [statement for statement in self.updates
+                  if 'CASE' in statement]
+        self.assertTrue(len(shifts) <= 5, len(shifts))
+
+    def test_insert_run(self):
+        root3 = self._get('root3')
+        nodes = [Spaced(name='node%02d' % idx) for idx in range(10)]
+        for node in nodes:
+            Spaced.tree.insert(node, root3, Spaced.tree.POSITION_LAST_CHILD)
+            db.session.add(node)
+        db.session.commit()
+        self._check_nesting()
+        self.assertEqual(
+            [node.name for node in root3.tree.query_children()],
+            ['node%02d' % idx for idx in range(10)])
+
+    def test_delete(self):
+        db.session.delete(self._get('child212'))
+        db.session.commit()
+        self.assertFalse([statement for statement in self.updates
+                          if 'tree_left=' in statement])
+        self._check_nesting()
+        child21 = self._get('child21')
+        self.assertEqual(
+            [node.name for node in child21.tree.query_children()],
+            ['child211', 'child2121', 'child2122'])
+
+
+    def test_delete_subtree(self):
+        Spaced.tree.delete_subtree(self._get('child212'))
+        db.session.commit()
+        self.assertFalse(self.updates)
+        self._check_nesting()
+        self.assertEqual(self._get_structure(), [
+            ('root1', [('child11', []), ('child12', []), ('child13', [])]),
+            ('root2', [('child21', [('child211', [])]),
+                       ('child22', []), ('child23', [])]),
+            ('root3', []),
+        ])
+
+    def test_leaf_nodes(self):
+        self.assertEqual(
+            sorted(node.name for node in
+                   db.session.query(Spaced)
+                   .filter(Spaced.tree.filter_leaf_nodes())),
+            ['child11', 'child12', 'child13', 'child211', 'child2121',
+             'child21221', 'child21222', 'child22', 'child23', 'root3'])
+        root2 = self._get('root2')
+        self.assertEqual(
+            [node.name for node in root2.tree.query_leaf_nodes()],
+            ['child211', 'child2121', 'child21221', 'child21222', 'child22',
+             'child23'])
+        self.assertEqual(root2.tree.get_descendant_count(), 9)
+        self.assertFalse(root2.tree.is_leaf_node)
+        child22 = self._get('child22')
+        self.assertTrue(child22.tree.is_leaf_node)
+
+    def test_move(self):
+        node = self._get('child212')
+        Spaced.tree.insert(node, self._get('root1'),
+                           Spaced.tree.POSITION_FIRST_CHILD)
+        db.session.commit()
+        self._check_nesting()
+        root1 = self._get('root1')
+        self.assertEqual(
+            [n.name for n in root1.tree.query_descendants()],
+            ['child212', 'child2121', 'child2122', 'child21221',
+             'child21222', 'child11', 'child12', 'child13'])
+        self._insert('new', 'child2122', Spaced.tree.POSITION_LEFT)
+        self._check_nesting()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SpacingTestCase))
+    return suite
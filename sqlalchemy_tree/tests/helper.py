@@ -20,10 +20,16 @@ except ImportError:  # Python 2.7
 # Python standard library, combinatoric generators
 from itertools import permutations
 
+# Python standard library, SQLite database driver
+import sqlite3
+
 # SQLAlchemy object-relational mapper
 import sqlalchemy
 from sqlalchemy import *
 from sqlalchemy.orm import mapper, relationship, backref, sessionmaker
+from sqlalchemy.dialects.sqlite.base import SQLiteCompiler
+from sqlalchemy.dialects.sqlite.pysqlite import SQLiteDialect_pysqlite
+from sqlalchemy.sql import expression
 
 # SQLAlchemy tree extension
 import sqlalchemy_tree
@@ -43,6 +49,30 @@ db = _Database()
 # ===----------------------------------------------------------------------===
 
 
+class _ReturningSQLiteCompiler(SQLiteCompiler):
+
+    def returning_clause(self, stmt, returning_cols):
+        return 'RETURNING ' + ', '.join(
+            self._label_select_column(None, column, True, False, {})
+            for column in expression._select_iterables(returning_cols))
+
+
+class ReturningSQLiteDialect(SQLiteDialect_pysqlite):
+    """SQLite has run ``UPDATE ... RETURNING`` since version 3.35, which the
+    SQLite dialect of this version of SQLAlchemy doesn't render. This one
+    does, so that the ``returning`` option of tree managers is run for real.
+    Only updates return rows: inserts still read back ``lastrowid``."""
+    statement_compiler = _ReturningSQLiteCompiler
+    update_returning = True
+    implicit_returning = False
+
+sqlalchemy.dialects.registry.register(
+    'sqlite.returning', __name__, 'ReturningSQLiteDialect')
+sqlite_has_returning = sqlite3.sqlite_version_info >= (3, 35)
+
+# ===----------------------------------------------------------------------===
+
+
 class Named(object):
 
     def __init__(self, *args, **kwargs):
@@ -19,7 +19,11 @@ __all__ = (
     'TreeEndpointType',
     'TreeLeftType',
     'TreeRightType',
+    'TreeRationalLeftType',
+    'TreeRationalRightType',
     'TreeDepthType',
+    'TreePathType',
+    'TreeRootOrderType',
 )
 
 
@@ -54,7 +58,35 @@ class TreeRightType(TreeEndpointType):
     pass
 
 
+class TreeRationalLeftType(TreeLeftType):
+
+    """Double-precision subtype of :class:`TreeLeftType`, holding the “left”
+    field of a node of a tree with rational encoding."""
+    impl = sqlalchemy.Float(precision=53)
+
+
+class TreeRationalRightType(TreeRightType):
+
+    """Double-precision subtype of :class:`TreeRightType`, holding the “right”
+    field of a node of a tree with rational encoding."""
+    impl = sqlalchemy.Float(precision=53)
+
+
 class TreeDepthType(TreeIntegerType):
 
     "Integer field subtype representing an node's depth level."
     pass
+
+
+class TreePathType(sqlalchemy.types.TypeDecorator):
+
+    """String field subtype holding the materialized path of a node: the
+    zero-padded primary keys of its ancestors, each followed by a separator."""
+    impl = sqlalchemy.Unicode
+
+
+class TreeRootOrderType(sqlalchemy.types.TypeDecorator):
+
+    """Big integer field subtype holding the sparse key root nodes are ordered
+    by, when it is kept."""
+    impl = sqlalchemy.BigInteger